@@ -27,6 +27,7 @@ setuptools.setup(
   packages=['wce_triage',
             'wce_triage.bin',
             'wce_triage.components',
+            'wce_triage.config',
             'wce_triage.lib',
             'wce_triage.http',
             'wce_triage.ops',
@@ -0,0 +1,161 @@
+import unittest
+import tempfile
+import shutil
+import os
+import io
+import time
+import threading
+import http.server
+
+from wce_triage.lib import capture_tee
+
+
+class UploadHandler(http.server.BaseHTTPRequestHandler):
+  """Takes chunked PUT and keeps the body in server.uploads."""
+  protocol_version = "HTTP/1.1"
+
+  def log_message(self, format, *args):
+    pass
+
+  def do_PUT(self):
+    body = io.BytesIO()
+    while True:
+      size = int(self.rfile.readline().strip(), 16)
+      if size == 0:
+        self.rfile.readline()
+        break
+      body.write(self.rfile.read(size))
+      self.rfile.readline()
+      pass
+    self.server.uploads[self.path] = (body.getvalue(), self.headers.get("Authorization"))
+    self.send_response(201)
+    self.send_header("Content-Length", "0")
+    self.end_headers()
+    pass
+  pass
+
+
+class SlowSink(capture_tee.Sink):
+  def __init__(self, delay, **kwargs):
+    super().__init__("slow", **kwargs)
+    self.delay = delay
+    self.chunks = []
+    pass
+
+  def write(self, data):
+    time.sleep(self.delay)
+    self.chunks.append(bytes(data))
+    pass
+  pass
+
+
+class BrokenSink(capture_tee.Sink):
+  def __init__(self, **kwargs):
+    super().__init__("broken", **kwargs)
+    pass
+
+  def write(self, data):
+    if self.written > 0:
+      raise OSError("No space left on device")
+    pass
+  pass
+
+
+class Test_CaptureTee(unittest.TestCase):
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.payload = os.urandom(6 * 2**20 + 4321)
+    self.server = http.server.HTTPServer(("127.0.0.1", 0), UploadHandler)
+    self.server.uploads = {}
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    pass
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    shutil.rmtree(self.tempdir)
+    pass
+
+  def _tee(self, sinks):
+    tee = capture_tee.CaptureTee(io.BytesIO(self.payload), sinks)
+    tee.start()
+    failed = tee.join(timeout=30)
+    self.assertFalse(tee.is_alive())
+    return tee, failed
+
+  def test_all_destinations(self):
+    primary = os.path.join(self.tempdir, "image.partclone.gz")
+    other = os.path.join(self.tempdir, "other.partclone.gz")
+    url = "http://127.0.0.1:%d/upload/image.partclone.gz?user=wce&password=secret" % self.server.server_address[1]
+    sinks = [ capture_tee.make_sink(dest) for dest in [primary, url, other] ]
+    self.assertIsInstance(sinks[1], capture_tee.HttpPutSink)
+    tee, failed = self._tee(sinks)
+    self.assertEqual(failed, [])
+    for path in [primary, other]:
+      with open(path, "rb") as image:
+        self.assertEqual(image.read(), self.payload)
+        pass
+      self.assertFalse(os.path.exists(path + ".partial"))
+      pass
+    body, authorization = self.server.uploads["/upload/image.partclone.gz"]
+    self.assertEqual(body, self.payload)
+    self.assertEqual(authorization, "Basic d2NlOnNlY3JldA==")
+    stats = tee.stats()
+    self.assertEqual(stats["read"], len(self.payload))
+    self.assertEqual([ sink["bytes"] for sink in stats["sinks"] ], [len(self.payload)] * 3)
+    pass
+
+  def test_slow_and_broken(self):
+    primary = capture_tee.FileSink(os.path.join(self.tempdir, "image.partclone.gz"))
+    slow = SlowSink(0.05, buffer_size=2**20)
+    broken = BrokenSink()
+    started = time.monotonic()
+    tee, failed = self._tee([slow, broken, primary])
+    self.assertEqual(failed, [broken])
+    self.assertIn("No space", broken.error)
+    # The primary did not wait for the slow one.
+    self.assertLess(primary.end_time - started, slow.end_time - started)
+    self.assertTrue(slow.following)
+    self.assertEqual(b"".join(slow.chunks), self.payload)
+    self.assertEqual(slow.state, "done")
+    pass
+
+  def test_reader_after_finish(self):
+    path = os.path.join(self.tempdir, "image.partclone.gz")
+    sink = capture_tee.FileSink(path)
+    sink.open()
+    sink._write(self.payload[:1000])
+    with sink.open_reader() as reader:
+      self.assertEqual(reader.read(), self.payload[:1000])
+      pass
+    # The file is renamed and the state is done at the same time.
+    sink.finish()
+    self.assertEqual(sink.state, "done")
+    with sink.open_reader() as reader:
+      self.assertEqual(reader.read(), self.payload[:1000])
+      pass
+    pass
+
+  def test_select_destinations(self):
+    catalog = ["/mnt/usb/wce-disk-images/wce-18", "http://10.3.2.2:8312/upload/wce-18/"]
+    self.assertEqual(capture_tee.select_capture_destinations(catalog, []), catalog)
+    self.assertEqual(capture_tee.select_capture_destinations(catalog, ["http://10.3.2.2:8312/upload/wce-18/"]), catalog[1:])
+    self.assertRaises(Exception, capture_tee.select_capture_destinations, catalog, ["/etc/shadow"])
+    self.assertRaises(Exception, capture_tee.select_capture_destinations, [], ["/tmp/image"])
+    pass
+
+  def test_upload_failure(self):
+    primary = os.path.join(self.tempdir, "image.partclone.gz")
+    url = "http://127.0.0.1:1/upload/image.partclone.gz"
+    tee, failed = self._tee([ capture_tee.make_sink(dest) for dest in [primary, url] ])
+    self.assertEqual([ sink.name for sink in failed ], [url])
+    with open(primary, "rb") as image:
+      self.assertEqual(image.read(), self.payload)
+      pass
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
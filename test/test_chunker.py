@@ -0,0 +1,150 @@
+import unittest
+import tempfile
+import shutil
+import os
+import io
+import json
+import random
+
+from wce_triage.lib import chunker
+from wce_triage.bin import delta_copy
+
+
+class Test_Chunker(unittest.TestCase):
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    rand = random.Random(37)
+    self.old_payload = bytes(rand.getrandbits(8) for _ in range(3 * 2**20))
+    # New image: something inserted at the front, something changed in the middle
+    self.new_payload = b"new header" + self.old_payload[:2**20] + os.urandom(50000) + self.old_payload[2**20 + 50000:]
+    pass
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+    pass
+
+  def _write_catalog(self, images_dir, name, payload):
+    catalog = os.path.join(images_dir, "triage")
+    os.makedirs(catalog, exist_ok=True)
+    with open(os.path.join(catalog, ".disk_image_type.json"), "w") as meta:
+      json.dump({"id": "triage"}, meta)
+      pass
+    path = os.path.join(catalog, name)
+    with open(path, "wb") as image:
+      image.write(payload)
+      pass
+    return path
+
+  def test_chunks_cover_file(self):
+    chunks = list(chunker.iter_chunks(io.BytesIO(self.old_payload)))
+    self.assertEqual(sum([length for offset, length, digest in chunks]), len(self.old_payload))
+    for offset, length, digest in chunks[:-1]:
+      self.assertGreaterEqual(length, chunker.CHUNK_MIN_SIZE)
+      self.assertLessEqual(length, chunker.CHUNK_MAX_SIZE)
+      pass
+    self.assertEqual(list(chunker.iter_chunks(io.BytesIO(b""))), [])
+    pass
+
+  def test_chunks_resync_after_insert(self):
+    old = set([digest for offset, length, digest in chunker.iter_chunks(io.BytesIO(self.old_payload))])
+    new = [digest for offset, length, digest in chunker.iter_chunks(io.BytesIO(self.new_payload))]
+    shared = [digest for digest in new if digest in old]
+    self.assertGreater(len(shared), len(new) // 2)
+    pass
+
+  def test_manifest_sidecar(self):
+    path = self._write_catalog(self.tempdir, "old.partclone.gz", self.old_payload)
+    self.assertIsNone(chunker.load_manifest(path))
+    manifest = chunker.get_manifest(path)
+    self.assertTrue(os.path.exists(chunker.manifest_path(path)))
+    self.assertEqual(chunker.load_manifest(path), manifest)
+    with open(path, "ab") as image:
+      image.write(b"more")
+      pass
+    self.assertIsNone(chunker.load_manifest(path))
+    pass
+
+  def test_manifest_from_source(self):
+    source_path = self._write_catalog(os.path.join(self.tempdir, "server"), "old.partclone.gz", self.old_payload)
+    copy_path = self._write_catalog(os.path.join(self.tempdir, "usb"), "old.partclone.gz", self.old_payload)
+    manifest = chunker.get_copy_manifest(copy_path, source_path)
+    # Made at the source, and saved for both.
+    self.assertEqual(chunker.load_manifest(source_path)["chunks"], manifest["chunks"])
+    self.assertEqual(chunker.load_manifest(copy_path), manifest)
+    self.assertEqual(delta_copy.get_source_copy(copy_path, os.path.join(os.path.dirname(source_path), "new.partclone.gz")), source_path)
+
+    # Not the same image. The copy is read.
+    other_path = self._write_catalog(os.path.join(self.tempdir, "usb"), "other.partclone.gz", self.new_payload)
+    self.assertEqual(chunker.get_copy_manifest(other_path, source_path)["size"], len(self.new_payload))
+    self.assertEqual(chunker.get_copy_manifest(other_path, os.path.join(self.tempdir, "none")), chunker.load_manifest(other_path))
+    pass
+
+  def test_plan_and_assemble(self):
+    old_path = self._write_catalog(self.tempdir, "old.partclone.gz", self.old_payload)
+    new_path = os.path.join(self.tempdir, "new.partclone.gz")
+    with open(new_path, "wb") as image:
+      image.write(self.new_payload)
+      pass
+    manifest = chunker.build_manifest(new_path)
+    plan = chunker.plan_delta(manifest, [(old_path, chunker.build_manifest(old_path))])
+    self.assertEqual(sum([length for path, offset, length, chunks in plan]), len(self.new_payload))
+
+    output = os.path.join(self.tempdir, "out.partclone.gz")
+    from_source, from_basis = chunker.assemble(new_path, output, manifest, plan)
+    with open(output, "rb") as image:
+      self.assertEqual(image.read(), self.new_payload)
+      pass
+    self.assertEqual(from_source + from_basis, len(self.new_payload))
+    self.assertGreater(from_basis, from_source)
+    self.assertFalse(os.path.exists(output + ".partial"))
+    pass
+
+  def test_assemble_with_changed_basis(self):
+    old_path = self._write_catalog(self.tempdir, "old.partclone.gz", self.old_payload)
+    new_path = os.path.join(self.tempdir, "new.partclone.gz")
+    with open(new_path, "wb") as image:
+      image.write(self.new_payload)
+      pass
+    manifest = chunker.build_manifest(new_path)
+    plan = chunker.plan_delta(manifest, [(old_path, chunker.build_manifest(old_path))])
+    # Old image is overwritten after the manifest was made
+    with open(old_path, "r+b") as image:
+      image.write(b"\0" * 2**20)
+      pass
+    output = os.path.join(self.tempdir, "out.partclone.gz")
+    chunker.assemble(new_path, output, manifest, plan)
+    with open(output, "rb") as image:
+      self.assertEqual(image.read(), self.new_payload)
+      pass
+    pass
+
+  def test_delta_copy(self):
+    source_path = os.path.join(self.tempdir, "source.partclone.gz")
+    with open(source_path, "wb") as image:
+      image.write(self.new_payload)
+      pass
+    dest_images = os.path.join(self.tempdir, "usb", "wce-disk-images")
+    old_path = self._write_catalog(dest_images, "old.partclone.gz", self.old_payload)
+    dest_path = os.path.join(os.path.dirname(old_path), "new.partclone.gz")
+
+    output = io.StringIO()
+    self.assertEqual(delta_copy.delta_copy(source_path, ["/dev/sdz:" + dest_path], output=output), 0)
+    with open(dest_path, "rb") as image:
+      self.assertEqual(image.read(), self.new_payload)
+      pass
+    # Manifests of the older image and the copy are kept on the destination
+    self.assertIsNotNone(chunker.load_manifest(old_path))
+    self.assertIsNotNone(chunker.load_manifest(dest_path))
+
+    reports = [json.loads(line) for line in output.getvalue().splitlines()]
+    self.assertEqual(reports[-1]["key"], "/dev/sdz")
+    self.assertEqual(reports[-1]["runStatus"], "Success")
+    self.assertEqual(reports[-1]["totalBytes"], len(self.new_payload))
+    self.assertIn("verdict", reports[-1])
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
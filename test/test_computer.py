@@ -0,0 +1,129 @@
+import unittest
+from unittest import mock
+
+from wce_triage.components import computer as _computer
+from wce_triage.components.component import Component
+
+
+def fake_component(component_type, decisions):
+  class FakeComponent(Component):
+    def __init__(self, live_system=False):
+      self.decisions = decisions
+      pass
+
+    def get_component_type(self):
+      return component_type
+
+    def decision(self, **kwargs):
+      return [ dict(decision) for decision in self.decisions ]
+    pass
+  return FakeComponent
+
+
+CPU = [{"component": "CPU", "result": True, "message": "P5"}]
+MEMORY = [{"component": "Memory", "result": True, "message": "4GB"}]
+VIDEO = [{"component": "Video", "result": True, "message": "Intel"}]
+DISK = [{"component": "Disk", "result": True, "message": "sda"}]
+OPTICAL = [{"component": "Optical drive", "result": True, "message": "sr0"}]
+NETWORK = [{"component": "Network", "device": "eth0", "result": True, "message": "eth0 connected"}]
+SOUND = [{"component": "Sound", "result": True, "message": "HDA"}]
+
+
+class Test_Computer(unittest.TestCase):
+
+  def setUp(self):
+    self.patches = [ mock.patch.object(_computer._cpu, "CPU", fake_component("CPU", CPU)),
+                     mock.patch.object(_computer._memory, "Memory", fake_component("Memory", MEMORY)),
+                     mock.patch.object(_computer._video, "Video", fake_component("Video", VIDEO)),
+                     mock.patch.object(_computer._disk, "DiskPortal", fake_component("Disk", DISK)),
+                     mock.patch.object(_computer._optical_drive, "OpticalDrives", fake_component("Optical drive", OPTICAL)),
+                     mock.patch.object(_computer._network, "Networks", fake_component("Network", NETWORK)),
+                     mock.patch.object(_computer._sound, "Sound", fake_component("Sound", SOUND)) ]
+    for patch in self.patches:
+      patch.start()
+      pass
+    pass
+
+  def tearDown(self):
+    for patch in self.patches:
+      patch.stop()
+      pass
+    pass
+
+  def make_snapshot(self, network):
+    computer = _computer.Computer()
+    computer.decisions = CPU + MEMORY + VIDEO + DISK + OPTICAL + network + SOUND
+    computer.decision = all([ decision["result"] for decision in computer.decisions ])
+    return computer.snapshot()
+
+  def test_restore_snapshot(self):
+    snapshot = self.make_snapshot(NETWORK)
+    computer = _computer.Computer()
+    # Nothing is detected for the cached result.
+    with mock.patch.object(_computer._cpu, "CPU") as cpu, mock.patch.object(_computer._disk, "DiskPortal") as disk_portal:
+      computer.restore_snapshot(snapshot)
+      cpu.assert_not_called()
+      disk_portal.assert_not_called()
+      pass
+    self.assertTrue(computer.from_cache)
+    self.assertTrue(computer.decision)
+    self.assertEqual(computer.decisions, snapshot["decisions"])
+    self.assertEqual(computer.components, [])
+    self.assertIsNone(computer.opticals)
+    pass
+
+  def test_replace_decisions(self):
+    computer = _computer.Computer()
+    computer.decisions = CPU + NETWORK + SOUND
+    wifi = [{"component": "Network", "device": "eth0", "result": False, "message": "eth0 not connected"},
+            {"component": "Network", "device": "wlan0", "result": True, "message": "wlan0"}]
+    computer._replace_decisions("Network", wifi)
+    self.assertEqual(computer.decisions, CPU + wifi + SOUND)
+    # No decision of the type yet
+    computer._replace_decisions("Disk", DISK)
+    self.assertEqual(computer.decisions, CPU + wifi + SOUND + DISK)
+    pass
+
+  def test_revalidate(self):
+    disconnected = [{"component": "Network", "device": "eth0", "result": False, "message": "eth0 not connected"}]
+    computer = _computer.Computer()
+    computer.restore_snapshot(self.make_snapshot(disconnected))
+    self.assertFalse(computer.decision)
+    old_components = computer.components
+    old_decisions = computer.decisions
+
+    detected = computer.detect_volatile()
+    # Detection does not touch the computer.
+    self.assertIs(computer.components, old_components)
+    self.assertIs(computer.decisions, old_decisions)
+    # Every component is detected once, and only disk and network are decided again.
+    self.assertEqual(sorted(detected.keys()), ["CPU", "Disk", "Memory", "Network", "Optical drive", "Sound", "Video"])
+    self.assertEqual(sorted([ component_type for component_type, (component, decisions) in detected.items() if decisions is not None ]), ["Disk", "Network"])
+
+    # A decision set while the detection runs is kept.
+    computer.set_decision({"component": "Memory Test"}, {"result": False, "message": "running"})
+    overall = []
+    refreshed = computer.apply_revalidation(detected, overall_changed=overall.append)
+    self.assertEqual(refreshed, NETWORK)
+    self.assertEqual(overall, [])
+    self.assertIs(computer.networks, detected["Network"][0])
+    self.assertIs(computer.disk_portal, detected["Disk"][0])
+    self.assertIs(computer.opticals, detected["Optical drive"][0])
+    self.assertEqual([ component.get_component_type() for component in computer.components ],
+                     ["CPU", "Memory", "Video", "Disk", "Optical drive", "Network", "Sound"])
+    self.assertEqual(computer.decisions[:3], CPU + MEMORY + VIDEO)
+    self.assertEqual(computer.decisions[-1]["component"], "Memory Test")
+
+    computer.set_decision({"component": "Memory Test"}, {"result": True, "message": "passed"})
+    self.assertTrue(computer.decision)
+    # Nothing changed since. Only the volatile ones are detected this time.
+    self.assertEqual(sorted(computer.detect_volatile().keys()), ["Disk", "Network"])
+    self.assertEqual(computer.revalidate(overall_changed=overall.append), [])
+    self.assertEqual(overall, [])
+    self.assertEqual(len(computer.components), 7)
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+import unittest.mock
+import time
+
+from wce_triage.lib.cpu_info import *
+
+
+class Test_CPUInfo(unittest.TestCase):
+
+  def test_kernels(self):
+    self.assertEqual(kernel_fibonacci(), 6765)
+    self.assertEqual(kernel_nqueens(), 92)
+    self.assertEqual(kernel_zlib(), 2**17)
+    self.assertEqual(kernel_hash(), kernel_hash())
+    pass
+
+  def test_run_benchmarks(self):
+    results = run_benchmarks(time_budget=0.1, n_cores=1)
+    self.assertEqual(sorted(results.keys()),
+                     sorted([ name for name, benchmark in benchmarks.items() if benchmark.get("kernel") ]))
+    for seconds_per_iteration, rate in results.values():
+      self.assertGreater(seconds_per_iteration, 0)
+      self.assertGreater(rate, 0)
+      pass
+    pass
+
+  def test_parse_hardinfo(self):
+    output = "[CPU Blowfish]\n" + "0;0;0;4.150282;2|Machine|Board|T7300|Desc|Config|2GB|1|2|2\n" + \
+             "[CPU Zlib]\n" + "0;0;0;9.928034;2|Machine|Board|T7300|Desc|Config|2GB|1|2|2\n"
+    self.assertEqual(parse_hardinfo(output), {"CPU Blowfish": 4.150282, "CPU Zlib": 9.928034})
+    pass
+
+  def test_calibrate(self):
+    # This machine takes half the time of the baseline in hardinfo, so the
+    # baseline machine takes twice as long per kernel iteration.
+    hardinfo_results = { name: benchmark["baseline"] / 2 for name, benchmark in benchmarks.items() }
+    calibration = calibrate(hardinfo_results, time_budget=0.1)
+    self.assertNotIn("CPU Blowfish", calibration)
+    self.assertEqual(len(calibration), 6)
+
+    # Scores on this machine come out close to 2.
+    cpu_info.pop("rating", None)
+    info = get_cpu_info(time_budget=0.6, calibration=calibration)
+    self.assertGreater(float(info["single_thread_rating"]), 1.0)
+    cpu_info.pop("rating", None)
+    pass
+
+  def test_rating(self):
+    # Every machine gets the rating from the built-in table, within the budget.
+    self.assertEqual(sorted(get_kernel_baselines().keys()),
+                     sorted([ name for name, benchmark in benchmarks.items() if benchmark.get("kernel") ]))
+    cpu_info.pop("rating", None)
+    with unittest.mock.patch("subprocess.run") as run:
+      start = time.perf_counter()
+      info = get_cpu_info(time_budget=0.5)
+      self.assertLess(time.perf_counter() - start, 5)
+      run.assert_not_called()
+      pass
+    self.assertGreater(float(info["rating"]), 0)
+    self.assertGreater(float(info["single_thread_rating"]), 0)
+    cpu_info.pop("rating", None)
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
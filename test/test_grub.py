@@ -112,6 +112,40 @@ class Test_grub(unittest.TestCase):
     self.assertTrue(updated)
     pass
 
+  def test_grub_template(self):
+    root = os.path.join(self.test_dir, "root")
+    for subdir in ["boot/grub", "etc/default"]:
+      os.makedirs(os.path.join(root, subdir))
+      pass
+    for filename in ["vmlinuz-5.4.0-42-generic", "initrd.img-5.4.0-42-generic",
+                     "vmlinuz-5.4.0-100-generic", "initrd.img-5.4.0-100-generic",
+                     "vmlinuz-5.3.0-1-generic"]:
+      open(os.path.join(root, "boot", filename), "w").close()
+      pass
+    shutil.copy(self.test_file, os.path.join(root, "etc/default/grub"))
+
+    self.assertIsNone(read_grub_template(root))
+    template = make_grub_template(root, title="Ubuntu")
+    # No initrd for 5.3.0-1
+    self.assertEqual([ kernel["version"] for kernel in template["kernels"] ], ["5.4.0-100-generic", "5.4.0-42-generic"])
+    self.assertEqual(template["cmdline"], "quiet splash")
+    write_grub_template(root, template)
+    template = read_grub_template(root)
+    self.assertFalse(is_grub_template_stale(template, root))
+
+    grub_cfg = render_grub_template(template, "1234-abcd", "quiet splash wce_share=/usr/local/share/wce")
+    self.assertIn("search --no-floppy --fs-uuid --set=root 1234-abcd\n", grub_cfg)
+    self.assertIn("linux\t/boot/vmlinuz-5.4.0-100-generic root=UUID=1234-abcd ro quiet splash wce_share=/usr/local/share/wce\n", grub_cfg)
+    self.assertIn("initrd\t/boot/initrd.img-5.4.0-42-generic\n", grub_cfg)
+    self.assertNotIn("@", grub_cfg)
+    # The menu entries call load_video, so it's defined before them.
+    self.assertLess(grub_cfg.index("function load_video {"), grub_cfg.index("\tload_video\n"))
+
+    # Kernel upgraded after the capture
+    os.remove(os.path.join(root, "boot", "vmlinuz-5.4.0-42-generic"))
+    self.assertTrue(is_grub_template_stale(template, root))
+    pass
+
   pass
 
 if __name__ == '__main__':
@@ -0,0 +1,136 @@
+import unittest
+import tempfile
+import shutil
+import struct
+import gzip
+import json
+import os
+import threading
+import functools
+import http.server
+
+from wce_triage.lib import partclone_image
+from wce_triage.lib import disk_images
+from wce_triage.lib.image_index import make_image_index, read_image_index, index_image, get_image_index_path
+from wce_triage.bin.index_disk_images import index_disk_images
+from wce_triage.ops.partclone_tasks import task_index_disk_image
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+  def log_message(self, format, *args):
+    pass
+  pass
+
+
+def make_image(totalblock, used, block_size=4096):
+  """partclone image v2 without checksum. Block data is all 0x55."""
+  head = struct.pack("<16s14s4sH", b"partclone-image", b"0.3.13", b"0002", 0xC0DE)
+  fs_info = struct.pack("<16sQQQQI", b"EXTFS", totalblock * block_size, totalblock, len(used), len(used), block_size)
+  options = struct.pack("<IHHHHIBB", 18, 2, 64, partclone_image.CSM_NONE, 0, 0, 0, partclone_image.BM_BIT)
+  desc = head + fs_info + options
+  bitmap = bytearray((totalblock + 7) // 8)
+  for block in used:
+    bitmap[block // 8] |= 1 << (block % 8)
+    pass
+  return (desc + struct.pack("<I", partclone_image.partclone_crc32(desc)) +
+          bytes(bitmap) + struct.pack("<I", partclone_image.partclone_crc32(bytes(bitmap))) +
+          b"\x55" * (len(used) * block_size))
+
+
+class Test_ImageIndex(unittest.TestCase):
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.catalog = os.path.join(self.tempdir, "wce-18")
+    os.mkdir(self.catalog)
+    with open(os.path.join(self.catalog, ".disk_image_type.json"), "w") as image_type:
+      json.dump({"id": "wce-18", "name": "WCE Ubuntu 18.04LTS", "efi_image": ".efi-512M.fat32.partclone.gz"}, image_type)
+      pass
+    self.image = os.path.join(self.catalog, "wce-mate18.ext4.partclone.gz")
+    with gzip.open(self.image, "wb") as image:
+      image.write(make_image(10000, list(range(0, 100)) + list(range(5000, 5010))))
+      pass
+    with gzip.open(os.path.join(self.catalog, ".efi-512M.fat32.partclone.gz"), "wb") as image:
+      image.write(make_image(512, [0, 1, 2]))
+      pass
+    self.saved_dir = disk_images.WCE_IMAGES
+    disk_images.set_wce_disk_image_dir(self.tempdir)
+    pass
+
+  def tearDown(self):
+    disk_images.set_wce_disk_image_dir(self.saved_dir)
+    shutil.rmtree(self.tempdir)
+    pass
+
+  def test_make_index(self):
+    index = make_image_index(self.image)
+    self.assertEqual(index["fileSystem"], "extfs")
+    self.assertEqual(index["blockSize"], 4096)
+    self.assertEqual(index["usedBlocks"], 110)
+    self.assertEqual(index["usedRuns"], 2)
+    self.assertEqual(index["lastUsedBlock"], 5009)
+    self.assertEqual(index["usedSize"], 110 * 4096)
+    self.assertEqual(index["minPartitionSize"], 10000 * 4096)
+    self.assertEqual(index["imageSize"], os.stat(self.image).st_size)
+    pass
+
+  def test_index_disk_images(self):
+    self.assertEqual(index_disk_images([self.tempdir]), 0)
+    self.assertTrue(os.path.exists(get_image_index_path(os.path.join(self.catalog, ".efi-512M.fat32.partclone.gz"))))
+    index = read_image_index(self.image)
+    self.assertEqual(index["usedBlocks"], 110)
+
+    images = disk_images.get_disk_images()
+    self.assertEqual(len(images), 1)
+    self.assertEqual(images[0]["partclone"], index)
+
+    # Image is replaced. The index is stale.
+    with open(self.image, "ab") as image:
+      image.write(b"\0")
+      pass
+    self.assertIsNone(read_image_index(self.image))
+    self.assertNotIn("partclone", disk_images.get_disk_images()[0])
+    pass
+
+  def test_captured_image(self):
+    task = task_index_disk_image("Index disk image", imagenames=[self.image, "http://10.3.2.1:8312/upload/wce-18/wce-mate18.ext4.partclone.gz"])
+    self.assertEqual(task.imagenames, [self.image])
+    task.run_python()
+    self.assertEqual(read_image_index(self.image)["usedRuns"], 2)
+    pass
+
+  def test_remote_index(self):
+    index_image(self.image)
+    server = http.server.HTTPServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory=self.tempdir))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+      url = "http://127.0.0.1:%d/wce-18/wce-mate18.ext4.partclone.gz" % server.server_address[1]
+      size = os.stat(self.image).st_size
+      self.assertEqual(read_image_index(url, image_size=size)["usedBlocks"], 110)
+      # Size from the server
+      self.assertEqual(read_image_index(url)["usedBlocks"], 110)
+      # The listing has the image replaced since the index.
+      self.assertIsNone(read_image_index(url, image_size=size + 1))
+      with open(self.image, "ab") as image:
+        image.write(b"\0")
+        pass
+      self.assertIsNone(read_image_index(url))
+    finally:
+      server.shutdown()
+      server.server_close()
+      pass
+    pass
+
+  def test_not_partclone(self):
+    with gzip.open(self.image, "wb") as image:
+      image.write(b"\0" * 4096)
+      pass
+    self.assertIsNone(index_image(self.image))
+    self.assertFalse(os.path.exists(get_image_index_path(self.image)))
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,59 @@
+import unittest
+import tempfile
+import shutil
+import os
+
+from wce_triage.lib.disk_images import read_image_metadata, write_image_metadata, get_image_metadata_path
+from wce_triage.ops.partclone_tasks import parse_dumpe2fs_header, parse_resize2fs_minimum, make_ext_fs_metadata
+
+dumpe2fs_output = """dumpe2fs 1.44.1 (24-Mar-2018)
+Filesystem volume name:   <none>
+Filesystem UUID:          0b1c6a4e-7d5e-4a3c-8b0e-2f0b7f7b8f11
+Filesystem features:      has_journal ext_attr resize_inode dir_index filetype extent 64bit
+Block count:              2621440
+Reserved block count:     131072
+Free blocks:              1572864
+Free inodes:              600000
+Block size:               4096
+"""
+
+resize2fs_output = """resize2fs 1.44.1 (24-Mar-2018)
+Estimated minimum size of the filesystem: 1100000
+"""
+
+class Test_ImageMetadata(unittest.TestCase):
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    pass
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+    pass
+
+  def test_ext_fs_metadata(self):
+    header = parse_dumpe2fs_header(dumpe2fs_output)
+    self.assertEqual(header["Block count"], "2621440")
+    self.assertEqual(parse_resize2fs_minimum(resize2fs_output), 1100000)
+    self.assertIsNone(parse_resize2fs_minimum("resize2fs: Bad magic number in super-block"))
+
+    metadata = make_ext_fs_metadata(header, 1100000)
+    self.assertEqual(metadata["fsSize"], 10 * 2**30)
+    self.assertEqual(metadata["usedBlocks"], 1048576)
+    self.assertEqual(metadata["usedSize"], 4 * 2**30)
+    self.assertEqual(metadata["minSize"], 1100000 * 4096)
+    self.assertFalse(metadata["shrunk"])
+    pass
+
+  def test_read_write(self):
+    image = os.path.join(self.tempdir, "wce-mate18-2019-10-01.ext4.partclone.gz")
+    self.assertIsNone(read_image_metadata(image))
+    write_image_metadata(image, {"fsSize": 1234})
+    self.assertTrue(os.path.exists(get_image_metadata_path(image)))
+    self.assertEqual(read_image_metadata(image), {"fsSize": 1234})
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
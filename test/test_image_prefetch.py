@@ -0,0 +1,179 @@
+import unittest
+import tempfile
+import shutil
+import gzip
+import time
+import threading
+import http.server
+import socketserver
+import os
+
+from wce_triage.lib import image_prefetch
+from wce_triage.lib import image_stream
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+
+  def log_message(self, format, *args):
+    pass
+
+  def do_GET(self):
+    payload = self.server.payload
+    start = 0
+    status = 200
+    range_header = self.headers.get("Range")
+    if range_header and self.headers.get("If-Range") == '"v1"':
+      start = int(range_header.split("=")[1].split("-")[0])
+      status = 206
+      pass
+    self.server.requests.append(range_header)
+    self.send_response(status)
+    self.send_header("Content-Length", str(len(payload) - start))
+    self.send_header("ETag", '"v1"')
+    if self.server.ranges:
+      self.send_header("Accept-Ranges", "bytes")
+      pass
+    if status == 206:
+      self.send_header("Content-Range", "bytes %d-%d/%d" % (start, len(payload) - 1, len(payload)))
+      pass
+    self.end_headers()
+    try:
+      self.wfile.write(payload[start:])
+    except (BrokenPipeError, ConnectionResetError):
+      # Prefetcher paused
+      pass
+    pass
+  pass
+
+
+class ThreadingServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+  daemon_threads = True
+  pass
+
+
+class Sink(object):
+  def __init__(self):
+    self.chunks = []
+    pass
+
+  def write(self, data):
+    self.chunks.append(bytes(data))
+    pass
+
+  def flush(self):
+    pass
+
+  def close(self):
+    pass
+
+  def getvalue(self):
+    return b"".join(self.chunks)
+  pass
+
+
+class Test_ImagePrefetch(unittest.TestCase):
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.raw = os.urandom(1000000) + b"\0" * 2000000
+    self.payload = gzip.compress(self.raw)
+    self.server = ThreadingServer(("127.0.0.1", 0), RangeHandler)
+    self.server.payload = self.payload
+    self.server.ranges = True
+    self.server.requests = []
+    self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+    self.thread.start()
+    self.url = "http://127.0.0.1:%d/wce/wce-disk-images/wce-18/wce-mate18.ext4.partclone.gz" % self.server.server_address[1]
+    pass
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    shutil.rmtree(self.tempdir)
+    pass
+
+  def _wait(self, condition):
+    deadline = time.time() + 30
+    while not condition() and time.time() < deadline:
+      time.sleep(0.05)
+      pass
+    return condition()
+
+  def test_budget(self):
+    meminfo = os.path.join(self.tempdir, "meminfo")
+    with open(meminfo, "w") as meminfo_fd:
+      meminfo_fd.write("MemTotal:        8000000 kB\nMemFree:         1000000 kB\nMemAvailable:    2359296 kB\n")
+      pass
+    self.assertEqual(image_prefetch.read_mem_available(meminfo), 2304 * 2**20)
+    self.assertEqual(image_prefetch.get_prefetch_budget(meminfo), 1024 * 2**20)
+    self.assertEqual(image_prefetch.get_prefetch_budget(meminfo, limit=100 * 2**20), 100 * 2**20)
+    # Too little to bother
+    self.assertEqual(image_prefetch.get_prefetch_budget(meminfo, limit=2**20), 0)
+    self.assertEqual(image_prefetch.get_prefetch_budget(os.path.join(self.tempdir, "none")), 0)
+    pass
+
+  def test_prefetch_and_handoff(self):
+    budget = len(self.payload) // 3
+    prefetcher = image_prefetch.ImagePrefetcher(self.url, budget=budget, spool_dir=self.tempdir)
+    self.assertTrue(prefetcher.start())
+    # Stops at the budget
+    self.assertTrue(self._wait(lambda: prefetcher.paused))
+    self.assertEqual(prefetcher.fetched, budget)
+    self.assertEqual(os.path.getsize(prefetcher.spool_path), budget)
+
+    state = prefetcher.handoff()
+    self.assertIsNotNone(state)
+    sink = Sink()
+    streamer = image_stream.open_image_stream(self.url, sink, buffer_size=2**20, prefetched=state)
+    streamer.start()
+    self.assertIsNone(streamer.join(timeout=30))
+    self.assertEqual(sink.getvalue(), self.raw)
+    # The rest is fetched from where the spool ends.
+    self.assertEqual(self.server.requests[-1], "bytes=%d-" % budget)
+    # Spool is gone after the loader is done with it.
+    self.assertFalse(os.path.exists(prefetcher.spool_path))
+    self.assertFalse(os.path.exists(state))
+    prefetcher.cancel()
+    pass
+
+  def test_whole_image(self):
+    prefetcher = image_prefetch.ImagePrefetcher(self.url, budget=len(self.payload) * 2, spool_dir=self.tempdir)
+    prefetcher.start()
+    self.assertTrue(self._wait(lambda: prefetcher.complete))
+    reader = image_prefetch.PrefetchedReader(prefetcher.handoff())
+    data = b""
+    while True:
+      chunk = reader.read()
+      if not chunk:
+        break
+      data += chunk
+      pass
+    reader.close()
+    self.assertEqual(data, self.payload)
+    self.assertEqual(len(self.server.requests), 1)
+    pass
+
+  def test_no_range(self):
+    self.server.ranges = False
+    prefetcher = image_prefetch.ImagePrefetcher(self.url, budget=len(self.payload) // 3, spool_dir=self.tempdir)
+    prefetcher.start()
+    self.assertTrue(self._wait(lambda: prefetcher.error))
+    self.assertIsNone(prefetcher.handoff())
+    prefetcher.cancel()
+    self.assertEqual(os.listdir(self.tempdir), [])
+    pass
+
+  def test_cancel(self):
+    prefetcher = image_prefetch.ImagePrefetcher(self.url, budget=len(self.payload) // 3, spool_dir=self.tempdir)
+    prefetcher.start()
+    self.assertTrue(self._wait(lambda: prefetcher.fetched > 0))
+    prefetcher.cancel()
+    self.assertFalse(prefetcher.thread.is_alive())
+    self.assertEqual(os.listdir(self.tempdir), [])
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
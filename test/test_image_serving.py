@@ -0,0 +1,65 @@
+import unittest
+import tempfile
+import shutil
+import os
+
+from wce_triage.lib.image_serving import *
+
+
+class Test_ImageServing(unittest.TestCase):
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.image = os.path.join(self.tempdir, "wce-18.ext4.partclone.gz")
+    with open(self.image, "wb") as image:
+      image.write(b"x" * 1000)
+      pass
+    pass
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+    pass
+
+  def test_parse_range(self):
+    self.assertIsNone(parse_range(None, 1000))
+    self.assertEqual(parse_range("bytes=0-99", 1000), (0, 100))
+    self.assertEqual(parse_range("bytes=900-", 1000), (900, 1000))
+    self.assertEqual(parse_range("bytes=-100", 1000), (900, 1000))
+    self.assertEqual(parse_range("bytes=500-5000", 1000), (500, 1000))
+    # multiple ranges are served as whole
+    self.assertIsNone(parse_range("bytes=0-1,5-6", 1000))
+    with self.assertRaises(RangeNotSatisfiable):
+      parse_range("bytes=1000-", 1000)
+      pass
+    pass
+
+  def test_etag(self):
+    filestat = os.stat(self.image)
+    etag = get_image_etag(self.image)
+    self.assertTrue(etag.startswith('"3e8-'))
+    self.assertTrue(if_range_matches(etag, etag, filestat.st_mtime))
+    self.assertFalse(if_range_matches('"other"', etag, filestat.st_mtime))
+    self.assertTrue(if_range_matches(format_http_date(filestat.st_mtime), etag, filestat.st_mtime))
+    self.assertFalse(if_range_matches(format_http_date(filestat.st_mtime - 10), etag, filestat.st_mtime))
+
+    with open(self.image + ".sha256", "w") as digest:
+      digest.write("abcdef0123  wce-18.ext4.partclone.gz\n")
+      pass
+    self.assertEqual(get_image_etag(self.image), '"abcdef0123"')
+    pass
+
+  def test_client_stats(self):
+    stats = ImageClientStats()
+    started = stats.start("10.3.2.100", "wce-18.ext4.partclone.gz")
+    self.assertEqual(stats.report()["10.3.2.100"]["active"], 1)
+    stats.finish("10.3.2.100", 1000, started)
+    report = stats.report()["10.3.2.100"]
+    self.assertEqual(report["active"], 0)
+    self.assertEqual(report["bytesSent"], 1000)
+    self.assertEqual(report["transfers"], 1)
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
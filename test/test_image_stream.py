@@ -0,0 +1,200 @@
+import unittest
+import os
+import gzip
+import lzma
+import threading
+import http.server
+
+from wce_triage.lib import image_stream
+
+
+class FlakyHandler(http.server.BaseHTTPRequestHandler):
+  """Serves the payload with Range, and cuts the connection in the middle
+for the first few requests."""
+  protocol_version = "HTTP/1.1"
+
+  def log_message(self, format, *args):
+    pass
+
+  def do_GET(self):
+    server = self.server
+    payload = server.payload
+    start = 0
+    status = 200
+    range_header = self.headers.get("Range")
+    if range_header and server.ranges:
+      start = int(range_header.split("=")[1].split("-")[0])
+      status = 206
+      if self.headers.get("If-Range") != '"v1"':
+        start = 0
+        status = 200
+        pass
+      pass
+    server.requests.append(range_header)
+    self.send_response(status)
+    self.send_header("Content-Length", str(len(payload) - start))
+    self.send_header("ETag", '"v1"')
+    if status == 206:
+      self.send_header("Content-Range", "bytes %d-%d/%d" % (start, len(payload) - 1, len(payload)))
+      pass
+    self.end_headers()
+    if server.cuts > 0:
+      server.cuts -= 1
+      self.wfile.write(payload[start:start + server.cut_size])
+      self.wfile.flush()
+      self.close_connection = True
+      return
+    self.wfile.write(payload[start:])
+    pass
+  pass
+
+
+class Sink(object):
+  def __init__(self):
+    self.chunks = []
+    self.closed = False
+    pass
+
+  def write(self, data):
+    self.chunks.append(bytes(data))
+    pass
+
+  def flush(self):
+    pass
+
+  def close(self):
+    self.closed = True
+    pass
+
+  def getvalue(self):
+    return b"".join(self.chunks)
+  pass
+
+
+class Test_ImageStream(unittest.TestCase):
+
+  def setUp(self):
+    self.raw = os.urandom(200000) + b"\0" * 3000000
+    self.payload = gzip.compress(self.raw)
+    self.server = http.server.HTTPServer(("127.0.0.1", 0), FlakyHandler)
+    self.server.payload = self.payload
+    self.server.cuts = 0
+    self.server.cut_size = 50000
+    self.server.ranges = True
+    self.server.requests = []
+    self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+    self.thread.start()
+    self.url = "http://127.0.0.1:%d/wce/wce-disk-images/triage/image.partclone.gz" % self.server.server_address[1]
+    pass
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    pass
+
+  def _stream(self, **kwargs):
+    sink = Sink()
+    reader = image_stream.ResumableHttpReader(self.url, retry_wait=0, **kwargs)
+    streamer = image_stream.ImageStreamer(reader, sink, decompressor=image_stream.get_decompressor(self.url), buffer_size=2**20)
+    streamer.start()
+    error = streamer.join(timeout=30)
+    return streamer, sink, error
+
+  def test_stream(self):
+    streamer, sink, error = self._stream()
+    self.assertIsNone(error)
+    self.assertEqual(sink.getvalue(), self.raw)
+    self.assertTrue(sink.closed)
+    stats = streamer.stats()
+    self.assertEqual(stats["fetched"], len(self.payload))
+    self.assertEqual(stats["decompressed"], len(self.raw))
+    self.assertEqual(stats["written"], len(self.raw))
+    self.assertEqual(stats["reconnects"], 0)
+    pass
+
+  def test_resume(self):
+    self.server.cuts = 3
+    streamer, sink, error = self._stream()
+    self.assertIsNone(error)
+    self.assertEqual(sink.getvalue(), self.raw)
+    self.assertEqual(streamer.stats()["reconnects"], 3)
+    self.assertEqual(self.server.requests[1:], ["bytes=%d-" % (n * 50000) for n in range(1, 4)])
+    pass
+
+  def test_no_range(self):
+    self.server.cuts = 1
+    self.server.ranges = False
+    streamer, sink, error = self._stream()
+    self.assertIsNotNone(error)
+    self.assertIn("can not be resumed", error)
+    self.assertTrue(sink.closed)
+    pass
+
+  def test_give_up(self):
+    self.server.cuts = 100
+    self.server.cut_size = 0
+    streamer, sink, error = self._stream(max_retries=2)
+    self.assertIn("Giving up", error)
+    pass
+
+  def test_truncated(self):
+    self.server.payload = self.payload[:len(self.payload) // 2]
+    streamer, sink, error = self._stream()
+    self.assertIn("middle of compressed stream", error)
+    pass
+
+  def test_multi_member_gzip(self):
+    decompressor = image_stream.get_decompressor("image.partclone.gz")
+    data = decompressor.decompress(gzip.compress(b"abc") + gzip.compress(b"def"))
+    self.assertEqual(data, b"abcdef")
+    self.assertTrue(decompressor.eof)
+    self.assertIsNone(image_stream.get_decompressor("image.partclone"))
+    self.assertFalse(image_stream.can_stream("image.partclone.7z"))
+    pass
+
+  def test_multi_stream_xz_at_chunk_boundary(self):
+    first = lzma.compress(b"abc" * 1000)
+    second = lzma.compress(b"def" * 1000)
+    decompressor = image_stream.get_decompressor("image.partclone.xz")
+    # The first chunk ends right at the end of the first stream.
+    data = decompressor.decompress(first)
+    self.assertTrue(decompressor.eof)
+    data += decompressor.decompress(second[:10])
+    data += decompressor.decompress(second[10:])
+    self.assertEqual(data, b"abc" * 1000 + b"def" * 1000)
+    self.assertTrue(decompressor.eof)
+    pass
+
+  def test_bounded_output(self):
+    raw = b"\0" * (20 * image_stream.READ_SIZE + 123)
+    for name, compressed in [("image.gz", gzip.compress(raw)), ("image.xz", lzma.compress(raw))]:
+      decompressor = image_stream.get_decompressor(name)
+      chunks = list(decompressor.decompress_chunks(compressed))
+      self.assertEqual(b"".join(chunks), raw, name)
+      self.assertEqual(max([ len(chunk) for chunk in chunks ]), image_stream.READ_SIZE, name)
+      self.assertTrue(decompressor.eof, name)
+      pass
+    pass
+
+  def test_bounded_buffer(self):
+    buffer = image_stream.BoundedBuffer(10)
+    buffer.put(b"12345678")
+    put_done = threading.Event()
+
+    def putter():
+      buffer.put(b"abcdef")
+      put_done.set()
+      pass
+    threading.Thread(target=putter, daemon=True).start()
+    self.assertFalse(put_done.wait(0.2))
+    self.assertEqual(buffer.get(), b"12345678")
+    self.assertTrue(put_done.wait(5))
+    buffer.close()
+    self.assertEqual(buffer.get(), b"abcdef")
+    self.assertEqual(buffer.get(), b"")
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+import subprocess
+import sys
+import os
+
+from wce_triage.lib import import_time
+
+SAMPLE = """import time: self [us] | cumulative | imported package
+import time:       120 |        120 |   _io
+import time:       300 |        300 |     re._parser
+import time:       900 |       1200 |   re
+import time:       150 |        150 | wce_triage
+import time:       200 |        200 |   wce_triage.lib.util
+import time:       100 |        300 | wce_triage.bin
+import time:       500 |       2000 | wce_triage.bin.multiwipe
+"""
+
+
+class Test_ImportTime(unittest.TestCase):
+
+  def test_parse(self):
+    imports = import_time.parse_importtime(SAMPLE)
+    self.assertEqual(len(imports), 7)
+    self.assertEqual(imports[0], ("_io", 120, 120, 1))
+    self.assertEqual(imports[1], ("re._parser", 300, 300, 2))
+    self.assertEqual(imports[-1], ("wce_triage.bin.multiwipe", 500, 2000, 0))
+    pass
+
+  def test_entry_points(self):
+    entry_points = import_time.list_entry_points()
+    self.assertIn("wce_triage.bin.restore_volume", entry_points)
+    self.assertIn("wce_triage.ops.restore_image_runner", entry_points)
+    # Library only
+    self.assertNotIn("wce_triage.ops.tasks", entry_points)
+    pass
+
+  def test_no_logger_at_import(self):
+    # Importing a module does not set up the log file. Only the entry point does.
+    code = "import logging, wce_triage.ops.partition_runner, wce_triage.ops.estimate, wce_triage.bin.process_driver; print(len(logging.getLogger().handlers))"
+    result = subprocess.run([sys.executable, "-c", code], stdout=subprocess.PIPE, env={"PYTHONPATH": import_time.get_package_root()})
+    self.assertEqual(result.stdout.strip(), b"0")
+    pass
+
+  def test_forbidden_imports(self):
+    measured = import_time.measure_import("wce_triage.bin.restore_volume")
+    self.assertTrue(measured["ok"])
+    self.assertGreater(measured["importTime"], 0)
+    self.assertNotIn("asyncio", measured["imported"])
+    self.assertEqual(import_time.check_budgets(timing=False), [])
+    pass
+
+  def test_check_budget(self):
+    measured = {"module": "wce_triage.bin.multiwipe", "ok": True, "importTime": 500.0, "imported": ["wce_triage.bin.multiwipe", "asyncio.events"]}
+    self.assertEqual(len(import_time.check_budget(measured)), 2)
+    self.assertEqual(import_time.check_budget(measured, timing=False), ["wce_triage.bin.multiwipe: imports asyncio.events"])
+    pass
+
+  @unittest.skipUnless(os.environ.get("WCE_TRIAGE_IMPORT_BUDGET"), "import time budget is checked with WCE_TRIAGE_IMPORT_BUDGET=1")
+  def test_budgets(self):
+    self.assertEqual(import_time.check_budgets(), [])
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
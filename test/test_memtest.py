@@ -0,0 +1,69 @@
+import unittest
+import mmap
+import signal
+import multiprocessing
+
+from wce_triage.lib.memtest import *
+
+
+class Test_MemTest(unittest.TestCase):
+
+  def test_patterns(self):
+    address = make_pattern("address")
+    chunk = address(CHUNK_SIZE * 3, CHUNK_SIZE)
+    self.assertEqual(struct.unpack_from('<Q', chunk, 0)[0], CHUNK_SIZE * 3)
+    self.assertEqual(struct.unpack_from('<Q', chunk, 8 * 100)[0], CHUNK_SIZE * 3 + 8 * 100)
+    ones = make_pattern("walking-ones")(0, 16)
+    self.assertEqual(struct.unpack('<QQ', ones), (1, 2))
+    rand = make_pattern("random", seed=1)
+    self.assertEqual(rand(CHUNK_SIZE, 4096), make_pattern("random", seed=1)(CHUNK_SIZE, 4096))
+    self.assertNotEqual(rand(0, 4096), rand(CHUNK_SIZE, 4096))
+    small = random_pattern(1, chunk_size=4096)
+    self.assertEqual(len(small.pool), 4096 + random_pattern.window_span)
+    self.assertNotEqual(small(0, 4096), small(4096, 4096))
+    pass
+
+  def test_check_buffer(self):
+    buffer = mmap.mmap(-1, CHUNK_SIZE * 2 + PAGE_SIZE)
+    self.assertEqual(check_buffer(buffer, PATTERNS), [])
+    buffer.close()
+    pass
+
+  def test_find_mismatches(self):
+    buffer = mmap.mmap(-1, CHUNK_SIZE)
+    expected = make_pattern("walking-ones")(0, CHUNK_SIZE)
+    buffer[0:CHUNK_SIZE] = expected
+    buffer[PAGE_SIZE * 3 + 16] = 0xff
+    errors = find_mismatches(buffer, 0, expected, 0, "walking-ones", 4)
+    self.assertEqual(len(errors), 1)
+    self.assertEqual(errors[0].offset, PAGE_SIZE * 3 + 16)
+    buffer.close()
+    pass
+
+  def test_run_memory_test(self):
+    result = run_memory_test(size=8 * 2**20, n_workers=2)
+    self.assertEqual(result.errors, [])
+    self.assertEqual(result.failed_workers, [])
+    self.assertEqual(result.tested_bytes, 8 * 2**20)
+    self.assertGreater(result.throughput, 0)
+    pass
+
+  def test_killed_worker(self):
+    killed = []
+    def progress(done_bytes, total_bytes):
+      if not killed:
+        worker = multiprocessing.active_children()[0]
+        os.kill(worker.pid, signal.SIGKILL)
+        killed.append(worker)
+        pass
+      pass
+    result = run_memory_test(size=2 * 2**27, n_workers=2, patterns=["walking-ones"], progress=progress)
+    self.assertEqual(len(killed), 1)
+    self.assertEqual(len(result.failed_workers), 1)
+    self.assertIn(str(-signal.SIGKILL), result.failed_workers[0][1])
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
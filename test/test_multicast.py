@@ -0,0 +1,196 @@
+import unittest
+import tempfile
+import shutil
+import os
+import io
+import sys
+import random
+import time
+import threading
+import subprocess
+import heapq
+import http.server
+
+from wce_triage.lib import multicast as multicast
+
+GROUP = "239.255.83.12"
+
+
+class LossyReceiver(multicast.MulticastReceiver):
+  """Drops the first copy of every 7th block from multicast."""
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.dropped = set()
+    pass
+
+  def _deposit(self, block, data, force=False):
+    if not force and block % 7 == 3 and block not in self.dropped:
+      self.dropped.add(block)
+      return False
+    return super()._deposit(block, data, force=force)
+  pass
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+  """Serves the image with Range like the triage server does."""
+  def log_message(self, format, *args):
+    pass
+
+  def do_GET(self):
+    payload = self.server.payload
+    start, end = 0, len(payload) - 1
+    range_header = self.headers.get("Range")
+    if range_header:
+      first, last = range_header.split("=")[1].split("-")
+      start, end = int(first), min(end, int(last))
+      self.send_response(206)
+      self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, len(payload)))
+    else:
+      self.send_response(200)
+      pass
+    self.send_header("Content-Length", str(end - start + 1))
+    self.end_headers()
+    try:
+      self.wfile.write(payload[start:end+1])
+    except (BrokenPipeError, ConnectionResetError):
+      pass
+    pass
+  pass
+
+
+class StalledReceiver(multicast.MulticastReceiver):
+  """Never gets block 5 from multicast, not even the repairs."""
+  def _deposit(self, block, data, force=False):
+    if not force and block == 5:
+      return False
+    return super()._deposit(block, data, force=force)
+  pass
+
+
+class Test_Multicast(unittest.TestCase):
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.image_name = "wce-mate18.ext4.partclone.gz"
+    self.image = os.path.join(self.tempdir, self.image_name)
+    self.payload = os.urandom(300 * 1000 + 123)
+    with open(self.image, "wb") as image:
+      image.write(self.payload)
+      pass
+    self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    self.server.payload = self.payload
+    self.server_thread = threading.Thread(target=self.server.serve_forever)
+    self.server_thread.start()
+    self.url = "http://127.0.0.1:%d/%s" % (self.server.server_address[1], self.image_name)
+    self.port = random.randrange(20000, 30000)
+    pass
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    self.server_thread.join()
+    shutil.rmtree(self.tempdir)
+    pass
+
+  def _sender(self, rate=2000000):
+    return multicast.MulticastSender(self.image, url=self.url, group=GROUP, port=self.port, rate=rate,
+                                     interface="127.0.0.1", linger=1.0)
+
+  def test_nak_ranges(self):
+    payloads = multicast.pack_ranges([1, 2, 3, 7, 9, 10])
+    self.assertEqual(len(payloads), 1)
+    self.assertEqual(multicast.unpack_ranges(payloads[0]), [1, 2, 3, 7, 9, 10])
+    pass
+
+  def test_repair_order(self):
+    sender = self._sender()
+    nak = multicast._multicast_socket("127.0.0.1")
+    sender_address = ("127.0.0.1", sender.sock.getsockname()[1])
+    for blocks in [[9, 10, 11], [3, 10], [150]]:
+      for payload in multicast.pack_ranges(blocks):
+        nak.sendto(multicast.make_packet(multicast.NAK, sender.session, 0, payload), sender_address)
+        pass
+      pass
+    nak.close()
+    time.sleep(0.2)
+    self.assertEqual(sender._read_naks(), 6)
+    self.assertEqual([ heapq.heappop(sender.repairs) for _ in range(len(sender.repairs)) ], [3, 9, 10, 11, 150])
+    sender.sock.close()
+    pass
+
+  def test_stalled_repair(self):
+    sender = self._sender(rate=500000)
+    sender_thread = threading.Thread(target=sender.run)
+    output = io.BytesIO()
+    receiver = StalledReceiver(self.image_name, output, group=GROUP, port=self.port, interface="127.0.0.1", repair_timeout=0.5)
+    receiver_thread = threading.Thread(target=receiver.run)
+    receiver_thread.start()
+    time.sleep(0.2)
+    sender_thread.start()
+    receiver_thread.join(60)
+    sender.stop()
+    sender_thread.join()
+    self.assertEqual(output.getvalue(), self.payload)
+    # Only the missing range came from http, and the rest from multicast.
+    self.assertLess(receiver.unicast_bytes, len(self.payload) // 4)
+    self.assertGreater(receiver.multicast_blocks, sender.n_blocks // 2)
+    pass
+
+  def test_receivers(self):
+    argv = [ sys.executable, "-m", "wce_triage.bin.multicast_receive", "--group", GROUP, "--port", str(self.port),
+             "--interface", "127.0.0.1", self.url ]
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(multicast.__file__))))
+    receivers = [ subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env) for _ in range(2) ]
+    lossy_output = io.BytesIO()
+    lossy = LossyReceiver(self.image_name, lossy_output, group=GROUP, port=self.port, interface="127.0.0.1")
+    lossy_thread = threading.Thread(target=lossy.run)
+    lossy_thread.start()
+
+    # Let receivers join
+    time.sleep(1)
+    sender = self._sender()
+    sender_thread = threading.Thread(target=sender.run)
+    sender_thread.start()
+
+    for receiver in receivers:
+      out, err = receiver.communicate(timeout=60)
+      self.assertEqual(receiver.returncode, 0, err)
+      self.assertEqual(out, self.payload)
+      pass
+    lossy_thread.join()
+    self.assertEqual(lossy_output.getvalue(), self.payload)
+    self.assertGreater(len(lossy.dropped), 0)
+    sender_thread.join()
+    self.assertGreater(sender.repaired_blocks, 0)
+    pass
+
+  def test_late_joiner(self):
+    sender = self._sender(rate=200000)
+    sender_thread = threading.Thread(target=sender.run)
+    sender_thread.start()
+    time.sleep(0.5)
+    output = io.BytesIO()
+    # Window is smaller than what the sender sent before joining.
+    receiver = multicast.MulticastReceiver(self.image_name, output, group=GROUP, port=self.port, interface="127.0.0.1",
+                                           memory_limit=64 * multicast.DEFAULT_BLOCK_SIZE)
+    self.assertEqual(receiver.run(), 0)
+    self.assertEqual(output.getvalue(), self.payload)
+    self.assertGreater(receiver.unicast_bytes, 0)
+    self.assertGreater(receiver.multicast_blocks, 0)
+    sender.stop()
+    sender_thread.join()
+    pass
+
+  def test_no_session(self):
+    output = io.BytesIO()
+    receiver = multicast.MulticastReceiver(self.image_name, output, url=self.url, group=GROUP, port=self.port,
+                                           interface="127.0.0.1", announce_timeout=0.5)
+    self.assertEqual(receiver.run(), 0)
+    self.assertEqual(output.getvalue(), self.payload)
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
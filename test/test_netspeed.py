@@ -0,0 +1,105 @@
+import unittest
+import threading
+import http.server
+import tempfile
+import shutil
+import os
+import urllib.parse
+
+from wce_triage.lib import netspeed as netspeed
+from wce_triage.components.network import NetworkDevice
+
+
+class SpeedTestHandler(http.server.BaseHTTPRequestHandler):
+  """Stand-in of the speed test routes of httpserver."""
+
+  def do_GET(self):
+    url = urllib.parse.urlsplit(self.path)
+    if not url.path.startswith(netspeed.SPEEDTEST_PATH + "/"):
+      self.send_error(404)
+      return
+    if url.path == netspeed.SPEEDTEST_PATH + "/ping":
+      body = b"pong"
+      self.send_response(200)
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+      return
+    size = int(urllib.parse.parse_qs(url.query)["size"][0])
+    self.send_response(200)
+    self.send_header("Content-Length", str(size))
+    self.end_headers()
+    while size > 0:
+      chunk = netspeed.SPEEDTEST_CHUNK[:min(size, netspeed.SPEEDTEST_CHUNK_SIZE)]
+      self.wfile.write(chunk)
+      size -= len(chunk)
+      pass
+    pass
+
+  def do_POST(self):
+    self.rfile.read(int(self.headers["Content-Length"]))
+    self.send_response(200)
+    self.send_header("Content-Length", "2")
+    self.end_headers()
+    self.wfile.write(b"{}")
+    pass
+
+  def log_message(self, format, *args):
+    pass
+  pass
+
+
+class Test_NetSpeed(unittest.TestCase):
+
+  def setUp(self):
+    self.server = http.server.HTTPServer(("127.0.0.1", 0), SpeedTestHandler)
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.start()
+    self.tempdir = tempfile.mkdtemp()
+    pass
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    self.thread.join()
+    shutil.rmtree(self.tempdir)
+    pass
+
+  def test_speedtest_url(self):
+    # Share is on lighttpd. Speed test is the triage server on the same machine.
+    self.assertEqual(netspeed.get_speedtest_url("http://10.3.2.1/wce"), "http://10.3.2.1:8312/dispatch/speedtest")
+    self.assertEqual(netspeed.get_speedtest_url("http://10.3.2.1:8080/wce", port=8400), "http://10.3.2.1:8400/dispatch/speedtest")
+    pass
+
+  def test_loopback(self):
+    share_url = "http://127.0.0.1/wce"
+    speedtest_url = netspeed.get_speedtest_url(share_url, port=self.server.server_address[1])
+    speed = netspeed.measure_network_speed(speedtest_url, download_size=4 * 2**20 + 100, upload_size=2**20, n_pings=3)
+    self.assertGreater(speed["download"], 0)
+    self.assertGreater(speed["upload"], 0)
+    self.assertGreaterEqual(speed["jitter"], 0)
+    self.assertGreater(speed["latency"], 0)
+    pass
+
+  def test_no_speedtest(self):
+    # Web server without the speed test
+    self.assertIsNone(netspeed.measure_network_speed("http://127.0.0.1:%d/no/speedtest" % self.server.server_address[1], n_pings=1))
+    # Nothing listening
+    self.server.socket.close()
+    self.assertIsNone(netspeed.measure_network_speed("http://127.0.0.1:%d%s" % (self.server.server_address[1], netspeed.SPEEDTEST_PATH), n_pings=1, timeout=2))
+    pass
+
+  def test_link_speed(self):
+    netdev = NetworkDevice(device_name="eth0")
+    netdev.device_node = self.tempdir
+    self.assertIsNone(netdev.get_link_speed())
+    with open(os.path.join(self.tempdir, "speed"), "w") as speed:
+      speed.write("100\n")
+      pass
+    self.assertEqual(netdev.get_link_speed(), 100)
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
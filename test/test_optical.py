@@ -0,0 +1,43 @@
+import unittest
+import tempfile
+import shutil
+import os
+
+from wce_triage.bin import test_optical as optical
+
+
+class Test_OpticalRawRead(unittest.TestCase):
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.disc = os.path.join(self.tempdir, "disc.iso")
+    with open(self.disc, "wb") as disc:
+      disc.write(os.urandom(optical.RAW_READ_SIZE * 40))
+      pass
+    pass
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+    pass
+
+  def test_raw_read(self):
+    result = optical.raw_read_optical(self.disc, time_budget=0.2)
+    self.assertTrue(result["result"])
+    self.assertEqual(result["device"], self.disc)
+    self.assertEqual(len(result["regions"]), optical.N_OPTICAL_REGIONS)
+    self.assertGreater(result["sustainedRate"], 0)
+    self.assertEqual(result["verdict"], [])
+    pass
+
+  def test_no_disc(self):
+    empty = os.path.join(self.tempdir, "empty")
+    open(empty, "wb").close()
+    result = optical.raw_read_optical(empty, time_budget=0.2)
+    self.assertFalse(result["result"])
+    self.assertEqual(result["message"], "No disc in %s." % empty)
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,215 @@
+import unittest
+import tempfile
+import shutil
+import struct
+import subprocess
+import os
+import io
+
+from wce_triage.lib import partclone_image
+
+
+def make_image(partition, block_size, used, blocks_per_checksum=4, reseed=True, version=b"0002"):
+  """partclone image v2 of partition. used is the list of block numbers."""
+  totalblock = len(partition) // block_size
+  head = struct.pack("<16s14s4sH", b"partclone-image", b"0.3.13", version, 0xC0DE)
+  fs_info = struct.pack("<16sQQQQI", b"EXTFS", len(partition), totalblock, len(used), len(used), block_size)
+  options = struct.pack("<IHHHHIBB", 18, 2, 64, partclone_image.CSM_CRC32, 4, blocks_per_checksum, 1 if reseed else 0, partclone_image.BM_BIT)
+  desc = head + fs_info + options
+  image = io.BytesIO()
+  image.write(desc + struct.pack("<I", partclone_image.partclone_crc32(desc)))
+  bitmap = bytearray((totalblock + 7) // 8)
+  for block in used:
+    bitmap[block // 8] |= 1 << (block % 8)
+    pass
+  image.write(bytes(bitmap) + struct.pack("<I", partclone_image.partclone_crc32(bytes(bitmap))))
+  crc = partclone_image.CRC32_SEED
+  in_checksum = 0
+  for block in sorted(used):
+    data = partition[block * block_size:(block + 1) * block_size]
+    image.write(data)
+    crc = partclone_image.partclone_crc32(data, crc)
+    in_checksum += 1
+    if in_checksum == blocks_per_checksum:
+      image.write(struct.pack("<I", crc))
+      in_checksum = 0
+      if reseed:
+        crc = partclone_image.CRC32_SEED
+        pass
+      pass
+    pass
+  if in_checksum > 0:
+    image.write(struct.pack("<I", crc))
+    pass
+  return image.getvalue()
+
+
+class Test_PartcloneImage(unittest.TestCase):
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.block_size = 4096
+    self.partition = os.urandom(200 * self.block_size)
+    # Runs, singles and a run across the bitmap bytes
+    self.used = list(range(0, 20)) + [23, 31, 32, 33] + list(range(60, 150)) + [199]
+    pass
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+    pass
+
+  def _restore(self, image, **kwargs):
+    dest = os.path.join(self.tempdir, "part.img")
+    with open(dest, "wb") as part:
+      part.truncate(len(self.partition))
+      pass
+    decoder = partclone_image.open_image(io.BytesIO(image), dest, **kwargs)
+    error = decoder.run()
+    with open(dest, "rb") as part:
+      return (decoder, error, part.read())
+    pass
+
+  def _expected(self):
+    expected = bytearray(len(self.partition))
+    for block in self.used:
+      expected[block * self.block_size:(block + 1) * self.block_size] = self.partition[block * self.block_size:(block + 1) * self.block_size]
+      pass
+    return bytes(expected)
+
+  def test_used_runs(self):
+    bitmap = bytearray(26)
+    for block in self.used:
+      bitmap[block // 8] |= 1 << (block % 8)
+      pass
+    runs = list(partclone_image.iterate_used_runs(bytes(bitmap), 200))
+    self.assertEqual(runs, [(0, 20), (23, 1), (31, 3), (60, 90), (199, 1)])
+    pass
+
+  def test_restore(self):
+    for reseed in [True, False]:
+      image = make_image(self.partition, self.block_size, self.used, blocks_per_checksum=7, reseed=reseed)
+      decoder, error, restored = self._restore(image, writers=3, write_size=5 * self.block_size)
+      self.assertIsNone(error)
+      self.assertEqual(restored, self._expected())
+      stats = decoder.stats()
+      self.assertEqual(stats["written"], len(self.used) * self.block_size)
+      self.assertEqual(stats["written"], stats["total"])
+      pass
+    pass
+
+  def test_corrupted(self):
+    image = bytearray(make_image(self.partition, self.block_size, self.used))
+    image[-self.block_size] ^= 0xff
+    decoder, error, restored = self._restore(bytes(image))
+    self.assertIn("Checksum does not match", error)
+
+    # Cut short
+    image = make_image(self.partition, self.block_size, self.used)
+    decoder, error, restored = self._restore(image[:-3 * self.block_size])
+    self.assertIn("Image ended", error)
+    pass
+
+  def test_unsupported(self):
+    image = make_image(self.partition, self.block_size, self.used, version=b"0001")
+    with self.assertRaises(partclone_image.UnsupportedImage) as context:
+      partclone_image.open_image(io.BytesIO(image), os.path.join(self.tempdir, "part.img"))
+      pass
+    # partclone gets the bytes already read and the rest.
+    self.assertEqual(context.exception.consumed, image[:partclone_image.IMAGE_DESC_SIZE])
+    pass
+
+  def _free_blocks(self, source):
+    """Free blocks of ext4 partition from dumpe2fs."""
+    out = subprocess.run(["dumpe2fs", source], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout.decode("iso-8859-1")
+    free = set()
+    for line in out.splitlines():
+      line = line.strip()
+      if not line.startswith("Free blocks:"):
+        continue
+      for extent in line[len("Free blocks:"):].split(","):
+        extent = extent.strip()
+        if not extent:
+          continue
+        first, _, last = extent.partition("-")
+        free.update(range(int(first), int(last if last else first) + 1))
+        pass
+      pass
+    return free
+
+  @unittest.skipUnless(shutil.which("mkfs.ext4") and shutil.which("dumpe2fs") and shutil.which("e2fsck"), "needs e2fsprogs")
+  def test_ext4_partition(self):
+    # The used blocks of a real file system are restored byte for byte.
+    files = os.path.join(self.tempdir, "files")
+    os.mkdir(files)
+    contents = {}
+    for index in range(16):
+      name = "file%d" % index
+      contents[name] = os.urandom((index * 37 + 1) * 1531)
+      with open(os.path.join(files, name), "wb") as out:
+        out.write(contents[name])
+        pass
+      pass
+    part_size = 64 * 2**20
+    source = os.path.join(self.tempdir, "source.img")
+    with open(source, "wb") as part:
+      part.truncate(part_size)
+      pass
+    subprocess.run(["mkfs.ext4", "-q", "-F", "-b", str(self.block_size), "-d", files, source], check=True)
+    with open(source, "rb") as part:
+      partition = part.read()
+      pass
+    free = self._free_blocks(source)
+    used = [block for block in range(part_size // self.block_size) if block not in free]
+    self.assertTrue(free and used)
+
+    dest = os.path.join(self.tempdir, "dest.img")
+    with open(dest, "wb") as part:
+      part.truncate(part_size)
+      pass
+    image = make_image(partition, self.block_size, used)
+    self.assertIsNone(partclone_image.open_image(io.BytesIO(image), dest, writers=3).run())
+    with open(dest, "rb") as part:
+      restored = part.read()
+      pass
+    for block in used:
+      self.assertEqual(restored[block * self.block_size:(block + 1) * self.block_size],
+                       partition[block * self.block_size:(block + 1) * self.block_size], "block %d" % block)
+      pass
+    fsck = subprocess.run(["e2fsck", "-fn", dest], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    self.assertEqual(fsck.returncode, 0)
+    if shutil.which("debugfs"):
+      cat = subprocess.run(["debugfs", "-R", "cat /file15", dest], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+      self.assertEqual(cat.stdout, contents["file15"])
+      pass
+    pass
+
+  @unittest.skipUnless(shutil.which("mkfs.ext4") and os.path.exists("/usr/sbin/partclone.ext4"), "needs mkfs.ext4 and partclone")
+  def test_same_as_partclone(self):
+    source = os.path.join(self.tempdir, "source.img")
+    with open(source, "wb") as part:
+      part.truncate(64 * 2**20)
+      pass
+    subprocess.run(["mkfs.ext4", "-q", "-F", source], check=True)
+    image = os.path.join(self.tempdir, "image.partclone")
+    subprocess.run(["/usr/sbin/partclone.ext4", "-c", "-s", source, "-o", image], check=True, stderr=subprocess.DEVNULL)
+    outputs = []
+    for name in ["partclone.img", "native.img"]:
+      dest = os.path.join(self.tempdir, name)
+      with open(dest, "wb") as part:
+        part.truncate(64 * 2**20)
+        pass
+      outputs.append(dest)
+      pass
+    subprocess.run(["/usr/sbin/partclone.ext4", "-r", "-s", image, "-o", outputs[0]], check=True, stderr=subprocess.DEVNULL)
+    with open(image, "rb") as stream:
+      self.assertIsNone(partclone_image.open_image(stream, outputs[1]).run())
+      pass
+    with open(outputs[0], "rb") as partclone_output, open(outputs[1], "rb") as native_output:
+      self.assertEqual(partclone_output.read(), native_output.read())
+      pass
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
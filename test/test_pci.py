@@ -0,0 +1,98 @@
+import unittest
+import tempfile
+import shutil
+import os
+
+from wce_triage.components import pci as pci
+from wce_triage.lib import pci_ids as pci_ids
+
+example_pci_ids = """#
+#	List of PCI ID's
+#
+1039  Silicon Integrated Systems [SiS]
+	0191  191 Gigabit Ethernet Adapter
+		1039 0191  191 Gigabit Ethernet Adapter
+1106  VIA Technologies, Inc.
+	3344  CN700/P4M800 Pro/P4M800 CE/VN800 Graphics [S3 UniChrome Pro]
+	7205  KM400/KN400/P4M800 [S3 UniChrome]
+8086  Intel Corporation
+	0166  3rd Gen Core processor Graphics Controller
+C 00  Unclassified device
+	00  Non-VGA unclassified device
+"""
+
+# address, class, vendor, device, driver
+example_devices = [ ("0000:00:02.0", "0x030000", "0x1106", "0x7205", None),
+                    ("0000:00:19.0", "0x020000", "0x1039", "0x0191", "sis190"),
+                    ("0000:01:00.0", "0x030000", "0x8086", "0x0166", "i915") ]
+
+
+class Test_PCI(unittest.TestCase):
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.pci_dir = os.path.join(self.tempdir, "devices")
+    os.mkdir(self.pci_dir)
+    for address, dev_class, vendor, device, driver in example_devices:
+      devnode = os.path.join(self.pci_dir, address)
+      os.mkdir(devnode)
+      for name, value in [("class", dev_class), ("vendor", vendor), ("device", device),
+                          ("subsystem_vendor", vendor), ("subsystem_device", device)]:
+        with open(os.path.join(devnode, name), "w") as sysfs:
+          sysfs.write(value + "\n")
+          pass
+        pass
+      if driver:
+        os.symlink(os.path.join("..", "drivers", driver), os.path.join(devnode, "driver"))
+        pass
+      pass
+
+    self.pci_ids_file = os.path.join(self.tempdir, "pci.ids")
+    with open(self.pci_ids_file, "w") as pci_ids_f:
+      pci_ids_f.write(example_pci_ids)
+      pass
+    pass
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+    pass
+
+  def test_list_pci(self):
+    devices = pci.list_pci(pci_dir=self.pci_dir)
+    self.assertEqual(len(devices), 3)
+    self.assertEqual(devices[0].address, "00:02.0")
+    self.assertEqual(devices[0].device_class, "video")
+    self.assertEqual(devices[0].vendor, pci.PCI_VENDOR_VIA)
+    self.assertEqual(devices[0].device, "7205")
+    self.assertIsNone(devices[0].driver)
+    self.assertEqual(devices[1].device_class, "network")
+    self.assertEqual(devices[1].driver, "sis190")
+    pass
+
+  def test_pci_ids_index(self):
+    index_file = os.path.join(self.tempdir, "pci.ids.idx")
+    pci_ids._pci_ids = None
+    try:
+      ids = pci_ids.get_pci_ids(index_file=index_file, pci_ids=self.pci_ids_file)
+      self.assertTrue(os.path.exists(index_file))
+      self.assertEqual(ids.vendor_name(0x1106), "VIA Technologies, Inc.")
+      self.assertEqual(ids.device_name(0x1106, 0x7205), "KM400/KN400/P4M800 [S3 UniChrome]")
+      self.assertEqual(ids.device_name(0x1039, 0x0191), "191 Gigabit Ethernet Adapter")
+      self.assertEqual(ids.device_name(0x8086, 0x0166), "3rd Gen Core processor Graphics Controller")
+      self.assertIsNone(ids.vendor_name(0x10de))
+      self.assertIsNone(ids.device_name(0x8086, 0x0000))
+    finally:
+      pci_ids._pci_ids = None
+      pass
+    pass
+
+  def test_in_memory_index(self):
+    ids = pci_ids.PCIIds(pci_ids.build_pci_ids_index(example_pci_ids.splitlines()))
+    self.assertEqual(ids.count, 7)
+    self.assertEqual(ids.vendor_name(0x8086), "Intel Corporation")
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
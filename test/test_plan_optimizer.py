@@ -0,0 +1,148 @@
+import unittest
+import uuid
+from unittest import mock
+
+from wce_triage.components.disk import Disk, Partition
+from wce_triage.ops import tasks as _tasks
+from wce_triage.ops import restore_image_runner
+from wce_triage.ops.ops_ui import ops_ui
+from wce_triage.ops.pplan import make_efi_partition_plan, EFI_NAME
+from wce_triage.ops.plan_optimizer import PlanOptimizer, PLAN_LEGACY
+from wce_triage.ops.tasks import task_mkfs, task_fsck, task_fetch_partitions, task_refresh_partitions, task_mount, task_unmount, task_set_ext_partition_uuid, op_task_wipe_disk
+from wce_triage.ops.partclone_tasks import task_restore_disk_image
+
+
+class QuietUI(ops_ui):
+  def __init__(self):
+    self.logs = []
+    pass
+
+  def report_tasks(self, runner_id, current_time, run_estimate, tasks):
+    pass
+
+  def log(self, runner_id, msg):
+    self.logs.append(msg)
+    pass
+  pass
+
+
+class Test_PlanOptimizer(unittest.TestCase):
+
+  def setUp(self):
+    self.saved_detect_video_cards = restore_image_runner.detect_video_cards
+    restore_image_runner.detect_video_cards = lambda: (0, 0, 1)
+    self.disk = Disk(device_name="/dev/sdz")
+    self.disk.byte_size = 64 * 2**30
+    pass
+
+  def tearDown(self):
+    restore_image_runner.detect_video_cards = self.saved_detect_video_cards
+    pass
+
+  def _runner(self, restore_type, **kwargs):
+    pplan = make_efi_partition_plan(self.disk, efi_boot=True, partition_id="Linux")
+    runner = restore_image_runner.RestoreDiskRunner(QuietUI(), self.disk.device_name, self.disk,
+                                                    "http://10.3.2.1/wce/wce-disk-images/wce-18/wce-mate18.ext4.partclone.gz",
+                                                    2**30, "http://10.3.2.1/wce/wce-disk-images/wce-18/.efi-512M.fat32.partclone.gz",
+                                                    partition_id="Linux", pplan=pplan, partition_map="gpt",
+                                                    restore_type=restore_type, **kwargs)
+    runner.prepare()
+    return runner
+
+  def _count(self, tasks, task_class):
+    return len([ task for task in tasks if isinstance(task, task_class) ])
+
+  def test_restore_plan(self):
+    runner = self._runner({"id": "wce-18", "efi_image": ".efi-512M.fat32.partclone.gz"})
+    original = list(runner.tasks)
+    runner.preflight()
+    tasks = runner.tasks
+
+    # mkfs.ext4 is gone. EFI's mkfs is needed for the volume ID.
+    mkfs = [ task for task in tasks if isinstance(task, task_mkfs) ]
+    self.assertEqual([ task.part.file_system for task in mkfs ], ['vfat'])
+    # One fsck -y
+    fscks = [ task for task in tasks if isinstance(task, task_fsck) ]
+    self.assertEqual([ task.fix_filesytem for task in fscks ], [True])
+    # The refresh after loading EFI is not needed
+    self.assertEqual(self._count(tasks, task_refresh_partitions), 1)
+    self.assertEqual(self._count(tasks, task_fetch_partitions), 1)
+    # The task numbers follow the new plan
+    self.assertEqual([ task.task_number for task in tasks ], list(range(len(tasks))))
+    self.assertEqual(len(original) - len(tasks), 3)
+    self.assertIn("removed 3 tasks", runner.ui.logs[0])
+    pass
+
+  def test_foreign_superblock(self):
+    runner = self._runner({"id": "wce-18", "efi_image": ".efi-512M.fat32.partclone.gz"})
+    mkfs = [ task for task in runner.tasks if isinstance(task, task_mkfs) and task.part.file_system == 'ext4' ][0]
+    planned_uuid = mkfs.argv[mkfs.argv.index("-U")+1]
+    runner.preflight()
+    set_uuid = [ task for task in runner.tasks if isinstance(task, task_set_ext_partition_uuid) ][0]
+    self.assertEqual(set_uuid.fs_uuid, planned_uuid)
+
+    # The disk had NTFS. The refresh before the restore reads its serial.
+    part = Partition(device_name="/dev/sdz2", partition_name="Linux", file_system="ntfs")
+    part.fs_uuid = "0123456789ABCDEF"
+    self.disk.partitions = [part]
+    with mock.patch.object(_tasks, "popen") as popen:
+      set_uuid.setup()
+      pass
+    self.assertEqual(set_uuid.argv, ["tune2fs", "-f", "-U", planned_uuid, "/dev/sdz2"])
+    self.assertEqual(str(uuid.UUID(part.fs_uuid)), planned_uuid)
+    self.assertEqual(popen.call_args[0][0], set_uuid.argv)
+    pass
+
+  def test_clone_plan(self):
+    runner = self._runner({"id": "clone"})
+    runner.preflight()
+    tasks = runner.tasks
+    # The fs UUID comes back with the refresh after the restore. fetch is not needed.
+    self.assertEqual(self._count(tasks, task_fetch_partitions), 1)
+    self.assertEqual(self._count(tasks, task_refresh_partitions), 2)
+    self.assertEqual(self._count(tasks, task_mkfs), 1)
+    pass
+
+  def test_legacy(self):
+    runner = self._runner({"id": "wce-18", "efi_image": ".efi-512M.fat32.partclone.gz"}, plan_mode=PLAN_LEGACY)
+    original = list(runner.tasks)
+    runner.preflight()
+    self.assertEqual(runner.tasks, original)
+    self.assertEqual(runner.ui.logs, [])
+    pass
+
+  def test_restore_aware_wipe(self):
+    restore_type = {"id": "wce-18", "efi_image": ".efi-512M.fat32.partclone.gz"}
+    runner = self._runner(restore_type, wipe=2)
+    runner.preflight()
+    wipes = [ task for task in runner.tasks if isinstance(task, op_task_wipe_disk) ]
+    self.assertEqual(len(wipes), 2)
+    self.assertIs(runner.tasks[0], wipes[0])
+    self.assertIn("-r", wipes[0].argv)
+    # Free space is wiped after the image is loaded.
+    self.assertIn("-e", wipes[1].argv)
+    loads = [ index for index, task in enumerate(runner.tasks) if isinstance(task, task_restore_disk_image) ]
+    self.assertGreater(runner.tasks.index(wipes[1]), loads[-1])
+    # Restore-aware wipe writes less than the disk.
+    self.assertLess(wipes[0].estimate_time() + wipes[1].estimate_time(), 2 + self.disk.byte_size/40000000)
+
+    runner = self._runner(restore_type, wipe=2, plan_mode=PLAN_LEGACY)
+    wipes = [ task for task in runner.tasks if isinstance(task, op_task_wipe_disk) ]
+    self.assertEqual([ task.argv[-2:] for task in wipes ], [["wce_triage.bin.multiwipe", "/dev/sdz"]])
+    pass
+
+  def test_idle_mount(self):
+    pplan = make_efi_partition_plan(self.disk, efi_boot=True, partition_id="Linux")
+    tasks = [ task_mount("Mount", disk=self.disk, partition_id="Linux"),
+              task_unmount("Unmount", disk=self.disk, partition_id="Linux"),
+              task_mount("Mount EFI", disk=self.disk, partition_id=EFI_NAME),
+              task_unmount("Unmount Linux", disk=self.disk, partition_id="Linux") ]
+    optimizer = PlanOptimizer(pplan)
+    self.assertEqual([ task.description for task in optimizer.optimize(tasks) ], ["Mount EFI", "Unmount Linux"])
+    self.assertEqual(optimizer.saved_time(), sum([ task.estimate_time() for task in tasks[:2] ]))
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
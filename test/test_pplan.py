@@ -21,6 +21,21 @@ class Test_(unittest.TestCase):
       pass
     pass
 
+  def test_fit_partition_plan(self):
+    small_disk = Disk(device_name="/dev/null")
+    small_disk.byte_size = 40 * 2**30
+    plan = make_efi_partition_plan(small_disk, partition_id="Linux")
+    linux_size = plan[4].size
+    swap_size = plan[3].size
+    fit_partition_plan(plan, "Linux", linux_size + 1000)
+    self.assertEqual(plan[4].size, linux_size + 1000)
+    self.assertEqual(plan[3].size, swap_size - 1000)
+    self.assertEqual(plan[4].start, plan[3].start + plan[3].size)
+
+    plan = make_traditional_partition_plan(small_disk)
+    self.assertRaises(Exception, fit_partition_plan, plan, 1, 40 * 1024)
+    pass
+
 
 if __name__ == '__main__':
   unittest.main()
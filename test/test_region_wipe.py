@@ -0,0 +1,89 @@
+import unittest
+import tempfile
+import shutil
+import os
+
+from wce_triage.lib import region_wipe
+from wce_triage.bin import multiwipe
+from wce_triage.components.disk import Disk
+from wce_triage.ops.pplan import make_efi_partition_plan
+
+# Trimmed "dumpe2fs /dev/sdb1" output
+example_dumpe2fs = """dumpe2fs 1.45.5 (07-Jan-2020)
+Filesystem volume name:   <none>
+Block count:              8192
+Free blocks:              4000
+Block size:               4096
+
+Group 0: (Blocks 0-4095) csum 0x1234
+  Primary superblock at 0, Group descriptors at 1-1
+  Block bitmap at 2 (+2)
+  2000 free blocks, 100 free inodes, 2 directories
+  Free blocks: 2096-4095
+  Free inodes: 12-112
+Group 1: (Blocks 4096-8191) csum 0x5678
+  2000 free blocks, 100 free inodes, 0 directories
+  Free blocks: 4096, 4097-4098, 6195-8191
+  Free inodes:
+"""
+
+
+class Test_RegionWipe(unittest.TestCase):
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.image = os.path.join(self.tempdir, "disk.img")
+    self.payload = os.urandom(4 * 2**20)
+    with open(self.image, "wb") as image:
+      image.write(self.payload)
+      pass
+    pass
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+    pass
+
+  def test_merge_regions(self):
+    self.assertEqual(region_wipe.merge_regions([(4096, 4096), (0, 4096), (100000, 0), (6000, 10000)]), [(0, 16000)])
+    spec = region_wipe.format_regions([(0, 512), (2**40, 2**20)])
+    self.assertEqual(region_wipe.parse_regions(spec), [(0, 512), (2**40, 2**20)])
+    pass
+
+  def test_pplan_outside_regions(self):
+    disk = Disk(device_name="/dev/null")
+    disk.byte_size = 64 * 2**30
+    pplan = make_efi_partition_plan(disk, partition_id="Linux")
+    regions = region_wipe.pplan_outside_regions(pplan, "Linux", disk.byte_size)
+    linux = pplan[4]
+    self.assertEqual(regions, [(0, linux.start * 2**20), ((linux.start + linux.size) * 2**20, 2**20)])
+    pass
+
+  def test_ext_free_regions(self):
+    block_size, block_count, free = region_wipe.parse_dumpe2fs_free_blocks(example_dumpe2fs)
+    self.assertEqual((block_size, block_count), (4096, 8192))
+    self.assertEqual(free, [(2096, 2000), (4096, 1), (4097, 2), (6195, 1997)])
+    # Partition is bigger than the file system
+    regions = region_wipe.ext_free_regions(example_dumpe2fs, 10000 * 4096)
+    self.assertEqual(regions, [(2096 * 4096, 2003 * 4096), (6195 * 4096, (10000 - 6195) * 4096)])
+    pass
+
+  def test_region_wiper(self):
+    regions = [(4096, 2**20), (3 * 2**20, 2**20)]
+    wiper = multiwipe.RegionWiper(regions, open(self.image, "r+b", buffering=0), self.image, region_wipe.ZERO_METHOD_ZEROOUT)
+    wiper.run()
+    self.assertEqual(wiper.n_written, wiper.n_sectors)
+    self.assertEqual(wiper.method, region_wipe.ZERO_METHOD_WRITE)
+    with open(self.image, "rb") as image:
+      data = image.read()
+      pass
+    self.assertEqual(len(data), len(self.payload))
+    self.assertEqual(data[:4096], self.payload[:4096])
+    self.assertEqual(data[4096:4096 + 2**20], bytes(2**20))
+    self.assertEqual(data[4096 + 2**20:3 * 2**20], self.payload[4096 + 2**20:3 * 2**20])
+    self.assertEqual(data[3 * 2**20:], bytes(2**20))
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,154 @@
+import unittest
+import os
+import io
+import time
+import threading
+import socketserver
+import http.server
+
+from wce_triage.lib import segmented_download
+from wce_triage.lib.disk_images import get_mirror_urls
+
+
+class MirrorHandler(http.server.BaseHTTPRequestHandler):
+  """Serves the payload with Range. server.delay is the sleep per 64KiB,
+server.broken makes every request fail, and server.cuts is the number of
+segment requests cut in the middle."""
+  protocol_version = "HTTP/1.1"
+
+  def log_message(self, format, *args):
+    pass
+
+  def do_GET(self):
+    server = self.server
+    if server.broken:
+      self.send_error(500)
+      return
+    payload = server.payload
+    first, last = self.headers["Range"].split("=")[1].split("-")
+    start, end = int(first), int(last) + 1
+    cut = False
+    with server.lock:
+      if server.cuts > 0 and end - start > 1:
+        server.cuts -= 1
+        cut = True
+        pass
+      pass
+    self.send_response(206)
+    self.send_header("Content-Length", str(end - start))
+    self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end - 1, len(payload)))
+    self.end_headers()
+    if cut:
+      self.wfile.write(payload[start:start + 100])
+      self.close_connection = True
+      return
+    try:
+      for offset in range(start, end, 2 ** 16):
+        self.wfile.write(payload[offset:min(end, offset + 2 ** 16)])
+        if server.delay:
+          time.sleep(server.delay)
+          pass
+        pass
+    except OSError:
+      pass
+    pass
+  pass
+
+
+class MirrorServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+  daemon_threads = True
+  pass
+
+
+class Test_SegmentedDownload(unittest.TestCase):
+
+  def setUp(self):
+    self.payload = os.urandom(5 * 2**20 + 1234)
+    self.servers = []
+    pass
+
+  def tearDown(self):
+    for server in self.servers:
+      server.shutdown()
+      server.server_close()
+      pass
+    pass
+
+  def _mirror(self, delay=0, broken=False, payload=None, cuts=0):
+    server = MirrorServer(("127.0.0.1", 0), MirrorHandler)
+    server.payload = self.payload if payload is None else payload
+    server.delay = delay
+    server.broken = broken
+    server.cuts = cuts
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    self.servers.append(server)
+    return "http://127.0.0.1:%d/wce/wce-disk-images/triage/image.partclone.gz" % server.server_address[1]
+
+  def _read_all(self, reader, size=2 ** 20):
+    output = io.BytesIO()
+    while True:
+      data = reader.read(size)
+      if not data:
+        break
+      output.write(data)
+      pass
+    reader.close()
+    return output.getvalue()
+
+  def test_multiple_mirrors(self):
+    urls = [ self._mirror(), self._mirror(), self._mirror() ]
+    reader = segmented_download.SegmentedReader(urls, segment_size=2**18, connections_per_mirror=2)
+    self.assertEqual(self._read_all(reader), self.payload)
+    stats = reader.mirror_stats()
+    self.assertEqual(sum([mirror["bytes"] for mirror in stats]) >= len(self.payload), True)
+    # Everybody helped
+    for mirror in stats:
+      self.assertGreater(mirror["segments"], 0)
+      pass
+    pass
+
+  def test_slow_and_broken_mirrors(self):
+    fast = self._mirror()
+    slow = self._mirror(delay=0.2)
+    urls = [ slow, fast, self._mirror(broken=True), self._mirror(payload=b"other image") ]
+    reader = segmented_download.SegmentedReader(urls, segment_size=2**18, connections_per_mirror=2)
+    self.assertEqual(self._read_all(reader), self.payload)
+    stats = dict([ (mirror["url"], mirror) for mirror in reader.mirror_stats() ])
+    self.assertGreater(stats[fast]["bytes"], stats[slow]["bytes"] * 3)
+    self.assertTrue(stats[urls[2]]["disabled"])
+    self.assertTrue(stats[urls[3]]["disabled"])
+    pass
+
+  def test_flaky_mirror(self):
+    # More failures in a row than the old limit of 3. The mirror is retried.
+    url = self._mirror(cuts=5)
+    reader = segmented_download.SegmentedReader([url], segment_size=2**18, connections_per_mirror=1, retry_wait=0.05)
+    self.assertEqual(self._read_all(reader, size=1000), self.payload)
+    stats = reader.mirror_stats()[0]
+    self.assertEqual(stats["failures"], 5)
+    self.assertFalse(stats["disabled"])
+
+    # Until the retries run out
+    reader = segmented_download.SegmentedReader([self._mirror(cuts=100)], segment_size=2**18, connections_per_mirror=1,
+                                                max_retries=3, retry_wait=0.05)
+    self.assertRaises(Exception, self._read_all, reader)
+    pass
+
+  def test_all_broken(self):
+    reader = segmented_download.SegmentedReader([ self._mirror(broken=True) ])
+    self.assertRaises(Exception, reader.read)
+    pass
+
+  def test_mirror_urls(self):
+    url = "http://10.3.2.1/wce/wce-disk-images/wce-18/wce-mate18.ext4.partclone.gz"
+    self.assertEqual(get_mirror_urls(url, ["http://10.3.2.2:8312/wce/", "http://10.3.2.1/wce"]),
+                     ["http://10.3.2.2:8312/wce/wce-disk-images/wce-18/wce-mate18.ext4.partclone.gz"])
+    self.assertEqual(get_mirror_urls("/usr/local/share/wce/image.partclone.gz", ["http://10.3.2.2/wce"]), [])
+    self.assertEqual(get_mirror_urls(url, None), [])
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+
+from wce_triage.lib.smart import *
+from wce_triage.components.disk import Disk
+
+ata_smart = { "smart_status": { "passed": True },
+              "power_on_time": { "hours": 12345 },
+              "ata_smart_attributes": { "table": [
+                { "id": 5, "name": "Reallocated_Sector_Ct", "value": 100, "raw": { "value": 8 } },
+                { "id": 9, "name": "Power_On_Hours", "value": 86, "raw": { "value": 12345 } },
+                { "id": 177, "name": "Wear_Leveling_Count", "value": 93, "raw": { "value": 71 } },
+                { "id": 197, "name": "Current_Pending_Sector", "value": 100, "raw": { "value": 0 } } ] } }
+
+nvme_smart = { "smart_status": { "passed": True },
+               "nvme_smart_health_information_log": { "percentage_used": 3, "power_on_hours": 2000,
+                                                       "media_errors": 0, "available_spare": 100 } }
+
+
+class Test_Smart(unittest.TestCase):
+
+  def test_parse_ata(self):
+    health = parse_smartctl_json(ata_smart)
+    self.assertEqual(health["reallocated"], 8)
+    self.assertEqual(health["pending"], 0)
+    self.assertEqual(health["power_on_hours"], 12345)
+    self.assertEqual(health["wear"], 7)
+    good, message = smart_verdict(health)
+    self.assertFalse(good)
+    self.assertEqual(message, "SMART: 8 reallocated, 12345 hours, 7% worn")
+    pass
+
+  def test_parse_nvme(self):
+    health = parse_smartctl_json(nvme_smart)
+    self.assertEqual(health["wear"], 3)
+    self.assertEqual(health["power_on_hours"], 2000)
+    self.assertEqual(smart_verdict(health), (True, "SMART: OK (2000 hours, 3% worn)"))
+    pass
+
+  def test_collector(self):
+    reads = []
+    def reader(device_name):
+      reads.append(device_name)
+      return parse_smartctl_json(nvme_smart)
+
+    collector = SmartCollector(reader=reader)
+    disks = [ Disk(device_name="/dev/sda"), Disk(device_name="/dev/sdb") ]
+    disks[0].serial_no = "S1"
+    disks[1].serial_no = "S2"
+    self.assertIsNone(collector.get(disks[0]))
+    self.assertEqual(len(collector.collect(disks)), 2)
+    self.assertEqual(sorted(reads), ["/dev/sda", "/dev/sdb"])
+    self.assertEqual(disks[1].smart_health["wear"], 3)
+    # Cached per serial
+    self.assertEqual(collector.collect(disks), [])
+    self.assertEqual(len(reads), 2)
+    self.assertFalse(collector.is_stale(disks[0]))
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
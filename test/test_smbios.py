@@ -0,0 +1,112 @@
+import unittest
+import tempfile
+import shutil
+import struct
+import os
+
+from wce_triage.lib.smbios import *
+from wce_triage.components import memory as memory
+
+
+def make_structure(smbios_type, handle, body, strings):
+  header = struct.pack('<BBH', smbios_type, 4 + len(body), handle)
+  if strings:
+    string_area = b'\x00'.join([s.encode('iso-8859-1') for s in strings]) + b'\x00\x00'
+  else:
+    string_area = b'\x00\x00'
+    pass
+  return header + body + string_area
+
+
+def make_memory_device(handle, locator_index, size, memtype):
+  # 0x04 array handle, 0x06 error handle, 0x08 total width, 0x0A data width, 0x0C size,
+  # 0x0E form factor, 0x0F device set, 0x10 locator, 0x11 bank locator, 0x12 type,
+  # 0x13 type detail, 0x15 speed, 0x17 manufacturer, 0x18 serial, 0x19 asset, 0x1A part,
+  # 0x1B attributes, 0x1C extended size
+  extended = 0
+  if size >= 0x7FFF:
+    extended = size
+    size = 0x7FFF
+    pass
+  body = struct.pack('<HHHHHBBBBBHHBBBBBI', 0x1000, 0xFFFE, 64, 64, size, 0x09, 0,
+                     locator_index, 0, memtype, 0x80, 1600, 0, 0, 0, 0, 0, extended)
+  return body
+
+
+# Fixture - SMBIOS 3.0 table with system, a memory module and 3 memory devices
+fixture_table = b''.join([
+  make_structure(0, 0x0000, struct.pack('<BBHBBBQ', 1, 2, 0xE800, 3, 0x0F, 0, 0), ["LENOVO", "8DET74WW (1.44 )", "12/01/2017"]),
+  make_structure(1, 0x0001,
+                 struct.pack('<BBBB', 1, 2, 3, 4) + bytes([0x33, 0x22, 0x11, 0x00, 0x55, 0x44, 0x77, 0x66, 0x88, 0x99, 0xaa, 0xbb, 0xcc, 0xdd, 0xee, 0xff]) + b'\x06\x00\x00',
+                 ["LENOVO", "4291W1B", "ThinkPad X220", "R9ABCDE"]),
+  make_structure(6, 0x0006, struct.pack('<BBBHBBB', 1, 0x01, 0, 0x0400, 0x0B, 0x0B, 0x00), ["DIMM_A"]),
+  make_structure(17, 0x0011, make_memory_device(0x0011, 1, 2048, 0x18), ["ChannelA-DIMM0"]),
+  make_structure(17, 0x0012, make_memory_device(0x0012, 1, 0, 0x02), ["ChannelB-DIMM0"]),
+  make_structure(17, 0x0013, make_memory_device(0x0013, 1, 65536, 0x1A), ["ChannelC-DIMM0"]),
+  make_structure(127, 0x007F, b'', []),
+])
+
+fixture_entry_point = b'_SM3_' + bytes([0, 0x18, 3, 0, 0, 1, 0]) + struct.pack('<IQ', len(fixture_table), 0)
+
+
+class Test_SMBIOS(unittest.TestCase):
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    with open(os.path.join(self.tempdir, "DMI"), "wb") as dmi:
+      dmi.write(fixture_table)
+      pass
+    with open(os.path.join(self.tempdir, "smbios_entry_point"), "wb") as entry_point:
+      entry_point.write(fixture_entry_point)
+      pass
+    pass
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+    pass
+
+  def test_parse(self):
+    smbios = read_smbios(self.tempdir)
+    self.assertEqual(smbios.version, (3, 0))
+    self.assertEqual(len(smbios.structures), 7)
+    bios, system, baseboard, processors = get_system_info(smbios)
+    self.assertEqual(bios.vendor, "LENOVO")
+    self.assertEqual(system.product, "4291W1B")
+    self.assertEqual(system.serial, "R9ABCDE")
+    self.assertEqual(system.uuid, "00112233-4455-6677-8899-aabbccddeeff")
+    self.assertIsNone(baseboard)
+    self.assertEqual(processors, [])
+    pass
+
+  def test_memory_device(self):
+    smbios = read_smbios(self.tempdir)
+    devices = [ decode_memory_device(structure) for structure in smbios.find(17) ]
+    self.assertEqual(devices[0].size, 2048)
+    self.assertEqual(devices[0].memtype, "DDR3")
+    self.assertEqual(devices[0].locator, "ChannelA-DIMM0")
+    self.assertEqual(devices[1].size, 0)
+    self.assertEqual(devices[2].size, 65536)
+    self.assertEqual(devices[2].memtype, "DDR4")
+    pass
+
+  def test_ram_info(self):
+    os.environ["WCETRIAGE_SMBIOS_TABLES"] = self.tempdir
+    try:
+      mem = memory.detect_memory()
+    finally:
+      del os.environ["WCETRIAGE_SMBIOS_TABLES"]
+      pass
+    self.assertEqual(mem.total, 2048 + 65536)
+    self.assertEqual(mem.ramtype, "DDR3")
+    self.assertEqual(len(mem.slots), 3)
+    self.assertEqual(mem.rams, [memory.RAM(socket="DIMM_A", size=2048, status=True)])
+    pass
+
+  def test_unreadable(self):
+    self.assertIsNone(read_smbios(os.path.join(self.tempdir, "nonexistent")))
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
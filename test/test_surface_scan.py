@@ -0,0 +1,70 @@
+import unittest
+import tempfile
+import shutil
+import os
+import io
+import json
+
+from wce_triage.bin import surface_scan as surface_scan
+from wce_triage.components.disk import Disk, DiskPortal
+
+
+class Test_SurfaceScan(unittest.TestCase):
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.image = os.path.join(self.tempdir, "disk.img")
+    with open(self.image, "wb") as image:
+      image.write(os.urandom(3 * 2**20 + 4096))
+      pass
+    pass
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+    pass
+
+  def test_merge_ranges(self):
+    self.assertEqual(surface_scan.merge_ranges([(256, 128), (0, 128), (128, 128), (1024, 8)]),
+                     [[0, 384], [1024, 8]])
+    pass
+
+  def test_sample_offsets(self):
+    self.assertIsNone(surface_scan.sample_offsets(4 * 2**20, 2**20, 8))
+    self.assertEqual(surface_scan.sample_offsets(100 * 2**20, 2**20, 3), [0, 49 * 2**20, 99 * 2**20])
+    pass
+
+  def test_scan(self):
+    scanner = surface_scan.Scanner(self.image, slow_ms=10000)
+    scanner.run()
+    self.assertEqual(scanner.n_read, scanner.total_bytes)
+    result = scanner._result()
+    self.assertEqual(sum(result["histogram"].values()), 4)
+    self.assertEqual(result["badRanges"], [])
+    self.assertEqual(result["slowRanges"], [])
+    pass
+
+  def test_report(self):
+    output = io.StringIO()
+    surface_scan.scanners = []
+    self.assertEqual(surface_scan.surface_scan([self.image], n_samples=2, output=output), 0)
+    report = json.loads(output.getvalue().splitlines()[-1])
+    self.assertEqual(report["event"], "surfacescan")
+    self.assertEqual(report["message"]["runStatus"], "Success")
+    self.assertEqual(report["message"]["totalBytes"], 2**20 + 4096)
+    pass
+
+  def test_decision(self):
+    portal = DiskPortal()
+    disk = Disk(device_name=self.image)
+    disk._set_byte_size(120 * 10**9)
+    disk.surface_scan = { "runStatus": "Failed", "badRanges": [[2048, 128]], "slowRanges": [] }
+    portal.disks = [disk]
+    decision = portal.decision(live_system=True)[0]
+    self.assertFalse(decision["result"])
+    self.assertEqual(decision["verdict"], ["Unreadable LBA 2048 - 2175"])
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,194 @@
+import unittest
+import tempfile
+import shutil
+import os
+import json
+import datetime
+
+from wce_triage.ops import sync_image_runner
+from wce_triage.ops.ops_ui import ops_ui
+from wce_triage.ops.run_state import RunState
+from wce_triage.ops.sync_image_tasks import task_image_sync_copy
+from wce_triage.lib.disk_images import get_image_metadata_path, read_image_metadata
+from wce_triage.lib.image_index import write_image_index, read_image_index
+
+
+class FakeDisk:
+  def __init__(self, device_name):
+    self.device_name = device_name
+    pass
+  pass
+
+
+class FakePartition:
+  def __init__(self, mount_point):
+    self.mount_point = mount_point
+    pass
+
+  def get_mount_point(self):
+    return self.mount_point
+  pass
+
+
+class RecordingUI(ops_ui):
+  def __init__(self):
+    self.successes = []
+    self.failures = []
+    self.run_estimates = {}
+    pass
+
+  def report_tasks(self, runner_id, current_time, run_estimate, tasks):
+    pass
+
+  def report_task_progress(self, runner_id, current_time, run_estimate, run_time, task, tasks):
+    pass
+
+  def report_task_failure(self, runner_id, current_time, run_time, task):
+    self.failures.append(task)
+    pass
+
+  def report_task_success(self, runner_id, current_time, run_time, task):
+    if task not in self.successes:
+      self.successes.append(task)
+      pass
+    pass
+
+  def report_run_progress(self, runner_id, current_time, runner_state, run_estimate, run_time, step, tasks):
+    self.run_estimates[runner_id] = run_estimate
+    pass
+
+  def log(self, runner_id, msg):
+    pass
+  pass
+
+
+class Test_SyncImageRunner(unittest.TestCase):
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.saved_pythonpath = os.environ.get("PYTHONPATH")
+    os.environ["PYTHONPATH"] = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(sync_image_runner.__file__))))
+
+    self.sources = []
+    source_dir = os.path.join(self.tempdir, "source", "triage")
+    os.makedirs(source_dir)
+    for index, size in enumerate([100000, 400000, 200000, 300000]):
+      name = "image%d.partclone.gz" % index
+      fullpath = os.path.join(source_dir, name)
+      with open(fullpath, "wb") as image:
+        image.write(os.urandom(size))
+        pass
+      self.sources.append({"name": name, "restoreType": "triage", "fullpath": fullpath, "size": size})
+      pass
+
+    self.disks = []
+    self.partitions = []
+    for index in range(3):
+      mount_point = os.path.join(self.tempdir, "disk%d" % index)
+      catalog = os.path.join(mount_point, "usr", "local", "share", "wce", "wce-disk-images", "triage")
+      os.makedirs(catalog)
+      with open(os.path.join(catalog, ".disk_image_type.json"), "w") as meta:
+        json.dump({"id": "triage"}, meta)
+        pass
+      self.disks.append(FakeDisk("/dev/sd%s" % "xyz"[index]))
+      self.partitions.append(FakePartition(mount_point))
+      pass
+
+    # disk 0 has image2 already
+    shutil.copy(self.sources[2]["fullpath"], os.path.join(self.partitions[0].get_mount_point(), "usr", "local", "share", "wce", "wce-disk-images", "triage"))
+    pass
+
+  def tearDown(self):
+    if self.saved_pythonpath is None:
+      del os.environ["PYTHONPATH"]
+    else:
+      os.environ["PYTHONPATH"] = self.saved_pythonpath
+      pass
+    shutil.rmtree(self.tempdir)
+    pass
+
+  def _make_runner(self, **kwargs):
+    ui = RecordingUI()
+    runner = sync_image_runner.SyncImageRunner(ui, "diskimage", self.sources, self.disks, **kwargs)
+    for disk in self.disks:
+      runner.scoreboard[disk.device_name] = {"total_size": 0, "completed_size": 0, "inflight_size" : 0, "inflight": {}, "completed_seconds": 0, "start_time": None, "bps": 0}
+      pass
+    for task_number, source in enumerate(self.sources):
+      task = task_image_sync_copy("Copy %s" % source['name'], source=source, scoreboard=runner.scoreboard)
+      task.task_number = task_number
+      task.runner = runner
+      for disk, part in zip(self.disks, self.partitions):
+        task.add_mount_point(disk, part)
+        pass
+      runner.tasks.append(task)
+      runner.copy_tasks.append(task)
+      pass
+    runner.state = RunState.Running
+    runner.start_time = datetime.datetime.now()
+    runner.task_step = 0
+    return runner, ui
+
+  def test_copy_pool(self):
+    runner, ui = self._make_runner(max_per_destination=2)
+    runner._run_copy_pool(ui)
+
+    self.assertEqual(runner.state, RunState.Running)
+    self.assertEqual(len(ui.successes), len(self.sources))
+    for disk, part in zip(self.disks, self.partitions):
+      for source in self.sources:
+        with open(os.path.join(part.get_mount_point(), "usr", "local", "share", "wce", "wce-disk-images", "triage", source["name"]), "rb") as copied, open(source["fullpath"], "rb") as original:
+          self.assertEqual(copied.read(), original.read())
+          pass
+        pass
+      pass
+
+    # Only the missing images are counted
+    total = sum([source["size"] for source in self.sources])
+    self.assertEqual(runner.scoreboard["/dev/sdx"]["total_size"], total - self.sources[2]["size"])
+    self.assertEqual(runner.scoreboard["/dev/sdy"]["total_size"], total)
+    for disk in self.disks:
+      scoreboard = runner.scoreboard[disk.device_name]
+      self.assertEqual(scoreboard["completed_size"], scoreboard["total_size"])
+      self.assertEqual(scoreboard["inflight_size"], 0)
+      pass
+
+    # Largest first, and two at a time
+    tasks = sorted(runner.copy_tasks, key=lambda task: task.start_time)
+    self.assertEqual([task.source["size"] for task in tasks[:2]], [400000, 300000])
+    self.assertLess(tasks[1].start_time, tasks[0].end_time)
+    pass
+
+  def test_copy_sidecars(self):
+    source_path = self.sources[1]["fullpath"]
+    with open(get_image_metadata_path(source_path), "w") as metadata:
+      json.dump({"fileSystem": "ext4", "partitionSize": 1000000}, metadata)
+      pass
+    filestat = os.stat(source_path)
+    write_image_index(source_path, {"fileSystem": "ext4", "imageSize": filestat.st_size, "imageMtime": filestat.st_mtime})
+
+    runner, ui = self._make_runner(max_per_destination=2)
+    runner._run_copy_pool(ui)
+    self.assertEqual(len(ui.successes), len(self.sources))
+    for part in self.partitions:
+      copied = os.path.join(part.get_mount_point(), "usr", "local", "share", "wce", "wce-disk-images", "triage", self.sources[1]["name"])
+      self.assertEqual(read_image_metadata(copied)["fileSystem"], "ext4")
+      # The index is still current for the copy.
+      self.assertEqual(read_image_index(copied)["fileSystem"], "ext4")
+      pass
+    pass
+
+  def test_copy_limits(self):
+    runner, ui = self._make_runner(max_per_destination=1)
+    runner._run_copy_pool(ui)
+    self.assertEqual(len(ui.successes), len(self.sources))
+    # Every copy writes to /dev/sdy, so they run one at a time.
+    tasks = sorted(runner.copy_tasks, key=lambda task: task.start_time)
+    for earlier, later in zip(tasks, tasks[1:]):
+      self.assertLessEqual(earlier.end_time, later.start_time)
+      pass
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
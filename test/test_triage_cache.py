@@ -0,0 +1,68 @@
+import unittest
+import tempfile
+import shutil
+import os
+
+from wce_triage.config.config_db import sqlite3_db
+from wce_triage.lib.triage_cache import *
+
+
+class Test_TriageCache(unittest.TestCase):
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.db_file = os.path.join(self.tempdir, "cache.db")
+    pass
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+    pass
+
+  def make_cache(self, fingerprint="abc", ttl=3600):
+    return TriageCache(db=sqlite3_db(db_file=self.db_file), ttl=ttl, machine="product_uuid:1234", fingerprint=fingerprint)
+
+  def test_save_load(self):
+    cache = self.make_cache()
+    self.assertIsNone(cache.load("triage"))
+    snapshot = {"decision": True, "decisions": [{"component": "CPU", "result": True, "message": "it's 'quoted'"}]}
+    cache.save("triage", snapshot)
+    self.assertEqual(self.make_cache().load("triage"), snapshot)
+    pass
+
+  def test_fingerprint_changed(self):
+    self.make_cache().save("triage", {"decision": True})
+    self.assertIsNone(self.make_cache(fingerprint="xyz").load("triage"))
+    pass
+
+  def test_expired(self):
+    self.make_cache().save("triage", {"decision": True})
+    self.assertIsNone(self.make_cache(ttl=-1).load("triage"))
+    pass
+
+  def test_invalidate(self):
+    cache = self.make_cache()
+    cache.save("triage", {"decision": True})
+    cache.save("cpu_info", {"rating": 2.0})
+    cache.invalidate("triage")
+    self.assertIsNone(cache.load("triage"))
+    self.assertEqual(cache.load("cpu_info"), {"rating": 2.0})
+    cache.invalidate()
+    self.assertIsNone(cache.load("cpu_info"))
+    pass
+
+  def test_machine_identity(self):
+    dmi_dir = os.path.join(self.tempdir, "dmi")
+    os.mkdir(dmi_dir)
+    with open(os.path.join(dmi_dir, "product_uuid"), "w") as uuid_f:
+      uuid_f.write("00000000-0000-0000-0000-000000000000\n")
+      pass
+    with open(os.path.join(dmi_dir, "product_serial"), "w") as serial_f:
+      serial_f.write("CNU1234XYZ\n")
+      pass
+    self.assertEqual(get_machine_identity(dmi_dir=dmi_dir), "product_serial:cnu1234xyz")
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,128 @@
+import unittest
+import tempfile
+import shutil
+import signal
+import subprocess
+import time
+import json
+import stat
+import sys
+import os
+
+from wce_triage.lib import worker_pool
+
+
+class Test_WorkerPool(unittest.TestCase):
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.socket_path = os.path.join(self.tempdir, "pool.sock")
+    env = os.environ.copy()
+    env["PYTHONPATH"] = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(worker_pool.__file__))))
+    # Job module of test_atexit
+    with open(os.path.join(self.tempdir, "atexit_job.py"), "w") as job:
+      job.write("import atexit\natexit.register(lambda: print('atexit ran'))\nprint('job ran')\n")
+      pass
+    self.server = subprocess.Popen([sys.executable, "-m", "wce_triage.lib.worker_pool", "--socket", self.socket_path, "--preload", "json.tool"],
+                                   env=env, cwd=self.tempdir, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while not os.path.exists(self.socket_path) and time.time() < deadline:
+      time.sleep(0.05)
+      pass
+    self.saved_env = os.environ.get(worker_pool.WORKER_POOL_SOCKET_ENV)
+    self.saved_pythonpath = os.environ.get("PYTHONPATH")
+    os.environ["PYTHONPATH"] = env["PYTHONPATH"]
+    pass
+
+  def tearDown(self):
+    self.server.terminate()
+    self.server.wait()
+    for name, value in [(worker_pool.WORKER_POOL_SOCKET_ENV, self.saved_env), ("PYTHONPATH", self.saved_pythonpath)]:
+      if value is None:
+        os.environ.pop(name, None)
+      else:
+        os.environ[name] = value
+        pass
+      pass
+    shutil.rmtree(self.tempdir)
+    pass
+
+  def _spawn(self, module, args=[], **kwargs):
+    return worker_pool.PooledProcess(self.socket_path, module, args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
+
+  def test_stdout(self):
+    job = self._spawn("json.tool")
+    self.assertIsNotNone(job.pid)
+    job.stdin.write(b'{"runner": "loadimage", "step": 3}')
+    job.stdin.close()
+    self.assertEqual(json.loads(job.stdout.read().decode("utf-8")), {"runner": "loadimage", "step": 3})
+    self.assertEqual(job.wait(10), 0)
+    self.assertEqual(job.poll(), 0)
+    pass
+
+  def test_exit_code(self):
+    job = self._spawn("json.tool")
+    job.stdin.write(b"not json")
+    job.stdin.close()
+    self.assertNotEqual(job.stderr.read(), b"")
+    self.assertEqual(job.wait(10), 1)
+    pass
+
+  def test_terminate(self):
+    job = self._spawn("json.tool")
+    self.assertIsNone(job.poll())
+    with self.assertRaises(subprocess.TimeoutExpired):
+      job.wait(0.2)
+      pass
+    job.terminate()
+    self.assertEqual(job.wait(10), -signal.SIGTERM)
+    pass
+
+  def test_atexit(self):
+    job = self._spawn("atexit_job")
+    job.stdin.close()
+    self.assertEqual(job.stdout.read(), b"job ran\natexit ran\n")
+    self.assertEqual(job.wait(10), 0)
+    pass
+
+  def test_socket_dir(self):
+    server = worker_pool.start_worker_pool(modules=[])
+    self.assertIsNotNone(server)
+    socket_path = os.environ[worker_pool.WORKER_POOL_SOCKET_ENV]
+    socket_dir = os.path.dirname(socket_path)
+    self.assertTrue(os.path.basename(socket_dir).startswith(worker_pool.SOCKET_DIR_PREFIX))
+    # Nobody else can get to the socket.
+    self.assertEqual(stat.S_IMODE(os.stat(socket_dir).st_mode), 0o700)
+    job = worker_pool.popen(["python3", "-m", "wce_triage.lib.worker_pool", "--help"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    self.assertIsInstance(job, worker_pool.PooledProcess)
+    self.assertEqual(job.wait(10), 0)
+    job.stdout.close()
+    job.stderr.close()
+    server.terminate()
+    self.assertEqual(server.wait(10), 0)
+    self.assertFalse(os.path.exists(socket_dir))
+    pass
+
+  def test_popen(self):
+    self.assertEqual(worker_pool._get_pool_module(["python3", "-m", "wce_triage.bin.multiwipe", "/dev/sdx"]), "wce_triage.bin.multiwipe")
+    self.assertIsNone(worker_pool._get_pool_module(["python3", "-m", "json.tool"]))
+    self.assertIsNone(worker_pool._get_pool_module(["wget", "-q", "-O", "-", "http://example.com/"]))
+
+    os.environ[worker_pool.WORKER_POOL_SOCKET_ENV] = self.socket_path
+    job = worker_pool.popen(["python3", "-m", "wce_triage.lib.worker_pool", "--help"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    self.assertIsInstance(job, worker_pool.PooledProcess)
+    self.assertIn(b"Fork server", job.stdout.read())
+    self.assertEqual(job.wait(10), 0)
+
+    # No server. It's a process.
+    os.environ[worker_pool.WORKER_POOL_SOCKET_ENV] = os.path.join(self.tempdir, "none.sock")
+    job = worker_pool.popen(["python3", "-m", "wce_triage.lib.worker_pool", "--help"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    self.assertIsInstance(job, subprocess.Popen)
+    self.assertIn(b"Fork server", job.stdout.read())
+    self.assertEqual(job.wait(10), 0)
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,177 @@
+#!/usr/bin/python3
+#
+# Delta copy - copy a disk image to disks that have older images
+#
+# Instead of copying the whole image like fanout_copy, the chunks the older
+# images on the destination already have are copied from them, and only the
+# rest is read from the source. See lib/chunker for the chunking.
+# Progress report on stderr is the same as fanout_copy.
+#
+import os, sys, datetime, json, traceback
+import threading, time
+from ..lib.util import get_triage_logger, init_triage_logger
+from ..lib.timeutil import in_seconds
+from ..lib.disk_images import list_image_files
+from ..lib.chunker import get_manifest, get_copy_manifest, plan_delta, assemble, save_manifest
+from ..ops.run_state import RunState, RUN_STATE
+
+start_time = datetime.datetime.now()
+tlog = get_triage_logger()
+
+
+def get_source_copy(basis_path, source_path):
+  """Image in the source catalog that basis_path on the destination is a copy of.
+The catalog layout is <images>/<restoreType>/<name> on both."""
+  source_images_dir = os.path.dirname(os.path.dirname(source_path))
+  restore_type = os.path.basename(os.path.dirname(basis_path))
+  return os.path.join(source_images_dir, restore_type, os.path.basename(basis_path))
+
+
+def find_basis_images(dest_path):
+  """Images in the same catalog as the destination. dest_path is <images>/<restoreType>/<name>"""
+  images_dir = os.path.dirname(os.path.dirname(dest_path))
+  try:
+    images = list_image_files([images_dir])
+  except Exception as exc:
+    tlog.info("Listing images in %s failed: %s" % (images_dir, str(exc)))
+    return []
+  return [ fullpath for fname, subdir, fullpath in images if fullpath != dest_path and os.path.isfile(fullpath) ]
+
+
+class DeltaCopier(threading.Thread):
+  def __init__(self, source_path, source_manifest, key, dest_path):
+    self.source_path = source_path
+    self.manifest = source_manifest
+    self.key = key
+    self.dest_path = dest_path
+    self.total_bytes = source_manifest["size"]
+    self.written = 0
+    self.from_source = 0
+    self.from_basis = 0
+    self.state = RunState.Running
+    self.message = None
+    super().__init__()
+    pass
+
+  def _progress(self, written, from_source):
+    self.written = written
+    self.from_source = from_source
+    pass
+
+  def run(self):
+    try:
+      basis = []
+      for path in find_basis_images(self.dest_path):
+        try:
+          # Chunking the source copy is faster than reading the destination disk.
+          basis.append((path, get_copy_manifest(path, get_source_copy(path, self.source_path))))
+        except Exception as exc:
+          tlog.info("Chunking %s failed: %s" % (path, str(exc)))
+          pass
+        pass
+      plan = plan_delta(self.manifest, basis)
+      self.from_source, self.from_basis = assemble(self.source_path, self.dest_path, self.manifest, plan, progress=self._progress)
+      self.written = self.total_bytes
+      # The copy has the same chunks. Saves rehashing when it becomes the older image.
+      save_manifest(self.dest_path, dict(self.manifest, mtime=int(os.stat(self.dest_path).st_mtime)))
+      self.state = RunState.Success
+    except Exception as exc:
+      tlog.info("Delta copy to %s failed.\n%s" % (self.dest_path, traceback.format_exc()))
+      self.message = str(exc)
+      self.state = RunState.Failed
+      pass
+    pass
+
+  def make_report(self):
+    dt_elapsed = in_seconds(datetime.datetime.now() - start_time)
+    speed = self.written / dt_elapsed if dt_elapsed > 0 else 0
+    if speed == 0:
+      speed = 2 ** 24
+      pass
+
+    report = {"key": self.key,
+              "destination": self.dest_path,
+              "runStatus": RUN_STATE[self.state.value] }
+
+    if self.state is RunState.Running:
+      report["totalBytes"] = self.written
+      report["runMessage"] = "Assembled %d of %d bytes. %d bytes from source. (%dMB/sec)" % (self.written, self.total_bytes, self.from_source, round(speed/(2**20), 1))
+      report["progress"] = min(99, max(1, round(100 * self.written / max(1, self.total_bytes))))
+      report["remainingBytes"] = self.total_bytes - self.written
+      report["runEstimate"] = round(dt_elapsed + report["remainingBytes"] / speed)
+    elif self.state is RunState.Success:
+      report["totalBytes"] = self.total_bytes
+      report["runMessage"] = "Copying completed (%d bytes copied, %d bytes from older images.)" % (self.from_source, self.from_basis)
+      report["verdict"] = "Delta copy reused %d of %d bytes from older images." % (self.from_basis, self.total_bytes)
+      report["progress"] = 100
+      report["remainingBytes"] = 0
+      report["runEstimate"] = round(dt_elapsed)
+    else:
+      report["totalBytes"] = self.written
+      report["runMessage"] = "Copying failed at %d. %s" % (self.written, self.message)
+      report["progress"] = 999
+      report["remainingBytes"] = 0
+      report["runEstimate"] = 0
+      pass
+    return report
+  pass
+
+
+def _report(report, output):
+  current_time = datetime.datetime.now()
+  report["startTime"] = start_time.isoformat()
+  report["currentTime"] = current_time.isoformat()
+  report["runTime"] = in_seconds(current_time - start_time)
+  print(json.dumps(report), file=output, flush=True)
+  pass
+
+
+def delta_copy(source_path, destinations, output=sys.stderr):
+  """destinations are "key:path" as fanout_copy. Returns exit code."""
+  manifest = get_manifest(source_path)
+
+  copiers = []
+  for dest in destinations:
+    key, _, dest_path = dest.rpartition(':')
+    copiers.append(DeltaCopier(source_path, manifest, key if key else None, dest_path))
+    pass
+
+  for copier in copiers:
+    copier.start()
+    pass
+
+  # Reports the finished one only once at the end since the task adds up the completed bytes.
+  while [ copier for copier in copiers if copier.is_alive() ]:
+    for copier in copiers:
+      if copier.state is RunState.Running:
+        _report(copier.make_report(), output)
+        pass
+      pass
+    time.sleep(1)
+    pass
+
+  for copier in copiers:
+    copier.join()
+    _report(copier.make_report(), output)
+    pass
+  return 0 if all([ copier.state is RunState.Success for copier in copiers ]) else 1
+
+
+if __name__ == "__main__":
+  tlog = init_triage_logger()
+  if len(sys.argv) < 3:
+    usage = '''delta_copy.py source_file destination [destination...]
+  desination:
+    key:destination file path
+    key is used to ID the copying file.'''
+    sys.stderr.write(usage)
+    sys.exit(1)
+    pass
+
+  try:
+    sys.exit(delta_copy(sys.argv[1], sys.argv[2:]))
+  except Exception as exc:
+    sys.stdout.write(traceback.format_exc())
+    sys.exit(1)
+    pass
+  pass
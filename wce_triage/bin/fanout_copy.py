@@ -2,14 +2,14 @@
 
 import os, sys, datetime, json, traceback, signal, stat
 import threading
-from ..lib.util import init_triage_logger
+from ..lib.util import get_triage_logger, init_triage_logger
 from ..lib.timeutil import in_seconds
 from ..ops.run_state import RunState, RUN_STATE
 import queue
 import time
 
 start_time = datetime.datetime.now()
-tlog = init_triage_logger()
+tlog = get_triage_logger()
 debugging = False
 
 def handler_stop_signals(signum, frame):
@@ -333,6 +333,7 @@ class fanout_copy:
   
   
 if __name__ == "__main__":
+  tlog = init_triage_logger()
   if len(sys.argv) < 2:
     usage = '''fanout_copy.py source_file destination[,destination...]
   desination:
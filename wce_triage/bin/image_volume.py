@@ -6,15 +6,35 @@
 # The status goes to the stderr. To make things simple, all of status
 # is prefixed and each status is a single line.
 #
-import os, sys, subprocess, urllib
+import os, sys, subprocess, argparse, threading, json
 
-import urllib.parse
+from ..lib.util import is_block_device, get_file_compression_app, init_triage_logger
+from ..lib.capture_tee import CaptureTee, FileSink, make_sink
 
-from ..lib.util import is_block_device, get_file_compression_app
+from ..bin.process_driver import drive_process, PipeInfo, Printer
 
-from ..bin.process_driver import drive_process, PipeInfo
+# Seconds between the sink stats
+TEE_REPORT_INTERVAL = 5
+
+
+def _report_tee(tee, printer, done):
+  while not done.wait(TEE_REPORT_INTERVAL):
+    printer.print_progress("tee: " + json.dumps(tee.stats()))
+    pass
+  pass
+
+
+def save_disk(source, dests, filesystem=None, encoding='iso-8859-1'):
+  """dests: list of destinations. Each is a file path, URL [?user=<usename>&password=<password>]
+or '-' for stdout. (A single destination can be given as string.)
+When there are more than one, or the destination is not a plain file, the
+compressed image goes through lib/capture_tee. The first destination is the
+one that must succeed. Failure of the others is reported but does not fail
+the imaging."""
+  if isinstance(dests, str):
+    dests = [dests]
+    pass
 
-def save_disk(source, dest, filesystem=None, encoding='iso-8859-1'):
   if not is_block_device(source):
     return 1
 
@@ -23,51 +43,28 @@ def save_disk(source, dest, filesystem=None, encoding='iso-8859-1'):
     print(partclone_path + " does not exist.")
     return 1
 
-  # compressor to use (gzip!)
-  comp = get_file_compression_app(dest)
-
-  # curl
-  parsed = urllib.parse.urlsplit(dest)
-  if parsed.scheme:
-    remotedest = urllib.parse.urljoin(dest, ".")
-    
-    addtions = []
-
-    if parsed.query:
-      params = urllib.parse.parse_qs(parsed.query)
-      user = params.get('user')[0]
-      password = params.get('password')[0]
-      if user and password:
-        addtions = [ "--user", "%s:%s" % (user, password) ]
-        pass
-      pass
-      
-    remotedest = urllib.parse.urlunsplit(parsed._replace(query="", fragment=""))
-    # the input is always stdin
-    argv_curl = [ "curl", "-s", "-T", "-", remotedest] + addtions
-    pass
-  else:
-    argv_curl = None
-    pass
+  # compressor to use (gzip!) - All destinations get the same stream.
+  comp = get_file_compression_app(dests[0])
 
   # When the compessor is used, it always reads from partclone's stdout
-  # The compressor output is always a pipe, to actual file, or curl
+  # The compressor output is always a pipe to the tee.
   if comp:
     argv_comp = comp[0] + comp[1]
     pass
   else:
     argv_comp = None
-    # Let partclone write to the local file.
     pass
 
-  # When compressor or curl exists, partclone outputs to stdout.
-  # When this is standalone, then, the actual file.
-  # If the destination is stdout, it's still goes through compressor.
-  if argv_comp or argv_curl or dest == '-':
+  sinks = [ make_sink(dest) for dest in dests ]
+  # Single local file without compressor - let partclone write to the local file.
+  teeing = argv_comp or len(dests) > 1 or not isinstance(sinks[0], FileSink)
+
+  # When compressor or tee exists, partclone outputs to stdout.
+  if teeing:
     partclone_output = "-"
     partclone_stdout = subprocess.PIPE
   else:
-    partclone_output = dest
+    partclone_output = dests[0]
     partclone_stdout = None
     pass
 
@@ -86,17 +83,10 @@ def save_disk(source, dest, filesystem=None, encoding='iso-8859-1'):
 
   # Now the compressor.
   # Input is always the partclone's stdout when the compressor exists.
-  if argv_comp or dest == '-':
-    if argv_curl:
-      comp_stdout = subprocess.PIPE
-    else:
-      if dest == '-':
-        comp_stdout = sys.stdout
-      else:
-        comp_stdout = open(dest, "wb")
-        pass
-      pass
-    comp = subprocess.Popen(argv_comp, stdin=partclone.stdout, stdout=comp_stdout, stderr=subprocess.PIPE)
+  if argv_comp:
+    comp = subprocess.Popen(argv_comp, stdin=partclone.stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    # Only the compressor reads it now.
+    partclone.stdout.close()
     processes.append((argv_comp[0], comp))
     pipes.append(PipeInfo(argv_comp[0], comp, "stderr", comp.stderr))
     pass
@@ -104,33 +94,43 @@ def save_disk(source, dest, filesystem=None, encoding='iso-8859-1'):
     comp = None
     pass
 
-  # Start curl
-  if argv_curl:
-    curl_input = comp.stdout if comp else partclone.stdout
-    print ("IMAGER: Exec " + " ".join(argv_curl))
-    curl = subprocess.Popen(argv_curl, stdin=curl_input, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    processes.append(("curl", curl))
-    # Curl's stdout/err not used at all. Listen to both.
-    pipes.append(PipeInfo("curl", curl, "stdout", curl.stdout))
-    pipes.append(PipeInfo("curl", curl, "stderr", curl.stderr))
+  if not teeing:
+    # all the processes are up. Drive them.
+    return drive_process("IMAGER", processes, pipes)
+
+  printer = Printer("IMAGER")
+  tee = CaptureTee(comp.stdout if comp else partclone.stdout, sinks)
+  tee.start()
+  done = threading.Event()
+  reporter = threading.Thread(target=_report_tee, args=(tee, printer, done), daemon=True)
+  reporter.start()
+
+  retcode = drive_process("IMAGER", processes, pipes)
+  if retcode != 0 and tee.is_alive():
+    tee.stop()
     pass
-  else:
-    curl = None
+  failed = tee.join()
+  done.set()
+  printer.print_progress("tee: " + json.dumps(tee.stats()))
+  for sink in failed:
+    printer.print_error("Saving to %s failed. %s" % (sink.name, sink.error))
     pass
-
-  # all the processes are up. Drive them.
-  return drive_process("IMAGER", processes, pipes)
+  if retcode == 0 and sinks[0] in failed:
+    retcode = 1
+    pass
+  return retcode
 
 
 if __name__ == "__main__":
-  if len(sys.argv) != 4:
-    sys.stderr.write('''image_volume.py <source> [ext4|fat32] <dest>\n  source: device file\n  dest: URL [?user=<usename>&password=<password>] or '-' for stdout\n''')
-    sys.exit(1)
-    pass
-    
-  if not is_block_device(sys.argv[1]):
-    sys.stderr.write("%s is not a block device.\n" % sys.argv[1])
+  init_triage_logger()
+  parser = argparse.ArgumentParser(description="Create partclone image of the device.")
+  parser.add_argument("source", help="device file")
+  parser.add_argument("filesystem", help="ext4 or fat32")
+  parser.add_argument("dests", nargs="+", help="URL [?user=<usename>&password=<password>], file path or '-' for stdout. When more than one is given, the image is saved to all of them in one pass.")
+  args = parser.parse_args()
+
+  if not is_block_device(args.source):
+    sys.stderr.write("%s is not a block device.\n" % args.source)
     sys.exit(1)
     pass
-  sys.exit(save_disk(sys.argv[1], sys.argv[3], filesystem=sys.argv[2]))
-  
+  sys.exit(save_disk(args.source, args.dests, filesystem=args.filesystem))
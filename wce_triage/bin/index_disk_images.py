@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+#
+# Makes the index of disk images. (lib/image_index)
+#
+# Run once after the images are copied to the server. An image that already
+# has the current index is skipped. EFI images (.efi-*) are indexed too.
+#
+import os, sys, json
+from argparse import ArgumentParser
+from ..lib.util import get_triage_logger, init_triage_logger
+from ..lib.disk_images import get_maybe_disk_image_directories, IMAGE_META_JSON_FILE
+from ..lib.image_index import index_image, IMAGE_INDEX_SUFFIX
+
+tlog = get_triage_logger()
+
+IMAGE_SUFFIXES = [ ".partclone.gz", ".partclone.xz", ".partclone" ]
+
+
+def find_images(dirs):
+  """Image files in the catalog directories"""
+  images = []
+  for a_dir in dirs:
+    for catalog in sorted(os.listdir(a_dir)):
+      catalog_dir = os.path.join(a_dir, catalog)
+      if not os.path.isdir(catalog_dir) or not os.path.exists(os.path.join(catalog_dir, IMAGE_META_JSON_FILE)):
+        continue
+      for filename in sorted(os.listdir(catalog_dir)):
+        if filename.endswith(IMAGE_INDEX_SUFFIX):
+          continue
+        if [ suffix for suffix in IMAGE_SUFFIXES if filename.endswith(suffix) ]:
+          images.append(os.path.join(catalog_dir, filename))
+          pass
+        pass
+      pass
+    pass
+  return images
+
+
+def index_disk_images(dirs, force=False):
+  n_failed = 0
+  for image in find_images(dirs):
+    index = index_image(image, force=force)
+    if index is None:
+      n_failed += 1
+      print("%s: not indexed" % image, file=sys.stderr, flush=True)
+      continue
+    print("%s: %s" % (image, json.dumps({ key: index[key] for key in ["fileSystem", "usedSize", "minPartitionSize"] })), flush=True)
+    pass
+  return n_failed
+
+
+if __name__ == "__main__":
+  tlog = init_triage_logger()
+  parser = ArgumentParser(description="Index the disk images.")
+  parser.add_argument("dirs", nargs="*", help="Disk image directories. Default is the wce-disk-images.")
+  parser.add_argument("-f", "--force", action="store_true", help="Index again even if there is the current index.")
+  args = parser.parse_args()
+
+  dirs = args.dirs if args.dirs else get_maybe_disk_image_directories()
+  sys.exit(1 if index_disk_images(dirs, force=args.force) else 0)
+  pass
@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+#
+# memory test
+#
+# Progress and result are printed in json as triageupdate so that the http
+# server can pass them to the UI as is.
+#
+import sys, json, time
+from argparse import ArgumentParser
+
+from ..lib.util import get_triage_logger, init_triage_logger
+from ..lib.memtest import run_memory_test, PATTERNS
+
+tlog = get_triage_logger()
+
+
+def reply_update(update):
+  jata = json.dumps( { "event": "triageupdate", "message": update } )
+  tlog.debug(jata)
+  print(jata)
+  sys.stdout.flush()
+  pass
+
+
+class Reporter(object):
+  """Throttles the progress report to once a second."""
+  def __init__(self):
+    self.report_time = 0
+    pass
+
+  def __call__(self, done_bytes, total_bytes):
+    now = time.monotonic()
+    if now - self.report_time < 1 and done_bytes < total_bytes:
+      return
+    self.report_time = now
+    progress = int(done_bytes * 100 / total_bytes) if total_bytes else 100
+    reply_update({"component": "Memory",
+                  "device": "memtest",
+                  "progress": progress,
+                  "message": "Memory test %d%%" % progress})
+    pass
+  pass
+
+
+def memory_test(fraction, size, patterns):
+  result = run_memory_test(fraction=fraction, size=size, patterns=patterns, progress=Reporter())
+
+  verdict = []
+  for error in result.errors:
+    if error["physical_address"] is not None:
+      where = "physical address 0x%x" % error["physical_address"]
+    else:
+      where = "worker %d offset 0x%x" % (error["worker"], error["offset"])
+      pass
+    verdict.append("%s: %s expected %s got %s" % (error["pattern"], where, error["expected"], error["actual"]))
+    pass
+  for worker, reason in result.failed_workers:
+    verdict.append("worker %d failed: %s" % (worker, reason))
+    pass
+
+  good = len(result.errors) == 0 and len(result.failed_workers) == 0
+  throughput = round(result.throughput / 2**20)
+  message = "Memory test %s: %dMB tested in %.1f seconds (%dMB/s)" % ("passed" if good else "FAILED",
+                                                                     result.tested_bytes // 2**20,
+                                                                     result.elapsed, throughput)
+  reply_update({"component": "Memory",
+                "device": "memtest",
+                "result": good,
+                "progress": 100,
+                "message": message,
+                "throughput": throughput,
+                "verdict": verdict})
+  return 0 if good else 1
+
+
+if __name__ == "__main__":
+  tlog = init_triage_logger()
+  parser = ArgumentParser(description="Memory test")
+  parser.add_argument("--fraction", type=float, default=0.5, help="Fraction of available memory to test.")
+  parser.add_argument("--size", type=int, default=None, help="Size to test in MB. Overrides --fraction.")
+  parser.add_argument("--patterns", type=str, default=",".join(PATTERNS))
+  args = parser.parse_args()
+  sys.exit(memory_test(args.fraction, args.size * 2**20 if args.size else None, args.patterns.split(",")))
+  pass
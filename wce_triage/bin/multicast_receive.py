@@ -0,0 +1,41 @@
+#!/usr/bin/python3
+#
+# Multicast receiver of disk image
+#
+# Writes the image from the multicast session to stdout in order. This is
+# the first stage of restore_volume's pipeline in place of wget.
+#
+import os, sys, traceback, urllib.parse
+from argparse import ArgumentParser
+
+from ..lib.util import get_triage_logger, init_triage_logger
+from ..lib.multicast import MulticastReceiver, DEFAULT_MULTICAST_GROUP, DEFAULT_MULTICAST_PORT
+
+tlog = get_triage_logger()
+
+
+if __name__ == "__main__":
+  tlog = init_triage_logger()
+  parser = ArgumentParser(description="Receive disk image from multicast group.")
+  parser.add_argument("source", help="http url of the image. The file name picks the multicast session.")
+  parser.add_argument("--group", default=DEFAULT_MULTICAST_GROUP)
+  parser.add_argument("--port", type=int, default=DEFAULT_MULTICAST_PORT)
+  parser.add_argument("--interface", default=None, help="IP address of interface to receive.")
+  parser.add_argument("--announce-timeout", type=float, dest="announce_timeout", default=5.0,
+                      help="Seconds to wait for the session. After that, the image is loaded with http.")
+  args = parser.parse_args()
+
+  name = os.path.basename(urllib.parse.urlsplit(args.source).path)
+  try:
+    receiver = MulticastReceiver(name, sys.stdout.buffer, url=args.source, group=args.group, port=args.port,
+                                 interface=args.interface, announce_timeout=args.announce_timeout)
+    result = receiver.run()
+    sys.stdout.buffer.flush()
+    sys.stderr.write("multicast %d blocks, unicast %d bytes\n" % (receiver.multicast_blocks, receiver.unicast_bytes))
+  except Exception as exc:
+    tlog.info(traceback.format_exc())
+    sys.stderr.write(traceback.format_exc())
+    result = 1
+    pass
+  sys.exit(result)
+  pass
@@ -0,0 +1,56 @@
+#!/usr/bin/python3
+#
+# Multicast sender of disk image
+#
+# Sends the image file to the multicast group once for all of receivers
+# (restore_volume --multicast), and serves the repairs. Progress is printed
+# on stderr as json.
+#
+import sys, json, signal, traceback
+from argparse import ArgumentParser
+
+from ..lib.util import get_triage_logger, init_triage_logger
+from ..lib.multicast import MulticastSender, DEFAULT_MULTICAST_GROUP, DEFAULT_MULTICAST_PORT, DEFAULT_RATE, DEFAULT_BLOCK_SIZE
+
+tlog = get_triage_logger()
+
+
+def report_progress(sender):
+  report = { "name": sender.name,
+             "session": sender.session,
+             "progress": round(100 * sender.position / max(1, sender.n_blocks)),
+             "rate": round(sender.rate),
+             "sentBlocks": sender.sent_blocks,
+             "repairedBlocks": sender.repaired_blocks,
+             "nakBlocks": sender.nak_blocks,
+             "finished": sender.finished }
+  print(json.dumps({ "event": "multicast", "message": report }), file=sys.stderr, flush=True)
+  pass
+
+
+if __name__ == "__main__":
+  tlog = init_triage_logger()
+  parser = ArgumentParser(description="Send disk image to multicast group.")
+  parser.add_argument("image", help="Disk image file")
+  parser.add_argument("--url", help="http url of the image for the late joiners and repairs.")
+  parser.add_argument("--group", default=DEFAULT_MULTICAST_GROUP)
+  parser.add_argument("--port", type=int, default=DEFAULT_MULTICAST_PORT)
+  parser.add_argument("--interface", default=None, help="IP address of interface to send.")
+  parser.add_argument("--rate", type=int, default=DEFAULT_RATE, help="Max rate in bytes/sec.")
+  parser.add_argument("--block-size", type=int, dest="block_size", default=DEFAULT_BLOCK_SIZE)
+  parser.add_argument("--linger", type=float, default=10.0, help="Seconds to wait for repair requests after sending all.")
+  args = parser.parse_args()
+
+  try:
+    sender = MulticastSender(args.image, url=args.url, group=args.group, port=args.port, rate=args.rate,
+                             block_size=args.block_size, interface=args.interface, linger=args.linger)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sender.stop())
+    sender.run(progress=report_progress)
+    report_progress(sender)
+  except Exception as exc:
+    tlog.info(traceback.format_exc())
+    sys.stderr.write(traceback.format_exc())
+    sys.exit(1)
+    pass
+  sys.exit(0)
+  pass
@@ -2,13 +2,15 @@
 
 import os, sys, datetime, json, traceback, signal, subprocess
 import threading
-from ..lib.util import init_triage_logger
+from argparse import ArgumentParser
+from ..lib.util import get_triage_logger, init_triage_logger
+from ..lib.region_wipe import get_zero_method, zero_range, iterate_chunks, total_region_size, parse_regions, get_ext_free_regions
 from ..lib.timeutil import in_seconds
 from ..ops.run_state import RunState, RUN_STATE
 import time
 
 start_time = datetime.datetime.now()
-tlog = init_triage_logger()
+tlog = get_triage_logger()
 debugging = False
 
 zeros_size = 2 ** 22
@@ -100,6 +102,38 @@ n_sectors: number of sectors.
   pass
 
 
+class RegionWiper(Wiper):
+  def __init__(self, regions, fd, dest, method):
+    """zero wipes only the regions (byte offset, byte length) of dest."""
+    self.regions = regions
+    self.method = method
+    super().__init__(total_region_size(regions) // 512, fd, dest)
+    if self.n_sectors == 0:
+      # Nothing to wipe
+      self.running = False
+      pass
+    pass
+
+  def run(self):
+    debuglog("%s is starting. %d regions, %d sectors" % (self.dest, len(self.regions), self.n_sectors))
+    try:
+      for offset, length in iterate_chunks(self.regions):
+        if not self.running:
+          break
+        self.method = zero_range(self.device.fileno(), offset, length, self.method)
+        self.n_written += length // 512
+        pass
+      os.fsync(self.device.fileno())
+    except Exception as exc:
+      debuglog("Error zeroing %s\n%s" % (self.dest, traceback.format_exc()))
+      pass
+    self.running = False
+    self.device.close()
+    self.end_time = datetime.datetime.now()
+    pass
+  pass
+
+
 class Reporter(threading.Thread):
 
   def __init__(self, wipers, output=sys.stderr):
@@ -194,6 +228,26 @@ def get_disk_total_sectors(device):
   return n_sectors
 
 
+def region_wipe(dest, regions=None, ext_free=False):
+  '''Wipe the regions of disk or the free blocks of ext file system.
+'''
+  if ext_free:
+    regions = get_ext_free_regions(dest)
+    pass
+  debuglog("Region wipe of %s started. %d bytes" % (dest, total_region_size(regions)))
+
+  signal.signal(signal.SIGINT, handler_stop_signals)
+  wiper = RegionWiper(regions, open(dest, 'r+b', buffering=0), dest, get_zero_method(dest))
+  wiper.start()
+  wipers.append(wiper)
+
+  reporter = Reporter(wipers)
+  reporter.start()
+  wiper.join()
+  reporter.join()
+  return 0 if wiper.n_written == wiper.n_sectors else 1
+
+
 def zero_wipe(short_wipe, destination_specs):
   '''Wipe disks
 '''
@@ -274,20 +328,23 @@ def zero_wipe(short_wipe, destination_specs):
   
   
 if __name__ == "__main__":
-  if len(sys.argv) < 2:
-    sys.stderr.write('zerowipe.py [-s] <wiped...>\n')
-    sys.exit(1)
-    pass
-    
-  args = sys.argv[1:]
-  short_wipe = False
-  if args[0] == '-s':
-    short_wipe = True
-    args = args[1:]
-    pass
+  tlog = init_triage_logger()
+  parser = ArgumentParser(description="Zero wipe disks.")
+  parser.add_argument("destinations", nargs="+", help="Device files such as /dev/sdb")
+  parser.add_argument("-s", "--short", action="store_true", help="Wipes only the first 1MB.")
+  parser.add_argument("-r", "--regions", default=None, help="Wipes only the regions. offset:length,... in bytes")
+  parser.add_argument("-e", "--ext-free", action="store_true", help="Wipes only the free blocks of ext file system and the partition past it.")
+  args = parser.parse_args()
 
   try:
-    zero_wipe(short_wipe, args)
+    if args.regions is not None or args.ext_free:
+      if len(args.destinations) != 1:
+        parser.error("Region wipe takes one destination.")
+        pass
+      regions = parse_regions(args.regions) if args.regions is not None else None
+      sys.exit(region_wipe(args.destinations[0], regions=regions, ext_free=args.ext_free))
+      pass
+    zero_wipe(args.short, args.destinations)
   except Exception as exc:
     sys.stdout.write(traceback.format_exc())
     sys.exit(1)
@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+#
+# Restore partclone image to the partition without partclone.
+#
+# This takes the place of "partclone.<fs> -r -s - -o <dev>" in restore_volume.
+# The image is decoded by lib/partclone_image. When the image is not the
+# version it can decode, partclone is run and the stream is handed to it.
+#
+# The progress is printed in the partclone's format so that the restore task
+# reads it the same way. "Native decoder" line tells the restore task that the
+# progress is what is written, not what is read.
+#
+import os, sys, time, json, shutil, threading, subprocess, traceback
+from argparse import ArgumentParser
+from ..lib.util import get_triage_logger, init_triage_logger
+from ..lib.partclone_image import open_image, UnsupportedImage, DEFAULT_WRITERS
+
+tlog = get_triage_logger()
+
+# Seconds between the progress
+PROGRESS_INTERVAL = 2
+
+
+def _report_progress(decoder, done):
+  block_size = decoder.header["blockSize"]
+  while not done.wait(PROGRESS_INTERVAL):
+    stats = decoder.stats()
+    percent = 100.0 * stats["written"] / max(1, stats["total"])
+    print("current block: %d, total block: %d, Complete: %.2f%%" % (stats["written"] // block_size, stats["total"] // block_size, percent), file=sys.stderr, flush=True)
+    pass
+  pass
+
+
+def run_partclone(filesystem, consumed, source, dest):
+  """Hands the image to partclone. consumed is what is read from the source already."""
+  partclone_path = os.path.join('/', 'usr', 'sbin', 'partclone.%s' % filesystem)
+  if not os.path.exists(partclone_path):
+    print("%s does not exist." % partclone_path, file=sys.stderr, flush=True)
+    return 1
+  partclone = subprocess.Popen([partclone_path, "-f", "2", "-r", "-s", "-", "-o", dest], stdin=subprocess.PIPE)
+  try:
+    partclone.stdin.write(consumed)
+    shutil.copyfileobj(source, partclone.stdin, 2**20)
+    partclone.stdin.close()
+  except BrokenPipeError:
+    pass
+  return partclone.wait()
+
+
+def restore_partclone(source, dest, filesystem, writers=DEFAULT_WRITERS, direct=True):
+  try:
+    decoder = open_image(source, dest, writers=writers, direct=direct)
+  except UnsupportedImage as exc:
+    print("%s Using partclone." % str(exc), file=sys.stderr, flush=True)
+    return run_partclone(filesystem, exc.consumed, source, dest)
+
+  header = decoder.header
+  # partclone prints these, and the restore task waits for the file system line.
+  print("Native decoder: %d writers, %s" % (decoder.n_writers, "O_DIRECT" if decoder.direct else "buffered"), file=sys.stderr, flush=True)
+  print("File system:  %s" % header["fileSystem"], file=sys.stderr, flush=True)
+  print("Device size:  %d" % header["deviceSize"], file=sys.stderr, flush=True)
+  print("Space in use: %d" % (header["usedBlocks"] * header["blockSize"]), file=sys.stderr, flush=True)
+  print("Block size:   %d Byte" % header["blockSize"], file=sys.stderr, flush=True)
+
+  done = threading.Event()
+  reporter = threading.Thread(target=_report_progress, args=(decoder, done), daemon=True)
+  reporter.start()
+  started = time.monotonic()
+  error = decoder.run()
+  done.set()
+  stats = decoder.stats()
+  stats["seconds"] = round(time.monotonic() - started, 1)
+  print("current block: %d, total block: %d, Complete: %.2f%%" % (stats["written"] // header["blockSize"], stats["total"] // header["blockSize"], 100.0 if not error else 0.0), file=sys.stderr, flush=True)
+  print("decoder: " + json.dumps(stats), file=sys.stderr, flush=True)
+  if error:
+    print("Restore failed. %s" % error, file=sys.stderr, flush=True)
+    return 1
+  return 0
+
+
+if __name__ == "__main__":
+  tlog = init_triage_logger()
+  parser = ArgumentParser(description="Restore partclone image to the partition.")
+  parser.add_argument("-s", "--source", default="-", help="Image file. - for stdin.")
+  parser.add_argument("-o", "--output", required=True, help="Partition device file")
+  parser.add_argument("--filesystem", default="extfs", help="File system for partclone when the image is not decodable.")
+  parser.add_argument("--writers", type=int, default=DEFAULT_WRITERS, help="Number of writer threads")
+  parser.add_argument("--no-direct", action="store_true", help="Do not use O_DIRECT.")
+  args = parser.parse_args()
+
+  try:
+    source = sys.stdin.buffer if args.source == "-" else open(args.source, "rb")
+    sys.exit(restore_partclone(source, args.output, args.filesystem, writers=args.writers, direct=not args.no_direct))
+  except Exception as exc:
+    sys.stderr.write(traceback.format_exc())
+    sys.exit(1)
+    pass
+  pass
@@ -1,18 +1,42 @@
 #
 # 
 #
-import os, sys, subprocess
+import os, sys, subprocess, argparse, threading, json
 
-from ..lib.util import is_block_device, get_transport_scheme, get_file_decompression_app
-from .process_driver import drive_process, PipeInfo
+from ..lib.util import is_block_device, get_transport_scheme, get_file_decompression_app, init_triage_logger
+from ..lib.image_stream import open_image_stream, can_stream
+from ..lib.worker_pool import popen
+from .process_driver import drive_process, PipeInfo, Printer
 
+# Seconds between the stream stats
+STREAM_REPORT_INTERVAL = 5
 
-def load_disk(source, dest_dev, filesystem=None):
+
+def _report_stream(streamer, printer, done):
+  while not done.wait(STREAM_REPORT_INTERVAL):
+    printer.print_progress("stream: " + json.dumps(streamer.stats()))
+    pass
+  pass
+
+
+def load_disk(source, dest_dev, filesystem=None, multicast=None, stream=True, mirrors=None, native=False, prefetched=None):
+  """multicast: "GROUP:PORT" of multicast session. The image is received from
+the multicast instead of wget. The receiver falls back to http when there is
+no session.
+stream: http source is fetched and decompressed in this process (lib/image_stream)
+so that a broken connection is resumed. Otherwise wget and decompressor app.
+mirrors: URLs of the same image on other servers. The image is fetched in
+segments from all of them. (lib/segmented_download)
+native: the image is decoded by bin/restore_partclone instead of partclone.
+It runs partclone when the image is not decodable. Off until the decoder is
+checked against partclone's own restore of real images.
+prefetched: state file of the image prefetched by the runner. (lib/image_prefetch)
+Only for the streaming."""
   if not is_block_device(dest_dev):
     return 1
 
   partclone_path = os.path.join('/', 'usr', 'sbin', 'partclone.%s' % filesystem)
-  if not os.path.exists(partclone_path):
+  if not native and not os.path.exists(partclone_path):
     return 1
 
   bin_name = "LOADER"
@@ -25,7 +49,19 @@ def load_disk(source, dest_dev, filesystem=None):
   # The source is used up so mark it as "-"
 
   argv_wget = None
-  if transport_scheme:
+  fetcher_name = "wget"
+  streaming = False
+  if transport_scheme in ["http", "https"] and not multicast and stream and can_stream(source):
+    streaming = True
+    image_url = source
+    source = "-"
+    decomp = None
+  elif transport_scheme and multicast:
+    group, port = multicast.split(":")
+    fetcher_name = "multicast"
+    argv_wget = [ "python3", "-m", "wce_triage.bin.multicast_receive", "--group", group, "--port", port, source ]
+    source = "-"
+  elif transport_scheme:
     argv_wget = [ "wget", "-q", "-O", "-", source ]
     source = "-"
   else:
@@ -49,13 +85,17 @@ def load_disk(source, dest_dev, filesystem=None):
   pipes = []
 
   # So, for partclone, the source is whatever upstream hands down.
-  argv_partclone = [ partclone_path, "-f", "2", "-r", "-s", source, "-o", dest_dev ]
+  if native:
+    argv_partclone = [ "python3", "-m", "wce_triage.bin.restore_partclone", "--filesystem", filesystem, "-s", source, "-o", dest_dev ]
+  else:
+    argv_partclone = [ partclone_path, "-f", "2", "-r", "-s", source, "-o", dest_dev ]
+    pass
 
   # wire up the apps
   if argv_wget:
-    wget = subprocess.Popen(argv_wget, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    processes.append(("wget", wget))
-    pipes.append(PipeInfo("wget", wget, "stderr", wget.stderr))
+    wget = popen(argv_wget, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    processes.append((fetcher_name, wget))
+    pipes.append(PipeInfo(fetcher_name, wget, "stderr", wget.stderr))
     pass
   else:
     wget = None
@@ -76,32 +116,63 @@ def load_disk(source, dest_dev, filesystem=None):
     partclone_stdin = decomp.stdout
   elif wget:
     partclone_stdin = wget.stdout
+  elif streaming:
+    partclone_stdin = subprocess.PIPE
   else:
     if source == "-":
       raise Exception("the source should be a pipe to stdin.")
     partclone_stdin = None
     pass
 
-  partclone = subprocess.Popen(argv_partclone, stdin=partclone_stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-  processes.append((argv_partclone[0], partclone))
+  partclone = popen(argv_partclone, stdin=partclone_stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  processes.append(("restore_partclone" if native else argv_partclone[0], partclone))
   pipes.append(PipeInfo("partclone", partclone, "stdout", partclone.stdout))
   pipes.append(PipeInfo("partclone", partclone, "stderr", partclone.stderr))
 
-  # all the processes are up. Drive them.
-  return drive_process(bin_name, processes, pipes)
+  if not streaming:
+    # all the processes are up. Drive them.
+    return drive_process(bin_name, processes, pipes)
+
+  printer = Printer(bin_name)
+  streamer = open_image_stream(image_url, partclone.stdin, mirrors=mirrors, prefetched=prefetched)
+  streamer.start()
+  done = threading.Event()
+  reporter = threading.Thread(target=_report_stream, args=(streamer, printer, done), daemon=True)
+  reporter.start()
+
+  retcode = drive_process(bin_name, processes, pipes)
+  # partclone is gone. Nobody reads the stream anymore.
+  if streamer.is_alive():
+    streamer.stop()
+    pass
+  error = streamer.join(timeout=10)
+  done.set()
+  printer.print_progress("stream: " + json.dumps(streamer.stats()))
+  if error and retcode == 0:
+    printer.print_error("Image stream failed. " + error)
+    retcode = 1
+    pass
+  return retcode
 
 
 if __name__ == "__main__":
-  if len(sys.argv) != 4:
-    sys.stderr.write('restore_volume.py <source> [ext4|fat32] <destdev>\n  source: URL\n  destdev: device file\n')
-    sys.exit(1)
-    pass
-    
-  device = sys.argv[3]
+  init_triage_logger()
+  parser = argparse.ArgumentParser(description="Restore partclone image to the device.")
+  parser.add_argument("source", help="URL or file path of image")
+  parser.add_argument("filesystem", help="ext4 or fat32")
+  parser.add_argument("destdev", help="device file")
+  parser.add_argument("--multicast", default=None, metavar="GROUP:PORT", help="Receives the image from multicast session.")
+  parser.add_argument("--wget", action="store_true", help="Uses wget and decompressor app instead of fetching in process.")
+  parser.add_argument("--native", action="store_true", help="Decodes the image with bin/restore_partclone instead of partclone.")
+  parser.add_argument("--mirror", action="append", dest="mirrors", default=None, metavar="URL", help="URL of the same image on other server. Can be given more than once.")
+  parser.add_argument("--prefetched", default=None, metavar="STATE", help="State file of the prefetched head of image.")
+  args = parser.parse_args()
+
+  device = args.destdev
   if not is_block_device(device):
     sys.stderr.write("%s is not a block device.\n" % device)
     sys.exit(1)
     pass
 
-  sys.exit(load_disk(sys.argv[1], device, filesystem=sys.argv[2]))
+  sys.exit(load_disk(args.source, device, filesystem=args.filesystem, multicast=args.multicast, stream=not args.wget, mirrors=args.mirrors, native=args.native, prefetched=args.prefetched))
   pass
@@ -0,0 +1,305 @@
+#!/usr/bin/python3
+#
+# Surface scan - read test of disks
+#
+# Reads every disk concurrently with large aligned O_DIRECT reads, and
+# measures the latency of each read. Slow and unreadable LBA ranges are
+# reported. Progress is reported on stderr as json, the same way as multiwipe.
+#
+import os, sys, datetime, json, traceback, signal, mmap
+import threading, time
+from argparse import ArgumentParser
+from ..lib.util import get_triage_logger, init_triage_logger, open_direct
+from ..lib.timeutil import in_seconds
+from ..ops.run_state import RunState, RUN_STATE
+
+start_time = datetime.datetime.now()
+tlog = get_triage_logger()
+
+SECTOR_SIZE = 512
+DEFAULT_BLOCK_SIZE = 2 ** 20
+# When a block read fails, it's read again with this size to narrow down the bad range.
+RETRY_SIZE = 2 ** 16
+# Reads slower than this (ms) are flagged
+DEFAULT_SLOW_MS = 500
+# Number of regions the disk is divided into for the latency map
+N_REGIONS = 100
+
+# Latency histogram buckets in ms. The last one is for anything slower.
+HISTOGRAM_BUCKETS = [ 10, 50, 150, 500, 2000 ]
+HISTOGRAM_LABELS = [ "<10ms", "<50ms", "<150ms", "<500ms", "<2s", ">=2s", "error" ]
+
+scanners = []
+
+
+def handler_stop_signals(signum, frame):
+  for scanner in scanners:
+    scanner.stop_request()
+    pass
+  pass
+
+
+def merge_ranges(ranges):
+  """Merges (lba, count, ...) ranges that are adjacent."""
+  merged = []
+  for lba_range in sorted(ranges):
+    if merged and merged[-1][0] + merged[-1][1] >= lba_range[0]:
+      last = merged[-1]
+      end = max(last[0] + last[1], lba_range[0] + lba_range[1])
+      merged[-1] = [last[0], end - last[0]] + list(lba_range[2:])
+    else:
+      merged.append(list(lba_range))
+      pass
+    pass
+  return merged
+
+
+def sample_offsets(disk_size, block_size, n_samples):
+  """Evenly spread block offsets for the sampled scan."""
+  n_blocks = (disk_size + block_size - 1) // block_size
+  if n_samples is None or n_samples >= n_blocks:
+    return None
+  if n_samples <= 1:
+    return [0]
+  return sorted(set([ (i * (n_blocks - 1) // (n_samples - 1)) * block_size for i in range(n_samples) ]))
+
+
+class Scanner(threading.Thread):
+  def __init__(self, device, block_size=DEFAULT_BLOCK_SIZE, n_samples=None, slow_ms=DEFAULT_SLOW_MS):
+    '''reads the device and records the latency.
+device: Device file eg. /dev/sdc
+n_samples: if given, only reads this many blocks spread over the disk.
+'''
+    self.running = True
+    self.device = device
+    self.block_size = block_size
+    self.slow_ms = slow_ms
+    self.fd = open_direct(device)
+    self.disk_size = os.lseek(self.fd, 0, os.SEEK_END)
+    self.offsets = sample_offsets(self.disk_size, block_size, n_samples)
+    if self.offsets is None:
+      self.total_bytes = self.disk_size
+    else:
+      self.total_bytes = sum([ min(block_size, self.disk_size - offset) for offset in self.offsets ])
+      pass
+    self.n_read = 0
+    self.histogram = [0] * len(HISTOGRAM_LABELS)
+    self.region_latency = [ [0.0, 0] for _ in range(N_REGIONS) ] # sum ms, count
+    self.slow_ranges = []
+    self.bad_ranges = []
+    # mmap gives page aligned buffer which O_DIRECT needs.
+    self.buffer = mmap.mmap(-1, block_size)
+    self.end_time = None
+    super().__init__()
+    pass
+
+  def _read(self, offset, view):
+    os.lseek(self.fd, offset, os.SEEK_SET)
+    return os.readv(self.fd, [view])
+
+  def _record(self, offset, length, latency_ms):
+    bucket = len(HISTOGRAM_BUCKETS)
+    for index, limit in enumerate(HISTOGRAM_BUCKETS):
+      if latency_ms < limit:
+        bucket = index
+        break
+      pass
+    self.histogram[bucket] += 1
+    region = self.region_latency[min(N_REGIONS - 1, offset * N_REGIONS // max(1, self.disk_size))]
+    region[0] += latency_ms
+    region[1] += 1
+    if latency_ms >= self.slow_ms:
+      self.slow_ranges.append((offset // SECTOR_SIZE, length // SECTOR_SIZE, round(latency_ms)))
+      pass
+    pass
+
+  def _narrow_down(self, offset, length):
+    """The block read failed. Read it in smaller pieces to find the bad ranges."""
+    view = memoryview(self.buffer)
+    for sub_offset in range(0, length, RETRY_SIZE):
+      sub_length = min(RETRY_SIZE, length - sub_offset)
+      try:
+        self._read(offset + sub_offset, view[:sub_length])
+      except OSError:
+        self.bad_ranges.append((( offset + sub_offset) // SECTOR_SIZE, sub_length // SECTOR_SIZE))
+        pass
+      pass
+    view.release()
+    pass
+
+  def scan_block(self, offset):
+    length = min(self.block_size, self.disk_size - offset)
+    view = memoryview(self.buffer)
+    started = time.monotonic()
+    try:
+      self._read(offset, view[:length])
+      self._record(offset, length, (time.monotonic() - started) * 1000)
+    except OSError:
+      self.histogram[-1] += 1
+      view.release()
+      self._narrow_down(offset, length)
+      view = None
+      pass
+    if view is not None:
+      view.release()
+      pass
+    self.n_read += length
+    pass
+
+  def run(self):
+    try:
+      if self.offsets is None:
+        offsets = range(0, self.disk_size, self.block_size)
+      else:
+        offsets = self.offsets
+        pass
+      for offset in offsets:
+        if not self.running:
+          break
+        self.scan_block(offset)
+        pass
+    except Exception as exc:
+      tlog.info("Scanning %s failed.\n%s" % (self.device, traceback.format_exc()))
+      pass
+    self.running = False
+    os.close(self.fd)
+    self.end_time = datetime.datetime.now()
+    pass
+
+  def stop_request(self):
+    self.running = False
+    pass
+
+  def _report(self):
+    report = { "device": self.device,
+               "totalBytes": self.total_bytes,
+               "bytesRead": self.n_read,
+               "sampled": self.offsets is not None,
+               "running": self.running}
+    return report
+
+  def _result(self):
+    """Final result of scan"""
+    return { "histogram": dict(zip(HISTOGRAM_LABELS, self.histogram)),
+             "regions": [ round(total / count, 1) if count else None for total, count in self.region_latency ],
+             "slowRanges": merge_ranges(self.slow_ranges),
+             "badRanges": merge_ranges(self.bad_ranges) }
+  pass
+
+
+class Reporter(threading.Thread):
+
+  def __init__(self, scanners, output=sys.stderr):
+    self.running = True
+    self.output = output
+    self.scanners = scanners[:]
+    super().__init__()
+    pass
+
+  def run(self):
+    while self.running:
+      current_time = datetime.datetime.now()
+      dt_duration = in_seconds(current_time - start_time)
+
+      n_running = 0
+
+      for scanner in self.scanners:
+        report = scanner._report()
+        report["startTime"] = start_time.isoformat()
+        report["currentTime"] = current_time.isoformat()
+        report["runTime"] = round(dt_duration, 1)
+
+        total_bytes = report['totalBytes']
+        bytes_read = report['bytesRead']
+        speed = float(bytes_read) / max(0.1, dt_duration)
+        report["readSpeed"] = round(speed / 1000000, 1) # MB/s
+
+        if report['running']:
+          n_running += 1
+          progress = min(99, max(1, round(100 * float(bytes_read) / max(1, total_bytes))))
+          report["progress"] = progress
+          report["runMessage"] = "%d of %d MB read." % (bytes_read // 1000000, total_bytes // 1000000)
+          report["runStatus"] = RUN_STATE[RunState.Running.value]
+          time_remaining = float(total_bytes - bytes_read) / max(2**20, speed)
+          report["timeRemaining"] = round(time_remaining)
+          report["runEstimate"] = round(dt_duration + time_remaining, 1)
+        else:
+          report.update(scanner._result())
+          n_bad = len(report["badRanges"])
+          n_slow = len(report["slowRanges"])
+          if bytes_read == total_bytes and n_bad == 0:
+            run_state = RunState.Success
+            progress = 100
+            report["runMessage"] = "Scan completed. %d slow ranges." % n_slow
+          else:
+            run_state = RunState.Failed
+            progress = 999
+            report["runMessage"] = "Scan failed. %d unreadable ranges, %d slow ranges. (%d of %d MB read)" % (n_bad, n_slow, bytes_read // 1000000, total_bytes // 1000000)
+            pass
+          report["runStatus"] = RUN_STATE[run_state.value]
+          report["progress"] = progress
+          report["timeRemaining"] = 0
+          report["runEstimate"] = round(dt_duration, 1)
+          pass
+
+        msg = { "event": "surfacescan", "message": report }
+        print(json.dumps(msg), file=self.output, flush=True)
+        pass
+
+      if n_running == 0:
+        self.running = False
+        break
+      time.sleep(1)
+      pass
+    pass
+  pass
+
+
+def surface_scan(devices, block_size=DEFAULT_BLOCK_SIZE, n_samples=None, slow_ms=DEFAULT_SLOW_MS, output=sys.stderr):
+  '''Scan disks concurrently.'''
+  for device in devices:
+    try:
+      scanners.append(Scanner(device, block_size=block_size, n_samples=n_samples, slow_ms=slow_ms))
+    except Exception as exc:
+      tlog.info("Opening %s failed with following error.\n%s" % (device, traceback.format_exc()))
+      return 1
+    pass
+
+  signal.signal(signal.SIGINT, handler_stop_signals)
+  signal.signal(signal.SIGTERM, handler_stop_signals)
+
+  for scanner in scanners:
+    scanner.start()
+    pass
+
+  reporter = Reporter(scanners, output=output)
+  reporter.start()
+
+  for scanner in scanners:
+    scanner.join()
+    pass
+  reporter.join()
+
+  for scanner in scanners:
+    if scanner.bad_ranges or scanner.n_read != scanner.total_bytes:
+      return 1
+    pass
+  return 0
+
+
+if __name__ == "__main__":
+  tlog = init_triage_logger()
+  parser = ArgumentParser(description="Read test of disks.")
+  parser.add_argument("devices", nargs="+", help="Device files such as /dev/sdb")
+  parser.add_argument("-s", "--sample", type=int, default=None, help="Reads only this many blocks spread over the disk.")
+  parser.add_argument("--block-size", type=int, default=DEFAULT_BLOCK_SIZE // 1024, help="Read size in KiB.")
+  parser.add_argument("--slow", type=int, default=DEFAULT_SLOW_MS, help="Reads slower than this (ms) are reported.")
+  args = parser.parse_args()
+
+  try:
+    sys.exit(surface_scan(args.devices, block_size=args.block_size * 1024, n_samples=args.sample, slow_ms=args.slow))
+  except Exception as exc:
+    sys.stdout.write(traceback.format_exc())
+    sys.exit(1)
+    pass
+  pass
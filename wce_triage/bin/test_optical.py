@@ -4,12 +4,17 @@
 # good/bad is printed in json.
 # Since thing this does is too simple, I'll do kind of one-off.
 #
-import os, sys, subprocess, datetime, traceback
+# --raw reads the sectors of device directly instead of mounting the disc.
+# It's bounded by the time budget, and all drives are tested concurrently.
+#
+import os, sys, subprocess, datetime, traceback, time, random, mmap, errno
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from ..lib.util import init_triage_logger, is_block_device, get_test_password
+from ..lib.util import get_triage_logger, init_triage_logger, is_block_device, get_test_password, open_direct
 from ..lib.timeutil import in_seconds
 
-tlog = init_triage_logger()
+tlog = get_triage_logger()
 
 import json
 
@@ -131,12 +136,147 @@ def test_optical(password, source, encoding='iso-8859-1'):
   return 0
 
 
+#
+# Raw read test
+#
+OPTICAL_SECTOR_SIZE = 2048
+RAW_READ_SIZE = 32 * OPTICAL_SECTOR_SIZE
+N_OPTICAL_REGIONS = 10
+DEFAULT_TIME_BUDGET = 30
+# 1x speed in KB/s
+CD_1X = 150
+DVD_1X = 1385
+CD_MAX_SIZE = 900 * 2**20
+
+
+def _read_at(fd, offset, view):
+  os.lseek(fd, offset, os.SEEK_SET)
+  return os.readv(fd, [view])
+
+
+def raw_read_optical(source, time_budget=DEFAULT_TIME_BUDGET):
+  """Reads the disc in the drive for the time budget. First half is sequential
+read from the beginning for the sustained rate, and second half is random
+reads over the disc for the seek rate. Returns the triageupdate message."""
+  start_time = datetime.datetime.now()
+  result = {"component": "Optical drive", "device": source, "result": False, "verdict": []}
+  try:
+    fd = open_direct(source)
+  except OSError as exc:
+    if exc.errno == errno.ENOMEDIUM:
+      result["message"] = "No disc in %s." % source
+    else:
+      result["message"] = "Failed to open %s. %s" % (source, exc.strerror)
+      pass
+    return result
+
+  try:
+    disc_size = os.lseek(fd, 0, os.SEEK_END) // RAW_READ_SIZE * RAW_READ_SIZE
+    if disc_size == 0:
+      result["message"] = "No disc in %s." % source
+      return result
+
+    buffer = mmap.mmap(-1, RAW_READ_SIZE)
+    view = memoryview(buffer)
+    region_reads = [0] * N_OPTICAL_REGIONS
+    region_errors = [0] * N_OPTICAL_REGIONS
+
+    def read_block(offset):
+      region = offset * N_OPTICAL_REGIONS // disc_size
+      region_reads[region] += 1
+      try:
+        _read_at(fd, offset, view)
+        return True
+      except OSError:
+        region_errors[region] += 1
+        pass
+      return False
+
+    # Sustained
+    started = time.monotonic()
+    deadline = started + time_budget / 2
+    sequential_bytes = 0
+    offset = 0
+    while offset < disc_size and time.monotonic() < deadline:
+      if read_block(offset):
+        sequential_bytes += RAW_READ_SIZE
+        pass
+      offset += RAW_READ_SIZE
+      pass
+    sequential_elapsed = max(0.001, time.monotonic() - started)
+
+    # Seek
+    rand = random.Random(source)
+    n_blocks = disc_size // RAW_READ_SIZE
+    started = time.monotonic()
+    deadline = started + time_budget / 2
+    n_seeks = 0
+    while time.monotonic() < deadline:
+      read_block(rand.randrange(n_blocks) * RAW_READ_SIZE)
+      n_seeks += 1
+      pass
+    seek_elapsed = max(0.001, time.monotonic() - started)
+
+    view.release()
+    buffer.close()
+  finally:
+    os.close(fd)
+    pass
+
+  rate = sequential_bytes / 1000 / sequential_elapsed
+  one_x = CD_1X if disc_size <= CD_MAX_SIZE else DVD_1X
+  n_errors = sum(region_errors)
+  region_size = disc_size // N_OPTICAL_REGIONS // 2**20
+  for region in range(N_OPTICAL_REGIONS):
+    if region_errors[region]:
+      result["verdict"].append("Region %d (%d-%dMB): %d of %d reads failed" % (region, region * region_size, (region + 1) * region_size,
+                                                                              region_errors[region], region_reads[region]))
+      pass
+    pass
+
+  result["result"] = n_errors == 0 and sequential_bytes > 0
+  result["message"] = "The device %s %s: %dKB/s (%.1fx) sustained, %.1f seeks/s, %d read errors." % (
+    source, "passed the test" if result["result"] else "FAILED the test", rate, rate / one_x, n_seeks / seek_elapsed, n_errors)
+  result["sustainedRate"] = round(rate)
+  result["seekRate"] = round(n_seeks / seek_elapsed, 1)
+  result["regions"] = [ {"reads": reads, "errors": errors} for reads, errors in zip(region_reads, region_errors) ]
+  result["elapseTime"] = deltatime(start_time, datetime.datetime.now())
+  return result
+
+
+def test_optical_raw(sources, time_budget=DEFAULT_TIME_BUDGET):
+  """Tests the drives concurrently. Each result is printed as it comes."""
+  all_good = True
+  with ThreadPoolExecutor(max_workers=len(sources)) as pool:
+    futures = [ pool.submit(raw_read_optical, source, time_budget) for source in sources ]
+    for future in as_completed(futures):
+      result = future.result()
+      all_good = all_good and result["result"]
+      reply_update(result)
+      pass
+    pass
+  return 0 if all_good else 1
+
+
+def reply_update(update):
+  jata = json.dumps( { "event": "triageupdate", "message": update } )
+  tlog.debug(jata)
+  print(jata)
+  sys.stdout.flush()
+  pass
+
+
 if __name__ == "__main__":
-  if len(sys.argv) != 2:
-    sys.stderr.write('test_optical.py <source>\n  source: optical device file\n')
-    sys.exit(1)
+  tlog = init_triage_logger()
+  parser = ArgumentParser(description="Optical drive test")
+  parser.add_argument("sources", nargs="+", help="optical device file")
+  parser.add_argument("--raw", action="store_true", help="Reads the sectors directly instead of mounting the disc.")
+  parser.add_argument("--time-budget", type=float, dest="time_budget", default=DEFAULT_TIME_BUDGET, help="Seconds for the raw read test.")
+  args = parser.parse_args()
+
+  if args.raw:
+    sys.exit(test_optical_raw(args.sources, time_budget=args.time_budget))
     pass
-    
-  sys.exit(test_optical(get_test_password(), sys.argv[1]))
+  sys.exit(test_optical(get_test_password(), args.sources[0]))
   pass
 
@@ -22,6 +22,10 @@ from ..lib.util import get_triage_logger
 
 tlog = get_triage_logger()
 
+# Attribute of computer for each component type, in the order of components
+_component_attributes = [ ("CPU", "cpu"), ("Memory", "memory"), ("Video", "video"), ("Disk", "disk_portal"),
+                          ("Optical drive", "opticals"), ("Network", "networks"), ("Sound", "sound") ]
+
 
 class Computer(Component):
   """Computer class.
@@ -36,6 +40,18 @@ Computer is a component but also an aggregator of all of components on the compu
     self.live_system = False
     self.decisions = []
     self.decision = None
+    self.components = []
+    # Components are None until they are detected. With the triage cache,
+    # that's after the revalidation.
+    self.cpu = None
+    self.memory = None
+    self.disk_portal = None
+    self.video = None
+    self.networks = None
+    self.sound = None
+    self.opticals = None
+    # True when the decisions came from the triage cache
+    self.from_cache = False
     pass
 
   #
@@ -65,23 +81,150 @@ As a aggregator of components, it calls into the device detections and accumulat
     pass
 
 
-  def triage(self, live_system = False) -> bool:
+  def triage(self, live_system = False, cache = None) -> bool:
     """gathers info of computer, and decides the overall triage status.
 
 arg: live_system -> bool
+arg: cache -> lib.triage_cache.TriageCache or None
 
 live_system denotes this triage is done for live system.
 The difference between live/non-live system is, the mounted disk counts for live system while non-live triage excludes the monted disk.
+
+When the cache has the result for this machine, the result is used as is and
+the volatile parts need to be refreshed by calling revalidate().
 """
 
     # live_system denotes this triage is done for live system
     # The difference between live/non-live system is, the mounted disk
     # counts for live system while non-live triage excludes the monted disk.
     self.live_system = live_system
+
+    if cache:
+      snapshot = cache.load("triage")
+      if snapshot and snapshot.get("live_system") == live_system:
+        self.restore_snapshot(snapshot)
+        tlog.info("Triage result is from the cache.")
+        return self.decision
+      pass
+
     self.gather_info();
     self.make_decision()
+
+    if cache:
+      cache.save("triage", self.snapshot())
+      pass
     return self.decision
 
+  #
+  # TRIAGE CACHE
+  #
+  # Network carrier and disk mounts change from boot to boot, so they are
+  # volatile parts and not trusted from the cache.
+
+  def snapshot(self):
+    return { "live_system": self.live_system,
+             "decision": self.decision,
+             "decisions": self.decisions }
+
+  def restore_snapshot(self, snapshot):
+    """restores the decisions from the cached snapshot.
+
+Nothing is detected here, so that the cached result comes back right away.
+The components are detected by revalidate() (detect_volatile() and
+apply_revalidation()), which also makes the decisions of network and disk
+again.
+"""
+    self.decisions = snapshot["decisions"]
+    self.decision = snapshot["decision"]
+    self.from_cache = True
+    self.components = []
+    pass
+
+  def detect_volatile(self) -> dict:
+    """detects the volatile components again, and makes the decisions of them.
+When the components are not detected yet (triage cache), the rest of them is
+detected too, and the cached decisions are kept for them.
+
+This is slow (ip, udevadm, dmidecode) so it is meant to run in an executor
+after the cached triage result is returned. Nothing of the computer is
+changed here - the result is applied by apply_revalidation() in the thread
+that owns the computer.
+Returns { component_type: (component, decisions or None to keep them) }
+"""
+    detected = {}
+    for component in [_disk.DiskPortal(live_system=self.live_system), _network.Networks()]:
+      detected[component.get_component_type()] = (component, component.decision(live_system=self.live_system))
+      pass
+    if not self.components:
+      for component in [_cpu.CPU(), _memory.Memory(), _video.Video(), _optical_drive.OpticalDrives(), _sound.Sound()]:
+        detected[component.get_component_type()] = (component, None)
+        pass
+      pass
+    return detected
+
+  def apply_revalidation(self, detected, overall_changed = None) -> list:
+    """replaces the volatile components and their decisions with the detected ones.
+Returns the list of decisions that are refreshed.
+"""
+    refreshed = []
+    for component_type, (component, new_decisions) in detected.items():
+      if new_decisions is not None:
+        old_decisions = [ decision for decision in self.decisions if decision.get("component") == component_type ]
+        if new_decisions != old_decisions:
+          self._replace_decisions(component_type, new_decisions)
+          refreshed = refreshed + new_decisions
+          pass
+        pass
+      for attr_type, attr in _component_attributes:
+        if attr_type == component_type:
+          setattr(self, attr, component)
+          pass
+        pass
+      pass
+    self.components = [ getattr(self, attr) for attr_type, attr in _component_attributes if getattr(self, attr) is not None ]
+
+    new_decision = True
+    for decision in self.decisions:
+      if not decision.get("result"):
+        new_decision = False
+        break
+      pass
+
+    if new_decision != self.decision:
+      self.decision = new_decision
+      if overall_changed:
+        overall_changed(new_decision)
+        pass
+      pass
+    return refreshed
+
+  def revalidate(self, overall_changed = None) -> list:
+    """detects the volatile components again, and replaces the decisions of them.
+
+Same as detect_volatile() followed by apply_revalidation(), for the caller that
+owns the computer in the same thread.
+Returns the list of decisions that are refreshed.
+"""
+    return self.apply_revalidation(self.detect_volatile(), overall_changed=overall_changed)
+
+  def _replace_decisions(self, component_type, new_decisions):
+    decisions = []
+    inserted = False
+    for decision in self.decisions:
+      if decision.get("component") == component_type:
+        if not inserted:
+          decisions = decisions + new_decisions
+          inserted = True
+          pass
+        continue
+      decisions.append(decision)
+      pass
+    if not inserted:
+      decisions = decisions + new_decisions
+      pass
+    self.decisions = decisions
+    pass
+
   def make_decision(self):
     """making decision based on the components' decision. 
 
@@ -102,6 +245,43 @@ Overall decision (self.decision) is True only when every component decision is g
       pass
     return
 
+  def set_decision(self, keys, decision, overall_changed = None):
+    """sets the decision matching the keys, or adds it when there is none.
+
+This is for the optional tests (such as memory test) that have no decision until they run.
+"""
+    new_decision = dict(keys)
+    new_decision.update(decision)
+    for index in range(len(self.decisions)):
+      matched = True
+      for key, value in keys.items():
+        if self.decisions[index].get(key) != value:
+          matched = False
+          break
+        pass
+      if matched:
+        self.decisions[index] = new_decision
+        break
+      pass
+    else:
+      self.decisions.append(new_decision)
+      pass
+
+    overall = True
+    for decision in self.decisions:
+      if not decision.get("result"):
+        overall = False
+        break
+      pass
+
+    if overall != self.decision:
+      self.decision = overall
+      if overall_changed:
+        overall_changed(overall)
+        pass
+      pass
+    pass
+
   # This may be too invasive...
   def update_decision( self, keys, updates, overall_changed = None):
     """updating decision of component. 
@@ -6,6 +6,7 @@ import re, subprocess, traceback, time, os
 import json
 
 from ..lib.util import get_triage_logger
+from ..lib.smart import smart_verdict
 from .component import Component
 
 tlog = get_triage_logger()
@@ -177,6 +178,10 @@ class Disk:
     self.disappeared = False
     self.smart = False
     self.smart_enabled = False
+    # Final report of bin/surface_scan
+    self.surface_scan = None
+    # Health numbers from lib/smart
+    self.smart_health = None
 
     # These two will be redesigned. Need a better way.
     self.is_usb3 = False
@@ -687,11 +692,36 @@ class DiskPortal(Component):
           disk_msg += " - TOO SMALL"
           pass
         msg = msg + disk_msg 
+        decision = {"component": "Disk",
+                    "result": good_disk,
+                    "device": disk.device_name}
+
+        if disk.surface_scan:
+          scan = disk.surface_scan
+          bad_ranges = scan.get("badRanges", [])
+          slow_ranges = scan.get("slowRanges", [])
+          if bad_ranges:
+            decision["result"] = False
+            msg += " - SURFACE SCAN: %d UNREADABLE RANGES" % len(bad_ranges)
+          elif scan.get("runStatus") != "Success":
+            msg += " - Surface scan incomplete"
+          else:
+            msg += " - Surface scan %s%s" % ("sampled " if scan.get("sampled") else "", "OK" if not slow_ranges else "%d slow ranges" % len(slow_ranges))
+            pass
+          decision["verdict"] = [ "Unreadable LBA %d - %d" % (lba, lba + count - 1) for lba, count in bad_ranges ] + \
+                                [ "Slow LBA %d - %d (%d ms)" % (lba, lba + count - 1, latency) for lba, count, latency in slow_ranges ]
+          pass
+
+        if disk.smart_health:
+          smart_good, smart_msg = smart_verdict(disk.smart_health)
+          if not smart_good:
+            decision["result"] = False
+            pass
+          msg += " - " + smart_msg
+          pass
 
-        decisions.append( {"component": "Disk",
-                           "result": good_disk,
-                           "device": disk.device_name,
-                           "message": msg})
+        decision["message"] = msg
+        decisions.append(decision)
         pass
       pass
     return decisions
@@ -6,6 +6,7 @@
 import re, subprocess, os
 from .component import Component
 from ..lib.util import get_test_password, safe_string
+from ..lib.smbios import read_smbios, decode_memory_module, decode_memory_device, SMBIOS_TABLES_DIR
 
 from collections import namedtuple
 MemoryInfo = namedtuple('MemoryInfo', 'rams, ramtype, total, slots')
@@ -211,15 +212,47 @@ def _maybe_run_dmidecode():
   return out
 
 
+#
+# Get RAM info from SMBIOS table
+#
+def get_ram_info_from_smbios(smbios):
+  """picks off the memory info from parsed SMBIOS table. Returns the same tuple as get_ram_info."""
+  rams = []
+  for structure in smbios.find(6):
+    module = decode_memory_module(structure)
+    rams.append(RAM(socket=module.socket, size=module.enabled_size, status=module.error_status == "OK"))
+    pass
+
+  slots = []
+  for structure in smbios.find(17):
+    device = decode_memory_device(structure)
+    size = device.size if device.size else 0
+    slots.append(MemorySlot(slot=device.locator, size=size, status=size > 0, memtype=device.memtype))
+    pass
+
+  # Physical memory array (type 16) does not tell the memory type. detect_memory
+  # picks it up from the slots.
+  return (None, rams, sorted(slots))
+
+
 #
 # Get RAM info using dmidecode
 #
 def get_ram_info():
-  """runs 'dmidecode -t memory' command and parses the output to pick off the memory info.
+  """reads the SMBIOS table, or runs 'dmidecode -t memory' command and parses the output to pick off the memory info.
+
+SMBIOS table in sysfs is readable only by root. When it's not readable, dmidecode with sudo is used.
 
 Environ:
 WCETRIAGE_DMIDECODE_OUTPUT: If set, reads a text file as dmidecode output for testing.
+WCETRIAGE_SMBIOS_TABLES: If set, reads DMI and smbios_entry_point from the directory for testing.
 """
+  if not os.environ.get("WCETRIAGE_DMIDECODE_OUTPUT"):
+    smbios = read_smbios(os.environ.get("WCETRIAGE_SMBIOS_TABLES", SMBIOS_TABLES_DIR))
+    if smbios is not None:
+      return get_ram_info_from_smbios(smbios)
+    pass
+
   out =  _maybe_run_dmidecode()
 
   parse_state = 0
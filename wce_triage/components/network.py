@@ -11,6 +11,9 @@ import urllib.parse
 
 tlog = get_triage_logger()
 
+# Ethernet slower than this (Mb/s) is stuck at 10/100.
+GIGABIT = 1000
+
 class NetworkDeviceType(Enum):
   Unknown = 0
   Ethernet = 1
@@ -61,6 +64,19 @@ class NetworkDevice(object):
       pass
     return self.connected
 
+  def get_link_speed(self):
+    """Negotiated link speed in Mb/s. None when unknown (not connected, wifi, etc.)"""
+    try:
+      with open(os.path.join(self.device_node, "speed")) as speed_file:
+        speed = int(speed_file.read())
+        pass
+      if speed > 0:
+        return speed
+      pass
+    except:
+      pass
+    return None
+
   # Syntax sugar for triage needs
   def is_wifi(self):
     return self.device_type == NetworkDeviceType.Wifi
@@ -165,6 +181,13 @@ class Networks(Component):
           pass
         else:
           msg = "Network device '{dev}' detected{conn}".format(dev=netdev.device_name, conn=connected)
+          link_speed = netdev.get_link_speed()
+          if link_speed:
+            msg += " at {speed}Mb/s".format(speed=link_speed)
+            if link_speed < GIGABIT:
+              msg += " -- SLOW LINK. CHECK CABLE OR NIC"
+              pass
+            pass
           pass
         decisions.append({"component": self.get_component_type(),
                           "device": netdev.device_name,
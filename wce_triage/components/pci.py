@@ -2,10 +2,12 @@
 # Copyright (c) 2019 Naoyuki tai
 # MIT license - see LICENSE
 
-import re, subprocess, os
+import os
 
 from collections import namedtuple
-PCI_Device = namedtuple('PCI_Device', 'address, device_class, device_subclass, vendor, device')
+PCI_Device = namedtuple('PCI_Device', 'address, device_class, device_subclass, vendor, device, subsystem_vendor, subsystem_device, driver')
+
+from ..lib.pci_ids import get_pci_ids
 
 # PCI vendors
 PCI_VENDOR_VIA = "1106"
@@ -13,18 +15,7 @@ PCI_VENDOR_SIS = "1039"
 PCI_VENDOR_NVIDIA = "10de"
 PCI_VENDOR_ATI = "1002"
 
-lspci_nm_re = re.compile(r'\s*([0-9a-f]{2}:[0-9a-f]{2}.[0-9a-f])\s+"([0-9a-f]{2})([0-9a-f]{2})"\s+"([0-9a-f]{4})"\s+"([0-9a-f]{4})"')
-lspci_output = None
-
-def get_lspci_nm_output():
-  # Dirty trick to avoid running lspci twice...
-  global lspci_output
-  if not lspci_output:
-    lspci = subprocess.Popen("lspci -nm", shell=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-    (lspci_output, err) = lspci.communicate()
-    pass
-  return lspci_output.decode('utf-8')
-
+PCI_DEVICES_DIR = '/sys/bus/pci/devices'
 
 # this is partial device class I care
 device_classes = {
@@ -36,32 +27,80 @@ device_classes = {
   '40': 'co-proc',      'ff': 'unassigned'
 }
 
-def list_pci():
-  out = get_lspci_nm_output()
+def _read_pci_id(devnode, name):
+  """reads "0x8086" and returns "8086" """
+  value = safe_read_text(os.path.join(devnode, name)).strip()
+  if value.startswith("0x"):
+    value = value[2:]
+    pass
+  return value.lower()
+
+
+# Dirty trick to avoid walking sysfs more than once.
+pci_devices = None
+
+def list_pci(pci_dir=PCI_DEVICES_DIR):
+  """lists PCI devices from sysfs."""
+  global pci_devices
+  if pci_devices is not None and pci_dir == PCI_DEVICES_DIR:
+    return pci_devices
+
   result = []
-  for line in out.splitlines():
-    m = lspci_nm_re.match(line)
-    # pci-addr device-class vendor device revision subclass? subdevice?
-    if m:
-      pci_address = m.group(1)
-      dev_class = device_classes.get(m.group(2))
-      dev_subclass = m.group(3)
-      vendor_id = m.group(4).lower()
-      device_id = m.group(5).lower()
-      result.append( PCI_Device(address=pci_address, device_class=dev_class, device_subclass=dev_subclass, vendor=vendor_id, device=device_id) )
+  try:
+    addresses = sorted(os.listdir(pci_dir))
+  except OSError:
+    addresses = []
+    pass
+
+  for address in addresses:
+    devnode = os.path.join(pci_dir, address)
+    # class is 0xCCSSPP - class, subclass, prog-if
+    dev_class = _read_pci_id(devnode, "class")
+    driver = None
+    driver_link = os.path.join(devnode, "driver")
+    if os.path.islink(driver_link):
+      driver = os.path.basename(os.readlink(driver_link))
+      pass
+    # lspci shows the address without domain 0000
+    if address.startswith("0000:"):
+      address = address[5:]
       pass
+    result.append( PCI_Device(address=address,
+                              device_class=device_classes.get(dev_class[0:2]),
+                              device_subclass=dev_class[2:4],
+                              vendor=_read_pci_id(devnode, "vendor"),
+                              device=_read_pci_id(devnode, "device"),
+                              subsystem_vendor=_read_pci_id(devnode, "subsystem_vendor"),
+                              subsystem_device=_read_pci_id(devnode, "subsystem_device"),
+                              driver=driver) )
+    pass
+
+  if pci_dir == PCI_DEVICES_DIR:
+    pci_devices = result
     pass
   return result
 
 
-def get_lspci_device_desc(pci_id):
-  lspci = subprocess.Popen("lspci -mm -s %s" % pci_id, shell=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-  (out, err) = lspci.communicate()
-  lspci_mm_s_re = re.compile(r'\s*([0-9a-f]{2}:[0-9a-f]{2}.[0-9a-f])\s+"([^"]*)"\s+"([^"]*)"\s+"([^"]*)"\s+([^\s]+)\s+"([^"]*)"\s+"([^"]*)"\s*')
-  m = lspci_mm_s_re.match(out.encode('utf-8').strip())
-  if m:
-    return m.group(3) + " " + m.group(4)
-  return ""
+def get_pci_device_desc(pcidev):
+  """returns "vendor device" name from pci.ids. Same as lspci -mm gives."""
+  pci_ids = get_pci_ids()
+  vendor_name = None
+  device_name = None
+  try:
+    if pci_ids:
+      vendor_name = pci_ids.vendor_name(int(pcidev.vendor, 16))
+      device_name = pci_ids.device_name(int(pcidev.vendor, 16), int(pcidev.device, 16))
+      pass
+    pass
+  except ValueError:
+    pass
+  if vendor_name is None:
+    vendor_name = "Vendor " + pcidev.vendor
+    pass
+  if device_name is None:
+    device_name = "Device " + pcidev.device
+    pass
+  return vendor_name + " " + device_name
 
 
 # Need a safe way to read from /sys device nodes
@@ -76,7 +115,7 @@ def safe_read_text(pathname):
 
 # 
 def find_pci_device_node(vendors, devices):
-  pci_path = '/sys/bus/pci/devices'
+  pci_path = PCI_DEVICES_DIR
   for a_device in os.listdir(pci_path):
     devnode = os.path.join(pci_path, a_device)
     vendor = safe_read_text(os.path.join(devnode, "vendor"))
@@ -112,7 +151,7 @@ def detect_blacklist_devices():
     if pcidev.device_class == 'network':
       try:
         if ethernet_device_blacklist[pcidev.vendor][pcidev.device]:
-          blacklisted_nics.append(get_lspci_device_desc(pcidev.address))
+          blacklisted_nics.append(get_pci_device_desc(pcidev))
           pass
         pass
       except KeyError:
@@ -120,7 +159,7 @@ def detect_blacklist_devices():
       pass
     elif pcidev.device_class == 'video':
       if pcidev.vendor in video_device_blacklist and pcidev.device in video_device_blacklist[pcidev.vendor]:
-        blacklisted_videos.append(get_lspci_device_desc(pcidev.address))
+        blacklisted_videos.append(get_pci_device_desc(pcidev))
         pass
       pass
     pass
@@ -129,7 +168,7 @@ def detect_blacklist_devices():
 
 if __name__ == "__main__":
   for device in list_pci():
-    print(str(device))
+    print("%s %s" % (str(device), get_pci_device_desc(device)))
     pass
 
   devnode = find_pci_device_node([0x14e4], [0x4312])
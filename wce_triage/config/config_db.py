@@ -120,7 +120,12 @@ class config_base(tag_value_table):
 class triage_config_db(sqlite3_db):
   def __init__(self):
     super().__init__("/var/lib/wce_triage/config.db")
-    self.open()
+    # On a machine without /var/lib/wce_triage (dev box, read-only live
+    # media), importing this module must not blow up.
+    try:
+      self.open()
+    except sqlite3.OperationalError:
+      pass
     pass
 
   def provision(self):
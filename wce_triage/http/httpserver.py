@@ -18,15 +18,20 @@ import json
 import os, re, subprocess, datetime, asyncio, traceback, queue
 import logging, logging.handlers
 
-from ..components.computer import Computer
 from ..components.disk import DiskPortal, PartitionLister
-from ..lib.util import get_triage_logger, init_triage_logger
+from ..lib.util import get_triage_logger, init_triage_logger, get_transport_scheme
 # from ..lib.timeutil import in_seconds
 from ..lib.pipereader import PipeReader
 # from ..components import optical_drive as _optical_drive
 from ..components import sound as _sound
 from ..lib.disk_images import get_disk_images, read_disk_image_types
+from ..lib.triage_cache import TriageCache
+from ..lib.smart import SmartCollector
+from ..lib.image_serving import get_image_etag, format_http_date, if_range_matches, parse_range, RangeNotSatisfiable, ImageClientStats, DEFAULT_MAX_IMAGE_CLIENTS
+from ..lib.capture_tee import select_capture_destinations
+from ..lib.netspeed import measure_network_speed, get_speedtest_url, SPEEDTEST_PATH, SPEEDTEST_CHUNK, SPEEDTEST_CHUNK_SIZE, SPEEDTEST_MAX_SIZE, DEFAULT_DOWNLOAD_SIZE
 from ..components import network as _network
+from ..lib import worker_pool
 # from ..lib.cpu_info import cpu_info
 
 
@@ -70,6 +75,7 @@ def jsoned_disk(disk):
           "serial_no": disk.serial_no,
           "smart": disk.smart,
           "smart_enabled": disk.smart_enabled,
+          "smartHealth": disk.smart_health,
   }
 
 def jsoned_optical(optical):
@@ -206,7 +212,7 @@ class TriageWeb(object):
   
   wiper_output_re = re.compile(r'^WIPE: python3\.stderr:(.*)')
 
-  def __init__(self, app, wce_share_url, rootdir, wcedir, cors, loop, live_triage, load_disk_options):
+  def __init__(self, app, wce_share_url, rootdir, wcedir, cors, loop, live_triage, load_disk_options, triage_cache=None):
     """
     HTTP request handler for triage
     """
@@ -236,6 +242,8 @@ class TriageWeb(object):
     self.computer = None
     self.messages = []
     self.triage_timestamp = None
+    self.triage_cache = triage_cache
+    self.loop = loop
 
     self.loading_status = { "pages": 1, "tasks": [], "diskRestroing": False }
     self.saving_status = { "pages": 1, "tasks": [], "diskSaving": False}
@@ -253,8 +261,20 @@ class TriageWeb(object):
     self.saver = None
     self.wiper = None
     self.optests = []
+    self.memtest = None
+    self.surface_scan = None
+    self.smart_collector = SmartCollector()
+    self.network_speed = None # Result of network speed test to WCE share
+    self.image_semaphore = None
+    self.multicaster = None
+    self.image_waiting = 0
+    self.image_client_stats = ImageClientStats()
     self.cpu_info = None # This is the process instance of cpu info
     self.benchmark = None # THis is the output of cpu info aka benchmark
+    self.benchmark_ready = None
+    # Set when the components of computer are detected. With the triage
+    # cache, that's after the revalidation.
+    self.components_ready = None
     self.syncer = None
     
     self.wock = wock
@@ -359,38 +379,94 @@ class TriageWeb(object):
   async def triage(self):
     if self.triage_timestamp is None:
       self.triage_timestamp = datetime.datetime.now()
+      # Computer pulls in all of component detection. Loaded when the triage runs.
+      from ..components.computer import Computer
       computer = Computer()
-      self.overall_decision = computer.triage(live_system=self.live_triage)
+      self.components_ready = asyncio.Event()
+      self.overall_decision = computer.triage(live_system=self.live_triage, cache=self.triage_cache)
       tlog.info("Triage is done.")
       self.computer = computer
+      if computer.from_cache:
+        # Cached result is returned right away. The components are detected,
+        # and network carrier and mounts are checked again in background.
+        asyncio.ensure_future(self.revalidate_triage(computer), loop=self.loop)
+      else:
+        self.components_ready.set()
+        self.collect_smart(self.disk_portal.disks)
+        pass
       pass
     return self.computer
 
+  async def get_components(self):
+    """Returns the computer after its components are detected."""
+    while self.computer is None:
+      await self.triage()
+      pass
+    await self.components_ready.wait()
+    return self.computer
+
+  # Detection runs in executor thread, and the result is applied here in the
+  # loop so that the periodic update never sees the computer half updated.
+  async def revalidate_triage(self, computer):
+    try:
+      detected = await self.loop.run_in_executor(None, computer.detect_volatile)
+      for decision in computer.apply_revalidation(detected, overall_changed=self.overall_changed):
+        Emitter._send('triageupdate', decision)
+        pass
+      tlog.info("Triage revalidation is done.")
+      # SMART updates the disk decisions, so after the revalidation.
+      self.collect_smart(self.disk_portal.disks)
+    except Exception as exc:
+      tlog.info("Triage revalidation failed.\n%s" % traceback.format_exc())
+      pass
+    self.components_ready.set()
+    pass
+
+  def jsoned_triage(self):
+    decisions = [ { "component": "Overall", "result": self.overall_decision } ] + self.computer.decisions
+    return { "components":  decisions }
+
   @routes.get("/dispatch/triage.json")
   async def route_triage(request):
     """Handles requesting triage result"""
     global me
     await me.triage()
-    computer = me.computer
+    return aiohttp.web.json_response(me.jsoned_triage())
 
-    decisions = [ { "component": "Overall", "result": me.overall_decision } ] + computer.decisions
-    jsonified = { "components":  decisions }
-    return aiohttp.web.json_response(jsonified)
+  @routes.post("/dispatch/triage-refresh")
+  async def route_triage_refresh(request):
+    """Drops the cached triage result, and triages again"""
+    global me
+    if me.triage_cache:
+      me.triage_cache.invalidate()
+      pass
+    me.triage_timestamp = None
+    me.computer = None
+    me.benchmark = None
+    me.cpu_info = None
+    await me.triage()
+    return aiohttp.web.json_response(me.jsoned_triage())
 
 
-  # get_cpu_info is potentially ver slow for older computers as this runs a
-  # cpu benchmark.
+  # get_cpu_info runs a cpu benchmark in a separate process. It's bounded by
+  # the time budget, and the result is cached per machine.
   async def get_cpu_info(self):
-    if self.cpu_info is None:
+    if self.benchmark is None and self.triage_cache:
+      self.benchmark = self.triage_cache.load("cpu_info")
+      pass
+
+    if self.benchmark is None and self.cpu_info is None:
       tlog.debug("get_cpu_info: starting")
-      self.cpu_info = subprocess.Popen("python3 -m wce_triage.lib.cpu_info", shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+      self.benchmark_ready = asyncio.Event()
+      self.cpu_info = worker_pool.popen(['python3', '-m', 'wce_triage.lib.cpu_info', '--time-budget', str(arguments.cpu_benchmark_time)],
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
       PipeReader.add_to_event_loop(self.cpu_info.stdout, self.watch_cpu_info, "stdout")
       tlog.debug("get_cpu_info: started")
       pass
 
-    while self.benchmark is None:
+    if self.benchmark is None:
       tlog.debug("get_cpu_info: waiting")
-      await asyncio.sleep(1)
+      await self.benchmark_ready.wait()
       pass
     return self.benchmark
 
@@ -408,6 +484,11 @@ class TriageWeb(object):
     if line == b'':
       tlog.debug("watch_cpu_info: done")
       pipereader.remove_from_event_loop()
+      if self.benchmark is None:
+        # Benchmark process died without result. Don't keep the requests waiting.
+        self.benchmark = { "rating": "Unknown" }
+        pass
+      self.benchmark_ready.set()
       pass
     elif line is not None:
       if len(line.strip()) == 0:
@@ -415,6 +496,10 @@ class TriageWeb(object):
       try:
         tlog.debug("watch_cpu_info: '%s'" % line)
         self.benchmark = json.loads(line)
+        if self.triage_cache:
+          self.triage_cache.save("cpu_info", self.benchmark)
+          pass
+        self.benchmark_ready.set()
       except Exception as exc:
         tlog.info("watch_cpu_info - json.loads: '%s'\n%s" % (line, traceback.format_exc()))
         pass
@@ -432,7 +517,8 @@ class TriageWeb(object):
     """Handles getting the list of disks"""
     global me
     me.disk_portal.detect_disks()
-    
+    me.collect_smart(me.disk_portal.disks)
+
     disks = [ jsoned_disk(disk) for disk in me.disk_portal.disks ]
     tlog.debug(str(disks))
     jsonified = { "diskPages": 1, "disks": disks }
@@ -501,11 +587,11 @@ class TriageWeb(object):
   async def route_opticaldrives(request):
     """Handles getting the list of disks"""
     global me
-    while me.computer is None:
-      await me.triage()
-      pass
-    
-    reply = [ jsoned_optical(optical) for optical in me.computer.opticals._drives ]
+    computer = await me.get_components()
+    if computer.opticals is None:
+      raise HTTPServiceUnavailable()
+
+    reply = [ jsoned_optical(optical) for optical in computer.opticals._drives ]
     jsonified = { "opticaldrives": reply }
     return aiohttp.web.json_response(jsonified)
 
@@ -515,23 +601,32 @@ class TriageWeb(object):
     """Test optical drive"""
     global me
 
-    while me.computer is None:
-      await me.triage()
-      pass
-
-    computer = me.computer
+    computer = await me.get_components()
     opticals = computer.opticals
+    if opticals is None:
+      raise HTTPServiceUnavailable()
 
     if opticals.count() == 0:
       tlog.debug('No optical drives detected.')
       raise HTTPNotFound()
 
+    # Raw read test reads all of drives concurrently in one process, and is bounded by time.
+    if request.query.get("mode") == "raw":
+      devices = [ optical.device_name for optical in opticals._drives ]
+      argv = ['python3', '-m', 'wce_triage.bin.test_optical', '--raw',
+              '--time-budget', request.query.get("timeBudget", "30")] + devices
+      tlog.debug("run " + " ".join(argv))
+      optical_test = worker_pool.popen(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+      PipeReader.add_to_event_loop(optical_test.stdout, me.watch_optest, "stdout")
+      me.optests.append((optical_test, ",".join(devices)))
+      return aiohttp.web.json_response({})
+
     # Since reading optical is slow, the answer goes back over websocket.
     for optical in opticals._drives:
       # await me.wock.emit("opticaldrive", { "device": optical.device_name })
       # restore image runs its own course, and output will be monitored by a call back
       tlog.debug("run wce_triage.bin.test_optical " + optical.device_name)
-      optical_test = subprocess.Popen( ['python3', '-m', 'wce_triage.bin.test_optical', optical.device_name],
+      optical_test = worker_pool.popen( ['python3', '-m', 'wce_triage.bin.test_optical', optical.device_name],
                                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
       
@@ -598,7 +693,7 @@ class TriageWeb(object):
         # packet['event'] == 'triageupdate'
         Emitter._send('triageupdate', payload)
       except Exception as exc:
-        tlog.info("FromOptest: '%s'\n%s" % (line, exc.format_exc()))
+        tlog.info("FromOptest: '%s'\n%s" % (line, traceback.format_exc()))
         pass
       pass
 
@@ -606,6 +701,59 @@ class TriageWeb(object):
     pass
 
 
+  @routes.post("/dispatch/memorytest")
+  async def route_memorytest(request):
+    """Test memory. Optional, as it takes a while and eats most of free memory."""
+    global me
+
+    while me.computer is None:
+      await me.triage()
+      pass
+
+    if me.memtest and me.memtest.returncode is None:
+      return aiohttp.web.json_response({})
+
+    argv = ['python3', '-m', 'wce_triage.bin.memory_test']
+    fraction = request.query.get("fraction")
+    if fraction:
+      argv = argv + ['--fraction', fraction]
+      pass
+    # Nobody reads stderr. The test logs to the triage log.
+    me.memtest = worker_pool.popen(argv, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    PipeReader.add_to_event_loop(me.memtest.stdout, me.watch_memtest, "stdout")
+    return aiohttp.web.json_response({})
+
+
+  def watch_memtest(self, pipereader):
+    line = pipereader.readline()
+    if line == b'':
+      tlog.debug("FromMemtest: memory test stream ended.")
+      pipereader.remove_from_event_loop()
+      self.memtest.poll()
+      pass
+    elif line is not None:
+      if len(line.strip()) == 0:
+        return
+      tlog.debug("FromMemtest: '%s'" % line)
+      try:
+        packet = json.loads(line)
+        message = packet['message']
+        # Only the final report carries the result
+        if 'result' in message and self.computer:
+          self.computer.set_decision({"component": "Memory", "device": "memtest"},
+                                     {"result": message['result'],
+                                      "message": message['message'],
+                                      "verdict": message['verdict']},
+                                     overall_changed=self.overall_changed)
+          pass
+        Emitter._send(packet['event'], message)
+      except Exception as exc:
+        tlog.info("FromMemtest: '%s'\n%s" % (line, traceback.format_exc()))
+        pass
+      pass
+    pass
+
+
   @routes.get("/dispatch/network-device-status.json")
   async def route_network_device_status(request):
     """Network status"""
@@ -615,7 +763,7 @@ class TriageWeb(object):
 
     netstat = []
     for netdev in _network.detect_net_devices():
-      netstat.append( { "device": netdev.device_name, "carrier": netdev.is_network_connected() } )
+      netstat.append( { "device": netdev.device_name, "carrier": netdev.is_network_connected(), "speed": netdev.get_link_speed() } )
       computer.update_decision( {"component": "Network",
                                  "device": netdev.device_name},
                                 {"result": netdev.is_network_connected(),
@@ -625,6 +773,84 @@ class TriageWeb(object):
     return aiohttp.web.json_response({ "network": netstat })
 
 
+  #
+  # Network speed test. The server side is served to other triage machines,
+  # and the client side measures from this machine to the WCE share.
+  #
+  @routes.get(SPEEDTEST_PATH + "/ping")
+  async def route_speedtest_ping(request):
+    return aiohttp.web.Response(body=b"pong")
+
+
+  @routes.get(SPEEDTEST_PATH + "/download")
+  async def route_speedtest_download(request):
+    """Streams generated payload of requested size."""
+    try:
+      size = int(request.query.get("size", str(DEFAULT_DOWNLOAD_SIZE)))
+    except ValueError:
+      raise HTTPBadRequest()
+    if size < 0 or size > SPEEDTEST_MAX_SIZE:
+      raise HTTPBadRequest()
+
+    response = aiohttp.web.StreamResponse()
+    response.content_type = "application/octet-stream"
+    response.content_length = size
+    await response.prepare(request)
+    remaining = size
+    while remaining > 0:
+      chunk = SPEEDTEST_CHUNK[:min(remaining, SPEEDTEST_CHUNK_SIZE)]
+      await response.write(chunk)
+      remaining -= len(chunk)
+      pass
+    await response.write_eof()
+    return response
+
+
+  @routes.post(SPEEDTEST_PATH + "/upload")
+  async def route_speedtest_upload(request):
+    """Reads and throws away the upload."""
+    received = 0
+    async for data in request.content.iter_chunked(SPEEDTEST_CHUNK_SIZE):
+      received += len(data)
+      pass
+    return aiohttp.web.json_response({ "received": received })
+
+
+  @routes.post("/dispatch/network-speed-test")
+  async def route_network_speed_test(request):
+    """Measures throughput to the WCE share. Result comes back as triageupdate."""
+    global me
+    await me.triage()
+    speedtest_url = arguments.speedtest_url if arguments.speedtest_url else get_speedtest_url(me.wce_share_url)
+    future = me.loop.run_in_executor(None, measure_network_speed, speedtest_url)
+    future.add_done_callback(me.network_speed_measured)
+    return aiohttp.web.json_response({})
+
+
+  def network_speed_measured(self, future):
+    try:
+      self.network_speed = future.result()
+      speed = self.network_speed
+      if speed is None:
+        # Server without the speed test is not a network problem.
+        decision = { "result": True, "message": "Network speed to WCE share: unknown" }
+      else:
+        decision = { "result": True,
+                     "message": "Network speed to WCE share: download %.1fMB/s, upload %.1fMB/s, latency %.1fms, jitter %.1fms" % (
+                       speed["download"] / 1000000, speed["upload"] / 1000000, speed["latency"], speed["jitter"]) }
+        pass
+    except Exception as exc:
+      tlog.info("Network speed test failed.\n%s" % traceback.format_exc())
+      decision = { "result": False, "message": "Network speed test failed. %s" % str(exc) }
+      pass
+    keys = {"component": "Network", "device": "speedtest"}
+    self.computer.set_decision(keys, decision, overall_changed=self.overall_changed)
+    payload = dict(keys)
+    payload.update(decision)
+    Emitter._send('triageupdate', payload)
+    pass
+
+
   @routes.get("/dispatch/disk-images.json")
   async def route_disk_images(request):
     """Handles getting the list of disk images on local media"""
@@ -711,7 +937,29 @@ class TriageWeb(object):
       argv.append(newhostname)
       pass
 
+    multicast = self._get_load_option("multicast")
+    if multicast:
+      argv = argv + ['--multicast', multicast]
+      pass
+
+    # Decodes the image in process, with partclone as the fallback.
+    native = self._get_load_option("native")
+    if native and native not in ["false", "0"]:
+      argv.append('--native')
+      pass
+
+    # "legacy" runs the restore plan without the optimizer
+    plan_mode = self._get_load_option("plan")
+    if plan_mode:
+      argv = argv + ['--plan', plan_mode]
+      pass
+
     imagefile = self._get_load_option("source")
+    # Loading over network is bound by the network speed when it's slower than disk
+    if self.network_speed and get_transport_scheme(imagefile) in ["http", "https"]:
+      argv = argv + ['--network-speed', str(self.network_speed["download"])]
+      pass
+
     imagefile_size = self._get_load_option("size") # This comes back in bytes from sending sources with size. value in query is always string.
     restore_type = self._get_load_option("restoretype")
 
@@ -722,7 +970,7 @@ class TriageWeb(object):
     # this is about making argv, after this, thing to do is the same. However, looking at the
     # callbacks, there aren't much to do in it so how much I can buy from refactoring is not much.
 
-    self.restore = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    self.restore = worker_pool.popen(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     PipeReader.add_to_event_loop(self.restore.stdout, me.restore_progress_report, "loadimage")
     PipeReader.add_to_event_loop(self.restore.stderr, me.restore_progress_report, "message")
     return
@@ -825,10 +1073,178 @@ class TriageWeb(object):
 
   @routes.get("/dispatch/download")
   async def route_download_image(request):
-    """Download disk image. not implemented yet."""
+    """Download disk image by name (and restoreType when names collide)."""
+    global me
+    name = request.query.get("name")
+    restore_type = request.query.get("restoreType")
+    for disk_image in get_disk_images():
+      if disk_image["name"] == name and (restore_type is None or disk_image["restoreType"] == restore_type):
+        return await me.serve_image(request, disk_image["fullpath"])
+      pass
+    raise HTTPNotFound()
+
+
+  # This is the URL of image in disk-images.json. It takes over the static route of /wce
+  # for the images.
+  @routes.get("/wce/wce-disk-images/{restoretype}/{filename}")
+  async def route_wce_disk_image(request):
+    global me
+    restore_type = request.match_info["restoretype"]
+    filename = request.match_info["filename"]
+    for disk_image in get_disk_images():
+      if disk_image["name"] == filename and disk_image["restoreType"] == restore_type:
+        return await me.serve_image(request, disk_image["fullpath"])
+      pass
+    raise HTTPNotFound()
+
+
+  @routes.post("/dispatch/multicast")
+  async def route_multicast(request):
+    """Starts sending the disk image to the multicast group. The clients
+load it with "multicast" load option."""
+    global me
+    if me.multicaster and me.multicaster.returncode is None:
+      return aiohttp.web.json_response({})
+
+    name = request.query.get("name")
+    restore_type = request.query.get("restoreType")
+    for disk_image in get_disk_images():
+      if disk_image["name"] == name and (restore_type is None or disk_image["restoreType"] == restore_type):
+        # Same as the url from get_disk_images(wce_share_url)
+        url = '{wce_share_url}/wce-disk-images/{restoretype}/{filename}'.format(wce_share_url=me.wce_share_url, restoretype=disk_image["restoreType"], filename=name)
+        argv = ['python3', '-m', 'wce_triage.bin.multicast_send', disk_image["fullpath"], '--url', url]
+        for option, arg in [("group", "--group"), ("port", "--port"), ("rate", "--rate")]:
+          if request.query.get(option):
+            argv = argv + [arg, request.query.get(option)]
+            pass
+          pass
+        me.multicaster = worker_pool.popen(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        PipeReader.add_to_event_loop(me.multicaster.stderr, me.watch_multicast, "multicast")
+        return aiohttp.web.json_response({})
+      pass
+    raise HTTPNotFound()
+
+
+  def watch_multicast(self, pipereader):
+    line = pipereader.readline()
+    if line == b'':
+      pipereader.remove_from_event_loop()
+      self.multicaster.poll()
+      pass
+    elif line is not None:
+      if len(line.strip()) == 0:
+        return
+      try:
+        packet = json.loads(line)
+        Emitter._send(packet['event'], packet['message'])
+      except Exception as exc:
+        tlog.info("FromMulticast: '%s'" % line)
+        pass
+      pass
+    pass
+
+
+  @routes.post("/dispatch/stop-multicast")
+  async def route_stop_multicast(request):
+    global me
+    if me.multicaster and me.multicaster.returncode is None:
+      me.multicaster.terminate()
+      pass
     return aiohttp.web.json_response({})
 
 
+  @routes.get("/dispatch/image-server-status.json")
+  async def route_image_server_status(request):
+    global me
+    return aiohttp.web.json_response({ "maxClients": arguments.max_image_clients,
+                                       "waiting": me.image_waiting,
+                                       "clients": me.image_client_stats.report() })
+
+
+  async def serve_image(self, request, path):
+    """Sends the image file with sendfile. Supports Range and If-Range so that
+the restore can resume. Number of concurrent transfers is capped, and the
+rest waits for the turn."""
+    if self.image_semaphore is None:
+      self.image_semaphore = asyncio.Semaphore(arguments.max_image_clients)
+      pass
+
+    try:
+      fobj = open(path, "rb")
+    except OSError:
+      raise HTTPNotFound()
+
+    try:
+      filestat = os.fstat(fobj.fileno())
+      size = filestat.st_size
+      etag = get_image_etag(path, filestat)
+      headers = { "ETag": etag,
+                  "Last-Modified": format_http_date(filestat.st_mtime),
+                  "Accept-Ranges": "bytes" }
+
+      if request.headers.get("If-None-Match") == etag:
+        return aiohttp.web.Response(status=304, headers=headers)
+
+      byte_range = None
+      if if_range_matches(request.headers.get("If-Range"), etag, filestat.st_mtime):
+        try:
+          byte_range = parse_range(request.headers.get("Range"), size)
+        except RangeNotSatisfiable:
+          headers["Content-Range"] = "bytes */%d" % size
+          return aiohttp.web.Response(status=416, headers=headers)
+        pass
+
+      if byte_range:
+        start, end = byte_range
+        headers["Content-Range"] = "bytes %d-%d/%d" % (start, end - 1, size)
+        status = 206
+      else:
+        start, end = 0, size
+        status = 200
+        pass
+
+      client = request.remote
+      self.image_waiting += 1
+      try:
+        await self.image_semaphore.acquire()
+      finally:
+        self.image_waiting -= 1
+        pass
+
+      started = self.image_client_stats.start(client, os.path.basename(path))
+      sent = 0
+      try:
+        response = aiohttp.web.StreamResponse(status=status, headers=headers)
+        response.content_type = "application/octet-stream"
+        response.content_length = end - start
+        await response.prepare(request)
+        try:
+          # Zero copy
+          await self.loop.sendfile(request.transport, fobj, start, end - start)
+          sent = end - start
+        except (AttributeError, NotImplementedError):
+          # No loop.sendfile or it's not available for the transport
+          fobj.seek(start)
+          while sent < end - start:
+            data = fobj.read(min(2**20, end - start - sent))
+            if not data:
+              break
+            await response.write(data)
+            sent += len(data)
+            pass
+          pass
+        await response.write_eof()
+        return response
+      finally:
+        self.image_client_stats.finish(client, sent, started)
+        self.image_semaphore.release()
+        pass
+    finally:
+      fobj.close()
+      pass
+    pass
+
+
   @routes.post("/dispatch/save")
   async def route_save_image(request):
     """Create disk image and save"""
@@ -892,10 +1308,23 @@ class TriageWeb(object):
       Emitter.alert("Imaging type info %s does not include the catalog directory." % image_type.get("id"))
       return
     
+    # The image is also saved to these in the same pass - other catalog directories or upload URLs.
+    # The request can only pick from the ones in the catalog.
+    try:
+      extra_destinations = select_capture_destinations(image_type.get('captureDestinations', []), request.query.getall("captureDestination", []))
+    except Exception as exc:
+      tlog.info("saveimage - " + str(exc))
+      Emitter.alert(str(exc))
+      raise HTTPBadRequest()
+
     # save image runs its own course, and output will be monitored by a call back
-    args = ['python3', '-m', 'wce_triage.ops.create_image_runner', devname, str(partition_id), destdir]
+    args = ['python3', '-m', 'wce_triage.ops.create_image_runner', devname, str(partition_id), destdir] + extra_destinations
+    # "shrink": false images the file system at full size
+    if image_type.get('shrink', True) is False:
+      args.append('--no-shrink')
+      pass
     tlog.info("saveimage - " + " ".join(args))
-    me.saver = subprocess.Popen( args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    me.saver = worker_pool.popen( args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
     PipeReader.add_to_event_loop(me.saver.stdout, me.saver_progress_report, "saveimage")
     PipeReader.add_to_event_loop(me.saver.stderr, me.saver_progress_report, "message")
@@ -941,7 +1370,7 @@ class TriageWeb(object):
     cmd = ['python3', '-m', 'wce_triage.bin.multiwipe'] + self.target_disks
     self.target_disks = []
 
-    me.wiper = subprocess.Popen( cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    me.wiper = worker_pool.popen( cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     PipeReader.add_to_event_loop(me.wiper.stdout, me.wiper_progress_report, "message")
     PipeReader.add_to_event_loop(me.wiper.stderr, me.wiper_progress_report, "wipe")
     pass
@@ -991,6 +1420,109 @@ class TriageWeb(object):
       pass
     return aiohttp.web.json_response({})
 
+  @routes.post("/dispatch/surfacescan")
+  async def route_surface_scan(request):
+    """Read test of disks. With "sample", only that many blocks spread over the disk are read."""
+    global me
+
+    while me.computer is None:
+      await me.triage()
+      pass
+
+    if me.surface_scan and me.surface_scan.returncode is None:
+      return aiohttp.web.json_response({})
+
+    target_disks = get_target_devices_from_request(request)
+    if not target_disks:
+      raise HTTPServiceUnavailable()
+
+    argv = ['python3', '-m', 'wce_triage.bin.surface_scan']
+    sample = request.query.get("sample")
+    if sample:
+      argv = argv + ['--sample', sample]
+      pass
+    me.surface_scan = worker_pool.popen(argv + target_disks, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    PipeReader.add_to_event_loop(me.surface_scan.stderr, me.watch_surface_scan, "scan")
+    return aiohttp.web.json_response({})
+
+
+  def watch_surface_scan(self, pipereader):
+    line = pipereader.readline()
+    if line == b'':
+      pipereader.remove_from_event_loop()
+      self.surface_scan.poll()
+      pass
+    elif line is not None:
+      if len(line.strip()) == 0:
+        return
+      try:
+        packet = json.loads(line)
+        report = packet['message']
+        # The final report carries the histogram and ranges.
+        if 'badRanges' in report:
+          self.surface_scan_done(report)
+          pass
+        Emitter._send(packet['event'], report)
+      except Exception as exc:
+        tlog.info("FromSurfaceScan: '%s'\n%s" % (line, traceback.format_exc()))
+        pass
+      pass
+    pass
+
+
+  def surface_scan_done(self, report):
+    """Keeps the scan result in the disk, and updates the disk decision with it."""
+    for disk in self.disk_portal.disks:
+      if disk.device_name == report['device']:
+        disk.surface_scan = report
+        self.update_disk_decision(disk)
+        break
+      pass
+    pass
+
+
+  def update_disk_decision(self, disk):
+    """Surface scan and SMART come after the triage. Replaces the disk decision."""
+    if self.computer is None:
+      return
+    for decision in self.disk_portal.decision(live_system=self.live_triage):
+      if decision.get("device") == disk.device_name:
+        self.computer.set_decision({"component": "Disk", "device": disk.device_name},
+                                   decision, overall_changed=self.overall_changed)
+        Emitter._send('triageupdate', decision)
+        pass
+      pass
+    pass
+
+
+  def collect_smart(self, disks):
+    """Reads SMART in background. disks.json does not wait for it, and the
+result is pushed as "disksmart" event."""
+    for disk in disks:
+      if disk.smart_health is None:
+        disk.smart_health = self.smart_collector.get(disk)
+        pass
+      pass
+    if any([ self.smart_collector.is_stale(disk) for disk in disks ]):
+      future = self.loop.run_in_executor(None, self.smart_collector.collect, disks[:])
+      future.add_done_callback(self.smart_collected)
+      pass
+    pass
+
+
+  def smart_collected(self, future):
+    try:
+      for disk in future.result():
+        Emitter._send('disksmart', {"deviceName": disk.device_name, "smartHealth": disk.smart_health})
+        self.update_disk_decision(disk)
+        pass
+      pass
+    except Exception as exc:
+      tlog.info("SMART collection failed.\n%s" % traceback.format_exc())
+      pass
+    pass
+
+
   # FIXME:
   @routes.get("/dispatch/disk-wipe-status.json")
   async def route_disk_wipe_status(request):
@@ -1150,7 +1682,11 @@ class TriageWeb(object):
         tlog.debug(self.sync_disk_image_options)
         argv = ['true']
       else:
-        argv = ['python3', '-m', 'wce_triage.ops.sync_image_runner', ",".join(self.sync_target_disks)] + imagefiles.split(',')
+        argv = ['python3', '-m', 'wce_triage.ops.sync_image_runner', ",".join(self.sync_target_disks)]
+        if self._get_sync_disk_image_option("delta") in ["true", "1"]:
+          argv.append("delta")
+          pass
+        argv = argv + imagefiles.split(',')
         pass
       pass
     tlog.debug("SYNC: " + " ".join(argv))
@@ -1159,7 +1695,7 @@ class TriageWeb(object):
     # this is about making argv, after this, thing to do is the same. However, looking at the
     # callbacks, there aren't much to do in it so how much I can buy from refactoring is not much.
 
-    self.syncer = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    self.syncer = worker_pool.popen(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     PipeReader.add_to_event_loop(self.syncer.stdout, me.diskimage_progress_report, "diskimage")
     PipeReader.add_to_event_loop(self.syncer.stderr, me.diskimage_progress_report, "message")
     return
@@ -1295,34 +1831,55 @@ def get_target_devices_from_request(request):
 
 
 
-# Define and parse the command line arguments
-import socket
-cli = ArgumentParser(description='Example Python Application')
-# Port for this HTTP server
-cli.add_argument("-p", "--port", type=int, metavar="PORT", dest="port", default=8312)
+# Command line arguments. Parsed in my_main so that importing this does not.
+arguments = None
+
+def make_argument_parser():
+  import socket
+  cli = ArgumentParser(description='Example Python Application')
+  # Port for this HTTP server
+  cli.add_argument("-p", "--port", type=int, metavar="PORT", dest="port", default=8312)
+
+  # And it's hostname. It's usually the local host FQDN but, as the client's DNS may not work reliably,
+  # you need to be able to set this sometimes.
+  cli.add_argument("--host", type=str, metavar="HOST", dest="host", default=socket.getfqdn())
 
-# And it's hostname. It's usually the local host FQDN but, as the client's DNS may not work reliably,
-# you need to be able to set this sometimes.
-cli.add_argument("--host", type=str, metavar="HOST", dest="host", default=socket.getfqdn())
+  # Location of UI assets.
+  cli.add_argument("--rootdir", type=str, metavar="WCE_TRIAGE_UI_ROOTDIR", dest="rootdir", default=None)
 
-# Location of UI assets.
-cli.add_argument("--rootdir", type=str, metavar="WCE_TRIAGE_UI_ROOTDIR", dest="rootdir", default=None)
+  # This is where disk images live
+  cli.add_argument("--wcedir", type=str, metavar="WCE_ROOT_DIR", dest="wcedir", default="/usr/local/share/wce")
 
-# This is where disk images live
-cli.add_argument("--wcedir", type=str, metavar="WCE_ROOT_DIR", dest="wcedir", default="/usr/local/share/wce")
+  # If you want to use other server (any other http server) you need to override this.
+  # This is necessary if you want to offload the payload download to web server light apache.
+  # For this case, you need to be able to use any URL.
+  # Note that, the boot arg (aka cmdline) is used for picking up the default value of wce_share_url
+  # as well, and this overrides this.
+  cli.add_argument("--wce_share", type=str, metavar="WCE_SHARE_URL", dest="wce_share", default=None)
 
-# If you want to use other server (any other http server) you need to override this.
-# This is necessary if you want to offload the payload download to web server light apache.
-# For this case, you need to be able to use any URL.
-# Note that, the boot arg (aka cmdline) is used for picking up the default value of wce_share_url
-# as well, and this overrides this.
-cli.add_argument("--wce_share", type=str, metavar="WCE_SHARE_URL", dest="wce_share", default=None)
+  cli.add_argument("--live-triage", dest="live_triage", action='store_true')
+
+  # Time budget of CPU benchmark in seconds
+  cli.add_argument("--cpu-benchmark-time", type=float, metavar="SECONDS", dest="cpu_benchmark_time", default=2.0)
+
+  # Triage result is cached per machine for this many seconds. 0 disables the cache.
+  cli.add_argument("--triage-cache-ttl", type=int, metavar="SECONDS", dest="triage_cache_ttl", default=7*24*3600)
+
+  # Number of disk images sent at the same time
+  cli.add_argument("--max-image-clients", type=int, metavar="N", dest="max_image_clients", default=DEFAULT_MAX_IMAGE_CLIENTS)
+
+  # Runners are forked from the pre-warmed worker instead of starting python3 each time.
+  cli.add_argument("--no-worker-pool", dest="worker_pool", action="store_false")
+
+  # Speed test of the triage server. Default is the triage server on the WCE share machine.
+  cli.add_argument("--speedtest-url", type=str, metavar="URL", dest="speedtest_url", default=None)
+  return cli
 
-cli.add_argument("--live-triage", dest="live_triage", action='store_true')
-arguments = cli.parse_args()
 
 # If the module is invoked directly, initialize the application
 def my_main():
+  global arguments
+  arguments = make_argument_parser().parse_args()
   tlog = init_triage_logger(log_level=logging.DEBUG)
   
   # Create and configure the HTTP server instance
@@ -1397,7 +1954,11 @@ def my_main():
   if rootdir is None:
     rootdir = os.path.join(wcedir, "wce-triage-ui")
     pass
-  me = TriageWeb(app, wce_share_url, rootdir, wcedir, cors, loop, arguments.live_triage, load_disk_options)
+  triage_cache = TriageCache(ttl=arguments.triage_cache_ttl) if arguments.triage_cache_ttl > 0 else None
+  if arguments.worker_pool:
+    worker_pool.start_worker_pool()
+    pass
+  me = TriageWeb(app, wce_share_url, rootdir, wcedir, cors, loop, arguments.live_triage, load_disk_options, triage_cache=triage_cache)
 
   tlog.info(u"Open {0}{1} in a web browser. WCE share is {2}".format(the_root_url, "/index.html", wce_share_url))
   Emitter.register(loop)
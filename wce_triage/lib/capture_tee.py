@@ -0,0 +1,449 @@
+# Copyright (c) 2019 Naoyuki tai
+# MIT license - see LICENSE
+"""Tee of the compressed disk image to more than one destination.
+
+image_volume used to write the image to one place, a local file or curl.
+Saving it to the local catalog, uploading it to the server and copying it to
+another catalog meant running the imaging again or copying it after. Here,
+the compressed stream is read once and handed to the sinks, each with its
+own buffer and thread.
+
+  compressor -> tee -> [buffer] -> FileSink     (first local file, "primary")
+                    -> [buffer] -> HttpPutSink
+                    -> [buffer] -> FileSink / CommandSink
+
+A sink that fails is dropped and the rest goes on. A sink that falls behind
+and fills up its buffer stops getting the stream from the tee, and catches
+up by reading the primary's file instead, so a slow upload does not hold
+back the imaging. Without a local file to read from, the slowest sink sets
+the pace.
+"""
+
+import os, sys, time, base64, threading, subprocess, urllib.parse
+from .image_stream import BoundedBuffer, StreamFailed
+from .util import get_triage_logger
+
+tlog = get_triage_logger()
+
+READ_SIZE = 2 ** 20
+DEFAULT_SINK_BUFFER_SIZE = 64 * 2 ** 20
+DEFAULT_TIMEOUT = 60
+
+
+class Sink(object):
+  """Base class of destination. Subclass implements open(), write(), finish()
+and abort()."""
+
+  def __init__(self, name, buffer_size=DEFAULT_SINK_BUFFER_SIZE):
+    self.name = name
+    self.buffer = BoundedBuffer(buffer_size)
+    self.written = 0
+    self.error = None
+    self.state = "waiting"
+    self.finished = False
+    self.primary = None # Sink to catch up from when following
+    self.following = False
+    self.start_time = None
+    self.end_time = None
+    self.cond = threading.Condition()
+    pass
+
+  def open(self):
+    pass
+
+  def write(self, data):
+    raise NotImplementedError()
+
+  def finish(self):
+    """Called after all of image is written."""
+    pass
+
+  def abort(self):
+    """Called when the sink failed. Should clean up the partial output."""
+    pass
+
+  def open_reader(self):
+    """File object to read back what's been written so far. Only the local file can."""
+    return None
+
+  def _write(self, data):
+    self.write(data)
+    with self.cond:
+      self.written += len(data)
+      self.cond.notify_all()
+      pass
+    pass
+
+  def follow(self, primary):
+    """Stops taking the stream from the tee. The rest comes from the primary."""
+    self.primary = primary
+    self.following = True
+    self.buffer.close()
+    pass
+
+  def _follow(self):
+    primary = self.primary
+    with primary.open_reader() as source:
+      source.seek(self.written)
+      while True:
+        with primary.cond:
+          while primary.written <= self.written and not primary.finished:
+            primary.cond.wait(1)
+            pass
+          available = primary.written - self.written
+          pass
+        if available <= 0:
+          if primary.error is not None:
+            raise StreamFailed("%s failed while catching up. %s" % (primary.name, primary.error))
+          break
+        data = source.read(min(READ_SIZE, available))
+        if not data:
+          raise StreamFailed("%s is shorter than %d bytes." % (primary.name, primary.written))
+        self._write(data)
+        pass
+      pass
+    pass
+
+  def run(self):
+    self.start_time = time.monotonic()
+    try:
+      self.open()
+      self.state = "running"
+      while True:
+        data = self.buffer.get()
+        if not data:
+          break
+        self._write(data)
+        pass
+      if self.following:
+        self.state = "following"
+        self._follow()
+        pass
+      self.finish()
+      self.state = "done"
+    except Exception as exc:
+      self.error = str(exc)
+      self.state = "failed"
+      tlog.info("Sink %s failed: %s" % (self.name, self.error))
+      self.buffer.fail(self.error)
+      try:
+        self.abort()
+      except Exception:
+        pass
+      pass
+    self.end_time = time.monotonic()
+    with self.cond:
+      self.finished = True
+      self.cond.notify_all()
+      pass
+    pass
+
+  def stats(self):
+    elapsed = None
+    if self.start_time is not None:
+      elapsed = (self.end_time or time.monotonic()) - self.start_time
+      pass
+    return { "name": self.name,
+             "state": self.state,
+             "bytes": self.written,
+             "buffered": self.buffer.size,
+             "rate": round(self.written / elapsed) if elapsed else None,
+             "error": self.error }
+  pass
+
+
+class FileSink(Sink):
+  """Writes to path.partial and renames it to path at the end."""
+
+  def __init__(self, path, **kwargs):
+    super().__init__(path, **kwargs)
+    self.path = path
+    self.partial_path = path + ".partial"
+    self.output = None
+    pass
+
+  def open(self):
+    # Unbuffered so that the followers can read it back right away.
+    self.output = open(self.partial_path, "wb", buffering=0)
+    pass
+
+  def write(self, data):
+    self.output.write(data)
+    pass
+
+  def finish(self):
+    self.output.close()
+    self.output = None
+    # The followers open the file by the state. Both change together.
+    with self.cond:
+      os.rename(self.partial_path, self.path)
+      self.state = "done"
+      pass
+    pass
+
+  def abort(self):
+    if self.output is not None:
+      self.output.close()
+      self.output = None
+      pass
+    if os.path.exists(self.partial_path):
+      os.unlink(self.partial_path)
+      pass
+    pass
+
+  def open_reader(self):
+    with self.cond:
+      return open(self.path if self.state == "done" else self.partial_path, "rb")
+    pass
+  pass
+
+
+class StreamSink(Sink):
+  """Writes to already opened file object, such as stdout."""
+
+  def __init__(self, output, name="stdout", **kwargs):
+    super().__init__(name, **kwargs)
+    self.output = output
+    pass
+
+  def write(self, data):
+    self.output.write(data)
+    pass
+
+  def finish(self):
+    self.output.flush()
+    pass
+  pass
+
+
+def _split_credentials(url):
+  """URL without query, and user/password from the query. The same as curl's
+destination of image_volume: URL?user=<user>&password=<password>"""
+  parsed = urllib.parse.urlsplit(url)
+  user = None
+  password = None
+  if parsed.query:
+    params = urllib.parse.parse_qs(parsed.query)
+    user = params.get('user', [None])[0]
+    password = params.get('password', [None])[0]
+    pass
+  return urllib.parse.urlunsplit(parsed._replace(query="", fragment="")), user, password
+
+
+class HttpPutSink(Sink):
+  """Uploads with http PUT in chunked transfer encoding."""
+
+  def __init__(self, url, timeout=DEFAULT_TIMEOUT, **kwargs):
+    self.url, self.user, self.password = _split_credentials(url)
+    super().__init__(self.url, **kwargs)
+    self.timeout = timeout
+    self.connection = None
+    pass
+
+  def open(self):
+    import http.client
+    parsed = urllib.parse.urlsplit(self.url)
+    if parsed.scheme == "https":
+      self.connection = http.client.HTTPSConnection(parsed.hostname, parsed.port, timeout=self.timeout)
+    else:
+      self.connection = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=self.timeout)
+      pass
+    self.connection.putrequest("PUT", parsed.path or "/")
+    self.connection.putheader("Transfer-Encoding", "chunked")
+    self.connection.putheader("Content-Type", "application/octet-stream")
+    if self.user and self.password:
+      credentials = base64.b64encode(("%s:%s" % (self.user, self.password)).encode("utf-8")).decode("ascii")
+      self.connection.putheader("Authorization", "Basic " + credentials)
+      pass
+    self.connection.endheaders()
+    pass
+
+  def write(self, data):
+    self.connection.send(b"%x\r\n" % len(data) + data + b"\r\n")
+    pass
+
+  def finish(self):
+    self.connection.send(b"0\r\n\r\n")
+    reply = self.connection.getresponse()
+    reply.read()
+    self.connection.close()
+    self.connection = None
+    if reply.status < 200 or reply.status >= 300:
+      raise StreamFailed("Upload to %s failed. (status %d %s)" % (self.url, reply.status, reply.reason))
+    pass
+
+  def abort(self):
+    if self.connection is not None:
+      self.connection.close()
+      self.connection = None
+      pass
+    pass
+  pass
+
+
+class CommandSink(Sink):
+  """Pipes to the stdin of command, such as curl for the schemes other than http."""
+
+  def __init__(self, argv, name=None, **kwargs):
+    super().__init__(name or argv[0], **kwargs)
+    self.argv = argv
+    self.process = None
+    pass
+
+  def open(self):
+    self.process = subprocess.Popen(self.argv, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    pass
+
+  def write(self, data):
+    self.process.stdin.write(data)
+    pass
+
+  def finish(self):
+    self.process.stdin.close()
+    error = self.process.stderr.read()
+    if self.process.wait() != 0:
+      raise StreamFailed("%s exited with %d. %s" % (self.argv[0], self.process.returncode, error.decode("iso-8859-1").strip()))
+    pass
+
+  def abort(self):
+    if self.process is not None and self.process.poll() is None:
+      self.process.kill()
+      self.process.wait()
+      pass
+    pass
+  pass
+
+
+def select_capture_destinations(allowed, requested):
+  """Destinations for the capture request.
+
+allowed: captureDestinations of the catalog (.disk_image_type.json)
+requested: destinations in the request, which pick from the allowed ones.
+The capture runs as root, so a destination that is not in the catalog is
+refused instead of written to. Without requested, all of allowed.
+"""
+  if not requested:
+    return list(allowed)
+  unknown = [ dest for dest in requested if dest not in allowed ]
+  if unknown:
+    raise Exception("Capture destination %s is not in the catalog." % ", ".join(unknown))
+  return [ dest for dest in allowed if dest in requested ]
+
+
+def make_sink(dest, **kwargs):
+  """Sink for the destination of image_volume: file path, URL or '-' for stdout."""
+  if dest == "-":
+    return StreamSink(sys.stdout.buffer, **kwargs)
+  scheme = urllib.parse.urlsplit(dest).scheme
+  if scheme in ["http", "https"]:
+    return HttpPutSink(dest, **kwargs)
+  if scheme:
+    url, user, password = _split_credentials(dest)
+    argv = [ "curl", "-s", "-S", "-T", "-", url ]
+    if user and password:
+      argv = argv + [ "--user", "%s:%s" % (user, password) ]
+      pass
+    return CommandSink(argv, name=url, **kwargs)
+  return FileSink(dest, **kwargs)
+
+
+class CaptureTee(object):
+  """Reads the source and hands the data to all of sinks.
+
+source: file-like with read(), such as stdout of compressor
+sinks: Sink objects. The first FileSink is the primary that lagging sinks catch up from.
+"""
+
+  def __init__(self, source, sinks):
+    self.source = source
+    self.sinks = sinks
+    self.primary = None
+    for sink in sinks:
+      if isinstance(sink, FileSink):
+        self.primary = sink
+        break
+      pass
+    # The primary gets the data first so that it's ahead of the followers.
+    if self.primary is not None:
+      self.sinks = [self.primary] + [ sink for sink in sinks if sink is not self.primary ]
+      pass
+    self.read_bytes = 0
+    self.error = None
+    self.threads = []
+    pass
+
+  def _feed(self, data):
+    primary_ok = self.primary is not None and self.primary.error is None
+    for sink in self.sinks:
+      if sink.error is not None or sink.following:
+        continue
+      try:
+        if sink is self.primary or not primary_ok:
+          # Back pressure
+          sink.buffer.put(data)
+        elif not sink.buffer.try_put(data):
+          tlog.info("Sink %s is behind. It catches up from %s." % (sink.name, self.primary.name))
+          sink.follow(self.primary)
+          pass
+        pass
+      except StreamFailed:
+        # The sink failed. Others go on.
+        pass
+      pass
+    pass
+
+  def _reader(self):
+    try:
+      while True:
+        data = self.source.read(READ_SIZE)
+        if not data:
+          break
+        self.read_bytes += len(data)
+        self._feed(data)
+        pass
+      for sink in self.sinks:
+        sink.buffer.close()
+        pass
+    except Exception as exc:
+      self.error = "read: %s" % str(exc)
+      tlog.info("Capture tee " + self.error)
+      for sink in self.sinks:
+        sink.buffer.fail(self.error)
+        pass
+      pass
+    pass
+
+  def start(self):
+    for target in [ sink.run for sink in self.sinks ] + [self._reader]:
+      thread = threading.Thread(target=target, daemon=True)
+      thread.start()
+      self.threads.append(thread)
+      pass
+    pass
+
+  def stop(self):
+    if self.error is None:
+      self.error = "Stop requested"
+      pass
+    for sink in self.sinks:
+      sink.buffer.fail(self.error)
+      pass
+    pass
+
+  def join(self, timeout=None):
+    """Returns the sinks that failed."""
+    for thread in self.threads:
+      thread.join(timeout)
+      pass
+    return self.failed_sinks()
+
+  def is_alive(self):
+    return [ thread for thread in self.threads if thread.is_alive() ] != []
+
+  def failed_sinks(self):
+    return [ sink for sink in self.sinks if sink.error is not None ]
+
+  def stats(self):
+    return { "read": self.read_bytes,
+             "sinks": [ sink.stats() for sink in self.sinks ] }
+  pass
@@ -0,0 +1,286 @@
+# Copyright (c) 2019 Naoyuki tai
+# MIT license - see LICENSE
+"""Content defined chunking of disk image files for delta sync.
+
+An image file is cut into chunks where the content has a marker byte
+sequence, so the cut points move with the content when bytes are inserted
+or removed in front of them. Each chunk is identified by its sha256. The
+list of chunks (manifest) is kept next to the image as <image>.chunks.json
+so that the image is read for this only once.
+
+When a new image is synced to a disk that has older images, the chunks the
+older images already have are copied from them, and only the rest is read
+from the source. Images compressed with "gzip --rsyncable" share far more
+chunks than the plain gzip ones, so the capture compresses with
+"pigz --rsyncable" (see util.get_file_compression_app).
+
+The older images on the disk are the copies of the images in the source
+catalog, so their manifests are made from the source copies instead of
+reading the images on the (slower) destination disk.
+"""
+
+import os, json, hashlib
+from .util import get_triage_logger
+
+tlog = get_triage_logger()
+
+MANIFEST_SUFFIX = ".chunks.json"
+MANIFEST_VERSION = 1
+
+# In compressed data, the 2 byte marker shows up every 64KiB on average.
+CHUNK_MARKER = b"\xa5\x5a"
+CHUNK_MIN_SIZE = 2 ** 16
+CHUNK_MAX_SIZE = 2 ** 20
+
+READ_SIZE = 8 * 2 ** 20
+
+
+def iter_chunks(fileobj, min_size=CHUNK_MIN_SIZE, max_size=CHUNK_MAX_SIZE, marker=CHUNK_MARKER):
+  """Yields (offset, length, sha256 hex digest) of the chunks of file."""
+  buf = b""
+  start = 0 # start of current chunk in buf
+  offset = 0
+  eof = False
+  while True:
+    if not eof and len(buf) - start < max_size:
+      data = fileobj.read(READ_SIZE)
+      if data:
+        buf = buf[start:] + data
+        start = 0
+      else:
+        eof = True
+        pass
+      continue
+    if start >= len(buf):
+      break
+    # Chunk ends right after the marker found past the min size
+    cut = buf.find(marker, start + min_size, start + max_size)
+    if cut >= 0:
+      cut += len(marker)
+    else:
+      cut = min(start + max_size, len(buf))
+      pass
+    yield (offset, cut - start, hashlib.sha256(buf[start:cut]).hexdigest())
+    offset += cut - start
+    start = cut
+    pass
+  pass
+
+
+def manifest_path(image_path):
+  return image_path + MANIFEST_SUFFIX
+
+
+def build_manifest(image_path):
+  """Reads the image and makes the manifest."""
+  filestat = os.stat(image_path)
+  with open(image_path, "rb") as image:
+    chunks = [ [length, digest] for offset, length, digest in iter_chunks(image) ]
+    pass
+  return { "version": MANIFEST_VERSION,
+           "size": filestat.st_size,
+           "mtime": int(filestat.st_mtime),
+           "marker": CHUNK_MARKER.hex(),
+           "minSize": CHUNK_MIN_SIZE,
+           "maxSize": CHUNK_MAX_SIZE,
+           "chunks": chunks }
+
+
+def is_manifest_valid(manifest, image_path):
+  """Manifest is for this image file, made with the same chunking."""
+  try:
+    filestat = os.stat(image_path)
+  except OSError:
+    return False
+  return (manifest.get("version") == MANIFEST_VERSION and
+          manifest.get("size") == filestat.st_size and
+          manifest.get("mtime") == int(filestat.st_mtime) and
+          manifest.get("marker") == CHUNK_MARKER.hex() and
+          manifest.get("minSize") == CHUNK_MIN_SIZE and
+          manifest.get("maxSize") == CHUNK_MAX_SIZE)
+
+
+def load_manifest(image_path):
+  """Returns the saved manifest of image, or None when it's missing or out of date."""
+  try:
+    with open(manifest_path(image_path)) as manifest_file:
+      manifest = json.load(manifest_file)
+      pass
+  except (OSError, ValueError):
+    return None
+  if not is_manifest_valid(manifest, image_path):
+    return None
+  return manifest
+
+
+def save_manifest(image_path, manifest):
+  """Saves the manifest next to the image. Read only catalog is fine."""
+  path = manifest_path(image_path)
+  try:
+    with open(path + ".tmp", "w") as manifest_file:
+      json.dump(manifest, manifest_file)
+      pass
+    os.rename(path + ".tmp", path)
+    return True
+  except OSError as exc:
+    tlog.info("Saving chunk manifest %s failed: %s" % (path, str(exc)))
+    pass
+  return False
+
+
+def get_manifest(image_path, save=True):
+  """Saved manifest, or makes one and saves it."""
+  manifest = load_manifest(image_path)
+  if manifest is None:
+    manifest = build_manifest(image_path)
+    if save:
+      save_manifest(image_path, manifest)
+      pass
+    pass
+  return manifest
+
+
+def get_copy_manifest(image_path, source_path, save=True):
+  """Manifest of image_path, which is a copy of source_path.
+
+When the copy has no manifest, the one of the source is used (made at the
+source when the source has none either) as long as the size is the same.
+The chunks are checked against the digest when they are used, so a copy
+that turns out to be different costs reading the source, not a broken image.
+"""
+  manifest = load_manifest(image_path)
+  if manifest is not None:
+    return manifest
+  try:
+    same_size = os.path.getsize(source_path) == os.path.getsize(image_path)
+  except OSError:
+    same_size = False
+    pass
+  if not same_size:
+    return get_manifest(image_path, save=save)
+  manifest = dict(get_manifest(source_path, save=save), mtime=int(os.stat(image_path).st_mtime))
+  if save:
+    save_manifest(image_path, manifest)
+    pass
+  return manifest
+
+
+def plan_delta(manifest, basis):
+  """Plans the delta copy.
+
+manifest: manifest of the image being copied.
+basis: list of (path, manifest) of the images the destination already has.
+
+Returns list of (path, offset, length, chunks). path is None for the ranges
+read from the source, and chunks is the [length, digest] of the chunks in it.
+Consecutive chunks read from the same place are merged.
+"""
+  known = {}
+  for path, basis_manifest in basis:
+    offset = 0
+    for length, digest in basis_manifest["chunks"]:
+      if digest not in known:
+        known[digest] = (path, offset)
+        pass
+      offset += length
+      pass
+    pass
+
+  plan = []
+  for length, digest in manifest["chunks"]:
+    path, offset = known.get(digest, (None, None))
+    if plan:
+      last_path, last_offset, last_length, last_chunks = plan[-1]
+      if path == last_path and (path is None or last_offset + last_length == offset):
+        last_chunks.append([length, digest])
+        plan[-1] = (last_path, last_offset, last_length + length, last_chunks)
+        continue
+      pass
+    plan.append((path, offset, length, [[length, digest]]))
+    pass
+
+  # Offsets of the source ranges
+  source_offset = 0
+  for index, (path, offset, length, chunks) in enumerate(plan):
+    if path is None:
+      plan[index] = (None, source_offset, length, chunks)
+      pass
+    source_offset += length
+    pass
+  return plan
+
+
+def _read_chunk(fileobj, offset, length):
+  fileobj.seek(offset)
+  data = fileobj.read(length)
+  if len(data) != length:
+    raise Exception("Short read at %d. (%d of %d bytes)" % (offset, len(data), length))
+  return data
+
+
+def assemble(source_path, output_path, manifest, plan, progress=None):
+  """Writes the image to output from the plan.
+
+Chunks from the older images are checked against the digest, and read from
+the source when they don't match. The image is written to output.partial and
+renamed when done. progress(bytes_written, bytes_from_source) is called per range.
+
+Returns (bytes from source, bytes from older images).
+"""
+  partial_path = output_path + ".partial"
+  basis_files = {}
+  from_source = 0
+  from_basis = 0
+  try:
+    with open(source_path, "rb") as source, open(partial_path, "wb") as output:
+      written = 0
+      source_offset = 0
+      for path, offset, length, chunks in plan:
+        if path is None:
+          for piece in range(0, length, READ_SIZE):
+            output.write(_read_chunk(source, offset + piece, min(READ_SIZE, length - piece)))
+            pass
+          from_source += length
+        else:
+          if path not in basis_files:
+            basis_files[path] = open(path, "rb")
+            pass
+          basis = basis_files[path]
+          basis.seek(offset)
+          chunk_offset = source_offset
+          for chunk_length, digest in chunks:
+            data = basis.read(chunk_length)
+            if hashlib.sha256(data).hexdigest() == digest:
+              from_basis += chunk_length
+            else:
+              # Older image changed since its manifest was made
+              data = _read_chunk(source, chunk_offset, chunk_length)
+              from_source += chunk_length
+              pass
+            output.write(data)
+            chunk_offset += chunk_length
+            pass
+          pass
+        written += length
+        source_offset += length
+        if progress:
+          progress(written, from_source)
+          pass
+        pass
+
+      if written != manifest["size"]:
+        raise Exception("Assembled %d bytes of %d." % (written, manifest["size"]))
+      pass
+    os.rename(partial_path, output_path)
+  except Exception:
+    try:
+      os.unlink(partial_path)
+    except OSError:
+      pass
+    raise
+  finally:
+    for basis in basis_files.values():
+      basis.close()
+      pass
+    pass
+  return (from_source, from_basis)
@@ -1,10 +1,22 @@
 # Copyright (c) 2019 Naoyuki tai
 # MIT license - see LICENSE
-"""cpubench gets the cpu perf. 
-Currently, this uses hardinfo.
+"""cpubench gets the cpu perf.
+
+This runs a few short, deterministic kernels (hashing, zlib, integer and
+float loops) single-threaded and on all cores, and normalizes the result
+against the baseline machine. It used to use hardinfo, which requires an
+exact version and takes long time on old machines.
+
+The seconds per kernel iteration of the baseline machine are in the table
+below. They are made offline with "--calibrate" on a machine with the hardinfo
+the baseline numbers are taken with: the ratio of the baseline to its hardinfo
+result is the speed of the machine relative to the baseline machine, and the
+seconds per kernel iteration multiplied by the ratio is what the baseline
+machine would take. The benchmark itself never runs hardinfo.
 """
 
-import subprocess, json
+import os, sys, json, time, hashlib, zlib, math, cmath
+from concurrent.futures import ProcessPoolExecutor
 
 from .util import get_triage_logger
 tlog = get_triage_logger()
@@ -14,82 +26,335 @@ global cpu_info
 # Baseline is Intel Core 2 Duo T7300 2GHz
 # This is probably the low end Core2 Duo
 #
-
+# "baseline" is the hardinfo result (seconds) of the baseline machine.
+# "kernel" is the built-in kernel standing in for the hardinfo benchmark,
+# and "kernel_baseline" is the seconds per kernel iteration on one core of
+# the baseline machine. Regenerate them with "--calibrate" when the kernels
+# change.
+#
 benchmarks = {
   'CPU Blowfish':   {"baseline": 8.300564},
-  'CPU CryptoHash': {"baseline": 1.748670},
-  'CPU Fibonacci' : {"baseline": 4.263994},
-  'CPU N-Queens' : {"baseline":  9.347419},
-  'CPU Zlib' : {"baseline": 19.856069},
-  'FPU FFT': {"baseline": 4.366442},
-  'FPU Raytracing':{"baseline": 12.173288}
+  'CPU CryptoHash': {"baseline": 1.748670, "kernel": "hash",        "kernel_baseline": 0.0040},
+  'CPU Fibonacci' : {"baseline": 4.263994, "kernel": "fibonacci",   "kernel_baseline": 0.0060},
+  'CPU N-Queens' : {"baseline":  9.347419, "kernel": "nqueens",     "kernel_baseline": 0.0040},
+  'CPU Zlib' : {"baseline": 19.856069,     "kernel": "zlib",        "kernel_baseline": 0.0176},
+  'FPU FFT': {"baseline": 4.366442,        "kernel": "fft",         "kernel_baseline": 0.0140},
+  'FPU Raytracing':{"baseline": 12.173288, "kernel": "raytracing",  "kernel_baseline": 0.0300}
 }
 
+# hardinfo of the baseline numbers. Only for --calibrate.
+HARDINFO_VERSION = 'HardInfo version 0.6-alpha'
+
+# Number of cores of baseline machine
+BASELINE_CORES = 2
+
+# Default time budget of whole benchmark in seconds
+DEFAULT_TIME_BUDGET = 2.0
+
 cpu_info = { 'benchmarks': benchmarks }
 
+#
+# Kernels
+#
+# Each kernel does one iteration of fixed amount of work and returns something
+# derived from the work so that it is not optimized away.
+#
 
-def get_cpu_info():
-  global cpu_info
+def _make_data(size, seed=0x5eed):
+  """Deterministic, semi-compressible data. Words from small vocabulary picked by LCG."""
+  words = [ b"triage ", b"world ", b"computer ", b"exchange ", b"disk ", b"image ", b"memory ", b"\x00\x01\x02\x03" ]
+  data = bytearray()
+  state = seed
+  while len(data) < size:
+    state = (state * 1103515245 + 12345) & 0x7fffffff
+    data += words[(state >> 16) & 7]
+    pass
+  return bytes(data[:size])
 
-  if 'rating' in cpu_info:
-    return cpu_info
+_kernel_data = {}
+
+def _get_data(size):
+  data = _kernel_data.get(size)
+  if data is None:
+    data = _make_data(size)
+    _kernel_data[size] = data
+    pass
+  return data
+
+
+def kernel_hash():
+  data = _get_data(2**18)
+  digest = b''
+  for _ in range(4):
+    digest = hashlib.sha256(data + digest).digest()
+    pass
+  return digest[0]
+
+
+def kernel_zlib():
+  compressed = zlib.compress(_get_data(2**17), 6)
+  return len(zlib.decompress(compressed))
+
+
+def _fibonacci(n):
+  if n < 2:
+    return n
+  return _fibonacci(n-1) + _fibonacci(n-2)
+
+def kernel_fibonacci():
+  return _fibonacci(20)
+
+
+def _nqueens(n, row=0, cols=0, diag1=0, diag2=0):
+  if row == n:
+    return 1
+  count = 0
+  avail = ((1 << n) - 1) & ~(cols | diag1 | diag2)
+  while avail:
+    bit = avail & -avail
+    avail ^= bit
+    count += _nqueens(n, row+1, cols | bit, ((diag1 | bit) << 1) & ((1 << n) - 1), (diag2 | bit) >> 1)
+    pass
+  return count
+
+def kernel_nqueens():
+  return _nqueens(8)
+
+
+def _fft(values):
+  n = len(values)
+  if n == 1:
+    return values
+  even = _fft(values[0::2])
+  odd = _fft(values[1::2])
+  result = [0] * n
+  for k in range(n // 2):
+    t = cmath.exp(-2j * math.pi * k / n) * odd[k]
+    result[k] = even[k] + t
+    result[k + n // 2] = even[k] - t
+    pass
+  return result
+
+def kernel_fft():
+  values = [ complex(math.sin(i * 0.1), math.cos(i * 0.3)) for i in range(1024) ]
+  return abs(_fft(values)[1])
+
+
+def kernel_raytracing():
+  # Rays from origin to 64x64 screen against 4 spheres
+  spheres = [ (0.0, 0.0, 5.0, 1.0), (1.5, 0.5, 6.0, 0.7), (-1.5, -0.5, 4.0, 0.5), (0.0, -101.0, 5.0, 100.0) ]
+  hits = 0
+  size = 64
+  for y in range(size):
+    for x in range(size):
+      dx = (x - size / 2) / size
+      dy = (y - size / 2) / size
+      norm = math.sqrt(dx * dx + dy * dy + 1.0)
+      dx, dy, dz = dx / norm, dy / norm, 1.0 / norm
+      nearest = None
+      for cx, cy, cz, radius in spheres:
+        b = dx * cx + dy * cy + dz * cz
+        c = cx * cx + cy * cy + cz * cz - radius * radius
+        disc = b * b - c
+        if disc >= 0:
+          t = b - math.sqrt(disc)
+          if t > 0 and (nearest is None or t < nearest):
+            nearest = t
+            pass
+          pass
+        pass
+      if nearest is not None:
+        hits += 1
+        pass
+      pass
+    pass
+  return hits
+
+
+kernels = { "hash": kernel_hash,
+            "zlib": kernel_zlib,
+            "fibonacci": kernel_fibonacci,
+            "nqueens": kernel_nqueens,
+            "fft": kernel_fft,
+            "raytracing": kernel_raytracing }
+
+
+def run_kernel(kernel_name, budget):
+  """runs the kernel repeatedly for the budget (seconds). Returns (iterations, elapsed).
+Runs at least once."""
+  kernel = kernels[kernel_name]
+  iterations = 0
+  start = time.perf_counter()
+  while True:
+    kernel()
+    iterations += 1
+    elapsed = time.perf_counter() - start
+    if elapsed >= budget:
+      break
+    pass
+  return (iterations, elapsed)
+
+
+def run_benchmarks(time_budget=DEFAULT_TIME_BUDGET, n_cores=None):
+  """runs the kernels single-threaded and then on all cores.
+
+Returns { benchmark name: (single core seconds per iteration, all core iterations per second) }
+"""
+  if n_cores is None:
+    n_cores = os.cpu_count() or 1
+    pass
+
+  names = [ name for name, benchmark in sorted(benchmarks.items()) if benchmark.get("kernel") ]
+  # Half of budget for single thread, and other half for all cores
+  budget = time_budget / (2 * len(names))
 
-  hardinfo = subprocess.run(["hardinfo", "-v"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  results = {}
+  for name in names:
+    iterations, elapsed = run_kernel(benchmarks[name]["kernel"], budget)
+    results[name] = (elapsed / iterations, iterations / elapsed)
+    pass
+
+  if n_cores > 1:
+    with ProcessPoolExecutor(max_workers=n_cores) as pool:
+      for name in names:
+        futures = [ pool.submit(run_kernel, benchmarks[name]["kernel"], budget) for _ in range(n_cores) ]
+        rate = 0
+        for future in futures:
+          iterations, elapsed = future.result()
+          rate = rate + iterations / elapsed
+          pass
+        results[name] = (results[name][0], rate)
+        pass
+      pass
+    pass
+  return results
+
+
+def _read_cpu_name():
+  try:
+    with open("/proc/cpuinfo") as cpuinfo:
+      for line in cpuinfo.readlines():
+        if line.startswith("model name"):
+          return line.split(":", 1)[1].strip()
+        pass
+      pass
+    pass
+  except:
+    pass
+  return "Unknown"
+
+
+def run_hardinfo():
+  """runs hardinfo benchmarks. Returns { benchmark name: seconds }, or None
+when hardinfo is not the version the baseline is taken with. Only for --calibrate."""
+  import subprocess
+  try:
+    hardinfo = subprocess.run(["hardinfo", "-v"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  except FileNotFoundError:
+    return None
   output = hardinfo.stdout.decode('iso-8859-1')
-  if output.splitlines()[0].strip() != 'HardInfo version 0.6-alpha':
-    cpu_info['rating'] = 'Unknown due to incompatible hardinfo version'
-    return cpu_info
+  if not output or output.splitlines()[0].strip() != HARDINFO_VERSION:
+    return None
 
   hardinfo = subprocess.run(["hardinfo", "-r", "-f", "text"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-  output = hardinfo.stdout.decode('iso-8859-1')
+  return parse_hardinfo(hardinfo.stdout.decode('iso-8859-1'))
+
+
+def parse_hardinfo(output):
+  results = {}
   bm_results = output.splitlines()[:15]
-  
-  benchmarks = cpu_info['benchmarks']
-  first = True
-  scores = []
-  
   while len(bm_results) > 1:
     bm_name = bm_results[0][1:-1]
     bm_result = bm_results[1]
     bm_results = bm_results[2:]
-
     if bm_name in benchmarks:
-      bm_columns = bm_result.split('|')
-      if first:
-        first = False
-        cpu_info['machine'] = bm_columns[1]
-        cpu_info['board'] = bm_columns[2]
-        cpu_info['name'] = bm_columns[3]
-        cpu_info['description'] = bm_columns[4]
-        cpu_info['config'] = bm_columns[5]
-        cpu_info['memory_size'] = bm_columns[6]
-        cpu_info['n_processors'] = bm_columns[7]
-        cpu_info['n_physical_cores'] = bm_columns[8]
-        cpu_info['n_logical_cores'] = bm_columns[9]
-        pass
-      details = bm_columns[0].split(';')
+      details = bm_result.split('|')[0].split(';')
+      results[bm_name] = float(details[3])
+      pass
+    pass
+  return results
 
-      result = float(details[3])
-      # n_threas = details[4]
 
-      benchmark = benchmarks[bm_name]
-      normalized_score = None
-      if 'baseline' in benchmark:
-        normalized_score = benchmark['baseline'] / result
-      elif 'baseline-count' in benchmark:
-        normalized_score = result / benchmark['baseline-count']
-        pass
-      if normalized_score:
-        benchmark['score'] = normalized_score
-        scores.append(normalized_score)
-        pass
-      pass
+def calibrate(hardinfo_results, time_budget=DEFAULT_TIME_BUDGET):
+  """Returns { benchmark name: seconds per kernel iteration of the baseline machine }
+
+hardinfo_results is the hardinfo result of this machine.
+"""
+  calibration = {}
+  results = run_benchmarks(time_budget=time_budget, n_cores=1)
+  for name, (seconds_per_iteration, rate) in results.items():
+    if not hardinfo_results.get(name):
+      continue
+    # How much faster this machine is than the baseline machine
+    ratio = benchmarks[name]['baseline'] / hardinfo_results[name]
+    calibration[name] = seconds_per_iteration * ratio
+    pass
+  return calibration
+
+
+def get_kernel_baselines():
+  """{ benchmark name: seconds per kernel iteration of the baseline machine }"""
+  return { name: benchmark["kernel_baseline"] for name, benchmark in benchmarks.items() if benchmark.get("kernel_baseline") }
+
+
+def get_cpu_info(time_budget=DEFAULT_TIME_BUDGET, calibration=None):
+  global cpu_info
+
+  if 'rating' in cpu_info:
+    return cpu_info
+
+  n_cores = os.cpu_count() or 1
+  cpu_info['name'] = _read_cpu_name()
+  cpu_info['n_logical_cores'] = n_cores
+
+  if calibration is None:
+    calibration = get_kernel_baselines()
+    pass
+
+  results = run_benchmarks(time_budget=time_budget, n_cores=n_cores)
+
+  scores = []
+  single_scores = []
+  for name, (seconds_per_iteration, rate) in results.items():
+    if name not in calibration:
+      continue
+    benchmark = cpu_info['benchmarks'][name]
+    # 1.0 is as fast as the baseline machine
+    single_score = calibration[name] / seconds_per_iteration
+    score = rate * calibration[name] / BASELINE_CORES
+    benchmark['single_score'] = round(single_score, 2)
+    benchmark['score'] = round(score, 2)
+    single_scores.append(single_score)
+    scores.append(score)
     pass
 
+  if not scores:
+    cpu_info['rating'] = 'Unknown due to no baseline'
+    return cpu_info
+
+  cpu_info['single_thread_rating'] = str(round(sum(single_scores) / len(single_scores), 2))
   cpu_info['rating'] = str(round(sum(scores) / len(scores), 2))
   return cpu_info
-      
+
 
 if __name__ == "__main__":
-  print(json.dumps(get_cpu_info()))
+  from argparse import ArgumentParser
+  parser = ArgumentParser(description="CPU benchmark")
+  parser.add_argument("--time-budget", type=float, dest="time_budget", default=DEFAULT_TIME_BUDGET)
+  parser.add_argument("--calibrate", action="store_true", help="For maintainer. Runs hardinfo and the kernels, and prints the kernel_baseline of the benchmarks table.")
+  args = parser.parse_args()
+
+  if args.calibrate:
+    hardinfo_results = run_hardinfo()
+    if not hardinfo_results:
+      print("Calibration needs %s." % HARDINFO_VERSION, file=sys.stderr)
+      sys.exit(1)
+      pass
+    calibration = calibrate(hardinfo_results, time_budget=max(args.time_budget, 20.0))
+    for name, seconds_per_iteration in sorted(calibration.items()):
+      print('%-16s "kernel_baseline": %.4f' % (name, seconds_per_iteration))
+      pass
+    sys.exit(0)
+    pass
+  print(json.dumps(get_cpu_info(time_budget=args.time_budget)))
   pass
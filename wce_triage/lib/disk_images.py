@@ -3,7 +3,8 @@
 """disk_image scans the disk image candidate directories and returns availabe disk images for loading.
 """
 import os, datetime, json, traceback
-from ..lib.util import get_triage_logger, init_triage_logger
+from ..lib.util import get_triage_logger, init_triage_logger, get_transport_scheme
+from .image_index import read_image_index
 
 tlog = get_triage_logger()
 
@@ -12,6 +13,9 @@ WCE_IMAGES = "/usr/local/share/wce/wce-disk-images"
 
 IMAGE_META_JSON_FILE = ".disk_image_type.json"
 
+# Per image metadata written at capture, next to the image file.
+IMAGE_METADATA_SUFFIX = ".meta.json"
+
 def set_wce_disk_image_dir(dir):
   global WCE_IMAGES
   WCE_IMAGES = dir
@@ -110,6 +114,10 @@ def get_disk_images(wce_share_url=None):
       name: filename - this is shown to the user.
       size: file size
       fullpath: the full path.
+      filesystem: metadata of the file system in the image, when it's recorded at capture.
+                  See read_image_metadata().
+      partclone: summary of partclone header and bitmap made by bin/index_disk_images.
+                 See lib/image_index.
 
     ..note the entries are deduped by the filename so if two directories
            contain the same file name, only one is pikced.
@@ -143,6 +151,21 @@ def get_disk_images(wce_share_url=None):
               "size": filestat.st_size,
               "subdir": subdir,
               "index": len(result) }
+    if wce_share_url:
+      image_meta = read_disk_image_type(os.path.dirname(image[2]))
+      mirrors = get_mirror_urls(fullpath, image_meta.get("mirrors") if image_meta else None)
+      if mirrors:
+        fattr["mirrors"] = mirrors
+        pass
+      pass
+    image_metadata = read_image_metadata(image[2])
+    if image_metadata:
+      fattr["filesystem"] = image_metadata
+      pass
+    image_index = read_image_index(image[2])
+    if image_index:
+      fattr["partclone"] = image_index
+      pass
     result.append(fattr)
     pass
 
@@ -152,6 +175,79 @@ def get_disk_images(wce_share_url=None):
   return result
 
 
+def get_image_metadata_path(image_path):
+  return image_path + IMAGE_METADATA_SUFFIX
+
+
+def read_image_metadata(image_path):
+  '''Reads the metadata of image recorded at capture.
+
+    :arg:
+      image_path: path of image file, or URL of image on the wce share.
+
+    :returns: dict or None if there is none.
+
+  { "fileSystem": "ext4",
+    "blockSize": 4096,
+    "blockCount": 2621440,  # size of file system in the image
+    "usedBlocks": 1048576,  # blocks partclone copies
+    "minBlocks": 1100000,   # resize2fs -P. Smallest the file system can be resized to.
+    "fsSize": 10737418240,
+    "usedSize": 4294967296,
+    "minSize": 4505600000,
+    "shrunk": false }       # true when the file system was shrunk with resize2fs -M
+  '''
+  path = get_image_metadata_path(image_path)
+  try:
+    if get_transport_scheme(path) in ["http", "https"]:
+      import urllib.request
+      with urllib.request.urlopen(path, timeout=10) as reply:
+        return json.loads(reply.read().decode("utf-8"))
+      pass
+    if os.path.exists(path):
+      with open(path) as metadata_file:
+        return json.load(metadata_file)
+      pass
+    pass
+  except Exception as exc:
+    tlog.info("No metadata for %s: %s" % (image_path, str(exc)))
+    pass
+  return None
+
+
+def write_image_metadata(image_path, metadata):
+  path = get_image_metadata_path(image_path)
+  tmp_path = path + ".tmp"
+  with open(tmp_path, "w") as metadata_file:
+    json.dump(metadata, metadata_file, indent=2)
+    pass
+  os.rename(tmp_path, path)
+  pass
+
+
+def get_mirror_urls(image_url, mirrors):
+  '''URLs of the image on the mirrors.
+
+    :arg:
+      image_url: URL of image on the wce share. {wce_share_url}/wce-disk-images/{restoretype}/{filename}
+      mirrors: "mirrors" of .disk_image_type.json. List of wce share URLs of other servers.
+
+    :returns: list of URLs. Empty if the image_url is not on the wce share.
+  '''
+  marker = "/wce-disk-images/"
+  if not mirrors or marker not in image_url:
+    return []
+  image_path = image_url[image_url.index(marker):]
+  urls = []
+  for mirror in mirrors:
+    url = mirror.rstrip("/") + image_path
+    if url != image_url and url not in urls:
+      urls.append(url)
+      pass
+    pass
+  return urls
+
+
 def read_disk_image_types(verbose=False):
   '''scans the known drectories for disk image and returns the list of disk image types
 
@@ -165,6 +261,9 @@ def read_disk_image_types(verbose=False):
       "timestamp": true,
       "efi_image": ".efi-512M.fat32.partclone.gz",
       "partition_map": "gpt",
+      "mirrors": [ "http://10.3.2.2:8312/wce" ],
+      "captureDestinations": [ "http://10.3.2.2:8312/upload/wce-18/" ],
+      "shrink": false,
       "hostname": "wce",
       "randomize_hostname": true,
       "cmdline": {
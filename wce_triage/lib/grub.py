@@ -1,6 +1,8 @@
 
 import re
+import os
 import sys
+import json
 from .kernel_flags import kernel_flags
 from ..const import const
 
@@ -124,6 +126,171 @@ class grub_config:
 
   
 
+def read_grub_cmdline(filename):
+  """Kernel command line grub-mkconfig would put on the linux line from /etc/default/grub.
+GRUB_CMDLINE_LINUX followed by GRUB_CMDLINE_LINUX_DEFAULT."""
+  variables = [ grub_variable('GRUB_CMDLINE_LINUX'), grub_variable('GRUB_CMDLINE_LINUX_DEFAULT') ]
+  with open(filename, "r") as grub_fd:
+    lines = grub_fd.read().splitlines()
+    pass
+  for line_no in range(len(lines)):
+    for variable in variables:
+      variable.parse_line(lines[line_no], line_no)
+      pass
+    pass
+  return " ".join([ variable.flags.get_cmdline() for variable in variables if variable.cmdline ])
+
+
+#
+# grub.cfg template
+#
+# grub-mkconfig in chroot probes the whole system and it's slow on slow media.
+# At capture, the kernels in /boot are recorded in the file system as the
+# template, and at restore, grub.cfg is made from it with the file system UUID
+# and the command line of the restored disk. When the kernels in /boot do not
+# match with the template, it's stale and grub-mkconfig is used.
+#
+GRUB_TEMPLATE_PATH = "boot/grub/wce-grub-template.json"
+GRUB_TEMPLATE_VERSION = 1
+
+grub_cfg_header = """# Generated by WCE triage from the template.
+set default=0
+set timeout=@TIMEOUT@
+insmod part_gpt
+insmod part_msdos
+insmod ext2
+search --no-floppy --fs-uuid --set=root @ROOT_UUID@
+
+# Same as the one grub-mkconfig writes. The menu entries call it.
+function load_video {
+  if [ x$feature_all_video_module = xy ]; then
+    insmod all_video
+  else
+    insmod efi_gop
+    insmod efi_uga
+    insmod ieee1275_fb
+    insmod vbe
+    insmod vga
+    insmod video_bochs
+    insmod video_cirrus
+  fi
+}
+"""
+
+grub_menuentry_template = """menuentry '@TITLE@' --class gnu-linux --class os {
+	load_video
+	insmod gzio
+	linux	@LINUX@ root=UUID=@ROOT_UUID@ ro @CMDLINE@
+	initrd	@INITRD@
+}
+"""
+
+_kernel_re = re.compile(r'^vmlinuz-(.+)$')
+
+
+def _version_key(version):
+  return [ (1, int(part), "") if part.isdigit() else (0, 0, part) for part in re.split(r'[.\-]', version) ]
+
+
+def find_kernels(root_dir):
+  """Kernel and initrd in /boot of root_dir, newest first. Paths are from the root."""
+  boot_dir = os.path.join(root_dir, "boot")
+  kernels = []
+  if not os.path.isdir(boot_dir):
+    return kernels
+  for filename in os.listdir(boot_dir):
+    matched = _kernel_re.match(filename)
+    if not matched:
+      continue
+    version = matched.group(1)
+    initrd = "initrd.img-%s" % version
+    if not os.path.exists(os.path.join(boot_dir, initrd)):
+      continue
+    kernels.append({ "version": version, "linux": "/boot/" + filename, "initrd": "/boot/" + initrd })
+    pass
+  kernels.sort(key=lambda kernel: _version_key(kernel["version"]), reverse=True)
+  return kernels
+
+
+def make_grub_template(root_dir, title=None):
+  """Template of grub.cfg for the system at root_dir, or None when there is no kernel."""
+  kernels = find_kernels(root_dir)
+  if not kernels:
+    return None
+  grub_default = os.path.join(root_dir, "etc", "default", "grub")
+  cmdline = read_grub_cmdline(grub_default) if os.path.exists(grub_default) else ""
+  if title is None:
+    title = "Linux"
+    os_release = os.path.join(root_dir, "etc", "os-release")
+    if os.path.exists(os_release):
+      with open(os_release) as os_release_fd:
+        for line in os_release_fd.read().splitlines():
+          if line.startswith("PRETTY_NAME="):
+            title = line[len("PRETTY_NAME="):].strip('"')
+            pass
+          pass
+        pass
+      pass
+    pass
+  return { "version": GRUB_TEMPLATE_VERSION,
+           "title": title,
+           "timeout": 10,
+           "cmdline": cmdline,
+           "kernels": kernels }
+
+
+def write_grub_template(root_dir, template):
+  path = os.path.join(root_dir, GRUB_TEMPLATE_PATH)
+  with open(path + ".tmp", "w") as template_fd:
+    json.dump(template, template_fd, indent=2)
+    pass
+  os.rename(path + ".tmp", path)
+  pass
+
+
+def read_grub_template(root_dir):
+  path = os.path.join(root_dir, GRUB_TEMPLATE_PATH)
+  if not os.path.exists(path):
+    return None
+  try:
+    with open(path) as template_fd:
+      return json.load(template_fd)
+    pass
+  except ValueError:
+    return None
+  pass
+
+
+def is_grub_template_stale(template, root_dir):
+  """The kernels installed are not what the template has."""
+  if template.get("version") != GRUB_TEMPLATE_VERSION:
+    return True
+  recorded = [ (kernel["linux"], kernel["initrd"]) for kernel in template.get("kernels", []) ]
+  installed = [ (kernel["linux"], kernel["initrd"]) for kernel in find_kernels(root_dir) ]
+  return not recorded or sorted(recorded) != sorted(installed)
+
+
+def render_grub_template(template, root_uuid, cmdline=None):
+  """grub.cfg text. cmdline is the current one from /etc/default/grub. Without it,
+the one at capture is used."""
+  if cmdline is None:
+    cmdline = template.get("cmdline", "")
+    pass
+  grub_cfg = grub_cfg_header.replace("@TIMEOUT@", str(template.get("timeout", 10))).replace("@ROOT_UUID@", root_uuid)
+  for kernel in template["kernels"]:
+    entry = grub_menuentry_template
+    for marker, value in [ ("@TITLE@", "%s, %s" % (template.get("title", "Linux"), kernel["version"])),
+                           ("@LINUX@", kernel["linux"]),
+                           ("@INITRD@", kernel["initrd"]),
+                           ("@ROOT_UUID@", root_uuid),
+                           ("@CMDLINE@", cmdline) ]:
+      entry = entry.replace(marker, value)
+      pass
+    grub_cfg = grub_cfg + entry
+    pass
+  return grub_cfg
+
+
 if __name__ == "__main__":
   filename = "/etc/default/grub"
   if len(sys.argv) > 1:
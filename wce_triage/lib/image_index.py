@@ -0,0 +1,182 @@
+# Copyright (c) 2019 Naoyuki tai
+# MIT license - see LICENSE
+"""Index of disk image - summary of partclone header and bitmap.
+
+The size of compressed image says little about how much the restore writes.
+The index is made once per image by reading the partclone image descriptor and
+the bitmap at the head of image (only that much is decompressed), and is kept
+next to the image as <image>.index.json. The capture makes it at the end
+(task_index_disk_image), the sync copies it with the image, and
+bin/index_disk_images makes it for the images already on the share.
+
+  { "fileSystem": "extfs",          # partclone's file system name
+    "partcloneVersion": "0.3.13",
+    "blockSize": 4096,
+    "totalBlocks": 2621440,
+    "usedBlocks": 1048576,
+    "usedRuns": 5012,               # number of contiguous used block ranges
+    "lastUsedBlock": 2621439,
+    "deviceSize": 10737418240,      # size of file system in the image
+    "usedSize": 4294967296,         # bytes the restore writes
+    "minPartitionSize": 10737418240,# partition has to be at least this big
+    "imageSize": 1800000000,        # the image file the index is made from
+    "imageMtime": 1570000000.0 }
+"""
+
+import os, json
+from .util import get_triage_logger, get_transport_scheme
+from .image_stream import get_decompressor
+from .partclone_image import read_exactly, parse_image_desc, read_bitmap, iterate_used_runs, IMAGE_DESC_SIZE
+
+tlog = get_triage_logger()
+
+IMAGE_INDEX_SUFFIX = ".index.json"
+READ_SIZE = 2 ** 16
+
+
+class _DecompressingReader(object):
+  """Reads the decompressed image from the head as much as asked."""
+
+  def __init__(self, fileobj, decompressor):
+    self.fileobj = fileobj
+    self.decompressor = decompressor
+    self.buffer = b""
+    self.compressed_read = 0
+    # Decompressed chunks of the last read
+    self.pending = iter([])
+    pass
+
+  def read(self, size):
+    while len(self.buffer) < size:
+      chunk = next(self.pending, None)
+      if chunk is not None:
+        self.buffer += chunk
+        continue
+      data = self.fileobj.read(READ_SIZE)
+      if not data:
+        break
+      self.compressed_read += len(data)
+      self.pending = self.decompressor.decompress_chunks(data) if self.decompressor else iter([data])
+      pass
+    data = self.buffer[:size]
+    self.buffer = self.buffer[size:]
+    return data
+  pass
+
+
+def get_image_index_path(image_path):
+  return image_path + IMAGE_INDEX_SUFFIX
+
+
+def make_image_index(image_path):
+  """Reads the head of image and returns the index. Raises UnsupportedImage
+when the image is not partclone image version 2."""
+  filestat = os.stat(image_path)
+  with open(image_path, "rb") as image_file:
+    reader = _DecompressingReader(image_file, get_decompressor(image_path))
+    header = parse_image_desc(read_exactly(reader, IMAGE_DESC_SIZE))
+    bitmap = read_bitmap(reader, header)
+    pass
+
+  used_runs = 0
+  last_used_block = None
+  for first, count in iterate_used_runs(bitmap, header["totalBlocks"]):
+    used_runs += 1
+    last_used_block = first + count - 1
+    pass
+  block_size = header["blockSize"]
+  return { "fileSystem": header["fileSystem"].lower(),
+           "partcloneVersion": header["partcloneVersion"],
+           "blockSize": block_size,
+           "totalBlocks": header["totalBlocks"],
+           "usedBlocks": header["usedBlocks"],
+           "usedRuns": used_runs,
+           "lastUsedBlock": last_used_block,
+           "deviceSize": header["deviceSize"],
+           "usedSize": header["usedBlocks"] * block_size,
+           # partclone refuses the partition smaller than the file system in the image.
+           "minPartitionSize": max(header["deviceSize"], header["totalBlocks"] * block_size),
+           "imageSize": filestat.st_size,
+           "imageMtime": filestat.st_mtime }
+
+
+def _is_current(index, image_path):
+  """The index is made from this image file."""
+  try:
+    filestat = os.stat(image_path)
+  except OSError:
+    return False
+  return index.get("imageSize") == filestat.st_size and index.get("imageMtime") == filestat.st_mtime
+
+
+def _get_remote_size(url):
+  """Content-Length of the image on the server, or None."""
+  import urllib.request
+  with urllib.request.urlopen(urllib.request.Request(url, method="HEAD"), timeout=10) as reply:
+    length = reply.headers.get("Content-Length")
+    pass
+  return int(length) if length else None
+
+
+def read_image_index(image_path, image_size=None):
+  '''Reads the index of image.
+
+    :arg:
+      image_path: path of image file, or URL of image on the wce share.
+      image_size: size of the image in the listing. The index of image on the
+        share is checked against it, or against the server's when not given.
+
+    :returns: dict or None if there is none, or the image is changed since.
+  '''
+  path = get_image_index_path(image_path)
+  try:
+    if get_transport_scheme(path) in ["http", "https"]:
+      import urllib.request
+      with urllib.request.urlopen(path, timeout=10) as reply:
+        index = json.loads(reply.read().decode("utf-8"))
+        pass
+      if not image_size:
+        image_size = _get_remote_size(image_path)
+        pass
+      if image_size and index.get("imageSize") != int(image_size):
+        tlog.info("Index of %s is stale." % image_path)
+        return None
+      return index
+    if os.path.exists(path):
+      with open(path) as index_file:
+        index = json.load(index_file)
+        pass
+      return index if _is_current(index, image_path) else None
+    pass
+  except Exception as exc:
+    tlog.info("No index for %s: %s" % (image_path, str(exc)))
+    pass
+  return None
+
+
+def write_image_index(image_path, index):
+  path = get_image_index_path(image_path)
+  tmp_path = path + ".tmp"
+  with open(tmp_path, "w") as index_file:
+    json.dump(index, index_file, indent=2)
+    pass
+  os.rename(tmp_path, path)
+  pass
+
+
+def index_image(image_path, force=False):
+  """Makes the index of image unless there is a current one. Returns the index,
+or None if the image cannot be indexed."""
+  if not force:
+    index = read_image_index(image_path)
+    if index:
+      return index
+    pass
+  try:
+    index = make_image_index(image_path)
+  except Exception as exc:
+    # Not partclone v2, the compression is not supported, or broken.
+    tlog.info("%s is not indexed. %s" % (image_path, str(exc)))
+    return None
+  write_image_index(image_path, index)
+  return index
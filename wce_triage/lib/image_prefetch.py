@@ -0,0 +1,245 @@
+# Copyright (c) 2019 Naoyuki tai
+# MIT license - see LICENSE
+"""Prefetch of disk image while the restore prepares the disk.
+
+Wipe, partitioning, mkfs and EFI load come before the image is opened. The
+prefetcher starts fetching the image when the runner starts, and keeps it in
+a spool file on tmpfs. The image is kept compressed so that the memory budget
+holds more of it. Decompression is not the bottleneck once the bytes are here.
+
+The budget is from MemAvailable of /proc/meminfo. When the spool reaches it,
+or the memory gets tight, the prefetcher pauses and closes the connection.
+
+When the restore task starts, the prefetcher is stopped and handed off. The
+loader (bin/restore_volume) reads the spool first, and continues from the
+server with Range where the spool ends. If-Range makes sure it is the same image.
+
+  runner.run() -> ImagePrefetcher.start()
+  task_restore_disk_image.setup() -> handoff() -> restore_volume --prefetched <state>
+  runner done/cancelled -> cancel() removes the spool
+"""
+
+import os, json, tempfile, threading
+from .util import get_triage_logger
+from .image_stream import ResumableHttpReader, READ_SIZE
+
+tlog = get_triage_logger()
+
+MEMINFO = "/proc/meminfo"
+# Part of MemAvailable the prefetch can use
+DEFAULT_MEMORY_FRACTION = 0.5
+# Pause when MemAvailable goes below this
+MEMORY_RESERVE = 256 * 2**20
+# Not worth it
+MIN_BUDGET = 16 * 2**20
+# Seconds between the memory checks while paused
+PAUSE_CHECK_INTERVAL = 1.0
+# Memory is checked after fetching this much
+MEMORY_CHECK_SIZE = 16 * 2**20
+
+
+def get_prefetch_dir():
+  return "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+
+def read_mem_available(meminfo=MEMINFO):
+  """MemAvailable in bytes, or None"""
+  try:
+    with open(meminfo) as meminfo_fd:
+      for line in meminfo_fd:
+        if line.startswith("MemAvailable:"):
+          return int(line.split()[1]) * 1024
+        pass
+      pass
+    pass
+  except (OSError, ValueError, IndexError):
+    pass
+  return None
+
+
+def get_prefetch_budget(meminfo=MEMINFO, fraction=DEFAULT_MEMORY_FRACTION, limit=None):
+  """Bytes the prefetch can hold. 0 when the memory is too tight."""
+  available = read_mem_available(meminfo)
+  if available is None:
+    return 0
+  budget = int((available - MEMORY_RESERVE) * fraction)
+  if limit is not None:
+    budget = min(budget, limit)
+    pass
+  return budget if budget >= MIN_BUDGET else 0
+
+
+class ImagePrefetcher(object):
+  """Fetches the head of image to the spool file with a thread."""
+
+  def __init__(self, url, budget=None, spool_dir=None, meminfo=MEMINFO):
+    self.url = url
+    self.meminfo = meminfo
+    self.budget = get_prefetch_budget(meminfo) if budget is None else budget
+    spool_dir = get_prefetch_dir() if spool_dir is None else spool_dir
+    fd, self.spool_path = tempfile.mkstemp(prefix="wce-prefetch-", dir=spool_dir)
+    os.close(fd)
+    self.state_path = self.spool_path + ".json"
+    self.reader = ResumableHttpReader(url)
+    self.fetched = 0
+    self.paused = False
+    self.complete = False
+    self.error = None
+    self.started = False
+    self.stopping = threading.Event()
+    self.thread = None
+    pass
+
+  def _memory_is_tight(self):
+    available = read_mem_available(self.meminfo)
+    return available is not None and available < MEMORY_RESERVE
+
+  def _pause(self):
+    """Waits until there is room again, or stopped. Returns False when stopped."""
+    self.paused = True
+    self.reader._close_reply()
+    while not self.stopping.wait(PAUSE_CHECK_INTERVAL):
+      if self.fetched < self.budget and not self._memory_is_tight():
+        self.paused = False
+        return True
+      pass
+    return False
+
+  def _fetch(self):
+    checked = 0
+    try:
+      with open(self.spool_path, "wb") as spool:
+        while not self.stopping.is_set():
+          if self.fetched >= self.budget or (self.fetched - checked >= MEMORY_CHECK_SIZE and self._memory_is_tight()):
+            spool.flush()
+            if not self._pause():
+              break
+            checked = self.fetched
+            pass
+          data = self.reader.read(min(READ_SIZE, self.budget - self.fetched))
+          if not data:
+            self.complete = not self.stopping.is_set()
+            break
+          if self.fetched == 0 and self.reader.reply and self.reader.reply.headers.get("Accept-Ranges") != "bytes":
+            # The loader could not continue from the spool.
+            raise Exception("Server does not take Range.")
+          spool.write(data)
+          self.fetched += len(data)
+          pass
+        pass
+      pass
+    except Exception as exc:
+      # The loader fetches it anyway.
+      self.error = str(exc)
+      tlog.info("Prefetch of %s stopped: %s" % (self.url, self.error))
+      pass
+    self.reader._close_reply()
+    pass
+
+  def start(self):
+    if self.budget <= 0:
+      tlog.info("No memory for prefetching %s" % self.url)
+      return False
+    self.started = True
+    self.thread = threading.Thread(target=self._fetch, daemon=True)
+    self.thread.start()
+    return True
+
+  def _stop(self):
+    self.stopping.set()
+    self.reader.running = False
+    self.reader._close_reply()
+    if self.thread:
+      self.thread.join()
+      pass
+    pass
+
+  def handoff(self):
+    """Stops the prefetch and returns the path of state file for the loader,
+or None when there is nothing prefetched."""
+    if not self.started:
+      return None
+    self._stop()
+    if self.error or self.fetched == 0 or (not self.reader.validator and not self.complete):
+      # Without the validator, the rest cannot be fetched safely.
+      return None
+    state = { "url": self.url,
+              "spool": self.spool_path,
+              "length": self.fetched,
+              "size": self.reader.size,
+              "validator": self.reader.validator }
+    with open(self.state_path, "w") as state_fd:
+      json.dump(state, state_fd)
+      pass
+    return self.state_path
+
+  def cancel(self):
+    """Stops and removes the spool. Safe to call after the handoff."""
+    self._stop()
+    for path in [self.spool_path, self.state_path]:
+      try:
+        os.unlink(path)
+      except FileNotFoundError:
+        pass
+      pass
+    pass
+
+  def stats(self):
+    return { "budget": self.budget,
+             "fetched": self.fetched,
+             "paused": self.paused,
+             "complete": self.complete,
+             "error": self.error }
+  pass
+
+
+class PrefetchedReader(object):
+  """File-like reader of the image that reads the spool first, then the rest
+from the server. The spool is removed at close."""
+
+  def __init__(self, state_path):
+    with open(state_path) as state_fd:
+      self.state = json.load(state_fd)
+      pass
+    self.state_path = state_path
+    self.spool = open(self.state["spool"], "rb")
+    self.rest = ResumableHttpReader(self.state["url"])
+    self.rest.position = self.state["length"]
+    self.rest.validator = self.state["validator"]
+    self.rest.size = self.state["size"]
+    self.prefetched = self.state["length"]
+    pass
+
+  @property
+  def reconnects(self):
+    return self.rest.reconnects
+
+  def read(self, size=READ_SIZE):
+    if self.spool:
+      data = self.spool.read(size)
+      if data:
+        return data
+      self._remove_spool()
+      pass
+    if self.rest.size is not None and self.rest.position >= self.rest.size:
+      return b""
+    return self.rest.read(size)
+
+  def _remove_spool(self):
+    if self.spool:
+      self.spool.close()
+      self.spool = None
+      for path in [self.state["spool"], self.state_path]:
+        try:
+          os.unlink(path)
+        except FileNotFoundError:
+          pass
+        pass
+      pass
+    pass
+
+  def close(self):
+    self._remove_spool()
+    self.rest.close()
+    pass
+  pass
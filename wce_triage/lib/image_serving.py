@@ -0,0 +1,136 @@
+# Copyright (c) 2019 Naoyuki tai
+# MIT license - see LICENSE
+"""Helpers for serving disk images from the triage http server.
+
+The http part is in http/httpserver. This has the parts that do not need
+aiohttp: ETag, Range/If-Range handling and the per-client accounting.
+"""
+
+import os, time, email.utils, threading
+
+# sha256sum/sha1sum output next to the image. When it exists, it is the ETag.
+IMAGE_DIGEST_SUFFIXES = [ ".sha256", ".sha1" ]
+
+# Number of images sent at the same time. Others wait for their turn.
+DEFAULT_MAX_IMAGE_CLIENTS = 8
+
+
+class RangeNotSatisfiable(Exception):
+  pass
+
+
+def get_image_etag(path, filestat=None):
+  """Strong ETag of image file. Digest from the sidecar file, or size and mtime."""
+  for suffix in IMAGE_DIGEST_SUFFIXES:
+    try:
+      with open(path + suffix) as digest_file:
+        digest = digest_file.read().split()
+        pass
+      if digest:
+        return '"%s"' % digest[0]
+      pass
+    except OSError:
+      pass
+    pass
+  if filestat is None:
+    filestat = os.stat(path)
+    pass
+  return '"%x-%x"' % (filestat.st_size, int(filestat.st_mtime * 1000000))
+
+
+def format_http_date(timestamp):
+  return email.utils.formatdate(timestamp, usegmt=True)
+
+
+def if_range_matches(if_range, etag, mtime):
+  """If-Range is either ETag or HTTP date. Range is honored only when it matches."""
+  if if_range is None:
+    return True
+  if_range = if_range.strip()
+  if if_range.startswith('"') or if_range.startswith('W/'):
+    # Weak ETag never matches for If-Range
+    return if_range == etag
+  try:
+    return email.utils.parsedate_to_datetime(if_range).timestamp() == int(mtime)
+  except (TypeError, ValueError):
+    pass
+  return False
+
+
+def parse_range(range_header, size):
+  """Parses Range header for single byte range.
+
+Returns (start, end) with end exclusive, or None to send the whole file.
+Multiple ranges are not supported, and the whole file is sent for them.
+Raises RangeNotSatisfiable when the range is out of file."""
+  if not range_header:
+    return None
+  unit, _, ranges = range_header.partition("=")
+  if unit.strip() != "bytes" or "," in ranges:
+    return None
+  first, dash, last = ranges.strip().partition("-")
+  if not dash:
+    return None
+  try:
+    if first == "":
+      # suffix range - last n bytes
+      length = int(last)
+      if length <= 0:
+        raise RangeNotSatisfiable(range_header)
+      return (max(0, size - length), size)
+    start = int(first)
+    end = int(last) + 1 if last else size
+  except ValueError:
+    return None
+  if start >= size or end <= start:
+    raise RangeNotSatisfiable(range_header)
+  return (start, min(end, size))
+
+
+class ImageClientStats(object):
+  """Bytes sent to each client and the transfers in flight."""
+
+  def __init__(self):
+    self.clients = {}
+    self.lock = threading.Lock()
+    pass
+
+  def _client(self, client):
+    entry = self.clients.get(client)
+    if entry is None:
+      entry = { "bytesSent": 0, "transfers": 0, "active": 0, "seconds": 0.0, "lastImage": None, "lastSeen": None }
+      self.clients[client] = entry
+      pass
+    return entry
+
+  def start(self, client, image):
+    with self.lock:
+      entry = self._client(client)
+      entry["active"] += 1
+      entry["lastImage"] = image
+      entry["lastSeen"] = time.time()
+      pass
+    return time.monotonic()
+
+  def finish(self, client, n_bytes, started):
+    with self.lock:
+      entry = self._client(client)
+      entry["active"] -= 1
+      entry["transfers"] += 1
+      entry["bytesSent"] += n_bytes
+      entry["seconds"] += time.monotonic() - started
+      entry["lastSeen"] = time.time()
+      pass
+    pass
+
+  def report(self):
+    """Per client stats with average rate in bytes/sec"""
+    with self.lock:
+      report = {}
+      for client, entry in self.clients.items():
+        report[client] = dict(entry)
+        report[client]["rate"] = round(entry["bytesSent"] / entry["seconds"]) if entry["seconds"] > 0 else 0
+        pass
+      pass
+    return report
+  pass
@@ -0,0 +1,408 @@
+# Copyright (c) 2019 Naoyuki tai
+# MIT license - see LICENSE
+"""In-process fetch and decompression of disk image for restore.
+
+restore_volume used to chain wget, gunzip and partclone. When the network
+hiccups, wget dies and the restore starts over. Here, the image is fetched
+with http and the connection is resumed with Range from where it broke.
+The decompression runs in its own thread (zlib and lzma release the GIL),
+and the decompressed stream goes through a large bounded buffer to partclone
+so a short stall of the network does not stall the disk writes.
+
+  fetcher -> [compressed buffer] -> decompressor -> [buffer] -> writer -> partclone
+"""
+
+import os, time, zlib, lzma, threading
+from .util import get_triage_logger
+
+tlog = get_triage_logger()
+
+READ_SIZE = 2 ** 20
+COMPRESSED_BUFFER_SIZE = 16 * 2 ** 20
+DEFAULT_BUFFER_SIZE = 256 * 2 ** 20
+
+# Reconnects in a row without getting any byte
+DEFAULT_MAX_RETRIES = 10
+DEFAULT_RETRY_WAIT = 2
+DEFAULT_TIMEOUT = 30
+
+
+class StreamFailed(Exception):
+  pass
+
+
+class ResumableHttpReader(object):
+  """File-like reader of http resource. When the connection breaks, it reconnects
+and continues from where it stopped with Range. If-Range makes sure the image
+did not change in between."""
+
+  def __init__(self, url, timeout=DEFAULT_TIMEOUT, max_retries=DEFAULT_MAX_RETRIES, retry_wait=DEFAULT_RETRY_WAIT):
+    self.url = url
+    self.timeout = timeout
+    self.max_retries = max_retries
+    self.retry_wait = retry_wait
+    self.reply = None
+    self.validator = None
+    self.size = None
+    self.position = 0
+    self.reconnects = 0
+    self.running = True
+    pass
+
+  def _connect(self):
+    import urllib.request
+    headers = {}
+    if self.position > 0:
+      headers["Range"] = "bytes=%d-" % self.position
+      if self.validator:
+        headers["If-Range"] = self.validator
+        pass
+      pass
+    reply = urllib.request.urlopen(urllib.request.Request(self.url, headers=headers), timeout=self.timeout)
+    if self.position > 0 and reply.status != 206:
+      reply.close()
+      raise StreamFailed("%s can not be resumed at %d. (status %d)" % (self.url, self.position, reply.status))
+
+    if self.validator is None:
+      self.validator = reply.headers.get("ETag") or reply.headers.get("Last-Modified")
+      length = reply.headers.get("Content-Length")
+      self.size = int(length) if length is not None else None
+      pass
+    self.reply = reply
+    pass
+
+  def read(self, size=READ_SIZE):
+    """Returns b"" at the end of image."""
+    # http is loaded when the image is fetched. Not when a tool imports this.
+    import http.client, urllib.error
+    retries = 0
+    while self.running:
+      if self.size is not None and self.position >= self.size:
+        return b""
+      try:
+        if self.reply is None:
+          self._connect()
+          pass
+        data = self.reply.read(size)
+        if data:
+          self.position += len(data)
+          return data
+        if self.size is None:
+          # No length to check. Trust the server.
+          return b""
+        raise StreamFailed("Connection closed at %d of %d" % (self.position, self.size))
+      except (OSError, http.client.HTTPException, StreamFailed) as exc:
+        if isinstance(exc, urllib.error.HTTPError) or (isinstance(exc, StreamFailed) and self.reply is None):
+          # Server says no. Retrying does not help.
+          raise
+        self._close_reply()
+        retries += 1
+        if retries > self.max_retries:
+          raise StreamFailed("Giving up %s at %d after %d retries: %s" % (self.url, self.position, self.max_retries, str(exc)))
+        self.reconnects += 1
+        tlog.info("Reconnecting %s at %d: %s" % (self.url, self.position, str(exc)))
+        time.sleep(self.retry_wait)
+        pass
+      pass
+    return b""
+
+  def _close_reply(self):
+    if self.reply is not None:
+      try:
+        self.reply.close()
+      except Exception:
+        pass
+      self.reply = None
+      pass
+    pass
+
+  def close(self):
+    self.running = False
+    self._close_reply()
+    pass
+  pass
+
+
+class BoundedBuffer(object):
+  """Byte chunk queue bounded by the total bytes in it."""
+
+  def __init__(self, capacity):
+    self.capacity = capacity
+    self.chunks = []
+    self.size = 0
+    self.high_water = 0
+    self.closed = False
+    self.error = None
+    self.cond = threading.Condition()
+    pass
+
+  def put(self, data):
+    with self.cond:
+      # A chunk bigger than the capacity is let in when the buffer is empty.
+      while self.size > 0 and self.size + len(data) > self.capacity and self.error is None:
+        self.cond.wait()
+        pass
+      if self.error is not None:
+        raise StreamFailed(self.error)
+      self.chunks.append(data)
+      self.size += len(data)
+      self.high_water = max(self.high_water, self.size)
+      self.cond.notify_all()
+      pass
+    pass
+
+  def try_put(self, data):
+    """Same as put() but returns False instead of waiting when it's full."""
+    with self.cond:
+      if self.error is not None:
+        raise StreamFailed(self.error)
+      if self.size > 0 and self.size + len(data) > self.capacity:
+        return False
+      self.chunks.append(data)
+      self.size += len(data)
+      self.high_water = max(self.high_water, self.size)
+      self.cond.notify_all()
+      pass
+    return True
+
+  def get(self):
+    """Returns b"" when closed and drained."""
+    with self.cond:
+      while not self.chunks and not self.closed and self.error is None:
+        self.cond.wait()
+        pass
+      if self.error is not None:
+        raise StreamFailed(self.error)
+      if not self.chunks:
+        return b""
+      data = self.chunks.pop(0)
+      self.size -= len(data)
+      self.cond.notify_all()
+      pass
+    return data
+
+  def close(self):
+    with self.cond:
+      self.closed = True
+      self.cond.notify_all()
+      pass
+    pass
+
+  def fail(self, error):
+    with self.cond:
+      if self.error is None:
+        self.error = error
+        pass
+      self.cond.notify_all()
+      pass
+    pass
+  pass
+
+
+class _MultiStreamDecompressor(object):
+  """gzip and xz files can have more than one stream back to back (pigz, pixz).
+
+The output is limited to max_length per chunk. A small chunk of zeros
+decompresses to a lot, and the bounded buffer lets in a chunk of any size
+when it's empty.
+"""
+
+  def __init__(self, factory):
+    self.factory = factory
+    self.decompressor = factory()
+    pass
+
+  @property
+  def eof(self):
+    return self.decompressor.eof
+
+  def decompress_chunks(self, data, max_length=READ_SIZE):
+    """Yields the decompressed data in chunks of at most max_length."""
+    while True:
+      if self.decompressor.eof:
+        # Next stream starts right after the end of this one. lzma raises
+        # EOFError when it is fed after the end.
+        data = self.decompressor.unused_data + data
+        if not data:
+          return
+        self.decompressor = self.factory()
+        pass
+      output = self.decompressor.decompress(data, max_length)
+      # zlib hands back the input it did not get to. lzma keeps it.
+      data = getattr(self.decompressor, "unconsumed_tail", b"")
+      if output:
+        yield output
+        pass
+      if self.decompressor.eof or data:
+        continue
+      if hasattr(self.decompressor, "needs_input"):
+        has_more = not self.decompressor.needs_input
+      else:
+        has_more = len(output) == max_length
+        pass
+      if not has_more:
+        return
+      pass
+    pass
+
+  def decompress(self, data):
+    return b"".join(self.decompress_chunks(data))
+  pass
+
+
+def get_decompressor(path):
+  """Decompressor object for the image by the extension, or None when the image
+is not compressed. Raises KeyError when it's not supported in-process."""
+  ext = os.path.splitext(path)[1]
+  if ext == ".gz":
+    return _MultiStreamDecompressor(lambda: zlib.decompressobj(16 + zlib.MAX_WBITS))
+  if ext == ".xz":
+    return _MultiStreamDecompressor(lzma.LZMADecompressor)
+  if ext in [".7z", ".lzo"]:
+    raise KeyError(ext)
+  return None
+
+
+def can_stream(path):
+  try:
+    get_decompressor(path)
+  except KeyError:
+    return False
+  return True
+
+
+class ImageStreamer(object):
+  """Fetches, decompresses and writes the image to output with threads.
+
+reader: file-like with read()/close(), such as ResumableHttpReader
+output: file object to write to, such as stdin of partclone. Closed at the end.
+"""
+
+  def __init__(self, reader, output, decompressor=None, buffer_size=DEFAULT_BUFFER_SIZE):
+    self.reader = reader
+    self.output = output
+    self.decompressor = decompressor
+    self.compressed = BoundedBuffer(COMPRESSED_BUFFER_SIZE)
+    self.buffer = BoundedBuffer(buffer_size)
+    self.fetched = 0
+    self.decompressed = 0
+    self.written = 0
+    self.error = None
+    self.threads = []
+    pass
+
+  def _fail(self, stage, exc):
+    if self.error is None:
+      self.error = "%s: %s" % (stage, str(exc))
+      tlog.info("Image stream %s" % self.error)
+      pass
+    self.compressed.fail(self.error)
+    self.buffer.fail(self.error)
+    pass
+
+  def _fetcher(self):
+    try:
+      while self.error is None:
+        data = self.reader.read(READ_SIZE)
+        if not data:
+          break
+        self.fetched += len(data)
+        self.compressed.put(data)
+        pass
+      self.compressed.close()
+    except Exception as exc:
+      self._fail("fetch", exc)
+      pass
+    self.reader.close()
+    pass
+
+  def _decompressor(self):
+    try:
+      while True:
+        data = self.compressed.get()
+        if not data:
+          break
+        for chunk in self.decompressor.decompress_chunks(data) if self.decompressor else [data]:
+          self.decompressed += len(chunk)
+          self.buffer.put(chunk)
+          pass
+        pass
+      if self.decompressor and not self.decompressor.eof:
+        raise StreamFailed("Image ended in the middle of compressed stream.")
+      self.buffer.close()
+    except Exception as exc:
+      self._fail("decompress", exc)
+      pass
+    pass
+
+  def _writer(self):
+    try:
+      while True:
+        data = self.buffer.get()
+        if not data:
+          break
+        self.output.write(data)
+        self.written += len(data)
+        pass
+      self.output.flush()
+    except Exception as exc:
+      self._fail("write", exc)
+      pass
+    try:
+      self.output.close()
+    except Exception:
+      pass
+    pass
+
+  def start(self):
+    for target in [self._fetcher, self._decompressor, self._writer]:
+      thread = threading.Thread(target=target, daemon=True)
+      thread.start()
+      self.threads.append(thread)
+      pass
+    pass
+
+  def stop(self):
+    self._fail("stop", "Stop requested")
+    self.reader.close()
+    pass
+
+  def join(self, timeout=None):
+    for thread in self.threads:
+      thread.join(timeout)
+      pass
+    return self.error
+
+  def is_alive(self):
+    return [ thread for thread in self.threads if thread.is_alive() ] != []
+
+  def stats(self):
+    """Bytes at each stage"""
+    stats = { "fetched": self.fetched,
+              "decompressed": self.decompressed,
+              "written": self.written,
+              "buffered": self.buffer.size,
+              "bufferHighWater": self.buffer.high_water,
+              "reconnects": getattr(self.reader, "reconnects", 0) }
+    if hasattr(self.reader, "mirror_stats"):
+      stats["mirrors"] = self.reader.mirror_stats()
+      pass
+    return stats
+  pass
+
+
+def open_image_stream(url, output, buffer_size=DEFAULT_BUFFER_SIZE, mirrors=None, prefetched=None):
+  """ImageStreamer of the url with decompressor by the extension.
+With mirrors, the image is fetched in segments from the url and the mirrors.
+prefetched: state file of the prefetch (lib/image_prefetch). The spool is read
+first and the rest is fetched from the url."""
+  if prefetched:
+    from .image_prefetch import PrefetchedReader
+    reader = PrefetchedReader(prefetched)
+  elif mirrors:
+    from .segmented_download import SegmentedReader
+    reader = SegmentedReader([url] + [ mirror for mirror in mirrors if mirror != url ])
+  else:
+    reader = ResumableHttpReader(url)
+    pass
+  return ImageStreamer(reader, output, decompressor=get_decompressor(url), buffer_size=buffer_size)
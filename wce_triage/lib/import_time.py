@@ -0,0 +1,184 @@
+# Copyright (c) 2019 Naoyuki tai
+# MIT license - see LICENSE
+"""Startup time of the entry points, from "python3 -X importtime".
+
+A PXE booted triage machine reads every module over NFS, so what a tool
+imports before it does anything is what it costs to start. Each entry point
+(a module in bin/ or ops/ with __main__) is imported in a fresh python with
+-X importtime, and the report has the import time, the number of modules and
+the heaviest imports.
+
+Entry points have the budget in milliseconds, and some modules must not be
+imported by them at all (the web server's stack, for example). The test suite
+checks the forbidden imports every time. The time depends on the machine and
+its load, so the budget is checked only on request, with --check here or with
+WCE_TRIAGE_IMPORT_BUDGET=1 in the environment of the test suite.
+
+  python3 -m wce_triage.lib.import_time            # report
+  python3 -m wce_triage.lib.import_time --check    # exit 1 when over the budget
+"""
+
+import os, sys, re, time, subprocess
+
+ENTRY_POINT_PACKAGES = ["bin", "ops"]
+
+# Import time budget in milliseconds. The runners carry the disk and task
+# modules. Measured on a desktop with the page cache warm, with margin.
+DEFAULT_IMPORT_BUDGET = 150
+IMPORT_BUDGETS = {
+  "wce_triage.ops.restore_image_runner": 300,
+  "wce_triage.ops.create_image_runner": 300,
+  "wce_triage.ops.sync_image_runner": 300,
+  "wce_triage.ops.clone_runner": 300,
+  "wce_triage.ops.test_restore": 300,
+}
+
+# Only the web server uses them.
+FORBIDDEN_IMPORTS = ["aiohttp", "socketio", "asyncio"]
+
+_importtime_re = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$')
+
+
+def parse_importtime(text):
+  """Parses the -X importtime output.
+Returns the list of (module, self_us, cumulative_us, depth) in the order of output."""
+  imports = []
+  for line in text.splitlines():
+    match = _importtime_re.match(line)
+    if match:
+      imports.append((match.group(4), int(match.group(1)), int(match.group(2)), (len(match.group(3)) - 1) // 2))
+      pass
+    pass
+  return imports
+
+
+def get_package_root():
+  return os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def list_entry_points():
+  """Modules in bin/ and ops/ that can run as __main__"""
+  package_dir = os.path.join(get_package_root(), "wce_triage")
+  entry_points = []
+  for package in ENTRY_POINT_PACKAGES:
+    for filename in sorted(os.listdir(os.path.join(package_dir, package))):
+      if not filename.endswith(".py") or filename == "__init__.py":
+        continue
+      with open(os.path.join(package_dir, package, filename)) as source:
+        if not re.search(r'^if __name__ == .__main__.:', source.read(), re.MULTILINE):
+          continue
+        pass
+      entry_points.append("wce_triage.%s.%s" % (package, filename[:-3]))
+      pass
+    pass
+  return entry_points
+
+
+def measure_import(module, python=sys.executable):
+  """Imports the module in a fresh python and returns the measurement."""
+  env = os.environ.copy()
+  env["PYTHONPATH"] = get_package_root()
+  start = time.time()
+  result = subprocess.run([python, "-X", "importtime", "-c", "import " + module],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+  wall = time.time() - start
+  stderr = result.stderr.decode("utf-8", "replace")
+  imports = parse_importtime(stderr)
+  measured = { "module": module,
+               "ok": result.returncode == 0,
+               "wall": round(wall * 1000, 1),
+               "importTime": None,
+               "modules": len(imports),
+               "wceModules": len([ name for name, self_us, cumulative_us, depth in imports if name.startswith("wce_triage") ]),
+               "imported": [ name for name, self_us, cumulative_us, depth in imports ],
+               "heaviest": [] }
+  if result.returncode != 0:
+    measured["error"] = stderr.strip().splitlines()[-1] if stderr.strip() else "exit %d" % result.returncode
+    return measured
+  # Output is children first. The direct imports of the module come right before it.
+  import_time = 0
+  children = []
+  for name, self_us, cumulative_us, depth in imports:
+    if depth == 1:
+      children.append((cumulative_us, name))
+    elif depth == 0:
+      if name.startswith("wce_triage"):
+        # The module and its packages
+        import_time += cumulative_us
+        pass
+      if name == module:
+        measured["heaviest"] = [ (child, round(child_us / 1000, 1)) for child_us, child in sorted(children, reverse=True)[:3] ]
+        pass
+      children = []
+      pass
+    pass
+  measured["importTime"] = round(import_time / 1000, 1)
+  return measured
+
+
+def get_import_budget(module):
+  return IMPORT_BUDGETS.get(module, DEFAULT_IMPORT_BUDGET)
+
+
+def check_budget(measured, timing=True):
+  """Returns the list of problems. Empty when it's within the budget.
+timing: False checks the forbidden imports only."""
+  module = measured["module"]
+  if not measured["ok"]:
+    # A tool that needs something not installed here is not a budget problem.
+    return []
+  problems = []
+  budget = get_import_budget(module)
+  if timing and measured["importTime"] is not None and measured["importTime"] > budget:
+    problems.append("%s: import %.1fms is over the budget %dms" % (module, measured["importTime"], budget))
+    pass
+  for name in measured["imported"]:
+    if name.split(".")[0] in FORBIDDEN_IMPORTS:
+      problems.append("%s: imports %s" % (module, name))
+      pass
+    pass
+  return problems
+
+
+def check_budgets(modules=None, timing=True):
+  problems = []
+  for module in list_entry_points() if modules is None else modules:
+    problems = problems + check_budget(measure_import(module), timing=timing)
+    pass
+  return problems
+
+
+def format_report(results):
+  lines = ["%-42s %9s %9s %7s %5s  %s" % ("entry point", "import", "wall", "modules", "wce", "heaviest")]
+  for measured in sorted(results, key=lambda m: -(m["importTime"] or 0)):
+    if not measured["ok"]:
+      lines.append("%-42s %s" % (measured["module"], "not importable: " + measured.get("error", "")))
+      continue
+    lines.append("%-42s %7.1fms %7.1fms %7d %5d  %s" % (measured["module"], measured["importTime"] or 0, measured["wall"],
+                                                      measured["modules"], measured["wceModules"],
+                                                      ", ".join([ "%s %.1fms" % heavy for heavy in measured["heaviest"] ])))
+    pass
+  return "\n".join(lines)
+
+
+if __name__ == "__main__":
+  from argparse import ArgumentParser
+  parser = ArgumentParser(description="Startup time of the bin/ and ops/ tools.")
+  parser.add_argument("modules", nargs="*", help="Entry point modules. Default is all of bin/ and ops/.")
+  parser.add_argument("--check", action="store_true", help="Exits with 1 when an entry point is over the budget.")
+  args = parser.parse_args()
+
+  modules = args.modules if args.modules else list_entry_points()
+  results = [ measure_import(module) for module in modules ]
+  print(format_report(results))
+  if args.check:
+    problems = []
+    for measured in results:
+      problems = problems + check_budget(measured)
+      pass
+    for problem in problems:
+      print(problem, file=sys.stderr)
+      pass
+    sys.exit(1 if problems else 0)
+    pass
+  pass
@@ -0,0 +1,284 @@
+#!/usr/bin/python3
+# Copyright (c) 2019 Naoyuki tai
+# MIT license - see LICENSE
+"""Memory test.
+
+Fills anonymous mmap with patterns, and verifies them. A worker process is
+pinned to each core, and each worker tests its own share of memory.
+
+The patterns are built as chunk-sized buffers and written/compared with
+slice operations, so the per-byte work is done by memcpy/memcmp rather than
+the python interpreter.
+
+Patterns
+  walking-ones  : word i has the bit (i % 64) set
+  walking-zeros : inverse of walking-ones
+  address       : each 64bit word holds its own offset
+  random        : windows of a PRNG generated pool
+"""
+
+import os, mmap, random, time, ctypes, struct
+import multiprocessing
+from multiprocessing.connection import wait
+from collections import namedtuple
+
+CHUNK_SIZE = 2 ** 20
+PAGE_SIZE = mmap.PAGESIZE
+
+# Stop recording errors after this many per worker
+MAX_ERRORS = 16
+
+PATTERNS = [ "walking-ones", "walking-zeros", "address", "random" ]
+
+MemoryFault = namedtuple('MemoryFault', 'worker, pattern, offset, expected, actual, physical_address')
+
+#
+# Pattern generators. pattern(offset) returns the bytes for the chunk at offset.
+#
+class walking_bits_pattern(object):
+  def __init__(self, invert=False, chunk_size=CHUNK_SIZE):
+    mask = 0xFFFFFFFFFFFFFFFF if invert else 0
+    block = b''.join([ struct.pack('<Q', (1 << bit) ^ mask) for bit in range(64) ])
+    self.chunk = block * (chunk_size // len(block))
+    pass
+
+  def __call__(self, offset, length):
+    return self.chunk[:length]
+  pass
+
+
+class address_pattern(object):
+  """Each word holds the offset of itself. Adding the chunk offset to every word
+of the template is done by a single big int multiply-add."""
+  def __init__(self, chunk_size=CHUNK_SIZE):
+    words = chunk_size // 8
+    self.chunk_size = chunk_size
+    self.template = int.from_bytes(b''.join([ struct.pack('<Q', 8 * i) for i in range(words) ]), 'little')
+    self.repunit = int.from_bytes(struct.pack('<Q', 1) * words, 'little')
+    pass
+
+  def __call__(self, offset, length):
+    return (self.template + offset * self.repunit).to_bytes(self.chunk_size, 'little')[:length]
+  pass
+
+
+class random_pattern(object):
+  """Generating random bytes is slow, so a pool is generated once and chunks
+take different windows out of it."""
+  window_span = 64 * 1024
+
+  def __init__(self, seed, chunk_size=CHUNK_SIZE):
+    self.pool = random.Random(seed).getrandbits((chunk_size + self.window_span) * 8).to_bytes(chunk_size + self.window_span, 'little')
+    self.seed = seed
+    self.chunk_size = chunk_size
+    pass
+
+  def __call__(self, offset, length):
+    # LCG on the chunk number picks the window. 8 byte aligned.
+    start = ((offset // self.chunk_size * 1103515245 + self.seed) & 0x7fffffff) % (self.window_span // 8) * 8
+    return self.pool[start:start+length]
+  pass
+
+
+def make_pattern(name, seed=0):
+  if name == "walking-ones":
+    return walking_bits_pattern()
+  if name == "walking-zeros":
+    return walking_bits_pattern(invert=True)
+  if name == "address":
+    return address_pattern()
+  if name == "random":
+    return random_pattern(seed)
+  raise Exception("Unknown memory test pattern %s" % name)
+
+
+def get_free_memory():
+  """returns MemAvailable in bytes"""
+  with open("/proc/meminfo") as meminfo:
+    for line in meminfo.readlines():
+      if line.startswith("MemAvailable:"):
+        return int(line.split()[1]) * 1024
+      pass
+    pass
+  return 0
+
+
+def get_physical_address(buffer, offset):
+  """Physical address hint from /proc/self/pagemap. Only root gets PFN, otherwise None."""
+  try:
+    pointer = ctypes.c_char.from_buffer(buffer, offset)
+    virtual_address = ctypes.addressof(pointer)
+    del pointer
+    with open("/proc/self/pagemap", "rb") as pagemap:
+      pagemap.seek(virtual_address // PAGE_SIZE * 8)
+      entry = struct.unpack('<Q', pagemap.read(8))[0]
+      pass
+    pfn = entry & ((1 << 55) - 1)
+    # bit 63 - page present
+    if (entry >> 63) and pfn:
+      return pfn * PAGE_SIZE + virtual_address % PAGE_SIZE
+    pass
+  except Exception:
+    pass
+  return None
+
+
+def find_mismatches(buffer, offset, expected, worker, pattern_name, limit):
+  """Narrows down the mismatched chunk to the words."""
+  errors = []
+  view = memoryview(buffer)
+  for page in range(0, len(expected), PAGE_SIZE):
+    if view[offset+page:offset+page+PAGE_SIZE] == expected[page:page+PAGE_SIZE]:
+      continue
+    for word in range(page, min(page + PAGE_SIZE, len(expected)), 8):
+      actual = bytes(view[offset+word:offset+word+8])
+      if actual != expected[word:word+8]:
+        errors.append(MemoryFault(worker=worker, pattern=pattern_name, offset=offset+word,
+                                  expected=expected[word:word+8].hex(), actual=actual.hex(),
+                                  physical_address=get_physical_address(buffer, offset+word)))
+        if len(errors) >= limit:
+          view.release()
+          return errors
+        pass
+      pass
+    pass
+  view.release()
+  return errors
+
+
+def check_buffer(buffer, patterns, worker=0, seed=0, progress=None):
+  """Runs write/verify passes of patterns on the buffer. Returns the list of MemoryFault.
+progress(bytes) is called after each chunk with the number of bytes processed."""
+  errors = []
+  size = len(buffer)
+  for pattern_name in patterns:
+    pattern = make_pattern(pattern_name, seed=seed + worker)
+    for offset in range(0, size, CHUNK_SIZE):
+      length = min(CHUNK_SIZE, size - offset)
+      buffer[offset:offset+length] = pattern(offset, length)
+      if progress:
+        progress(length)
+        pass
+      pass
+
+    for offset in range(0, size, CHUNK_SIZE):
+      length = min(CHUNK_SIZE, size - offset)
+      expected = pattern(offset, length)
+      if buffer[offset:offset+length] != expected and len(errors) < MAX_ERRORS:
+        errors = errors + find_mismatches(buffer, offset, expected, worker, pattern_name, MAX_ERRORS - len(errors))
+        pass
+      if progress:
+        progress(length)
+        pass
+      pass
+    pass
+  return errors
+
+
+def _memtest_worker(worker, core, size, patterns, seed, report):
+  try:
+    if core is not None and hasattr(os, "sched_setaffinity"):
+      os.sched_setaffinity(0, {core})
+      pass
+    buffer = mmap.mmap(-1, size, flags=mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS)
+    # Report every 64MB
+    pending = [0]
+    def progress(n_bytes):
+      pending[0] += n_bytes
+      if pending[0] >= 2 ** 26:
+        report.send(("progress", worker, pending[0], None))
+        pending[0] = 0
+        pass
+      pass
+    errors = check_buffer(buffer, patterns, worker=worker, seed=seed, progress=progress)
+    report.send(("progress", worker, pending[0], None))
+    buffer.close()
+    report.send(("done", worker, 0, [ error._asdict() for error in errors ]))
+  except Exception as exc:
+    report.send(("failed", worker, 0, str(exc)))
+    pass
+  report.close()
+  pass
+
+
+MemoryTestResult = namedtuple('MemoryTestResult', 'tested_bytes, elapsed, throughput, errors, failed_workers')
+
+def run_memory_test(fraction=0.5, size=None, patterns=PATTERNS, n_workers=None, seed=None, progress=None):
+  """runs the memory test on all cores.
+
+fraction: fraction of available memory to test. Ignored when size is given.
+progress(done_bytes, total_bytes): called as the workers report.
+throughput is in bytes per second of pattern write + verify.
+"""
+  if n_workers is None:
+    n_workers = os.cpu_count() or 1
+    pass
+  if size is None:
+    size = int(get_free_memory() * fraction)
+    pass
+  if seed is None:
+    seed = int(time.time())
+    pass
+
+  share = max(PAGE_SIZE, size // n_workers // PAGE_SIZE * PAGE_SIZE)
+  cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+  total_bytes = share * n_workers * len(patterns) * 2
+
+  # A pipe per worker. A worker killed (OOM killer, SIGKILL) in the middle of
+  # report cannot leave a lock shared with the others held, and its pipe is
+  # closed when it dies.
+  workers = []
+  start = time.monotonic()
+  for worker in range(n_workers):
+    core = cores[worker % len(cores)] if cores else None
+    reader, writer = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=_memtest_worker, args=(worker, core, share, patterns, seed, writer))
+    process.start()
+    writer.close()
+    workers.append((process, reader))
+    pass
+
+  done_bytes = 0
+  errors = []
+  failed_workers = []
+  finished = set()
+  while len(finished) < n_workers:
+    readers = { reader: worker for worker, (process, reader) in enumerate(workers) if worker not in finished }
+    for reader in wait(list(readers.keys())):
+      worker = readers[reader]
+      try:
+        kind, worker, n_bytes, payload = reader.recv()
+      except (EOFError, OSError):
+        # Died without the report, or in the middle of it. It's a failed test.
+        process = workers[worker][0]
+        process.join()
+        failed_workers.append((worker, "worker exited with %d" % process.exitcode))
+        finished.add(worker)
+        continue
+      if kind == "progress":
+        done_bytes += n_bytes
+        if progress:
+          progress(done_bytes, total_bytes)
+          pass
+        pass
+      elif kind == "done":
+        errors = errors + payload
+        finished.add(worker)
+        pass
+      else:
+        failed_workers.append((worker, payload))
+        finished.add(worker)
+        pass
+      pass
+    pass
+
+  for process, reader in workers:
+    process.join()
+    reader.close()
+    pass
+  elapsed = time.monotonic() - start
+  return MemoryTestResult(tested_bytes=share * n_workers,
+                          elapsed=elapsed,
+                          throughput=done_bytes / elapsed if elapsed > 0 else 0,
+                          errors=errors,
+                          failed_workers=failed_workers)
@@ -0,0 +1,639 @@
+# Copyright (c) 2019 Naoyuki tai
+# MIT license - see LICENSE
+"""Multicast distribution of disk image.
+
+When many PXE clients load the same image, each client pulling its own http
+stream makes the server NIC the bottleneck. The sender transmits the image
+file once to a multicast group, and the receivers on the clients feed the
+image to the decompressor/partclone pipeline of restore_volume.
+
+Protocol - UDP, every packet starts with HEADER (magic, type, session, block)
+  ANNOUNCE : json of the session (name, size, block size, url, position).
+             Sent every second.
+  DATA     : one block of the image file.
+  NAK      : receiver -> sender (unicast). List of (start block, count) missing.
+             Repairs are multicast so every receiver missing it gets it.
+  END      : the first pass is done. block is the number of blocks.
+
+Late joiner gets the blocks it missed before joining with http Range from
+the url in the announcement while it receives the rest from multicast. When
+a block does not come with the repairs, the missing range is fetched with
+http and the receiver goes back to multicast. When the sender is gone, the
+rest comes from http, so http is always the last resort.
+
+Rate control: sender starts at the given rate, backs off when receivers NAK
+a lot, and speeds up back to the rate when there are no NAKs.
+"""
+
+import os, json, time, socket, struct, select, threading, random, heapq
+from .util import get_triage_logger
+
+tlog = get_triage_logger()
+
+DEFAULT_MULTICAST_GROUP = "239.255.83.12"
+DEFAULT_MULTICAST_PORT = 8313
+# Fits in an ethernet frame with the IP/UDP header and ours.
+DEFAULT_BLOCK_SIZE = 1400
+DEFAULT_RATE = 50 * 1000000 # bytes/sec
+
+MAGIC = b"WCEM"
+HEADER = struct.Struct("!4sBIQ")
+NAK_RANGE = struct.Struct("!QI")
+MAX_NAK_RANGES = 64
+
+ANNOUNCE = 1
+DATA = 2
+NAK = 3
+END = 4
+
+ANNOUNCE_INTERVAL = 1.0
+# Rate adjustment interval and thresholds
+RATE_INTERVAL = 0.5
+RATE_BACKOFF = 0.8
+RATE_RECOVER = 1.05
+NAK_RATIO_LIMIT = 0.02
+
+SOCKET_BUFFER_SIZE = 8 * 2**20
+
+
+def make_packet(packet_type, session, block, payload=b""):
+  return HEADER.pack(MAGIC, packet_type, session, block) + payload
+
+
+def parse_packet(packet):
+  """Returns (type, session, block, payload) or None if it's not ours."""
+  if len(packet) < HEADER.size:
+    return None
+  magic, packet_type, session, block = HEADER.unpack_from(packet)
+  if magic != MAGIC:
+    return None
+  return (packet_type, session, block, packet[HEADER.size:])
+
+
+def pack_ranges(blocks):
+  """Sorted block numbers to NAK payloads (list of bytes, each fits in a packet)"""
+  ranges = []
+  for block in blocks:
+    if ranges and ranges[-1][0] + ranges[-1][1] == block:
+      ranges[-1][1] += 1
+    else:
+      ranges.append([block, 1])
+      pass
+    pass
+  payloads = []
+  for index in range(0, len(ranges), MAX_NAK_RANGES):
+    payloads.append(b"".join([ NAK_RANGE.pack(start, count) for start, count in ranges[index:index+MAX_NAK_RANGES] ]))
+    pass
+  return payloads
+
+
+def unpack_ranges(payload):
+  blocks = []
+  for offset in range(0, len(payload) - NAK_RANGE.size + 1, NAK_RANGE.size):
+    start, count = NAK_RANGE.unpack_from(payload, offset)
+    blocks.extend(range(start, start + count))
+    pass
+  return blocks
+
+
+def _multicast_socket(interface=None):
+  sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+  sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+  sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+  if interface:
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+    pass
+  return sock
+
+
+class MulticastSender(object):
+  """Sends the image file to the multicast group once, and serves the repairs."""
+
+  def __init__(self, path, url=None, group=DEFAULT_MULTICAST_GROUP, port=DEFAULT_MULTICAST_PORT,
+               rate=DEFAULT_RATE, block_size=DEFAULT_BLOCK_SIZE, interface=None, linger=10.0, name=None):
+    self.path = path
+    self.url = url
+    self.name = name if name else os.path.basename(path)
+    self.group = group
+    self.port = port
+    self.max_rate = rate
+    self.rate = rate
+    self.block_size = block_size
+    self.linger = linger
+    self.size = os.path.getsize(path)
+    self.n_blocks = (self.size + block_size - 1) // block_size
+    self.session = random.getrandbits(32)
+    self.sock = _multicast_socket(interface)
+    self.sock.bind(("", 0))
+    self.sock.setblocking(False)
+    self.position = 0
+    self.finished = False
+    self.repairs = []        # heap of block numbers to send again
+    self.repair_set = set()  # blocks in the heap
+    self.running = True
+    # stats
+    self.sent_blocks = 0
+    self.repaired_blocks = 0
+    self.nak_blocks = 0
+    pass
+
+  def announcement(self):
+    return { "session": self.session,
+             "name": self.name,
+             "size": self.size,
+             "blockSize": self.block_size,
+             "blocks": self.n_blocks,
+             "url": self.url,
+             "position": self.position,
+             "finished": self.finished }
+
+  def _send(self, packet):
+    while True:
+      try:
+        self.sock.sendto(packet, (self.group, self.port))
+        return
+      except BlockingIOError:
+        select.select([], [self.sock], [], 0.1)
+        pass
+      pass
+    pass
+
+  def _send_block(self, fd, block):
+    data = os.pread(fd, self.block_size, block * self.block_size)
+    self._send(make_packet(DATA, self.session, block, data))
+    return len(data)
+
+  def _read_naks(self):
+    """Drains NAKs. Returns the number of blocks NAKed."""
+    n_naked = 0
+    while True:
+      try:
+        packet, _ = self.sock.recvfrom(65536)
+      except (BlockingIOError, InterruptedError):
+        break
+      parsed = parse_packet(packet)
+      if parsed is None or parsed[0] != NAK or parsed[1] != self.session:
+        continue
+      for block in unpack_ranges(parsed[3]):
+        if block < self.n_blocks:
+          if block not in self.repair_set:
+            self.repair_set.add(block)
+            heapq.heappush(self.repairs, block)
+            pass
+          n_naked += 1
+          pass
+        pass
+      pass
+    return n_naked
+
+  def stop(self):
+    self.running = False
+    pass
+
+  def run(self, progress=None):
+    """Sends the image. Returns when the repairs are quiet for linger seconds after the first pass."""
+    fd = os.open(self.path, os.O_RDONLY)
+    try:
+      next_announce = 0
+      rate_started = time.monotonic()
+      rate_sent = 0
+      rate_naked = 0
+      bucket_time = time.monotonic()
+      bucket = 0.0
+      last_nak = None
+
+      while self.running:
+        now = time.monotonic()
+        if now >= next_announce:
+          self._send(make_packet(ANNOUNCE, self.session, self.position, json.dumps(self.announcement()).encode("utf-8")))
+          if self.finished:
+            self._send(make_packet(END, self.session, self.n_blocks))
+            pass
+          if progress:
+            progress(self)
+            pass
+          next_announce = now + ANNOUNCE_INTERVAL
+          pass
+
+        n_naked = self._read_naks()
+        if n_naked:
+          self.nak_blocks += n_naked
+          rate_naked += n_naked
+          last_nak = now
+          pass
+
+        # Rate control
+        if now - rate_started >= RATE_INTERVAL:
+          if rate_sent and rate_naked > rate_sent * NAK_RATIO_LIMIT:
+            self.rate = max(self.max_rate * 0.05, self.rate * RATE_BACKOFF)
+          elif rate_naked == 0:
+            self.rate = min(self.max_rate, self.rate * RATE_RECOVER)
+            pass
+          rate_started = now
+          rate_sent = 0
+          rate_naked = 0
+          pass
+
+        # Token bucket. Allow a burst of 10ms.
+        bucket = min(max(self.block_size, self.rate * 0.01), bucket + (now - bucket_time) * self.rate)
+        bucket_time = now
+        if bucket < self.block_size:
+          time.sleep((self.block_size - bucket) / self.rate)
+          continue
+
+        if self.repairs:
+          block = heapq.heappop(self.repairs)
+          self.repair_set.discard(block)
+          bucket -= self._send_block(fd, block)
+          self.repaired_blocks += 1
+          rate_sent += 1
+        elif self.position < self.n_blocks:
+          bucket -= self._send_block(fd, self.position)
+          self.position += 1
+          self.sent_blocks += 1
+          rate_sent += 1
+          if self.position == self.n_blocks:
+            self.finished = True
+            last_nak = now
+            self._send(make_packet(END, self.session, self.n_blocks))
+            pass
+        else:
+          # First pass is done. Wait for NAKs.
+          if now - last_nak > self.linger:
+            break
+          select.select([self.sock], [], [], min(0.1, max(0, next_announce - now)))
+          pass
+        pass
+    finally:
+      os.close(fd)
+      pass
+    pass
+  pass
+
+
+class MulticastReceiver(object):
+  """Receives the image from multicast group and writes it in order to the output.
+
+name: image file name to pick the session from announcements.
+url: unicast url of the image. The url in announcement is used when not given.
+"""
+
+  def __init__(self, name, output, url=None, group=DEFAULT_MULTICAST_GROUP, port=DEFAULT_MULTICAST_PORT,
+               interface=None, announce_timeout=5.0, repair_timeout=3.0, nak_interval=0.2,
+               memory_limit=256 * 2**20):
+    self.name = name
+    self.output = output
+    self.url = url
+    self.group = group
+    self.port = port
+    self.announce_timeout = announce_timeout
+    self.repair_timeout = repair_timeout
+    self.nak_interval = nak_interval
+    self.memory_limit = memory_limit
+
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+      self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+    except OSError:
+      pass
+    self.sock.bind(("", port))
+    membership = struct.pack("4s4s", socket.inet_aton(group), socket.inet_aton(interface if interface else "0.0.0.0"))
+    self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+
+    self.session = None
+    self.sender = None
+    self.block_size = None
+    self.n_blocks = None
+    self.size = None
+    self.window = None
+
+    self.lock = threading.Condition()
+    self.blocks = {}         # block number: data, not written yet
+    self.next_out = 0        # next block to write
+    self.first_seen = None   # blocks before this come from http
+    self.highest = -1
+    self.naked = {}          # block number: time of last NAK
+    self.overflowed = set()  # blocks dropped as too far ahead, to NAK when the window moves
+    self.catching_up = False # blocks before first_seen are coming from http
+    self.last_packet = None  # time of the last packet of the session
+    self.end_seen = False
+    self.failed = None
+    # stats
+    self.multicast_blocks = 0
+    self.unicast_bytes = 0
+    pass
+
+  #
+  # Session
+  #
+  def _start_session(self, announcement, sender):
+    self.session = announcement["session"]
+    self.sender = (sender[0], sender[1])
+    self.block_size = announcement["blockSize"]
+    self.n_blocks = announcement["blocks"]
+    self.size = announcement["size"]
+    self.window = max(64, self.memory_limit // self.block_size)
+    if self.url is None:
+      self.url = announcement.get("url")
+      pass
+    tlog.info("Multicast session %x for %s from %s" % (self.session, self.name, str(self.sender)))
+    pass
+
+  #
+  # Unicast
+  #
+  def _fetch_range(self, start_block, end_block):
+    """Fetches blocks [start, end) with http Range, and deposits them."""
+    if self.url is None:
+      raise Exception("No url to fetch missing blocks of %s" % self.name)
+    start = start_block * self.block_size
+    end = min(self.size, end_block * self.block_size)
+    import urllib.request
+    request = urllib.request.Request(self.url, headers={"Range": "bytes=%d-%d" % (start, end - 1)})
+    with urllib.request.urlopen(request, timeout=30) as reply:
+      if reply.status != 206 and start != 0:
+        raise Exception("Server of %s does not support Range." % self.url)
+      block = start_block
+      while block < end_block:
+        data = reply.read(min(self.block_size, end - block * self.block_size))
+        if not data:
+          raise Exception("Short read from %s" % self.url)
+        # partial read is possible. Read the rest of block.
+        while len(data) < min(self.block_size, end - block * self.block_size):
+          more = reply.read(min(self.block_size, end - block * self.block_size) - len(data))
+          if not more:
+            raise Exception("Short read from %s" % self.url)
+          data += more
+          pass
+        self._deposit(block, data, force=True)
+        self.unicast_bytes += len(data)
+        block += 1
+        pass
+      pass
+    pass
+
+  def _catch_up(self, end_block):
+    try:
+      self._fetch_range(0, end_block)
+    except Exception as exc:
+      tlog.info("Catching up %s failed: %s" % (self.name, str(exc)))
+      with self.lock:
+        self.failed = str(exc)
+        self.lock.notify_all()
+        pass
+      pass
+    finally:
+      with self.lock:
+        self.catching_up = False
+        pass
+      pass
+    pass
+
+  def _fetch_stalled(self):
+    """The repairs of the blocks the writer is waiting for do not come. The
+missing range from the next block to write is fetched from http, and the
+rest keeps coming from multicast."""
+    with self.lock:
+      end = self.next_out
+      limit = min(self.n_blocks, max(self.highest + 1, self.next_out + 1), self.next_out + self.window)
+      while end < limit and end not in self.blocks:
+        end += 1
+        pass
+      start = self.next_out
+      pass
+    if start < end:
+      tlog.info("Fetching blocks %d-%d of %s from http." % (start, end - 1, self.name))
+      self._fetch_range(start, end)
+      pass
+    pass
+
+  def _fetch_missing(self):
+    """Last resort when the sender is gone. Everything not received yet comes from http."""
+    with self.lock:
+      missing = [ block for block in range(self.next_out, self.n_blocks) if block not in self.blocks ]
+      pass
+    ranges = []
+    for block in missing:
+      if ranges and ranges[-1][1] == block:
+        ranges[-1][1] = block + 1
+      else:
+        ranges.append([block, block + 1])
+        pass
+      pass
+    for start, end in ranges:
+      self._fetch_range(start, end)
+      pass
+    pass
+
+  #
+  # Block store
+  #
+  def _window_start(self):
+    # While a late joiner catches up, the blocks from http are written out
+    # as they come, and the window is for the blocks from multicast.
+    if self.catching_up and self.first_seen is not None:
+      return max(self.next_out, self.first_seen)
+    return self.next_out
+
+  def _deposit(self, block, data, force=False):
+    with self.lock:
+      if block < self.next_out or block in self.blocks:
+        return False
+      # Blocks too far ahead are dropped, and NAKed when the window moves.
+      if not force and block >= self._window_start() + self.window:
+        self.overflowed.add(block)
+        return False
+      self.blocks[block] = data
+      self.naked.pop(block, None)
+      self.overflowed.discard(block)
+      if block == self.next_out:
+        self.lock.notify_all()
+        pass
+      pass
+    return True
+
+  def _writer(self):
+    try:
+      while True:
+        with self.lock:
+          while self.next_out not in self.blocks and self.next_out < self.n_blocks and self.failed is None:
+            self.lock.wait(1)
+            pass
+          if self.failed is not None or self.next_out >= self.n_blocks:
+            return
+          chunks = []
+          while self.next_out in self.blocks:
+            chunks.append(self.blocks.pop(self.next_out))
+            self.next_out += 1
+            pass
+          pass
+        self.output.write(b"".join(chunks))
+        pass
+      pass
+    except Exception as exc:
+      with self.lock:
+        self.failed = "Writing output failed: %s" % str(exc)
+        pass
+      pass
+    pass
+
+  def _missing_to_nak(self, now):
+    """Blocks missing in the window that are not NAKed recently."""
+    with self.lock:
+      low = max(self.next_out, self.first_seen if self.first_seen is not None else 0)
+      high = min(self.highest + 1 if not self.end_seen else self.n_blocks, self._window_start() + self.window)
+      missing = []
+      for block in range(low, high):
+        if block in self.blocks:
+          continue
+        last = self.naked.get(block)
+        if last is None or now - last >= self.nak_interval * 5:
+          self.naked[block] = now
+          missing.append(block)
+          pass
+        pass
+      # Dropped ones came in the window, and are in the range above.
+      self.overflowed = set([ block for block in self.overflowed if block >= high ])
+      pass
+    return missing
+
+  def _stream_unicast(self):
+    """No multicast session. Whole image comes from http."""
+    import urllib.request
+    with urllib.request.urlopen(self.url, timeout=30) as reply:
+      while True:
+        data = reply.read(2**20)
+        if not data:
+          break
+        self.output.write(data)
+        self.unicast_bytes += len(data)
+        pass
+      pass
+    return 0
+
+  def run(self):
+    """Receives the image. Returns 0 on success."""
+    deadline = time.monotonic() + self.announce_timeout
+    while self.session is None:
+      timeout = deadline - time.monotonic()
+      if timeout <= 0:
+        break
+      readable, _, _ = select.select([self.sock], [], [], timeout)
+      if not readable:
+        continue
+      packet, sender = self.sock.recvfrom(65536)
+      parsed = parse_packet(packet)
+      if parsed and parsed[0] == ANNOUNCE:
+        announcement = json.loads(parsed[3].decode("utf-8"))
+        if announcement.get("name") == self.name:
+          # Too late to join. Most of it would come from http anyway.
+          if announcement.get("finished"):
+            if self.url is None:
+              self.url = announcement.get("url")
+              pass
+            break
+          self._start_session(announcement, sender)
+          pass
+        pass
+      pass
+
+    if self.session is None:
+      if self.url is None:
+        tlog.info("No multicast session for %s and no url." % self.name)
+        return 1
+      tlog.info("No multicast session for %s. Loading from %s" % (self.name, self.url))
+      self.sock.close()
+      return self._stream_unicast()
+
+    writer = threading.Thread(target=self._writer)
+    writer.start()
+    catch_up = None
+    last_next_out = -1
+    last_progress = time.monotonic()
+    next_nak = time.monotonic()
+
+    try:
+      while True:
+        with self.lock:
+          if self.failed is not None or self.next_out >= self.n_blocks:
+            break
+          pass
+        now = time.monotonic()
+
+        readable, _, _ = select.select([self.sock], [], [], self.nak_interval)
+        if readable:
+          packet, sender = self.sock.recvfrom(65536)
+          parsed = parse_packet(packet)
+          if parsed and parsed[1] == self.session:
+            self.last_packet = now
+            packet_type, _, block, payload = parsed
+            if packet_type == DATA:
+              if self.first_seen is None:
+                self.first_seen = block
+                if block > 0:
+                  self.catching_up = True
+                  catch_up = threading.Thread(target=self._catch_up, args=(block,))
+                  catch_up.start()
+                  pass
+                pass
+              if self._deposit(block, payload):
+                self.multicast_blocks += 1
+                pass
+              self.highest = max(self.highest, block)
+              pass
+            elif packet_type == END:
+              self.end_seen = True
+              pass
+            pass
+          pass
+
+        if now >= next_nak and self.first_seen is not None:
+          next_nak = now + self.nak_interval
+          missing = self._missing_to_nak(now)
+          for payload in pack_ranges(missing):
+            self.sock.sendto(make_packet(NAK, self.session, 0, payload), self.sender)
+            pass
+          pass
+
+        # The writer is waiting for the next block. When the repairs don't come
+        # for a while, http for the missing range. When the sender is gone,
+        # http for the rest.
+        with self.lock:
+          starving = self.next_out not in self.blocks
+          if self.next_out != last_next_out or not starving:
+            last_next_out = self.next_out
+            last_progress = now
+            pass
+          pass
+        if starving and now - last_progress > self.repair_timeout:
+          if catch_up:
+            catch_up.join()
+            catch_up = None
+            pass
+          if self.last_packet is None or now - self.last_packet > self.repair_timeout:
+            self._fetch_missing()
+          else:
+            self._fetch_stalled()
+            pass
+          last_progress = time.monotonic()
+          pass
+        pass
+    except Exception as exc:
+      tlog.info("Multicast receive of %s failed: %s" % (self.name, str(exc)))
+      with self.lock:
+        self.failed = str(exc)
+        pass
+      pass
+    finally:
+      with self.lock:
+        self.lock.notify_all()
+        pass
+      if catch_up:
+        catch_up.join()
+        pass
+      writer.join()
+      self.sock.close()
+      pass
+    return 0 if self.failed is None and self.next_out >= self.n_blocks else 1
+  pass
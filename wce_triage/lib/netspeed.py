@@ -0,0 +1,136 @@
+#!/usr/bin/python3
+# Copyright (c) 2019 Naoyuki tai
+# MIT license - see LICENSE
+"""Network throughput test between triage machine and WCE share server.
+
+The server side is in http/httpserver (/dispatch/speedtest/*). It streams
+generated payload for download and throws away the upload. This is the
+client side probe. It measures the round trip of tiny requests for latency
+and jitter, then download and upload throughput.
+
+The speed test is the API of the triage server, not the share. On PXE boot,
+the share url points at the web server (lighttpd) of the same machine, so
+the host is the same but the port is the triage server's. When the server
+does not have the speed test, the speed is unknown.
+"""
+
+import os, time, urllib.request, urllib.parse, urllib.error
+from .util import get_triage_logger
+
+tlog = get_triage_logger()
+
+SPEEDTEST_PATH = "/dispatch/speedtest"
+SPEEDTEST_CHUNK_SIZE = 2 ** 16
+# Random so that compression on the way does not help.
+SPEEDTEST_CHUNK = os.urandom(SPEEDTEST_CHUNK_SIZE)
+# Server refuses bigger download than this
+SPEEDTEST_MAX_SIZE = 2 ** 30
+
+DEFAULT_DOWNLOAD_SIZE = 64 * 2**20
+DEFAULT_UPLOAD_SIZE = 16 * 2**20
+DEFAULT_PINGS = 10
+DEFAULT_TIMEOUT = 10
+
+# Port of the triage http server
+TRIAGE_SERVER_PORT = 8312
+
+
+def get_speedtest_url(wce_share_url, port=TRIAGE_SERVER_PORT):
+  """Speed test lives in the triage server on the machine of WCE share."""
+  parsed = urllib.parse.urlsplit(wce_share_url)
+  host = "[%s]" % parsed.hostname if ":" in parsed.hostname else parsed.hostname
+  return urllib.parse.urlunsplit((parsed.scheme, "%s:%d" % (host, port), SPEEDTEST_PATH, "", ""))
+
+
+def has_speedtest(base_url, timeout=DEFAULT_TIMEOUT):
+  """True when the server answers the speed test ping."""
+  try:
+    with urllib.request.urlopen(base_url + "/ping", timeout=timeout) as reply:
+      reply.read()
+      pass
+    return True
+  except urllib.error.HTTPError as exc:
+    tlog.info("Speed test is not on %s. HTTP %d" % (base_url, exc.code))
+    pass
+  except (urllib.error.URLError, ConnectionError) as exc:
+    tlog.info("Speed test is not on %s. %s" % (base_url, str(exc)))
+    pass
+  return False
+
+
+def _upload_body(size):
+  remaining = size
+  while remaining > 0:
+    chunk = SPEEDTEST_CHUNK[:min(remaining, SPEEDTEST_CHUNK_SIZE)]
+    remaining -= len(chunk)
+    yield chunk
+    pass
+  pass
+
+
+def measure_latency(base_url, n_pings=DEFAULT_PINGS, timeout=DEFAULT_TIMEOUT):
+  """Returns (latency ms, jitter ms). Jitter is the mean difference of consecutive round trips."""
+  round_trips = []
+  for _ in range(n_pings):
+    started = time.monotonic()
+    with urllib.request.urlopen(base_url + "/ping", timeout=timeout) as reply:
+      reply.read()
+      pass
+    round_trips.append((time.monotonic() - started) * 1000)
+    pass
+  latency = sum(round_trips) / len(round_trips)
+  diffs = [ abs(round_trips[i] - round_trips[i-1]) for i in range(1, len(round_trips)) ]
+  jitter = sum(diffs) / len(diffs) if diffs else 0.0
+  return (latency, jitter)
+
+
+def measure_download(base_url, size=DEFAULT_DOWNLOAD_SIZE, timeout=DEFAULT_TIMEOUT):
+  """Returns bytes per second."""
+  started = time.monotonic()
+  received = 0
+  with urllib.request.urlopen(base_url + "/download?size=%d" % size, timeout=timeout) as reply:
+    while True:
+      data = reply.read(2 ** 20)
+      if not data:
+        break
+      received += len(data)
+      pass
+    pass
+  elapsed = max(0.001, time.monotonic() - started)
+  if received != size:
+    raise Exception("Speed test download got %d bytes of %d." % (received, size))
+  return received / elapsed
+
+
+def measure_upload(base_url, size=DEFAULT_UPLOAD_SIZE, timeout=DEFAULT_TIMEOUT):
+  """Returns bytes per second."""
+  request = urllib.request.Request(base_url + "/upload", data=_upload_body(size), method="POST",
+                                   headers={"Content-Length": str(size),
+                                            "Content-Type": "application/octet-stream"})
+  started = time.monotonic()
+  with urllib.request.urlopen(request, timeout=timeout) as reply:
+    reply.read()
+    pass
+  return size / max(0.001, time.monotonic() - started)
+
+
+def measure_network_speed(base_url, download_size=DEFAULT_DOWNLOAD_SIZE, upload_size=DEFAULT_UPLOAD_SIZE,
+                          n_pings=DEFAULT_PINGS, timeout=DEFAULT_TIMEOUT):
+  """Runs the probe against the speed test url (see get_speedtest_url).
+Returns dict of download/upload (bytes/s), latency/jitter (ms), or None when
+the server has no speed test."""
+  if not has_speedtest(base_url, timeout=timeout):
+    return None
+  latency, jitter = measure_latency(base_url, n_pings=n_pings, timeout=timeout)
+  download = measure_download(base_url, size=download_size, timeout=timeout)
+  upload = measure_upload(base_url, size=upload_size, timeout=timeout)
+  return { "download": round(download),
+           "upload": round(upload),
+           "latency": round(latency, 2),
+           "jitter": round(jitter, 2) }
+
+
+if __name__ == "__main__":
+  import sys, json
+  print(json.dumps(measure_network_speed(get_speedtest_url(sys.argv[1]))))
+  pass
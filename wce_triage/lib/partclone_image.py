@@ -0,0 +1,399 @@
+# Copyright (c) 2019 Naoyuki tai
+# MIT license - see LICENSE
+"""Decoder of partclone image.
+
+partclone -r reads the image through the page cache and its progress is the
+input it has read, not what is on the disk. This decodes the image in process
+and writes the used blocks to the partition with large writes, optionally with
+O_DIRECT, from a few writer threads. The progress is the bytes written.
+
+Only the image format version 2 (partclone 0.3 and up) is decoded. For the
+others, UnsupportedImage is raised after reading the descriptor so that the
+caller can hand the stream to partclone.
+
+Image format version 2 (little endian, packed)
+
+  image_head_v2      magic[16] "partclone-image", ptc_version[14], version[4] "0002", endianess u16 0xC0DE
+  file_system_info   fs[16], device_size u64, totalblock u64, usedblocks u64, used_bitmap u64, block_size u32
+  image_options      feature_size u32, image_version u16, cpu_bits u16, checksum_mode u16,
+                     checksum_size u16, blocks_per_checksum u32, reseed_checksum u8, bitmap_mode u8
+  crc                u32 of the above
+  bitmap             (totalblock + 7) / 8 bytes, bit n of byte (block / 8) is (block % 8). crc u32 follows.
+  blocks             used blocks in order. After every blocks_per_checksum blocks, and after the
+                     last blocks, the checksum of the blocks.
+
+partclone's crc32 is the plain table driven crc with the seed 0xFFFFFFFF and
+without the final xor.
+"""
+
+import os, re, zlib, mmap, errno, struct, queue, threading
+from .util import get_triage_logger
+
+tlog = get_triage_logger()
+
+IMAGE_MAGIC = b"partclone-image"
+IMAGE_VERSION_2 = b"0002"
+ENDIAN_MAGIC = 0xC0DE
+CRC32_SEED = 0xFFFFFFFF
+
+CSM_NONE = 0x00
+CSM_CRC32 = 0x20
+
+BM_NONE = 0x00
+BM_BIT = 0x01
+BM_BYTE = 0x08
+
+_head_struct = struct.Struct("<16s14s4sH")
+_fs_info_struct = struct.Struct("<16sQQQQI")
+_options_struct = struct.Struct("<IHHHHIBB")
+_crc_struct = struct.Struct("<I")
+IMAGE_DESC_SIZE = _head_struct.size + _fs_info_struct.size + _options_struct.size + _crc_struct.size
+
+DEFAULT_WRITE_SIZE = 8 * 2**20
+DEFAULT_WRITERS = 4
+# Without O_DIRECT, the written bytes are counted after they are flushed.
+FLUSH_SIZE = 256 * 2**20
+# O_DIRECT needs the offset and length aligned to the logical block of device.
+DIRECT_ALIGNMENT = 4096
+
+
+class UnsupportedImage(Exception):
+  """The image is not something this decoder knows. partclone should do it."""
+  pass
+
+
+def partclone_crc32(data, crc=CRC32_SEED):
+  return zlib.crc32(data, crc ^ 0xFFFFFFFF) ^ 0xFFFFFFFF
+
+
+def _cstring(value):
+  return value.split(b"\0", 1)[0].decode("iso-8859-1")
+
+
+def read_exactly(stream, size):
+  data = bytearray()
+  while len(data) < size:
+    chunk = stream.read(size - len(data))
+    if not chunk:
+      break
+    data += chunk
+    pass
+  return bytes(data)
+
+
+def readinto_exactly(stream, view):
+  got = 0
+  while got < len(view):
+    n = stream.readinto(view[got:])
+    if not n:
+      raise Exception("Image ended after %d of %d bytes." % (got, len(view)))
+    got += n
+    pass
+  pass
+
+
+def parse_image_desc(desc):
+  """The image descriptor to dict. Raises UnsupportedImage."""
+  if len(desc) < IMAGE_DESC_SIZE:
+    raise UnsupportedImage("Image is too short.")
+  magic, ptc_version, version, endianess = _head_struct.unpack_from(desc, 0)
+  if not magic.startswith(IMAGE_MAGIC):
+    raise UnsupportedImage("Not a partclone image.")
+  if version != IMAGE_VERSION_2:
+    raise UnsupportedImage("Image version %s is not supported." % version.decode("iso-8859-1"))
+  if endianess != ENDIAN_MAGIC:
+    raise UnsupportedImage("Image is made on the different endian.")
+  offset = _head_struct.size
+  fs, device_size, totalblock, usedblocks, used_bitmap, block_size = _fs_info_struct.unpack_from(desc, offset)
+  offset += _fs_info_struct.size
+  (feature_size, image_version, cpu_bits, checksum_mode, checksum_size,
+   blocks_per_checksum, reseed_checksum, bitmap_mode) = _options_struct.unpack_from(desc, offset)
+  offset += _options_struct.size
+  crc = _crc_struct.unpack_from(desc, offset)[0]
+  if partclone_crc32(desc[:offset]) != crc:
+    raise Exception("Image descriptor checksum does not match.")
+  if bitmap_mode != BM_BIT:
+    raise UnsupportedImage("Bitmap mode %d is not supported." % bitmap_mode)
+  if checksum_mode not in [CSM_NONE, CSM_CRC32]:
+    raise UnsupportedImage("Checksum mode %d is not supported." % checksum_mode)
+  if checksum_mode == CSM_CRC32 and (checksum_size != 4 or blocks_per_checksum == 0):
+    raise UnsupportedImage("Checksum size %d per %d blocks is not supported." % (checksum_size, blocks_per_checksum))
+  return { "partcloneVersion": _cstring(ptc_version),
+           "fileSystem": _cstring(fs),
+           "deviceSize": device_size,
+           "totalBlocks": totalblock,
+           "usedBlocks": usedblocks,
+           "blockSize": block_size,
+           "checksumMode": checksum_mode,
+           "checksumSize": checksum_size if checksum_mode != CSM_NONE else 0,
+           "blocksPerChecksum": blocks_per_checksum,
+           "reseedChecksum": bool(reseed_checksum) }
+
+
+def read_bitmap(stream, header):
+  size = (header["totalBlocks"] + 7) // 8
+  bitmap = read_exactly(stream, size)
+  if len(bitmap) != size:
+    raise Exception("Image ended in the bitmap.")
+  crc = read_exactly(stream, _crc_struct.size)
+  if len(crc) != _crc_struct.size or _crc_struct.unpack(crc)[0] != partclone_crc32(bitmap):
+    raise Exception("Bitmap checksum does not match.")
+  return bitmap
+
+
+_bitmap_run_re = re.compile(b"\x00+|\xff+|[\x01-\xfe]")
+
+def iterate_used_runs(bitmap, totalblock):
+  """(first block, n blocks) of the used blocks. Full and empty bytes are
+skipped over a byte at a time."""
+  run_start = None
+  run_end = None
+  for matched in _bitmap_run_re.finditer(bitmap):
+    first_byte = matched.start()
+    token = matched.group(0)
+    if token[0] == 0:
+      ranges = []
+    elif token[0] == 0xff:
+      ranges = [ (first_byte * 8, matched.end() * 8) ]
+    else:
+      ranges = [ (first_byte * 8 + bit, first_byte * 8 + bit + 1) for bit in range(8) if token[0] & (1 << bit) ]
+      pass
+    for start, end in ranges:
+      end = min(end, totalblock)
+      if start >= end:
+        continue
+      if run_end == start:
+        run_end = end
+        continue
+      if run_start is not None:
+        yield (run_start, run_end - run_start)
+        pass
+      run_start, run_end = start, end
+      pass
+    pass
+  if run_start is not None:
+    yield (run_start, run_end - run_start)
+    pass
+  pass
+
+
+def open_for_write(path, direct):
+  """Opens the partition for writing. When O_DIRECT is refused, it's opened normally.
+Returns (fd, direct)"""
+  o_direct = getattr(os, "O_DIRECT", 0)
+  if direct and o_direct:
+    try:
+      return (os.open(path, os.O_WRONLY | o_direct), True)
+    except OSError as exc:
+      if exc.errno != errno.EINVAL:
+        raise
+      pass
+    pass
+  return (os.open(path, os.O_WRONLY), False)
+
+
+class ImageDecoder(object):
+  """Writes the used blocks of the image stream to dest.
+
+stream: the image after the descriptor and the bitmap are read. Use
+  read_image_desc/read_bitmap, or open() does it.
+direct: O_DIRECT writes. Ignored if the block size is not aligned.
+writers: number of writer threads. The reader hands the block ranges to
+  whichever is free."""
+
+  def __init__(self, stream, dest, header, bitmap, writers=DEFAULT_WRITERS, direct=True, write_size=DEFAULT_WRITE_SIZE):
+    self.stream = stream
+    self.dest = dest
+    self.header = header
+    self.bitmap = bitmap
+    self.n_writers = max(1, writers)
+    block_size = header["blockSize"]
+    self.direct = direct and (block_size % DIRECT_ALIGNMENT == 0)
+    self.write_size = max(block_size, write_size - write_size % block_size)
+    self.total_bytes = header["usedBlocks"] * block_size
+    self.read_bytes = 0
+    self.written_bytes = 0
+    self.error = None
+    self.lock = threading.Lock()
+    self.fd = None
+    # Buffers go around: free -> reader -> jobs -> writer -> free
+    self.free_buffers = queue.Queue()
+    self.jobs = queue.Queue()
+    self.writer_threads = []
+    self.unflushed = 0
+    pass
+
+  def _fail(self, message):
+    with self.lock:
+      if self.error is None:
+        self.error = message
+        pass
+      pass
+    pass
+
+  def _writer(self):
+    while True:
+      job = self.jobs.get()
+      if job is None:
+        break
+      offset, buffer, length = job
+      try:
+        if self.error is None:
+          view = memoryview(buffer)[:length]
+          while len(view) > 0:
+            written = os.pwrite(self.fd, view, offset)
+            view = view[written:]
+            offset += written
+            pass
+          self._written(length)
+          pass
+        pass
+      except Exception as exc:
+        self._fail("Writing to %s failed. %s" % (self.dest, str(exc)))
+        pass
+      self.free_buffers.put(buffer)
+      pass
+    pass
+
+  def _written(self, length):
+    if self.direct:
+      with self.lock:
+        self.written_bytes += length
+        pass
+      return
+    with self.lock:
+      self.unflushed += length
+      flush = self.unflushed >= FLUSH_SIZE
+      if flush:
+        flushing = self.unflushed
+        self.unflushed = 0
+        pass
+      pass
+    if flush:
+      os.fdatasync(self.fd)
+      with self.lock:
+        self.written_bytes += flushing
+        pass
+      pass
+    pass
+
+  def _verify_checksum(self, crc, n_blocks_checked):
+    expected = read_exactly(self.stream, self.header["checksumSize"])
+    if len(expected) != self.header["checksumSize"]:
+      raise Exception("Image ended in the checksum.")
+    if _crc_struct.unpack(expected)[0] != crc:
+      raise Exception("Checksum does not match after %d blocks." % n_blocks_checked)
+    pass
+
+  def run(self):
+    """Decodes the image. Returns None on success, or error message."""
+    self.fd, self.direct = open_for_write(self.dest, self.direct)
+    for _ in range(self.n_writers * 2):
+      self.free_buffers.put(mmap.mmap(-1, self.write_size))
+      pass
+    for _ in range(self.n_writers):
+      writer = threading.Thread(target=self._writer, daemon=True)
+      writer.start()
+      self.writer_threads.append(writer)
+      pass
+
+    try:
+      self._read_blocks()
+    except Exception as exc:
+      self._fail(str(exc))
+      pass
+
+    for _ in self.writer_threads:
+      self.jobs.put(None)
+      pass
+    for writer in self.writer_threads:
+      writer.join()
+      pass
+    try:
+      os.fdatasync(self.fd)
+      with self.lock:
+        self.written_bytes += self.unflushed
+        self.unflushed = 0
+        pass
+    except OSError as exc:
+      self._fail("Flushing %s failed. %s" % (self.dest, str(exc)))
+      pass
+    os.close(self.fd)
+    return self.error
+
+  def _read_blocks(self):
+    block_size = self.header["blockSize"]
+    checksumming = self.header["checksumMode"] == CSM_CRC32
+    blocks_per_checksum = self.header["blocksPerChecksum"]
+    blocks_in_checksum = 0
+    n_blocks = 0
+    crc = CRC32_SEED
+
+    for first, count in iterate_used_runs(self.bitmap, self.header["totalBlocks"]):
+      block = first
+      while count > 0:
+        if self.error:
+          return
+        # A write does not go across the checksum so that the crc is done per write
+        n = min(count, self.write_size // block_size)
+        if checksumming:
+          n = min(n, blocks_per_checksum - blocks_in_checksum)
+          pass
+        buffer = self.free_buffers.get()
+        length = n * block_size
+        view = memoryview(buffer)[:length]
+        readinto_exactly(self.stream, view)
+        with self.lock:
+          self.read_bytes += length
+          pass
+        if checksumming:
+          crc = partclone_crc32(view, crc)
+          blocks_in_checksum += n
+          pass
+        view.release()
+        self.jobs.put((block * block_size, buffer, length))
+        block += n
+        count -= n
+        n_blocks += n
+
+        if checksumming and blocks_in_checksum == blocks_per_checksum:
+          self._verify_checksum(crc, n_blocks)
+          blocks_in_checksum = 0
+          if self.header["reseedChecksum"]:
+            crc = CRC32_SEED
+            pass
+          pass
+        pass
+      pass
+
+    if n_blocks != self.header["usedBlocks"]:
+      raise Exception("Bitmap has %d blocks but the image says %d." % (n_blocks, self.header["usedBlocks"]))
+    if checksumming and blocks_in_checksum > 0:
+      self._verify_checksum(crc, n_blocks)
+      pass
+    pass
+
+  def stats(self):
+    with self.lock:
+      return { "dest": self.dest,
+               "direct": self.direct,
+               "writers": self.n_writers,
+               "total": self.total_bytes,
+               "read": self.read_bytes,
+               "written": self.written_bytes,
+               "error": self.error }
+    pass
+  pass
+
+
+def open_image(stream, dest, **kwargs):
+  """Reads the descriptor and the bitmap, and returns the decoder.
+UnsupportedImage has the bytes read so far as .consumed."""
+  desc = read_exactly(stream, IMAGE_DESC_SIZE)
+  try:
+    header = parse_image_desc(desc)
+  except UnsupportedImage as exc:
+    exc.consumed = desc
+    raise
+  bitmap = read_bitmap(stream, header)
+  return ImageDecoder(stream, dest, header, bitmap, **kwargs)
@@ -0,0 +1,180 @@
+#!/usr/bin/python3
+# Copyright (c) 2019 Naoyuki tai
+# MIT license - see LICENSE
+"""PCI ID to name lookup without lspci.
+
+pci.ids is a 1MB+ text file, and parsing it for every triage is slower than
+running lspci. Instead, it is converted once into a compact binary index
+which is memory-mapped and binary-searched.
+
+Index file format (little endian)
+  header:  magic (8 bytes) "WCEPCI1\\0", count of records (uint32)
+  records: count x (key uint64, name offset uint32), sorted by key
+  names:   NUL terminated UTF-8 strings
+
+key is (vendor << 17) for a vendor, and (vendor << 17) | (1 << 16) | device
+for a device of the vendor.
+"""
+
+import os, struct, mmap
+
+PCI_IDS_FILES = [ "/usr/share/misc/pci.ids", "/usr/share/hwdata/pci.ids", "/usr/share/pci.ids" ]
+PCI_IDS_INDEX = "/var/lib/wce_triage/pci.ids.idx"
+
+INDEX_MAGIC = b'WCEPCI1\x00'
+INDEX_HEADER = struct.Struct('<8sI')
+INDEX_RECORD = struct.Struct('<QI')
+
+
+def vendor_key(vendor):
+  return vendor << 17
+
+def device_key(vendor, device):
+  return (vendor << 17) | (1 << 16) | device
+
+
+def find_pci_ids_file():
+  for pci_ids in PCI_IDS_FILES:
+    if os.path.exists(pci_ids):
+      return pci_ids
+    pass
+  return None
+
+
+def parse_pci_ids(lines):
+  """Generates (key, name) from the lines of pci.ids."""
+  vendor = None
+  for line in lines:
+    if len(line) == 0 or line[0] == '#' or len(line.strip()) == 0:
+      continue
+    # Device class section follows the vendors. Not needed.
+    if line.startswith("C "):
+      break
+    if line[0] != '\t':
+      try:
+        vendor = int(line[0:4], 16)
+      except ValueError:
+        vendor = None
+        continue
+      yield (vendor_key(vendor), line[4:].strip())
+    elif line[1] != '\t' and vendor is not None:
+      try:
+        device = int(line[1:5], 16)
+      except ValueError:
+        continue
+      yield (device_key(vendor, device), line[5:].strip())
+      pass
+    # Subsystems (two tabs) are not indexed.
+    pass
+  pass
+
+
+def build_pci_ids_index(lines):
+  """returns the index as bytes"""
+  entries = sorted(dict(parse_pci_ids(lines)).items())
+  names = bytearray()
+  records = bytearray()
+  for key, name in entries:
+    records += INDEX_RECORD.pack(key, len(names))
+    names += name.encode('utf-8') + b'\x00'
+    pass
+  return INDEX_HEADER.pack(INDEX_MAGIC, len(entries)) + bytes(records) + bytes(names)
+
+
+def write_pci_ids_index(pci_ids, index_file):
+  with open(pci_ids, encoding='utf-8', errors='replace') as pci_ids_f:
+    index = build_pci_ids_index(pci_ids_f)
+    pass
+  tmp_file = index_file + ".tmp"
+  with open(tmp_file, "wb") as index_f:
+    index_f.write(index)
+    pass
+  os.rename(tmp_file, index_file)
+  pass
+
+
+class PCIIds(object):
+  """Lookup by binary search on the memory-mapped index."""
+
+  def __init__(self, index):
+    # index is either a mmap or bytes
+    self.index = index
+    magic, self.count = INDEX_HEADER.unpack_from(index, 0)
+    if magic != INDEX_MAGIC:
+      raise Exception("Bad PCI IDs index.")
+    self.names_offset = INDEX_HEADER.size + self.count * INDEX_RECORD.size
+    pass
+
+  def _find(self, key):
+    low = 0
+    high = self.count
+    while low < high:
+      middle = (low + high) // 2
+      middle_key, name_offset = INDEX_RECORD.unpack_from(self.index, INDEX_HEADER.size + middle * INDEX_RECORD.size)
+      if middle_key < key:
+        low = middle + 1
+      elif middle_key > key:
+        high = middle
+      else:
+        start = self.names_offset + name_offset
+        end = self.index.find(b'\x00', start)
+        return self.index[start:end].decode('utf-8')
+      pass
+    return None
+
+  def vendor_name(self, vendor):
+    return self._find(vendor_key(vendor))
+
+  def device_name(self, vendor, device):
+    return self._find(device_key(vendor, device))
+  pass
+
+
+_pci_ids = None
+
+def get_pci_ids(index_file=PCI_IDS_INDEX, pci_ids=None):
+  """returns PCIIds, or None if pci.ids is not available.
+
+The index is rebuilt when pci.ids is newer than the index. When the index
+cannot be written, it's built in memory.
+"""
+  global _pci_ids
+  if _pci_ids is not None:
+    return _pci_ids
+
+  if pci_ids is None:
+    pci_ids = find_pci_ids_file()
+    pass
+
+  try:
+    if pci_ids and ((not os.path.exists(index_file)) or os.path.getmtime(index_file) < os.path.getmtime(pci_ids)):
+      write_pci_ids_index(pci_ids, index_file)
+      pass
+    with open(index_file, "rb") as index_f:
+      _pci_ids = PCIIds(mmap.mmap(index_f.fileno(), 0, access=mmap.ACCESS_READ))
+      pass
+    return _pci_ids
+  except (IOError, OSError, ValueError):
+    pass
+
+  if pci_ids:
+    with open(pci_ids, encoding='utf-8', errors='replace') as pci_ids_f:
+      _pci_ids = PCIIds(build_pci_ids_index(pci_ids_f))
+      pass
+    pass
+  return _pci_ids
+
+
+#
+if __name__ == "__main__":
+  import sys
+  # Prebuild the index
+  source = sys.argv[1] if len(sys.argv) > 1 else find_pci_ids_file()
+  index_file = sys.argv[2] if len(sys.argv) > 2 else PCI_IDS_INDEX
+  if source is None:
+    print("pci.ids is not found.")
+    sys.exit(1)
+    pass
+  write_pci_ids_index(source, index_file)
+  print("%s -> %s" % (source, index_file))
+  pass
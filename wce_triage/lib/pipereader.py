@@ -2,7 +2,7 @@
 pipe reader utility. reads stream from pipe and buffer data.
 """
 from collections import deque
-import subprocess, sys, asyncio
+import subprocess, sys
 from ..lib.util import get_triage_logger
 import functools
 
@@ -22,11 +22,14 @@ class PipeReader:
     pass
 
   def add_to_event_loop(pipe, callback, tag):
+    # Only the web server has the event loop.
+    import asyncio
     asyncio.get_event_loop().add_reader(pipe, functools.partial(callback, PipeReader(pipe, tag=tag)))
     pass
   
   def remove_from_event_loop(self):
     if self.asyncio_reader:
+      import asyncio
       self.asyncio_reader = False
       asyncio.get_event_loop().remove_reader(self.pipe)
       pass
@@ -0,0 +1,213 @@
+# Copyright (c) 2019 Naoyuki tai
+# MIT license - see LICENSE
+"""Zeroing the regions of disk the restore does not write.
+
+Full wipe before loading the image zeroes the blocks partclone writes right
+after. For the restore, the wipe is split to two.
+
+- Before partitioning, everything outside of the partition the image goes in.
+  The partition map, BIOS boot, EFI partition, swap and the gaps.
+- After the restore, the free blocks of the restored file system and the tail
+  of the partition past the file system. partclone writes only the used blocks.
+
+Together, every block of the disk is either zeroed or written by the restore.
+
+Regions are (byte offset, byte length). Zeroing uses BLKZEROOUT so that the
+kernel can offload it to the device (WRITE ZEROES / WRITE SAME, which is unmap
+on most SSDs). BLKDISCARD is used only when the device says the discarded
+blocks read back as zero. When neither works (eg. plain file), zeros are written.
+"""
+
+import os, re, fcntl, struct, errno, subprocess
+from .util import get_triage_logger
+
+tlog = get_triage_logger()
+
+BLKDISCARD = 0x1277
+BLKZEROOUT = 0x127f
+BLKGETSIZE64 = 0x80081272
+
+ZERO_METHOD_DISCARD = "discard"
+ZERO_METHOD_ZEROOUT = "zeroout"
+ZERO_METHOD_WRITE = "write"
+
+# Each ioctl/write is this big so that the progress moves and stop works.
+ZERO_CHUNK_SIZE = 2 ** 26
+_zeros = bytes(2 ** 22)
+
+MiB = 2 ** 20
+
+
+def merge_regions(regions):
+  """Sorts and merges the overlapping and adjacent regions. Empty ones are dropped."""
+  merged = []
+  for offset, length in sorted([ region for region in regions if region[1] > 0 ]):
+    if merged and offset <= merged[-1][0] + merged[-1][1]:
+      last_offset, last_length = merged[-1]
+      merged[-1] = (last_offset, max(last_offset + last_length, offset + length) - last_offset)
+      continue
+    merged.append((offset, length))
+    pass
+  return merged
+
+
+def total_region_size(regions):
+  return sum([ length for offset, length in regions ])
+
+
+def format_regions(regions):
+  """For command line. offset:length,offset:length"""
+  return ",".join([ "%d:%d" % (offset, length) for offset, length in regions ])
+
+
+def parse_regions(spec):
+  regions = []
+  for region in spec.split(","):
+    if not region:
+      continue
+    offset, length = region.split(":")
+    regions.append((int(offset), int(length)))
+    pass
+  return regions
+
+
+def pplan_outside_regions(pplan, partition_id, disk_size):
+  """Regions of disk outside of the partition in the partition plan."""
+  target = None
+  for part in pplan:
+    if part.name == partition_id or str(part.no) == str(partition_id):
+      target = part
+      break
+    pass
+  if target is None:
+    raise Exception("Partition %s is not in the partition plan." % str(partition_id))
+  start = target.start * MiB
+  end = (target.start + target.size) * MiB
+  return merge_regions([ (0, start), (end, max(0, disk_size - end)) ])
+
+
+#
+# Free blocks of ext file system
+#
+_free_range_re = re.compile(r'^(\d+)(?:-(\d+))?$')
+
+def parse_dumpe2fs_free_blocks(output):
+  """dumpe2fs output to (block size, block count, [(first block, n blocks)]).
+The per group "  Free blocks: 1234-5678, 9000" lines are indented. The header
+one is the count."""
+  block_size = None
+  block_count = None
+  free = []
+  for line in output.splitlines():
+    if line.startswith("Block size:"):
+      block_size = int(line.split(":")[1])
+    elif line.startswith("Block count:"):
+      block_count = int(line.split(":")[1])
+    elif line[:1].isspace() and line.strip().startswith("Free blocks:"):
+      for block_range in line.split(":", 1)[1].split(","):
+        matched = _free_range_re.match(block_range.strip())
+        if not matched:
+          continue
+        first = int(matched.group(1))
+        last = int(matched.group(2)) if matched.group(2) else first
+        free.append((first, last - first + 1))
+        pass
+      pass
+    pass
+  if block_size is None or block_count is None:
+    raise Exception("dumpe2fs output has no block size or block count.")
+  return (block_size, block_count, free)
+
+
+def ext_free_regions(dumpe2fs_output, partition_size):
+  """Regions of the partition the file system does not use. The tail past the
+file system (the image is shrunk) is included."""
+  block_size, block_count, free = parse_dumpe2fs_free_blocks(dumpe2fs_output)
+  regions = [ (first * block_size, n_blocks * block_size) for first, n_blocks in free ]
+  fs_size = block_count * block_size
+  if partition_size > fs_size:
+    regions.append((fs_size, partition_size - fs_size))
+    pass
+  return merge_regions(regions)
+
+
+def get_device_size(fd):
+  try:
+    return struct.unpack("Q", fcntl.ioctl(fd, BLKGETSIZE64, b"\0" * 8))[0]
+  except OSError:
+    return os.fstat(fd).st_size
+  pass
+
+
+def get_ext_free_regions(device):
+  dumpe2fs = subprocess.run(["dumpe2fs", device], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  if dumpe2fs.returncode != 0:
+    raise Exception("dumpe2fs %s failed.\n%s" % (device, dumpe2fs.stderr.decode("iso-8859-1")))
+  fd = os.open(device, os.O_RDONLY)
+  try:
+    partition_size = get_device_size(fd)
+  finally:
+    os.close(fd)
+    pass
+  return ext_free_regions(dumpe2fs.stdout.decode("iso-8859-1"), partition_size)
+
+
+#
+# Zeroing
+#
+def _sysfs_queue(device, name):
+  """/sys/block/sda/queue/<name> of /dev/sda or /dev/sda1"""
+  devname = os.path.basename(os.path.realpath(device))
+  for path in [ "/sys/class/block/%s/queue/%s" % (devname, name),
+                "/sys/class/block/%s/../queue/%s" % (devname, name) ]:
+    try:
+      with open(path) as queue_fd:
+        return queue_fd.read().strip()
+      pass
+    except OSError:
+      pass
+    pass
+  return None
+
+
+def get_zero_method(device):
+  """Discard is used only when the discarded blocks are guaranteed to read as zero."""
+  if _sysfs_queue(device, "rotational") == "0" and _sysfs_queue(device, "discard_zeroes_data") == "1":
+    return ZERO_METHOD_DISCARD
+  return ZERO_METHOD_ZEROOUT
+
+
+def zero_range(fd, offset, length, method):
+  """Zeroes one range. Returns the method that worked, so the caller uses it
+for the rest. The ioctls fall back to writing zeros."""
+  if method in [ZERO_METHOD_DISCARD, ZERO_METHOD_ZEROOUT]:
+    request = BLKDISCARD if method == ZERO_METHOD_DISCARD else BLKZEROOUT
+    try:
+      fcntl.ioctl(fd, request, struct.pack("QQ", offset, length))
+      return method
+    except OSError as exc:
+      if exc.errno not in [errno.ENOTTY, errno.EINVAL, errno.EOPNOTSUPP]:
+        raise
+      tlog.info("ioctl %s is not supported. Writing zeros." % method)
+      method = ZERO_METHOD_WRITE
+      pass
+    pass
+
+  end = offset + length
+  while offset < end:
+    written = os.pwrite(fd, _zeros[:min(len(_zeros), end - offset)], offset)
+    offset += written
+    pass
+  return method
+
+
+def iterate_chunks(regions, chunk_size=ZERO_CHUNK_SIZE):
+  for offset, length in regions:
+    end = offset + length
+    while offset < end:
+      size = min(chunk_size, end - offset)
+      yield (offset, size)
+      offset += size
+      pass
+    pass
+  pass
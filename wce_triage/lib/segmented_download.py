@@ -0,0 +1,319 @@
+# Copyright (c) 2019 Naoyuki tai
+# MIT license - see LICENSE
+"""Segmented download of disk image from multiple mirrors.
+
+The image is split into segments, and the segments are fetched with http
+Range from all mirrors at the same time, with a few connections per mirror.
+The reader gets them back in order as one stream, so this plugs in to
+lib/image_stream in place of ResumableHttpReader.
+
+A mirror that is slow or failing gets fewer segments on its own since
+the workers of faster mirrors come back for more sooner. A failing mirror
+is retried the same way as ResumableHttpReader of lib/image_stream does, and
+is dropped after the retries run out. On top of that,
+when the segment the reader is waiting for is stuck on a slow mirror, an
+idle worker of a faster mirror fetches it too and the first one wins.
+
+Mirrors are listed in .disk_image_type.json as "mirrors", the URLs of the
+wce share on each server. See get_mirror_urls() in lib/disk_images.
+"""
+
+import time, threading, urllib.request, urllib.error
+from .util import get_triage_logger
+from .image_stream import DEFAULT_MAX_RETRIES, DEFAULT_RETRY_WAIT
+
+tlog = get_triage_logger()
+
+DEFAULT_SEGMENT_SIZE = 8 * 2 ** 20
+DEFAULT_CONNECTIONS_PER_MIRROR = 2
+# Segments fetched ahead of the reader. Bounds the memory use.
+DEFAULT_WINDOW = 16
+DEFAULT_TIMEOUT = 30
+# The stuck segment is fetched again when the other mirror is this much faster.
+HEDGE_FACTOR = 2.0
+
+READ_SIZE = 2 ** 16
+
+
+class Mirror(object):
+  def __init__(self, url):
+    self.url = url
+    self.rate = None # bytes/sec, moving average
+    self.bytes = 0
+    self.segments = 0
+    self.failures = 0 # in a row
+    self.total_failures = 0
+    self.retry_at = None # time.monotonic() the mirror is tried again after a failure
+    self.disabled = False
+    pass
+
+  def update_rate(self, n_bytes, seconds):
+    rate = n_bytes / max(0.001, seconds)
+    self.rate = rate if self.rate is None else 0.7 * self.rate + 0.3 * rate
+    pass
+
+  def stats(self):
+    return { "url": self.url,
+             "bytes": self.bytes,
+             "segments": self.segments,
+             "rate": round(self.rate) if self.rate else None,
+             "failures": self.total_failures,
+             "disabled": self.disabled }
+  pass
+
+
+class Segment(object):
+  def __init__(self, index, start, end):
+    self.index = index
+    self.start = start
+    self.end = end
+    self.data = None
+    self.progress = {} # mirror: bytes received so far
+    self.started = {} # mirror: time.monotonic() of start
+    pass
+  pass
+
+
+class SegmentedReader(object):
+  """File-like sequential reader of the image fetched in segments from the mirrors."""
+
+  def __init__(self, urls, size=None, segment_size=DEFAULT_SEGMENT_SIZE,
+               connections_per_mirror=DEFAULT_CONNECTIONS_PER_MIRROR,
+               window=DEFAULT_WINDOW, timeout=DEFAULT_TIMEOUT,
+               max_retries=DEFAULT_MAX_RETRIES, retry_wait=DEFAULT_RETRY_WAIT):
+    self.mirrors = [ Mirror(url) for url in urls ]
+    self.size = size
+    self.segment_size = segment_size
+    self.connections_per_mirror = connections_per_mirror
+    self.window = window
+    self.timeout = timeout
+    self.max_retries = max_retries
+    self.retry_wait = retry_wait
+    self.segments = []
+    self.next_out = 0
+    self.out_offset = 0 # bytes of the segment at next_out the reader has taken
+    self.hedged = 0
+    self.error = None
+    self.running = True
+    self.started = False
+    self.cond = threading.Condition()
+    self.workers = []
+    pass
+
+  #
+  # Start up
+  #
+  def _probe(self, mirror):
+    """Size of image on the mirror."""
+    request = urllib.request.Request(mirror.url, headers={"Range": "bytes=0-0"})
+    with urllib.request.urlopen(request, timeout=self.timeout) as reply:
+      content_range = reply.headers.get("Content-Range")
+      if reply.status != 206 or not content_range:
+        raise Exception("%s does not support Range." % mirror.url)
+      return int(content_range.split("/")[1])
+    pass
+
+  def start(self):
+    for mirror in self.mirrors:
+      try:
+        size = self._probe(mirror)
+      except Exception as exc:
+        tlog.info("Mirror %s is not usable: %s" % (mirror.url, str(exc)))
+        mirror.disabled = True
+        continue
+      if self.size is None:
+        self.size = size
+      elif size != self.size:
+        tlog.info("Mirror %s has different image. (%d bytes, not %d)" % (mirror.url, size, self.size))
+        mirror.disabled = True
+        pass
+      pass
+
+    if self.size is None:
+      raise Exception("None of mirrors has the image.")
+
+    self.segments = [ Segment(index, start, min(self.size, start + self.segment_size))
+                      for index, start in enumerate(range(0, self.size, self.segment_size)) ]
+    for mirror in self.mirrors:
+      if mirror.disabled:
+        continue
+      for _ in range(self.connections_per_mirror):
+        worker = threading.Thread(target=self._worker, args=(mirror,), daemon=True)
+        worker.start()
+        self.workers.append(worker)
+        pass
+      pass
+    self.started = True
+    pass
+
+  #
+  # Scheduling
+  #
+  def _eta(self, segment, mirror):
+    """Seconds until the mirror finishes the segment. None when unknown yet."""
+    received = segment.progress.get(mirror, 0)
+    remaining = (segment.end - segment.start) - received
+    elapsed = time.monotonic() - segment.started.get(mirror, time.monotonic())
+    # Rate of this fetch tells better than the average once it's been going for a while.
+    rate = received / elapsed if elapsed >= 1 else mirror.rate
+    if rate is None:
+      return None
+    if rate == 0:
+      return float("inf")
+    return remaining / rate
+
+  def _pick_segment(self, mirror):
+    """Next segment to fetch for the mirror, or None. Called with the lock held."""
+    window = self.segments[self.next_out:self.next_out + self.window]
+    for segment in window:
+      if segment.data is None and not segment.progress:
+        return segment
+      pass
+
+    # Nothing new. Help the oldest segment being fetched if its mirrors are much slower.
+    if not mirror.rate:
+      return None
+    for segment in window:
+      if segment.data is not None:
+        continue
+      if mirror in segment.progress:
+        return None
+      my_time = (segment.end - segment.start) / mirror.rate
+      etas = [ self._eta(segment, owner) for owner in segment.progress ]
+      if [ eta for eta in etas if eta is None or eta <= my_time * HEDGE_FACTOR ]:
+        return None
+      self.hedged += 1
+      return segment
+    return None
+
+  def _worker(self, mirror):
+    while True:
+      with self.cond:
+        segment = None
+        while self.running and self.error is None and not mirror.disabled and self.next_out < len(self.segments):
+          # Backing off after a failure
+          wait = mirror.retry_at - time.monotonic() if mirror.retry_at else 0
+          if wait <= 0:
+            segment = self._pick_segment(mirror)
+            if segment is not None:
+              break
+            pass
+          self.cond.wait(min(0.2, wait) if wait > 0 else 0.2)
+          pass
+        if segment is None:
+          return
+        segment.progress[mirror] = 0
+        segment.started[mirror] = time.monotonic()
+        pass
+      self._fetch_segment(mirror, segment)
+      pass
+    pass
+
+  def _fetch_segment(self, mirror, segment):
+    started = time.monotonic()
+    chunks = []
+    received = 0
+    try:
+      request = urllib.request.Request(mirror.url, headers={"Range": "bytes=%d-%d" % (segment.start, segment.end - 1)})
+      with urllib.request.urlopen(request, timeout=self.timeout) as reply:
+        if reply.status != 206:
+          raise Exception("Range is ignored. (status %d)" % reply.status)
+        while received < segment.end - segment.start:
+          if segment.data is not None or not self.running:
+            # The other mirror won.
+            break
+          data = reply.read(min(READ_SIZE, segment.end - segment.start - received))
+          if not data:
+            raise Exception("Connection closed at %d" % (segment.start + received))
+          chunks.append(data)
+          received += len(data)
+          with self.cond:
+            segment.progress[mirror] = received
+            pass
+          pass
+        pass
+    except Exception as exc:
+      with self.cond:
+        segment.progress.pop(mirror, None)
+        mirror.failures += 1
+        mirror.total_failures += 1
+        tlog.info("Mirror %s failed at segment %d: %s" % (mirror.url, segment.index, str(exc)))
+        mirror.retry_at = time.monotonic() + self.retry_wait
+        # Server says no, or the retries ran out.
+        if isinstance(exc, urllib.error.HTTPError) or mirror.failures > self.max_retries:
+          mirror.disabled = True
+          if not [ other for other in self.mirrors if not other.disabled ]:
+            self.error = "All mirrors failed. Last error: %s" % str(exc)
+            pass
+          pass
+        self.cond.notify_all()
+        pass
+      return
+
+    with self.cond:
+      segment.progress.pop(mirror, None)
+      if received == segment.end - segment.start:
+        mirror.failures = 0
+        mirror.retry_at = None
+        mirror.bytes += received
+        mirror.segments += 1
+        mirror.update_rate(received, time.monotonic() - started)
+        if segment.data is None:
+          segment.data = b"".join(chunks)
+          pass
+        pass
+      self.cond.notify_all()
+      pass
+    pass
+
+  #
+  # Reader
+  #
+  def read(self, size=None):
+    """Returns the next segment (or rest of it), b"" at the end."""
+    if not self.started:
+      self.start()
+      pass
+    with self.cond:
+      if self.next_out >= len(self.segments):
+        return b""
+      segment = self.segments[self.next_out]
+      while segment.data is None and self.error is None and self.running:
+        self.cond.wait(1)
+        pass
+      if self.error is not None:
+        raise Exception(self.error)
+      if segment.data is None:
+        return b""
+      # Segment is handed out in pieces from the offset. Not by cutting the
+      # rest of it every time.
+      data = segment.data
+      if size is not None and len(data) - self.out_offset > size:
+        piece = data[self.out_offset:self.out_offset + size]
+        self.out_offset += size
+        return piece
+      piece = data[self.out_offset:] if self.out_offset else data
+      # Done with the segment. Let it go.
+      segment.data = b""
+      self.out_offset = 0
+      self.next_out += 1
+      self.cond.notify_all()
+      pass
+    return piece
+
+  def close(self):
+    with self.cond:
+      self.running = False
+      self.cond.notify_all()
+      pass
+    pass
+
+  @property
+  def reconnects(self):
+    return sum([ mirror.total_failures for mirror in self.mirrors ])
+
+  def mirror_stats(self):
+    with self.cond:
+      return [ mirror.stats() for mirror in self.mirrors ]
+    pass
+  pass
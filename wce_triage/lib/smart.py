@@ -0,0 +1,213 @@
+#!/usr/bin/python3
+# Copyright (c) 2019 Naoyuki tai
+# MIT license - see LICENSE
+"""SMART health of disks.
+
+smartctl --json is run for all disks concurrently. For NVMe, smartctl reads
+the health information log page, and for ATA/SCSI it reads the attributes,
+so both come out of the same json. Result is cached per disk serial for a
+short time since smartctl on a sleeping disk spins it up and takes seconds.
+"""
+
+import json, time, subprocess, threading
+from concurrent.futures import ThreadPoolExecutor
+from .util import get_triage_logger
+
+tlog = get_triage_logger()
+
+# SMART numbers do not change much while the machine is on the bench.
+DEFAULT_SMART_TTL = 600
+
+SMARTCTL_TIMEOUT = 30
+
+# ATA attribute IDs
+ATA_REALLOCATED_SECTORS = 5
+ATA_POWER_ON_HOURS = 9
+ATA_PENDING_SECTORS = 197
+ATA_OFFLINE_UNCORRECTABLE = 198
+# Vendors use different IDs for SSD wear. Value (normalized) is the life left in percent.
+ATA_WEAR_ATTRIBUTES = [ 177, # Wear_Leveling_Count (Samsung)
+                        231, # SSD_Life_Left
+                        233, # Media_Wearout_Indicator (Intel)
+                        202 ] # Percent_Lifetime_Remain (Crucial/Micron)
+
+
+def _ata_attributes(smart):
+  attributes = {}
+  for attribute in smart.get("ata_smart_attributes", {}).get("table", []):
+    attributes[attribute.get("id")] = attribute
+    pass
+  return attributes
+
+
+def parse_smartctl_json(smart):
+  """Picks the health numbers out of smartctl --json output.
+
+Returns dict with passed, reallocated, pending, uncorrectable, power_on_hours,
+wear (percent used) and media_errors. Unknown values are None.
+"""
+  health = { "passed": smart.get("smart_status", {}).get("passed"),
+             "reallocated": None,
+             "pending": None,
+             "uncorrectable": None,
+             "power_on_hours": smart.get("power_on_time", {}).get("hours"),
+             "wear": None,
+             "media_errors": None }
+
+  nvme = smart.get("nvme_smart_health_information_log")
+  if nvme:
+    health["wear"] = nvme.get("percentage_used")
+    health["media_errors"] = nvme.get("media_errors")
+    if health["power_on_hours"] is None:
+      health["power_on_hours"] = nvme.get("power_on_hours")
+      pass
+    return health
+
+  attributes = _ata_attributes(smart)
+  for key, attr_id in [("reallocated", ATA_REALLOCATED_SECTORS),
+                       ("pending", ATA_PENDING_SECTORS),
+                       ("uncorrectable", ATA_OFFLINE_UNCORRECTABLE),
+                       ("power_on_hours", ATA_POWER_ON_HOURS)]:
+    attribute = attributes.get(attr_id)
+    if attribute and health[key] is None:
+      health[key] = attribute.get("raw", {}).get("value")
+      pass
+    pass
+
+  for attr_id in ATA_WEAR_ATTRIBUTES:
+    attribute = attributes.get(attr_id)
+    if attribute and attribute.get("value") is not None:
+      health["wear"] = max(0, 100 - attribute["value"])
+      break
+    pass
+
+  # SCSI disks report grown defects instead
+  if health["reallocated"] is None and "scsi_grown_defect_list" in smart:
+    health["reallocated"] = smart["scsi_grown_defect_list"]
+    pass
+  return health
+
+
+def read_smart(device_name, timeout=SMARTCTL_TIMEOUT):
+  """Runs smartctl on the device. Returns the health dict or None when SMART is not available."""
+  try:
+    smartctl = subprocess.run(["smartctl", "--json", "-a", device_name],
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=timeout)
+    # smartctl exit status is a bit mask. Bit 0 and 1 mean the device could not be read at all.
+    if smartctl.returncode & 0x3:
+      return None
+    return parse_smartctl_json(json.loads(smartctl.stdout.decode('utf-8')))
+  except Exception as exc:
+    tlog.info("smartctl %s failed: %s" % (device_name, str(exc)))
+    pass
+  return None
+
+
+def smart_verdict(health):
+  """Returns (good, message) for the decision."""
+  if health is None:
+    return (True, "SMART: not available")
+
+  problems = []
+  if health["passed"] is False:
+    problems.append("SMART FAILED")
+    pass
+  for key, label in [("reallocated", "reallocated"), ("pending", "pending"),
+                     ("uncorrectable", "uncorrectable"), ("media_errors", "media errors")]:
+    if health[key]:
+      problems.append("%d %s" % (health[key], label))
+      pass
+    pass
+
+  details = []
+  if health["power_on_hours"] is not None:
+    details.append("%d hours" % health["power_on_hours"])
+    pass
+  if health["wear"] is not None:
+    details.append("%d%% worn" % health["wear"])
+    pass
+
+  if problems:
+    return (False, "SMART: " + ", ".join(problems + details))
+  return (True, "SMART: OK" + (" (%s)" % ", ".join(details) if details else ""))
+
+
+class SmartCollector(object):
+  """Collects SMART health of disks concurrently, and caches it per disk serial."""
+
+  def __init__(self, ttl=DEFAULT_SMART_TTL, reader=read_smart, max_workers=8):
+    self.ttl = ttl
+    self.reader = reader
+    self.max_workers = max_workers
+    self.cache = {} # serial: (time, health)
+    self.pending = set()
+    self.lock = threading.Lock()
+    pass
+
+  def _key(self, disk):
+    return disk.serial_no or disk.device_name
+
+  def get(self, disk):
+    """Cached health of disk. Never runs smartctl."""
+    with self.lock:
+      entry = self.cache.get(self._key(disk))
+      pass
+    if entry is None:
+      return None
+    return entry[1]
+
+  def is_stale(self, disk):
+    with self.lock:
+      entry = self.cache.get(self._key(disk))
+      pass
+    return entry is None or time.monotonic() - entry[0] > self.ttl
+
+  def collect(self, disks):
+    """Reads SMART of the disks with stale cache concurrently, and sets disk.smart_health.
+Returns the list of disks updated. Disks being read by other collect are skipped."""
+    targets = []
+    with self.lock:
+      now = time.monotonic()
+      for disk in disks:
+        key = self._key(disk)
+        entry = self.cache.get(key)
+        if key in self.pending or (entry and now - entry[0] <= self.ttl):
+          continue
+        self.pending.add(key)
+        targets.append(disk)
+        pass
+      pass
+
+    if not targets:
+      return []
+
+    try:
+      with ThreadPoolExecutor(max_workers=min(self.max_workers, len(targets))) as pool:
+        results = list(pool.map(lambda disk: self.reader(disk.device_name), targets))
+        pass
+    finally:
+      with self.lock:
+        for disk in targets:
+          self.pending.discard(self._key(disk))
+          pass
+        pass
+      pass
+
+    with self.lock:
+      now = time.monotonic()
+      for disk, health in zip(targets, results):
+        self.cache[self._key(disk)] = (now, health)
+        disk.smart_health = health
+        pass
+      pass
+    return targets
+  pass
+
+
+if __name__ == "__main__":
+  import sys
+  for device_name in sys.argv[1:]:
+    health = read_smart(device_name)
+    print("%s %s %s" % (device_name, json.dumps(health), smart_verdict(health)[1]))
+    pass
+  pass
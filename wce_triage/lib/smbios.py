@@ -0,0 +1,295 @@
+#!/usr/bin/python3
+# Copyright (c) 2019 Naoyuki tai
+# MIT license - see LICENSE
+"""SMBIOS (DMI) table parser.
+
+Kernel exposes the raw SMBIOS tables in /sys/firmware/dmi/tables. Reading the
+table directly is a lot faster than running "sudo dmidecode" and parsing its
+text output, and needs no password.
+
+Only the structure types triage cares about are decoded.
+  0 - BIOS
+  1 - System
+  2 - Baseboard
+  4 - Processor
+  6 - Memory module (obsolete, but old machines have only this)
+ 16 - Physical memory array
+ 17 - Memory device
+"""
+
+import os, struct, uuid
+from collections import namedtuple
+
+SMBIOS_TABLES_DIR = "/sys/firmware/dmi/tables"
+
+SMBIOSStructure = namedtuple('SMBIOSStructure', 'type, handle, data, strings')
+
+BIOSInfo = namedtuple('BIOSInfo', 'vendor, version, release_date')
+SystemInfo = namedtuple('SystemInfo', 'manufacturer, product, version, serial, uuid')
+BaseboardInfo = namedtuple('BaseboardInfo', 'manufacturer, product, version, serial')
+ProcessorInfo = namedtuple('ProcessorInfo', 'socket, manufacturer, version, max_speed, current_speed, core_count, thread_count, populated')
+MemoryModuleInfo = namedtuple('MemoryModuleInfo', 'socket, installed_size, enabled_size, error_status')
+MemoryArrayInfo = namedtuple('MemoryArrayInfo', 'location, use, error_correction, max_capacity, number_of_devices')
+MemoryDeviceInfo = namedtuple('MemoryDeviceInfo', 'locator, bank_locator, size, memtype, speed, manufacturer, serial, part_number')
+
+# SMBIOS spec 7.18.2 Memory Device - Type
+memory_device_types = {
+  0x01: "Other",  0x02: "Unknown", 0x03: "DRAM", 0x04: "EDRAM", 0x05: "VRAM",
+  0x06: "SRAM", 0x07: "RAM", 0x08: "ROM", 0x09: "Flash", 0x0A: "EEPROM",
+  0x0B: "FEPROM", 0x0C: "EPROM", 0x0D: "CDRAM", 0x0E: "3DRAM", 0x0F: "SDRAM",
+  0x10: "SGRAM", 0x11: "RDRAM", 0x12: "DDR", 0x13: "DDR2", 0x14: "DDR2 FB-DIMM",
+  0x18: "DDR3", 0x19: "FBD2", 0x1A: "DDR4", 0x1B: "LPDDR", 0x1C: "LPDDR2",
+  0x1D: "LPDDR3", 0x1E: "LPDDR4", 0x1F: "Logical non-volatile device",
+  0x20: "HBM", 0x21: "HBM2", 0x22: "DDR5", 0x23: "LPDDR5" }
+
+# SMBIOS spec 7.17.1 Physical Memory Array - Location
+memory_array_locations = {
+  0x01: "Other", 0x02: "Unknown", 0x03: "System Board Or Motherboard",
+  0x04: "ISA Add-on Card", 0x05: "EISA Add-on Card", 0x06: "PCI Add-on Card",
+  0x07: "MCA Add-on Card", 0x08: "PCMCIA Add-on Card", 0x09: "Proprietary Add-on Card",
+  0x0A: "NuBus" }
+
+# 7.17.2 Physical Memory Array - Use
+memory_array_uses = {
+  0x01: "Other", 0x02: "Unknown", 0x03: "System Memory", 0x04: "Video Memory",
+  0x05: "Flash Memory", 0x06: "Non-volatile RAM", 0x07: "Cache Memory" }
+
+# 7.17.3 Physical Memory Array - Error Correction Types
+memory_error_corrections = {
+  0x01: "Other", 0x02: "Unknown", 0x03: "None", 0x04: "Parity",
+  0x05: "Single-bit ECC", 0x06: "Multi-bit ECC", 0x07: "CRC" }
+
+
+class SMBIOS(object):
+  """Parsed SMBIOS table."""
+
+  def __init__(self, version, structures):
+    self.version = version # (major, minor)
+    self.structures = structures
+    pass
+
+  def find(self, smbios_type):
+    return [ structure for structure in self.structures if structure.type == smbios_type ]
+  pass
+
+
+def parse_entry_point(entry_point):
+  """returns the SMBIOS version as (major, minor) from the entry point."""
+  if entry_point[0:5] == b'_SM3_':
+    return (entry_point[7], entry_point[8])
+  if entry_point[0:4] == b'_SM_':
+    return (entry_point[6], entry_point[7])
+  if entry_point[0:5] == b'_DMI_':
+    # Legacy DMI entry point. BCD revision.
+    return (entry_point[0x0E] >> 4, entry_point[0x0E] & 0x0F)
+  return None
+
+
+def parse_structures(table):
+  """Splits the raw DMI table into structures."""
+  structures = []
+  offset = 0
+  table_len = len(table)
+  while offset + 4 <= table_len:
+    smbios_type, length, handle = struct.unpack_from('<BBH', table, offset)
+    if length < 4:
+      # broken table
+      break
+    strings_start = offset + length
+    strings_end = table.find(b'\x00\x00', strings_start)
+    if strings_end < 0:
+      break
+    strings = [ piece.decode('iso-8859-1').strip() for piece in table[strings_start:strings_end].split(b'\x00') ]
+    if strings_end == strings_start:
+      strings = []
+      pass
+    structures.append(SMBIOSStructure(type=smbios_type, handle=handle, data=table[offset:offset+length], strings=strings))
+    offset = strings_end + 2
+    # End-of-Table
+    if smbios_type == 127:
+      break
+    pass
+  return structures
+
+
+def read_smbios(tables_dir=SMBIOS_TABLES_DIR):
+  """Reads the SMBIOS tables from sysfs. Returns None when it's not readable.
+The DMI table is readable only by root."""
+  try:
+    with open(os.path.join(tables_dir, "DMI"), "rb") as dmi:
+      table = dmi.read()
+      pass
+    pass
+  except (IOError, OSError):
+    return None
+
+  version = None
+  try:
+    with open(os.path.join(tables_dir, "smbios_entry_point"), "rb") as entry_point:
+      version = parse_entry_point(entry_point.read())
+      pass
+    pass
+  except (IOError, OSError):
+    pass
+  return SMBIOS(version if version else (2, 6), parse_structures(table))
+
+#
+# Structure decoders
+#
+
+def _byte(structure, offset):
+  if offset < len(structure.data):
+    return structure.data[offset]
+  return None
+
+def _word(structure, offset):
+  if offset + 2 <= len(structure.data):
+    return struct.unpack_from('<H', structure.data, offset)[0]
+  return None
+
+def _dword(structure, offset):
+  if offset + 4 <= len(structure.data):
+    return struct.unpack_from('<I', structure.data, offset)[0]
+  return None
+
+def _string(structure, offset):
+  index = _byte(structure, offset)
+  if index is None or index == 0 or index > len(structure.strings):
+    return None
+  return structure.strings[index-1]
+
+
+def decode_bios(structure):
+  return BIOSInfo(vendor=_string(structure, 0x04),
+                  version=_string(structure, 0x05),
+                  release_date=_string(structure, 0x08))
+
+
+def decode_system(structure, version=(2, 6)):
+  system_uuid = None
+  raw_uuid = structure.data[0x08:0x18]
+  if len(raw_uuid) == 16 and raw_uuid not in [b'\x00' * 16, b'\xff' * 16]:
+    # Since SMBIOS 2.6, the first 3 fields are little endian.
+    if version >= (2, 6):
+      system_uuid = str(uuid.UUID(bytes_le=raw_uuid))
+    else:
+      system_uuid = str(uuid.UUID(bytes=raw_uuid))
+      pass
+    pass
+  return SystemInfo(manufacturer=_string(structure, 0x04),
+                    product=_string(structure, 0x05),
+                    version=_string(structure, 0x06),
+                    serial=_string(structure, 0x07),
+                    uuid=system_uuid)
+
+
+def decode_baseboard(structure):
+  return BaseboardInfo(manufacturer=_string(structure, 0x04),
+                       product=_string(structure, 0x05),
+                       version=_string(structure, 0x06),
+                       serial=_string(structure, 0x07))
+
+
+def decode_processor(structure):
+  status = _byte(structure, 0x18)
+  core_count = _byte(structure, 0x23)
+  thread_count = _byte(structure, 0x25)
+  return ProcessorInfo(socket=_string(structure, 0x04),
+                       manufacturer=_string(structure, 0x07),
+                       version=_string(structure, 0x10),
+                       max_speed=_word(structure, 0x14),
+                       current_speed=_word(structure, 0x16),
+                       core_count=core_count if core_count else None,
+                       thread_count=thread_count if thread_count else None,
+                       populated=bool(status & 0x40) if status is not None else False)
+
+
+def _memory_module_size(size_byte):
+  """Type 6 size - returns MB or 0 when not installed/enabled"""
+  if size_byte is None:
+    return 0
+  size = size_byte & 0x7F
+  if size in [0x7D, 0x7E, 0x7F]:
+    return 0
+  return 2 ** size
+
+
+def decode_memory_module(structure):
+  error_status = _byte(structure, 0x0B) or 0
+  return MemoryModuleInfo(socket=_string(structure, 0x04),
+                          installed_size=_memory_module_size(_byte(structure, 0x09)),
+                          enabled_size=_memory_module_size(_byte(structure, 0x0A)),
+                          error_status="OK" if (error_status & 0x03) == 0 else "Error")
+
+
+def decode_memory_array(structure):
+  max_capacity = _dword(structure, 0x07)
+  if max_capacity == 0x80000000:
+    # Extended maximum capacity in bytes (2.7+)
+    extended = structure.data[0x0F:0x17]
+    max_capacity = struct.unpack('<Q', extended)[0] // 1024 if len(extended) == 8 else None
+    pass
+  return MemoryArrayInfo(location=memory_array_locations.get(_byte(structure, 0x04), "Unknown"),
+                         use=memory_array_uses.get(_byte(structure, 0x05), "Unknown"),
+                         error_correction=memory_error_corrections.get(_byte(structure, 0x06), "Unknown"),
+                         max_capacity=max_capacity, # in KB
+                         number_of_devices=_word(structure, 0x0D))
+
+
+def decode_memory_device(structure):
+  """size is in MB. 0 is no module installed and None is unknown."""
+  size = _word(structure, 0x0C)
+  if size == 0xFFFF:
+    size = None
+  elif size == 0x7FFF:
+    # Extended Size (2.7+) in MB
+    size = _dword(structure, 0x1C)
+    if size is not None:
+      size = size & 0x7FFFFFFF
+      pass
+    pass
+  elif size is not None and size & 0x8000:
+    # granularity is KB
+    size = (size & 0x7FFF) // 1024
+    pass
+
+  speed = _word(structure, 0x15)
+  return MemoryDeviceInfo(locator=_string(structure, 0x10),
+                          bank_locator=_string(structure, 0x11),
+                          size=size,
+                          memtype=memory_device_types.get(_byte(structure, 0x12), "Unknown"),
+                          speed=speed if speed else None,
+                          manufacturer=_string(structure, 0x17),
+                          serial=_string(structure, 0x18),
+                          part_number=_string(structure, 0x1A))
+
+
+def get_system_info(smbios):
+  """returns (BIOSInfo, SystemInfo, BaseboardInfo, [ProcessorInfo])"""
+  bios = [ decode_bios(structure) for structure in smbios.find(0) ]
+  system = [ decode_system(structure, version=smbios.version) for structure in smbios.find(1) ]
+  baseboard = [ decode_baseboard(structure) for structure in smbios.find(2) ]
+  processors = [ decode_processor(structure) for structure in smbios.find(4) ]
+  return (bios[0] if bios else None,
+          system[0] if system else None,
+          baseboard[0] if baseboard else None,
+          processors)
+
+
+#
+if __name__ == "__main__":
+  smbios = read_smbios()
+  if smbios is None:
+    print("%s is not readable." % SMBIOS_TABLES_DIR)
+  else:
+    print("SMBIOS %d.%d" % smbios.version)
+    for info in get_system_info(smbios):
+      print(info)
+      pass
+    for decode, smbios_type in [(decode_memory_module, 6), (decode_memory_array, 16), (decode_memory_device, 17)]:
+      for structure in smbios.find(smbios_type):
+        print(decode(structure))
+        pass
+      pass
+    pass
+  pass
@@ -0,0 +1,276 @@
+#!/usr/bin/python3
+# Copyright (c) 2019 Naoyuki tai
+# MIT license - see LICENSE
+"""Triage snapshot cache.
+
+The same machine is rebooted on the bench many times, and the hardware does
+not change between the reboots. The triage result (and the cpu benchmark)
+is stored in sqlite keyed by the machine identity (DMI system UUID/serial),
+together with a hardware fingerprint (PCI IDs, disk serials, memory size).
+When the fingerprint still matches and the entry is not older than TTL,
+the cached result is returned and only the volatile parts are revalidated.
+"""
+
+import os, json, time, hashlib, sqlite3
+from ..config.config_db import sqlite3_db, sqlite3_table
+from .util import get_triage_logger
+
+tlog = get_triage_logger()
+
+TRIAGE_CACHE_DB = "/var/lib/wce_triage/triage_cache.db"
+
+# A week. Long enough to cover the bench life of machine.
+DEFAULT_TRIAGE_CACHE_TTL = 7 * 24 * 3600
+
+DMI_ID_DIR = "/sys/class/dmi/id"
+PCI_DEVICES_DIR = "/sys/bus/pci/devices"
+DISK_BY_ID_DIR = "/dev/disk/by-id"
+
+# Known bogus values in DMI that manufacturers put in.
+bogus_dmi_values = [ "", "none", "default string", "to be filled by o.e.m.",
+                     "system serial number", "not specified", "not applicable",
+                     "00000000-0000-0000-0000-000000000000",
+                     "ffffffff-ffff-ffff-ffff-ffffffffffff",
+                     "03000200-0400-0500-0006-000700080009", "0123456789" ]
+
+
+def _read_sysfs(path):
+  try:
+    with open(path) as sysfs:
+      return sysfs.read().strip()
+    pass
+  except:
+    pass
+  return None
+
+
+def _read_dmi_id(tag, dmi_dir=DMI_ID_DIR):
+  value = _read_sysfs(os.path.join(dmi_dir, tag))
+  if value is None or value.lower() in bogus_dmi_values:
+    return None
+  return value
+
+
+def get_machine_identity(dmi_dir=DMI_ID_DIR, net_dir='/sys/class/net'):
+  """Returns the identity of this machine as a string.
+
+DMI system UUID and serial numbers are preferred. For machines with bogus DMI,
+vendor/product plus the ethernet MAC addresses are used instead.
+"""
+  for tag in ["product_uuid", "product_serial", "board_serial", "chassis_serial"]:
+    value = _read_dmi_id(tag, dmi_dir=dmi_dir)
+    if value:
+      return "%s:%s" % (tag, value.lower())
+    pass
+
+  macs = []
+  try:
+    for netdev in sorted(os.listdir(net_dir)):
+      # Only the physical NICs have "device"
+      if not os.path.exists(os.path.join(net_dir, netdev, "device")):
+        continue
+      mac = _read_sysfs(os.path.join(net_dir, netdev, "address"))
+      if mac:
+        macs.append(mac)
+        pass
+      pass
+    pass
+  except:
+    pass
+
+  vendor = _read_dmi_id("sys_vendor", dmi_dir=dmi_dir) or ""
+  product = _read_dmi_id("product_name", dmi_dir=dmi_dir) or ""
+  if not macs and not vendor and not product:
+    return None
+  return "mac:%s:%s:%s" % (vendor, product, ",".join(macs))
+
+
+def list_pci_ids(pci_dir=PCI_DEVICES_DIR):
+  pci_ids = []
+  try:
+    for address in os.listdir(pci_dir):
+      vendor = _read_sysfs(os.path.join(pci_dir, address, "vendor"))
+      device = _read_sysfs(os.path.join(pci_dir, address, "device"))
+      pci_ids.append("%s=%s:%s" % (address, vendor, device))
+      pass
+    pass
+  except:
+    pass
+  return sorted(pci_ids)
+
+
+def list_disk_ids(by_id_dir=DISK_BY_ID_DIR):
+  """Disk IDs contain the model and serial number. USB sticks come and go, so
+they are excluded."""
+  disk_ids = []
+  try:
+    for disk_id in os.listdir(by_id_dir):
+      if disk_id.startswith("usb-") or "-part" in disk_id:
+        continue
+      if disk_id.split('-')[0] in ["ata", "nvme", "scsi"]:
+        disk_ids.append(disk_id)
+        pass
+      pass
+    pass
+  except:
+    pass
+  return sorted(disk_ids)
+
+
+def get_memory_total_mb(meminfo="/proc/meminfo"):
+  try:
+    with open(meminfo) as meminfo_f:
+      for line in meminfo_f.readlines():
+        if line.startswith("MemTotal:"):
+          # Round it to 64MB as the kernel reserves slightly differently
+          return int(round(int(line.split()[1]) / 65536)) * 64
+        pass
+      pass
+    pass
+  except:
+    pass
+  return 0
+
+
+def get_hardware_fingerprint():
+  """hash of PCI IDs, disk IDs and memory size."""
+  fingerprint = hashlib.sha1()
+  for pci_id in list_pci_ids():
+    fingerprint.update(pci_id.encode('iso-8859-1'))
+    pass
+  for disk_id in list_disk_ids():
+    fingerprint.update(disk_id.encode('iso-8859-1'))
+    pass
+  fingerprint.update(str(get_memory_total_mb()).encode('iso-8859-1'))
+  return fingerprint.hexdigest()
+
+
+class triage_snapshot_table(sqlite3_table):
+  """machine + section -> (fingerprint, timestamp, snapshot JSON)"""
+
+  def __init__(self, db, table_name="triage_snapshot"):
+    super().__init__(db, table_name)
+    pass
+
+  def open(self):
+    if self.is_open:
+      return
+    self.execute("create table if not exists {} (machine varchar, section varchar, fingerprint varchar, timestamp real, snapshot text, primary key (machine, section))".format(self.table_name))
+    self.commit()
+    self._is_open = True
+    pass
+
+  def get(self, machine, section):
+    cursor = self.cursor()
+    cursor.execute("select fingerprint, timestamp, snapshot from {} where machine = ? and section = ?".format(self.table_name), (machine, section))
+    for row in cursor.fetchall():
+      return row
+    return None
+
+  def set(self, machine, section, fingerprint, timestamp, snapshot):
+    cursor = self.cursor()
+    cursor.execute("insert or replace into {} (machine, section, fingerprint, timestamp, snapshot) values(?, ?, ?, ?, ?)".format(self.table_name),
+                   (machine, section, fingerprint, timestamp, snapshot))
+    self.commit()
+    pass
+
+  def delete(self, machine, section=None):
+    cursor = self.cursor()
+    if section is None:
+      cursor.execute("delete from {} where machine = ?".format(self.table_name), (machine,))
+    else:
+      cursor.execute("delete from {} where machine = ? and section = ?".format(self.table_name), (machine, section))
+      pass
+    self.commit()
+    pass
+  pass
+
+
+class TriageCache(object):
+  """Persistent cache of triage results.
+
+section is a name of cached result such as "triage" or "cpu_info". The value
+must be JSON serializable.
+"""
+
+  def __init__(self, db=None, ttl=DEFAULT_TRIAGE_CACHE_TTL, machine=None, fingerprint=None):
+    self.ttl = ttl
+    self._machine = machine
+    self._fingerprint = fingerprint
+    self.table = None
+    if db is None:
+      db = sqlite3_db(db_file=TRIAGE_CACHE_DB)
+      pass
+    try:
+      db_dir = os.path.dirname(db.db_file)
+      if db_dir and not os.path.exists(db_dir):
+        os.makedirs(db_dir)
+        pass
+      db.open()
+      self.table = triage_snapshot_table(db)
+    except (OSError, sqlite3.Error) as exc:
+      tlog.info("Triage cache is disabled. %s" % str(exc))
+      pass
+    pass
+
+  @property
+  def machine(self):
+    if self._machine is None:
+      self._machine = get_machine_identity()
+      pass
+    return self._machine
+
+  @property
+  def fingerprint(self):
+    if self._fingerprint is None:
+      self._fingerprint = get_hardware_fingerprint()
+      pass
+    return self._fingerprint
+
+  @property
+  def is_enabled(self):
+    return self.table is not None and self.machine is not None
+
+
+  def load(self, section):
+    """Returns the cached value or None when it's missing, stale or the hardware changed."""
+    if not self.is_enabled:
+      return None
+    row = self.table.get(self.machine, section)
+    if row is None:
+      return None
+    fingerprint, timestamp, snapshot = row
+    if fingerprint != self.fingerprint:
+      tlog.info("Triage cache: hardware of %s changed." % self.machine)
+      return None
+    if time.time() - timestamp > self.ttl:
+      tlog.debug("Triage cache: %s of %s expired." % (section, self.machine))
+      return None
+    try:
+      return json.loads(snapshot)
+    except ValueError:
+      return None
+    pass
+
+
+  def save(self, section, value):
+    if not self.is_enabled:
+      return
+    self.table.set(self.machine, section, self.fingerprint, time.time(), json.dumps(value))
+    pass
+
+
+  def invalidate(self, section=None):
+    """Drops the cached value. When section is None, everything for this machine is dropped."""
+    if not self.is_enabled:
+      return
+    self.table.delete(self.machine, section)
+    pass
+  pass
+
+
+#
+if __name__ == "__main__":
+  print("machine: %s" % get_machine_identity())
+  print("fingerprint: %s" % get_hardware_fingerprint())
+  pass
@@ -1,7 +1,6 @@
 import uuid, os, subprocess, datetime, select, stat, errno, re
 import urllib.parse
 import logging
-import logging.handlers
 
 
 def safe_string(piece):
@@ -138,8 +137,10 @@ def get_file_decompression_app(path):
 # if there is a good reason (hence, the decomp takes more
 # options but for compression from here, gzip/pigz is it.
 
+# --rsyncable resets the compression at content defined points, so that a new
+# image shares most of compressed bytes with the older one (see lib/chunker).
 def get_file_compression_app(path):
-  return ( ["pigz", "-7" ], [] )
+  return ( ["pigz", "-7", "--rsyncable" ], [] )
 
 #
 #
@@ -155,12 +156,26 @@ def is_block_device(path):
   path_stat = os.stat(path)
   return stat.S_ISBLK(path_stat.st_mode)
 
+def open_direct(path):
+  """Opens the device read only with O_DIRECT so that the page cache does not hide the
+device. Some file systems (like tmpfs) refuse O_DIRECT, then it's opened normally."""
+  o_direct = getattr(os, "O_DIRECT", 0)
+  try:
+    return os.open(path, os.O_RDONLY | o_direct)
+  except OSError as exc:
+    if exc.errno != errno.EINVAL:
+      raise
+    pass
+  return os.open(path, os.O_RDONLY)
+
 import logging
 
 #
 #
 #
 def init_triage_logger(log_level=None, filename='/tmp/triage.log'):
+  # Only the entry points need the handlers.
+  import logging.handlers
   if log_level is None:
     log_level = logging.INFO
     pass
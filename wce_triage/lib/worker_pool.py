@@ -0,0 +1,481 @@
+# Copyright (c) 2019 Naoyuki tai
+# MIT license - see LICENSE
+"""Pre-warmed worker process for "python3 -m wce_triage..." jobs.
+
+Every runner and tool used to be a fresh python3 that imports the package from
+the scratch. On a triage machine booting from NFS, the imports alone take
+seconds. The worker pool is a fork server. It imports the wce_triage modules
+once, and forks a job from itself for each launch. The job runs the module as
+__main__ with the argv, environment and cwd of the caller, and its stdin,
+stdout and stderr are the file descriptors the caller passes over the unix
+socket. So the JSON on stdout and the progress on stderr come out the same as
+before.
+
+  caller --(argv, env, fds)--> server --fork--> monitor --fork--> job
+  caller <--{"pid": n}-------------------------- monitor
+  caller <--{"returncode": rc}------------------ monitor (after waitpid)
+
+popen() looks like subprocess.Popen. It goes to the pool when
+WCE_TRIAGE_WORKER_POOL names the socket of running server, and falls back to
+subprocess.Popen otherwise.
+
+The server runs as root, so the socket is in a directory only the owner can
+get in (tempfile.mkdtemp), not at a fixed path in /tmp.
+
+  python3 -m wce_triage.lib.worker_pool
+  python3 -m wce_triage.lib.worker_pool --socket /run/wce/worker-pool.sock
+  python3 -m wce_triage.lib.worker_pool --benchmark 10
+"""
+
+import os, sys, json, time, array, socket, struct, select, signal, subprocess, importlib, runpy, threading, traceback, atexit, tempfile, shutil
+from .util import get_triage_logger
+
+tlog = get_triage_logger()
+
+WORKER_POOL_SOCKET_ENV = "WCE_TRIAGE_WORKER_POOL"
+SOCKET_DIR_PREFIX = "wce-worker-pool-"
+SOCKET_NAME = "pool.sock"
+
+# Modules imported by the server. The jobs get them for free.
+PRELOAD_MODULES = [
+  "wce_triage.ops.restore_image_runner",
+  "wce_triage.ops.create_image_runner",
+  "wce_triage.ops.sync_image_runner",
+  "wce_triage.bin.restore_volume",
+  "wce_triage.bin.restore_partclone",
+  "wce_triage.bin.multiwipe",
+  "wce_triage.bin.surface_scan",
+  "wce_triage.bin.test_optical",
+  "wce_triage.bin.memory_test",
+  "wce_triage.bin.multicast_send",
+  "wce_triage.bin.multicast_receive",
+  "wce_triage.lib.cpu_info",
+]
+
+# Seconds between the checks of the parent while idle
+PARENT_CHECK_INTERVAL = 2.0
+# Seconds to wait for the server to come up
+START_TIMEOUT = 30
+
+_LENGTH = struct.Struct("!I")
+
+
+def _send_message(conn, message):
+  conn.sendall((json.dumps(message) + "\n").encode("utf-8"))
+  pass
+
+
+def _send_request(conn, request, fds):
+  data = json.dumps(request).encode("utf-8")
+  conn.sendmsg([_LENGTH.pack(len(data)) + data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))])
+  pass
+
+
+def _receive_request(conn):
+  """Returns the request and the file descriptors for stdin, stdout and stderr."""
+  fds = array.array("i")
+  data, ancdata, flags, addr = conn.recvmsg(2**16, socket.CMSG_SPACE(3 * fds.itemsize))
+  for level, kind, cmsg_data in ancdata:
+    if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+      fds.frombytes(cmsg_data[:len(cmsg_data) - (len(cmsg_data) % fds.itemsize)])
+      pass
+    pass
+  if len(fds) != 3:
+    raise Exception("Request needs 3 file descriptors. Got %d." % len(fds))
+  while len(data) < _LENGTH.size or len(data) < _LENGTH.size + _LENGTH.unpack(data[:_LENGTH.size])[0]:
+    chunk = conn.recv(2**16)
+    if not chunk:
+      raise Exception("Request is cut short.")
+    data += chunk
+    pass
+  length = _LENGTH.unpack(data[:_LENGTH.size])[0]
+  return json.loads(data[_LENGTH.size:_LENGTH.size + length].decode("utf-8")), list(fds)
+
+
+def _returncode(status):
+  # Same as Popen.returncode
+  if os.WIFSIGNALED(status):
+    return -os.WTERMSIG(status)
+  return os.WEXITSTATUS(status)
+
+
+def _run_job(request, fds):
+  """Runs in the forked job. Never returns."""
+  code = 1
+  try:
+    for target, fd in enumerate(fds):
+      os.dup2(fd, target)
+      pass
+    for fd in fds:
+      if fd > 2:
+        os.close(fd)
+        pass
+      pass
+    sys.stdin = open(0, "r", closefd=False)
+    sys.stdout = open(1, "w", closefd=False)
+    sys.stderr = open(2, "w", buffering=1, closefd=False)
+    os.chdir(request["cwd"])
+    os.environ.clear()
+    os.environ.update(request["env"])
+    module = request["module"]
+    # Preloaded module runs again as __main__.
+    sys.modules.pop(module, None)
+    sys.argv = [module] + request["args"]
+    runpy.run_module(module, run_name="__main__", alter_sys=True)
+    code = 0
+  except SystemExit as exc:
+    if exc.code is None or isinstance(exc.code, int):
+      code = exc.code or 0
+    else:
+      print(exc.code, file=sys.stderr)
+      code = 1
+      pass
+    pass
+  except BaseException:
+    traceback.print_exc()
+    code = 1
+    pass
+
+  try:
+    # What the interpreter does at exit. The atexit functions include
+    # logging.shutdown and the multiprocessing's cleanup of daemonic children.
+    for thread in threading.enumerate():
+      if thread is not threading.current_thread() and not thread.daemon:
+        thread.join()
+        pass
+      pass
+    atexit._run_exitfuncs()
+    sys.stdout.flush()
+    sys.stderr.flush()
+  except BaseException:
+    pass
+  os._exit(code)
+  pass
+
+
+def _run_monitor(conn):
+  """Runs in the forked monitor. Starts the job and reports the exit. Never returns."""
+  signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+  signal.signal(signal.SIGTERM, signal.SIG_DFL)
+  try:
+    request, fds = _receive_request(conn)
+    pid = os.fork()
+    if pid == 0:
+      conn.close()
+      _run_job(request, fds)
+      pass
+    for fd in fds:
+      os.close(fd)
+      pass
+    _send_message(conn, {"pid": pid})
+    status = os.waitpid(pid, 0)[1]
+    _send_message(conn, {"returncode": _returncode(status)})
+  except Exception as exc:
+    try:
+      _send_message(conn, {"error": str(exc)})
+    except Exception:
+      pass
+    pass
+  os._exit(0)
+  pass
+
+
+def preload(modules=PRELOAD_MODULES):
+  for module in modules:
+    try:
+      importlib.import_module(module)
+    except Exception as exc:
+      # The job imports it by itself.
+      tlog.info("Worker pool could not preload %s: %s" % (module, str(exc)))
+      pass
+    pass
+  pass
+
+
+def make_socket_path():
+  """Socket in a new directory that only the owner can get in."""
+  return os.path.join(tempfile.mkdtemp(prefix=SOCKET_DIR_PREFIX), SOCKET_NAME)
+
+
+def serve(socket_path, modules=PRELOAD_MODULES, remove_dir=False):
+  """Fork server. Runs until the parent goes away or it's terminated.
+remove_dir: removes the directory of socket at the end."""
+  preload(modules)
+  # Monitors are reaped by the kernel.
+  signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+  parent = os.getppid()
+  server = os.getpid()
+
+  listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  binding_path = socket_path + ".new"
+  if os.path.exists(binding_path):
+    os.unlink(binding_path)
+    pass
+  listener.bind(binding_path)
+  listener.listen(16)
+  # The socket shows up when it's ready to accept.
+  os.rename(binding_path, socket_path)
+
+  try:
+    while os.getppid() == parent:
+      readable = select.select([listener], [], [], PARENT_CHECK_INTERVAL)[0]
+      if not readable:
+        continue
+      conn = listener.accept()[0]
+      sys.stdout.flush()
+      sys.stderr.flush()
+      if os.fork() == 0:
+        listener.close()
+        _run_monitor(conn)
+        pass
+      conn.close()
+      pass
+  finally:
+    listener.close()
+    if os.getpid() != server:
+      # Forked monitor terminated before it got going
+      os._exit(1)
+      pass
+    if os.path.exists(socket_path):
+      os.unlink(socket_path)
+      pass
+    if remove_dir:
+      os.rmdir(os.path.dirname(socket_path))
+      pass
+    pass
+  pass
+
+
+class PooledProcess(object):
+  """Job in the worker pool that looks like subprocess.Popen."""
+
+  def __init__(self, socket_path, module, args, stdin=None, stdout=None, stderr=None, env=None, cwd=None):
+    self.args = ["python3", "-m", module] + args
+    self.stdin = None
+    self.stdout = None
+    self.stderr = None
+    self.pid = None
+    self.returncode = None
+    self._buffer = b""
+
+    child_fds = []
+    opened = []
+    pipes = {}
+    self.conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      self.conn.connect(socket_path)
+      for target, spec in enumerate([stdin, stdout, stderr]):
+        if spec is None:
+          fd = target
+        elif spec == subprocess.STDOUT and target == 2:
+          fd = child_fds[1]
+        elif spec == subprocess.DEVNULL:
+          fd = os.open(os.devnull, os.O_RDWR)
+          opened.append(fd)
+        elif spec == subprocess.PIPE:
+          read_fd, write_fd = os.pipe()
+          fd, pipes[target] = (read_fd, write_fd) if target == 0 else (write_fd, read_fd)
+          opened.append(fd)
+        elif isinstance(spec, int):
+          fd = spec
+        else:
+          fd = spec.fileno()
+          pass
+        child_fds.append(fd)
+        pass
+      _send_request(self.conn, {"module": module,
+                                "args": args,
+                                "env": dict(os.environ if env is None else env),
+                                "cwd": os.getcwd() if cwd is None else cwd},
+                    child_fds)
+      reply = self._read_message(None)
+      if reply is None or "pid" not in reply:
+        raise Exception("Worker pool did not start %s: %s" % (module, str(reply.get("error") if reply else "no reply")))
+      self.pid = reply["pid"]
+    except Exception:
+      self.conn.close()
+      for fd in pipes.values():
+        os.close(fd)
+        pass
+      raise
+    finally:
+      for fd in opened:
+        os.close(fd)
+        pass
+      pass
+
+    if 0 in pipes:
+      self.stdin = os.fdopen(pipes[0], "wb")
+      pass
+    if 1 in pipes:
+      self.stdout = os.fdopen(pipes[1], "rb")
+      pass
+    if 2 in pipes:
+      self.stderr = os.fdopen(pipes[2], "rb")
+      pass
+    pass
+
+  def _read_message(self, timeout):
+    """Next message from the monitor, or None when there is none in time."""
+    deadline = None if timeout is None else time.time() + timeout
+    while b"\n" not in self._buffer:
+      wait = None if deadline is None else max(0, deadline - time.time())
+      if not select.select([self.conn], [], [], wait)[0]:
+        return None
+      data = self.conn.recv(4096)
+      if not data:
+        # Monitor is gone without telling the exit.
+        return {"returncode": -signal.SIGKILL}
+      self._buffer += data
+      pass
+    line, self._buffer = self._buffer.split(b"\n", 1)
+    return json.loads(line.decode("utf-8"))
+
+  def _check_exit(self, timeout):
+    if self.returncode is None:
+      message = self._read_message(timeout)
+      if message is not None:
+        self.returncode = message.get("returncode", 1)
+        self.conn.close()
+        pass
+      pass
+    return self.returncode
+
+  def poll(self):
+    return self._check_exit(0)
+
+  def wait(self, timeout=None):
+    if self._check_exit(timeout) is None:
+      raise subprocess.TimeoutExpired(self.args, timeout)
+    return self.returncode
+
+  def send_signal(self, sig):
+    if self.poll() is None:
+      try:
+        os.kill(self.pid, sig)
+      except ProcessLookupError:
+        pass
+      pass
+    pass
+
+  def terminate(self):
+    self.send_signal(signal.SIGTERM)
+    pass
+
+  def kill(self):
+    self.send_signal(signal.SIGKILL)
+    pass
+  pass
+
+
+def _get_pool_module(argv):
+  """The module name when argv is "python3 -m wce_triage...", otherwise None."""
+  if len(argv) >= 3 and os.path.basename(argv[0]) in ["python3", "python"] and argv[1] == "-m" and argv[2].startswith("wce_triage."):
+    return argv[2]
+  return None
+
+
+def popen(argv, stdin=None, stdout=None, stderr=None):
+  """subprocess.Popen, or the job in the worker pool for wce_triage modules."""
+  socket_path = os.environ.get(WORKER_POOL_SOCKET_ENV)
+  module = _get_pool_module(argv)
+  if module and socket_path and os.path.exists(socket_path):
+    try:
+      return PooledProcess(socket_path, module, argv[3:], stdin=stdin, stdout=stdout, stderr=stderr)
+    except Exception as exc:
+      tlog.info("Worker pool failed. Starting %s as process: %s" % (module, str(exc)))
+      pass
+    pass
+  return subprocess.Popen(argv, stdin=stdin, stdout=stdout, stderr=stderr)
+
+
+def start_worker_pool(socket_path=None, modules=None):
+  """Starts the server and sets the environment so that popen() uses it.
+The socket is made in a new directory unless socket_path is given.
+Returns the server process, or None if it did not come up."""
+  remove_dir = socket_path is None
+  if remove_dir:
+    socket_path = make_socket_path()
+  elif os.path.exists(socket_path):
+    os.unlink(socket_path)
+    pass
+  argv = ["python3", "-m", "wce_triage.lib.worker_pool", "--socket", socket_path]
+  if remove_dir:
+    argv.append("--remove-dir")
+    pass
+  if modules is not None:
+    argv = argv + ["--preload", ",".join(modules)]
+    pass
+  server = subprocess.Popen(argv, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+  deadline = time.time() + START_TIMEOUT
+  while not os.path.exists(socket_path):
+    if server.poll() is not None or time.time() > deadline:
+      tlog.info("Worker pool did not start.")
+      server.kill()
+      server.wait()
+      if remove_dir:
+        shutil.rmtree(os.path.dirname(socket_path), ignore_errors=True)
+        pass
+      return None
+    time.sleep(0.05)
+    pass
+  os.environ[WORKER_POOL_SOCKET_ENV] = socket_path
+  return server
+
+
+def _measure(launch, count):
+  latencies = []
+  for _ in range(count):
+    start = time.time()
+    process = launch()
+    process.wait()
+    latencies.append(time.time() - start)
+    pass
+  latencies.sort()
+  return { "median": round(latencies[len(latencies) // 2], 3),
+           "min": round(latencies[0], 3),
+           "max": round(latencies[-1], 3) }
+
+
+def benchmark(count, module):
+  """Launch to exit of "python3 -m <module> --help", as process and from the pool."""
+  argv = ["python3", "-m", module, "--help"]
+  result = { "module": module, "count": count }
+  result["process"] = _measure(lambda: subprocess.Popen(argv, stdout=subprocess.DEVNULL), count)
+  server = start_worker_pool()
+  if server is None:
+    return result
+  try:
+    result["pool"] = _measure(lambda: popen(argv, stdout=subprocess.DEVNULL), count)
+  finally:
+    server.terminate()
+    server.wait()
+    pass
+  return result
+
+
+if __name__ == "__main__":
+  from argparse import ArgumentParser
+  parser = ArgumentParser(description="Fork server of wce_triage jobs.")
+  parser.add_argument("--socket", default=None, help="Path of unix socket. Default is in a new directory, and the path is printed.")
+  parser.add_argument("--remove-dir", action="store_true", help="Removes the directory of socket at exit.")
+  parser.add_argument("--preload", default=None, help="Comma separated modules to preload.")
+  parser.add_argument("--benchmark", type=int, default=0, metavar="N", help="Measures the launch latency N times with and without the pool.")
+  parser.add_argument("--module", default="wce_triage.ops.restore_image_runner", help="Module for the benchmark.")
+  args = parser.parse_args()
+
+  if args.benchmark:
+    print(json.dumps(benchmark(args.benchmark, args.module)))
+    sys.exit(0)
+    pass
+
+  socket_path = args.socket
+  remove_dir = args.remove_dir
+  if socket_path is None:
+    socket_path = make_socket_path()
+    remove_dir = True
+    print("%s=%s" % (WORKER_POOL_SOCKET_ENV, socket_path), flush=True)
+    pass
+  serve(socket_path, PRELOAD_MODULES if args.preload is None else [ module for module in args.preload.split(",") if module ], remove_dir=remove_dir)
+  pass
@@ -15,9 +15,9 @@ from .ops_ui import console_ui
 from .pplan import make_usb_stick_partition_plan
 from ..components.disk import create_storage_instance, Partition
 from .runner import Runner
-from ..lib.util import init_triage_logger
+from ..lib.util import get_triage_logger, init_triage_logger
 
-tlog = init_triage_logger()
+tlog = get_triage_logger()
 
 #
 # create a new gpt partition from partition plan
@@ -122,6 +122,7 @@ class CloneRunner(Runner):
 
 
 if __name__ == "__main__":
+  tlog = init_triage_logger()
   devname = sys.argv[1]
   disk = create_storage_instance(device_name=devname)
   efi_boot = True
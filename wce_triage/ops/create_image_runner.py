@@ -3,10 +3,10 @@
 # Create disk image
 #
 
-import re, sys, traceback
+import os, re, sys, traceback, argparse, urllib.parse
 
-from .tasks import task_fetch_partitions, task_refresh_partitions, task_mount, task_remove_persistent_rules, task_remove_logs, task_fsck, task_shrink_partition, task_expand_partition, task_unmount
-from .partclone_tasks import task_create_disk_image
+from .tasks import task_fetch_partitions, task_refresh_partitions, task_mount, task_remove_persistent_rules, task_remove_logs, task_save_grub_template, task_fsck, task_shrink_partition, task_expand_partition, task_unmount
+from .partclone_tasks import task_create_disk_image, task_save_image_metadata, task_index_disk_image
 from .ops_ui import console_ui
 from ..components.disk import create_storage_instance
 from .runner import Runner
@@ -27,21 +27,45 @@ class ImageDiskRunner(Runner):
   '''Runner for creating disk image. does fsck, shrink partition, create disk 
 image and resize the file system back to the max.
 For now, this is only dealing with the EXT4 linux partition.
+
+With shrink=False, the file system is imaged at full size. partclone copies
+only the used blocks anyway, so this skips the resize2fs -M and expand which
+can take longer than the imaging. Either way, the file system size, used
+blocks and the minimum size are recorded next to the image, and the restore
+sizes the partition from it.
 '''
   # FIXME: If I want to make this to a generic clone app, I need to deal with all of partitions on the disk.
   # One step at a time.
     
-  def __init__(self, ui, runner_id, disk, destdir, suggestedname=None, partition_id='Linux'):
+  def __init__(self, ui, runner_id, disk, destdir, suggestedname=None, partition_id='Linux', extra_destinations=None, shrink=True):
+    """extra_destinations: directories or URLs to save the image to at the same time,
+such as the catalog on the other disk or the upload URL of the server.
+shrink: shrink the file system to the smallest before imaging, and expand it back after."""
     super().__init__(ui, runner_id)
     self.time_estimate = 600
     self.disk = disk
     self.partition_id = partition_id
     self.destdir = destdir
+    self.shrink = shrink
 
     self.imagename = make_disk_image_name(destdir, suggestedname)
+    self.extra_destinations = [ self._get_image_destination(destination) for destination in (extra_destinations or []) ]
     pass
 
 
+  def _get_image_destination(self, destination):
+    """The image file name is added to the directory, or the URL ending with '/'."""
+    filename = os.path.basename(self.imagename)
+    parsed = urllib.parse.urlsplit(destination)
+    if parsed.scheme:
+      if parsed.path.endswith('/'):
+        return urllib.parse.urlunsplit(parsed._replace(path=parsed.path + filename))
+      return destination
+    if os.path.isdir(destination):
+      return os.path.join(destination, filename)
+    return destination
+
+
   def prepare(self):
     super().prepare()
     
@@ -52,15 +76,24 @@ For now, this is only dealing with the EXT4 linux partition.
     self.tasks.append(task_mount("Mount the target disk", disk=self.disk, partition_id=self.partition_id))
     self.tasks.append(task_remove_persistent_rules("Remove persistent rules", disk=self.disk, partition_id=self.partition_id))
     self.tasks.append(task_remove_logs("Remove/Clean Logs", disk=self.disk, partition_id=self.partition_id))
+    self.tasks.append(task_save_grub_template("Record grub.cfg template", disk=self.disk, partition_id=self.partition_id))
     task = task_unmount("Unmount target", disk=self.disk, partition_id=self.partition_id)
     task.set_teardown_task()
     self.tasks.append(task)
     self.tasks.append(task_fsck("fsck partition", disk=self.disk, partition_id=self.partition_id))
-    self.tasks.append(task_shrink_partition("Shrink partition to smallest", disk=self.disk, partition_id=self.partition_id))
-    self.tasks.append(task_create_disk_image("Create disk image", disk=self.disk, partition_id=self.partition_id, imagename=self.imagename))
-    task = task_expand_partition("Expand the partion back", disk=self.disk, partition_id=self.partition_id)
-    task.set_teardown_task()
-    self.tasks.append(task)
+    if self.shrink:
+      self.tasks.append(task_shrink_partition("Shrink partition to smallest", disk=self.disk, partition_id=self.partition_id))
+      pass
+    self.tasks.append(task_create_disk_image("Create disk image", disk=self.disk, partition_id=self.partition_id, imagename=self.imagename, extra_destinations=self.extra_destinations))
+    # The file system is still unmounted and the same as imaged.
+    self.tasks.append(task_save_image_metadata("Record file system size", disk=self.disk, partition_id=self.partition_id,
+                                               imagenames=[self.imagename] + self.extra_destinations, shrunk=self.shrink))
+    self.tasks.append(task_index_disk_image("Index disk image", imagenames=[self.imagename] + self.extra_destinations))
+    if self.shrink:
+      task = task_expand_partition("Expand the partion back", disk=self.disk, partition_id=self.partition_id)
+      task.set_teardown_task()
+      self.tasks.append(task)
+      pass
     pass
 
   pass
@@ -69,20 +102,23 @@ For now, this is only dealing with the EXT4 linux partition.
 if __name__ == "__main__":
   tlog = init_triage_logger()
 
-  if len(sys.argv) == 1:
-    print( 'Unloader: devicename part destdir')
-    sys.exit(0)
-    # NOTREACHED
-    pass 
-  devname = sys.argv[1]
+  parser = argparse.ArgumentParser(description="Create disk image of the partition.")
+  parser.add_argument("devname", help="Device name. This is /dev/sdX or /dev/nvmeXnX, not the partition.")
+  parser.add_argument("part", help="Partition ID")
+  parser.add_argument("destdir", help="Destination directory. 'preflight' and 'testflight' are for testing.")
+  parser.add_argument("destinations", nargs="*", help="Additional catalog directories and upload URLs")
+  parser.add_argument("--no-shrink", dest="shrink", action="store_false", help="Images the file system at full size without shrinking.")
+  args = parser.parse_args()
+
+  devname = args.devname
   if not is_block_device(devname):
     print( '%s is not a block device.' % devname)
     sys.exit(1)
     # NOTREACHED
     pass
 
-  part = sys.argv[2] # This is a partition id
-  destdir = sys.argv[3] # Destination directory
+  part = args.part # This is a partition id
+  destdir = args.destdir # Destination directory
   disk = create_storage_instance(devname)
 
   # Preflight is for me to see the tasks. http server runs this with json_ui.
@@ -104,7 +140,7 @@ if __name__ == "__main__":
     pass
 
   runner_id = disk.device_name
-  runner = ImageDiskRunner(ui, runner_id, disk, destdir, partition_id=part)
+  runner = ImageDiskRunner(ui, runner_id, disk, destdir, partition_id=part, extra_destinations=args.destinations, shrink=args.shrink)
   try:
     runner.prepare()
     runner.preflight()
@@ -2,8 +2,8 @@
 #
 #
 import sys
-from ..lib.util import init_triage_logger
-tlog = init_triage_logger()
+from ..lib.util import get_triage_logger, init_triage_logger
+tlog = get_triage_logger()
 
 MiB = 2**20
 
@@ -64,6 +64,7 @@ class E2E:
   pass
 
 if __name__ == "__main__":
+  tlog = init_triage_logger()
   e2e = E2E()
   # I'm the source file
   # Throughput(input_size=filesize, input_rate=None)
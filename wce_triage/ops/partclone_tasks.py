@@ -8,12 +8,13 @@ Actual running of process is done by wce_triage/bin's process driver and this on
 Important part is about parsing the partclone output and send out the progress.
 """
 
-import datetime, re
+import datetime, re, subprocess
 
-from .tasks import op_task_process
+from .tasks import op_task_process, op_task_python_simple
 from ..lib.timeutil import in_seconds
-from ..lib.util import get_triage_logger
-from ..lib.disk_images import get_file_system_from_source
+from ..lib.util import get_triage_logger, get_transport_scheme
+from ..lib.disk_images import get_file_system_from_source, write_image_metadata
+from ..lib.image_index import index_image
 
 tlog = get_triage_logger()
 
@@ -113,13 +114,16 @@ class task_partclone(op_task_process):
 #
 class task_create_disk_image(task_partclone):
   
-  def __init__(self, description, disk=None, partition_id="Linux", imagename=None, partition_size=None, **kwargs):
+  def __init__(self, description, disk=None, partition_id="Linux", imagename=None, partition_size=None, extra_destinations=None, **kwargs):
+    """extra_destinations: file paths or URLs the image is saved to as well, in
+the same pass. Failing one of them does not fail the task."""
     # FIXME: This time_estimate is so wrong in so many levels.
     super().__init__(description, time_estimate=disk.get_byte_size() / 500000000, **kwargs)
     self.disk = disk
     self.partition_id = partition_id
     self.imagename = imagename
     self.partition_size = partition_size
+    self.extra_destinations = extra_destinations if extra_destinations else []
     pass
 
   # 
@@ -134,31 +138,152 @@ class task_create_disk_image(task_partclone):
       return
 
     # Unlike others, image_volume outputs progress to stderr.
-    self.argv = ["python3", "-m", "wce_triage.bin.image_volume", part.device_name, part.file_system, self.imagename ]
+    self.argv = ["python3", "-m", "wce_triage.bin.image_volume", part.device_name, part.file_system, self.imagename ] + self.extra_destinations
     super().setup()
     pass
 
   def explain(self):
+    if self.extra_destinations:
+      return "Create disk image of %s to %s and %s using WCE Triage's image_volume" % (self.disk.device_name, self.imagename, ", ".join(self.extra_destinations))
     return "Create disk image of %s to %s using WCE Triage's image_volume" % (self.disk.device_name, self.imagename)
   pass
 
+#
+# Image metadata
+#
+def parse_dumpe2fs_header(output):
+  """dumpe2fs -h output to dict. 'Block count:   2621440' -> {'Block count': '2621440'}"""
+  header = {}
+  for line in output.splitlines():
+    colon = line.find(':')
+    if colon <= 0:
+      continue
+    header[line[:colon].strip()] = line[colon+1:].strip()
+    pass
+  return header
+
+
+resize2fs_minimum_re = re.compile(r'Estimated minimum size of the filesystem:\s+(\d+)')
+
+def parse_resize2fs_minimum(output):
+  """Blocks from resize2fs -P output, or None."""
+  m = resize2fs_minimum_re.search(output)
+  return int(m.group(1)) if m else None
+
+
+def make_ext_fs_metadata(header, min_blocks, shrunk=False):
+  block_size = int(header["Block size"])
+  block_count = int(header["Block count"])
+  used_blocks = block_count - int(header["Free blocks"])
+  return { "fileSystem": "ext4",
+           "blockSize": block_size,
+           "blockCount": block_count,
+           "usedBlocks": used_blocks,
+           "minBlocks": min_blocks,
+           "fsSize": block_count * block_size,
+           "usedSize": used_blocks * block_size,
+           "minSize": min_blocks * block_size if min_blocks else None,
+           "shrunk": shrunk }
+
+
+class task_save_image_metadata(op_task_python_simple):
+  """Records the file system size, used blocks and the minimum size next to the image.
+The restore sizes the partition from it. (read_image_metadata in lib/disk_images)
+Needs the partition unmounted and unchanged since the imaging."""
+
+  def __init__(self, description, disk=None, partition_id="Linux", imagenames=None, shrunk=False, **kwargs):
+    super().__init__(description, time_estimate=5, **kwargs)
+    self.disk = disk
+    self.partition_id = partition_id
+    # Only the local files. URL destinations don't get it.
+    self.imagenames = [ imagename for imagename in imagenames if not get_transport_scheme(imagename) ]
+    self.shrunk = shrunk
+    pass
+
+  def run_python(self):
+    part = self.disk.find_partition(self.partition_id)
+    if part is None:
+      self.set_progress(999, "No partion %s" % self.partition_id)
+      return
+
+    dumpe2fs = subprocess.run(["dumpe2fs", "-h", part.device_name], timeout=60, encoding='iso-8859-1',
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if dumpe2fs.returncode != 0:
+      self.set_progress(999, "dumpe2fs failed: %s" % dumpe2fs.stderr.strip())
+      return
+    # resize2fs -P only reads the bitmaps. Not having the minimum is not fatal.
+    resize2fs = subprocess.run(["resize2fs", "-P", part.device_name], timeout=600, encoding='iso-8859-1',
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    metadata = make_ext_fs_metadata(parse_dumpe2fs_header(dumpe2fs.stdout), parse_resize2fs_minimum(resize2fs.stdout), shrunk=self.shrunk)
+    for imagename in self.imagenames:
+      write_image_metadata(imagename, metadata)
+      pass
+    self.verdict.append("File system %d bytes, used %d bytes, minimum %s bytes." % (metadata["fsSize"], metadata["usedSize"], str(metadata["minSize"])))
+    pass
+
+  def explain(self):
+    return "Record file system size of %s next to %s" % (self.disk.device_name, ", ".join(self.imagenames))
+  pass
+
+
+class task_index_disk_image(op_task_python_simple):
+  """Makes the index of the captured images. (lib/image_index)
+The restore plans the partition and estimates the time from it."""
+
+  def __init__(self, description, imagenames=None, **kwargs):
+    super().__init__(description, time_estimate=5, **kwargs)
+    # Only the local files. URL destinations don't get it.
+    self.imagenames = [ imagename for imagename in imagenames if not get_transport_scheme(imagename) ]
+    pass
+
+  def run_python(self):
+    for imagename in self.imagenames:
+      index = index_image(imagename, force=True)
+      if index is None:
+        # The restore works without it.
+        self.verdict.append("%s is not indexed." % imagename)
+        continue
+      self.verdict.append("%s: %d bytes used in %d runs." % (imagename, index["usedSize"], index["usedRuns"]))
+      pass
+    pass
+
+  def explain(self):
+    return "Index %s" % ", ".join(self.imagenames)
+  pass
+
+
 #
 #
 class task_restore_disk_image(task_partclone):
   
   # Restore partclone image file to the first partition
-  def __init__(self, description, disk=None, partition_id="Linux", source=None, source_size=None, **kwargs):
+  # used_size: bytes the restore writes, from the image index. Without it, it's
+  # guessed from the compressed size.
+  # use_prefetch: takes over the image the runner is prefetching. (lib/image_prefetch)
+  # native: decodes the image with bin/restore_partclone. partclone is the fallback.
+  def __init__(self, description, disk=None, partition_id="Linux", source=None, source_size=None, network_speed=None, multicast=None, mirrors=None, used_size=None, use_prefetch=False, native=False, **kwargs):
     #
     speed = disk.estimate_speed(operation="restore")
-    self.initial_time_estimate=2*source_size/speed
+    self.initial_time_estimate = (used_size if used_size else 2*source_size)/speed
+    # network_speed is the measured download speed (bytes/sec) when the source is on the network.
+    # Compressed image goes over the network, so it's compared to the source size.
+    if network_speed and source and get_transport_scheme(source) in ["http", "https"]:
+      self.initial_time_estimate = max(self.initial_time_estimate, source_size/network_speed)
+      pass
     super().__init__(description, time_estimate=self.initial_time_estimate, **kwargs)
     self.disk = disk
     self.partition_id = partition_id
     self.source = source
     self.source_size = source_size
+    self.multicast = multicast
+    self.mirrors = mirrors
+    self.use_prefetch = use_prefetch
+    self.use_native = native
     if self.source is None:
       raise Exception("bone head. it needs the source image.")
     self.percent_done = None
+    # bin/restore_partclone reports the bytes written rather than read.
+    self.native = False
     pass
 
   def setup(self):
@@ -166,12 +291,32 @@ class task_restore_disk_image(task_partclone):
     if part is None:
       raise Exception("Partition %s is not found." % self.partition_id)
     self.argv = ["python3", "-m", "wce_triage.bin.restore_volume", self.source, get_file_system_from_source(self.source), part.device_name]
+    if self.use_native:
+      self.argv.append("--native")
+      pass
+    if self.multicast:
+      self.argv = self.argv + ["--multicast", self.multicast]
+    elif self.mirrors:
+      for mirror in self.mirrors:
+        self.argv = self.argv + ["--mirror", mirror]
+        pass
+      pass
+    prefetcher = getattr(self.runner, "prefetcher", None) if self.use_prefetch else None
+    if prefetcher:
+      state = prefetcher.handoff()
+      if state:
+        self.argv = self.argv + ["--prefetched", state]
+        tlog.info("Restore starts with %d bytes prefetched." % prefetcher.fetched)
+        pass
+      pass
     super().setup()
     pass
 
   def explain(self):
     return "Restore disk image from %s to %s %s" % (self.source, self.disk.device_name, str(self.partition_id))
 
+  native_re = re.compile(r'partclone\.stderr:Native decoder')
+
   # ignore parsing partclone progress. for restore, it is 100$ wrong.
   def parse_partclone_progress(self):
     #
@@ -190,6 +335,10 @@ class task_restore_disk_image(task_partclone):
       current_time = datetime.datetime.now()
 
       tlog.debug("partclone: %s" % line)
+      if self.native_re.search(line):
+        self.native = True
+        pass
+
       # Look for the EXT parition cloning start marker
       while len(self.start_re) > 0:
         m = self.start_re[0].search(line)
@@ -212,7 +361,11 @@ class task_restore_disk_image(task_partclone):
           percent = self._estimate_progress_from_time_estimate(dt.total_seconds())
           try:
             percent = min(float(m.group(3)), 99)
-            if percent > 10:
+            if percent > 10 and self.native:
+              # What's written is on the disk. No need to fudge.
+              self.set_time_estimate(in_seconds(dt) / (percent/100))
+              percent = self._estimate_progress_from_time_estimate(dt.total_seconds())
+            elif percent > 10:
               sofar = percent/100
               # Progress coming back from partclone is always super optimistic
               # it doesn't include the cache flushing at the end. In other word, it
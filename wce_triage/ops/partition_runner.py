@@ -17,9 +17,9 @@ from .ops_ui import console_ui
 from .pplan import make_usb_stick_partition_plan
 from ..components.disk import Disk, Partition
 from .runner import Runner
-from ..lib.util import init_triage_logger
+from ..lib.util import get_triage_logger, init_triage_logger
 
-tlog = init_triage_logger()
+tlog = get_triage_logger()
 
 #
 # create a new gpt partition from partition plan
@@ -35,9 +35,7 @@ class PartitionDiskRunner(Runner):
     self.media = media
     pass
 
-  def prepare(self):
-    super().prepare()
-
+  def prepare_wipe(self):
     # wipe?
     if self.wipe == 1 or self.wipe == 2:
       if self.wipe == 1:
@@ -47,6 +45,12 @@ class PartitionDiskRunner(Runner):
         pass
       self.tasks.append(op_task_wipe_disk(desc, disk=self.disk, short=(self.wipe == 1)))
       pass
+    pass
+
+  def prepare(self):
+    super().prepare()
+
+    self.prepare_wipe()
 
     # Calling parted
     argv = ['parted', '-s', '-a', 'optimal', self.disk.device_name, 'unit', 'MiB', 'mklabel', self.partition_map]
@@ -124,6 +128,7 @@ class PartitionDiskRunner(Runner):
 
 
 if __name__ == "__main__":
+  tlog = init_triage_logger()
   devname = sys.argv[1]
   disk = Disk(device_name=devname)
   efi_boot = True
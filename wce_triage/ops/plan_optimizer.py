@@ -0,0 +1,250 @@
+#
+# Plan optimizer
+#
+# Runner's prepare lays out the tasks as building blocks - partition runner
+# makes file systems, and restore runner loads the image on top of it, fetches
+# partitions again, runs fsck a few times. Some of the tasks do nothing
+# useful when put together. The optimizer goes through the tasks, keeps track
+# of what each task does to the disk (partition table, file system on
+# partition, mount) and removes the tasks that are redundant.
+#
+"""Removes redundant tasks from the runner's plan.
+
+"strict" removes only the tasks whose effect is overwritten or repeated by
+the other tasks in the plan. "legacy" leaves the plan as it is.
+
+- mkfs.ext4 of the partition partclone overwrites right after. The file
+  system UUID is set by task_set_ext_partition_uuid or read back after the
+  restore, so the one mkfs made is not used. The UUID mkfs would have made
+  goes to task_set_ext_partition_uuid, as the refresh before the restore
+  reads whatever superblock was on the partition.
+- fsck without fixing when the same partition gets fsck -y later and
+  nothing resizes it in between.
+- task_fetch_partitions when the partition table has not changed since the
+  last fetch, and task_refresh_partitions when no file system changed since
+  the last refresh.
+- task_mount immediately followed by task_unmount of the same partition.
+
+Teardown tasks are never removed.
+"""
+
+from .tasks import task_mkfs, task_fsck, task_fetch_partitions, task_refresh_partitions, task_mount, task_unmount, task_expand_partition, task_shrink_partition, task_set_ext_partition_uuid, task_set_fat_volume_id, task_set_fat_label, task_mkswap, task_sync_partitions, task_finalize_disk, task_finalize_efi, task_install_grub, op_task_wipe_disk
+from .partclone_tasks import task_restore_disk_image
+from ..components.disk import Partition
+from ..lib.util import get_triage_logger
+
+tlog = get_triage_logger()
+
+PLAN_STRICT = "strict"
+PLAN_LEGACY = "legacy"
+PLAN_MODES = [PLAN_STRICT, PLAN_LEGACY]
+
+# Tasks that change the file system identity (type, UUID, label) of the partition
+_fs_identity_changers = (task_mkfs, task_mkswap, task_restore_disk_image, task_set_fat_label)
+# Tasks that write the UUID the runner knows back to the file system.
+_fs_identity_setters = (task_set_ext_partition_uuid, task_set_fat_volume_id)
+# Tasks that use the file system UUID the runner knows
+_fs_identity_users = (task_finalize_disk, task_finalize_efi, task_install_grub)
+# Tasks that change the file system size
+_fs_resizers = (task_expand_partition, task_shrink_partition)
+
+
+def _is_partitioning(task):
+  """parted mklabel, wipe and partprobe change the partition table as far as the runner knows.
+Wiping the free blocks of a partition does not."""
+  if isinstance(task, op_task_wipe_disk):
+    return task.partition_id is None
+  if isinstance(task, task_sync_partitions):
+    return True
+  argv = getattr(task, "argv", None)
+  return bool(argv) and argv[0] == "parted" and "mklabel" in argv
+
+
+class PlanOptimizer(object):
+
+  def __init__(self, pplan, mode=PLAN_STRICT):
+    if mode not in PLAN_MODES:
+      raise Exception("Unknown plan mode %s" % str(mode))
+    self.pplan = pplan
+    self.mode = mode
+    self.removed = [] # (task, reason)
+    pass
+
+  def _partition_no(self, task):
+    """Partition number the task works on, or None."""
+    part = getattr(task, "part", None)
+    if isinstance(part, Partition):
+      return part.partition_number
+    partition_id = getattr(task, "partition_id", None)
+    if partition_id is None:
+      return None
+    for plan in self.pplan or []:
+      if plan.name == partition_id or plan.no == partition_id or str(plan.no) == str(partition_id):
+        return plan.no
+      pass
+    return None
+
+  def _remove(self, tasks, index, reason):
+    task = tasks.pop(index)
+    self.removed.append((task, reason))
+    tlog.info("Plan optimizer: removed '%s' - %s" % (task.description, reason))
+    pass
+
+  def optimize(self, tasks):
+    """Returns the optimized list of tasks. The removed tasks are in self.removed."""
+    tasks = list(tasks)
+    if self.mode == PLAN_LEGACY:
+      return tasks
+    for optimization in [self._remove_overwritten_mkfs, self._merge_fsck, self._remove_repeated_partition_reads, self._remove_idle_mounts]:
+      optimization(tasks)
+      pass
+    return tasks
+
+  #
+  # mkfs followed by restore
+  #
+  def _fs_identity_is_recovered(self, tasks, start, part_no):
+    """After the restore at start, the file system UUID is set or read back
+before anybody uses it."""
+    for task in tasks[start+1:]:
+      if isinstance(task, task_set_ext_partition_uuid) and self._partition_no(task) == part_no:
+        return True
+      if isinstance(task, task_refresh_partitions):
+        return True
+      if isinstance(task, _fs_identity_users):
+        return False
+      pass
+    return True
+
+  def _hand_over_fs_uuid(self, tasks, start, part_no):
+    """The UUID of the mkfs at start goes to the task that sets the UUID after the restore."""
+    mkfs = tasks[start]
+    fs_uuid = mkfs.argv[mkfs.argv.index("-U")+1]
+    for task in tasks[start+1:]:
+      if isinstance(task, task_set_ext_partition_uuid) and self._partition_no(task) == part_no:
+        if task.fs_uuid is None:
+          task.fs_uuid = fs_uuid
+          pass
+        break
+      pass
+    pass
+
+  def _remove_overwritten_mkfs(self, tasks):
+    index = 0
+    while index < len(tasks):
+      task = tasks[index]
+      if not isinstance(task, task_mkfs) or task.teardown_task or task.part.file_system != 'ext4':
+        index += 1
+        continue
+      part_no = self._partition_no(task)
+      overwritten = False
+      for later_index in range(index+1, len(tasks)):
+        later = tasks[later_index]
+        if self._partition_no(later) != part_no:
+          continue
+        if isinstance(later, task_restore_disk_image):
+          overwritten = self._fs_identity_is_recovered(tasks, later_index, part_no)
+          pass
+        break
+      if overwritten:
+        self._hand_over_fs_uuid(tasks, index, part_no)
+        self._remove(tasks, index, "partition %d is overwritten by the disk image" % part_no)
+        continue
+      index += 1
+      pass
+    pass
+
+  #
+  # fsck twice
+  #
+  def _merge_fsck(self, tasks):
+    index = 0
+    while index < len(tasks):
+      task = tasks[index]
+      if not isinstance(task, task_fsck) or task.teardown_task or task.fix_filesytem:
+        index += 1
+        continue
+      part_no = self._partition_no(task)
+      merged = False
+      for later in tasks[index+1:]:
+        if self._partition_no(later) != part_no:
+          continue
+        if isinstance(later, _fs_resizers):
+          break
+        if isinstance(later, task_fsck) and later.fix_filesytem:
+          merged = True
+          break
+        pass
+      if merged:
+        self._remove(tasks, index, "the later fsck -y of partition %d checks it again" % part_no)
+        continue
+      index += 1
+      pass
+    pass
+
+  #
+  # Reading partitions again and again
+  #
+  def _remove_repeated_partition_reads(self, tasks):
+    fetched = False # partition table is fetched since it changed
+    refreshed = False # file systems are read since the fetch
+    stale = set() # partitions whose file system changed since the refresh
+    index = 0
+    while index < len(tasks):
+      task = tasks[index]
+      if _is_partitioning(task):
+        fetched = False
+        refreshed = False
+        pass
+      elif isinstance(task, task_fetch_partitions):
+        if fetched and not task.teardown_task:
+          self._remove(tasks, index, "partition table has not changed since the last fetch")
+          continue
+        fetched = True
+        refreshed = False
+        pass
+      elif isinstance(task, task_refresh_partitions):
+        if fetched and refreshed and not stale and not task.teardown_task:
+          self._remove(tasks, index, "no file system has changed since the last refresh")
+          continue
+        refreshed = True
+        stale = set()
+        pass
+      elif isinstance(task, _fs_identity_changers):
+        stale.add(self._partition_no(task))
+        pass
+      elif isinstance(task, _fs_identity_setters):
+        stale.discard(self._partition_no(task))
+        pass
+      index += 1
+      pass
+    pass
+
+  #
+  # mount and unmount for nothing
+  #
+  def _remove_idle_mounts(self, tasks):
+    index = 0
+    while index + 1 < len(tasks):
+      task = tasks[index]
+      after = tasks[index+1]
+      if (isinstance(task, task_mount) and isinstance(after, task_unmount)
+          and not task.teardown_task and not after.teardown_task
+          and self._partition_no(task) == self._partition_no(after)):
+        self._remove(tasks, index+1, "nothing uses the mount")
+        self._remove(tasks, index, "nothing uses the mount")
+        continue
+      index += 1
+      pass
+    pass
+
+  def saved_time(self):
+    return sum([ task.estimate_time() for task, reason in self.removed ])
+
+  def report(self):
+    lines = [ "Plan optimizer removed %d tasks, saving about %d seconds." % (len(self.removed), self.saved_time()) ]
+    for task, reason in self.removed:
+      lines.append("  %s: %s" % (task.description, reason))
+      pass
+    return "\n".join(lines)
+  pass
@@ -66,6 +66,46 @@ def size_partitions(pplan, diskmbsize):
 
   return pplan
 
+
+# Swap can be made this small to make room for the image
+MIN_SWAP_SIZE = 512
+
+def fit_partition_plan(pplan, partition_id, required_mb):
+  """Makes the partition at least required_mb so that the file system in the
+image fits. The room is taken from the swap. Raises when the disk is too small."""
+  target = None
+  for part in pplan:
+    if part.name == partition_id or part.no == partition_id:
+      target = part
+      break
+    pass
+  if target is None:
+    raise Exception("Partition %s is not in the partition plan." % str(partition_id))
+
+  shortage = required_mb - target.size
+  if shortage <= 0:
+    return pplan
+
+  for part in pplan:
+    if part.filesys == 'linux-swap' and part.size > MIN_SWAP_SIZE:
+      taken = min(shortage, part.size - MIN_SWAP_SIZE)
+      part.size = part.size - taken
+      target.size = target.size + taken
+      shortage = shortage - taken
+      pass
+    pass
+
+  if shortage > 0:
+    raise Exception("Partition %s needs %dMiB for the image but the disk has room for %dMiB." % (str(partition_id), required_mb, target.size))
+
+  partion_start = 0
+  for part in pplan:
+    part.start = partion_start
+    partion_start = partion_start + part.size
+    pass
+  return pplan
+
+
 #
 # This is univeral partition plan, should work for efi or traditional boot.
 # I think Ubuntu 18.04LTS and up should use EFI boot.
@@ -2,20 +2,25 @@
 # Restore disk
 #
 
-import sys, uuid, traceback, argparse, os, json
+import sys, uuid, traceback, argparse, os, json, math, signal
 
-from .tasks import task_fetch_partitions, task_refresh_partitions, task_set_fat_volume_id, task_fsck, task_set_ext_partition_uuid, task_mount, task_unmount, task_remove_persistent_rules, task_finalize_disk, task_install_grub, task_expand_partition, task_finalize_efi
+from .tasks import task_fetch_partitions, task_refresh_partitions, task_set_fat_volume_id, task_fsck, task_set_ext_partition_uuid, task_mount, task_unmount, task_remove_persistent_rules, task_finalize_disk, task_install_grub, task_expand_partition, task_finalize_efi, op_task_wipe_disk
 
 from .ops_ui import console_ui
 from .partition_runner import PartitionDiskRunner
+from .plan_optimizer import PlanOptimizer, PLAN_STRICT, PLAN_LEGACY, PLAN_MODES
 from ..components.video import detect_video_cards
 from ..components.disk import create_storage_instance
 from .partclone_tasks import task_restore_disk_image
-from ..lib.util import init_triage_logger
+from ..lib.util import init_triage_logger, get_transport_scheme
 from .json_ui import json_ui
 from ..const import const
-from .pplan import make_traditional_partition_plan, make_efi_partition_plan, make_usb_stick_partition_plan, EFI_NAME
-from ..lib.disk_images import read_disk_image_types
+from .pplan import make_traditional_partition_plan, make_efi_partition_plan, make_usb_stick_partition_plan, fit_partition_plan, EFI_NAME
+from ..lib.disk_images import read_disk_image_types, get_mirror_urls, read_image_metadata
+from ..lib.region_wipe import pplan_outside_regions
+from ..lib.image_index import read_image_index
+from ..lib.image_prefetch import ImagePrefetcher, get_prefetch_budget
+from ..lib.image_stream import can_stream
 
 
 # "Waiting", "Prepare", "Preflight", "Running", "Success", "Failed"]
@@ -40,7 +45,14 @@ class RestoreDiskRunner(PartitionDiskRunner):
                restore_type=None,
                wipe=None,
                media=None,
-               wce_share_url=None):
+               wce_share_url=None,
+               network_speed=None,
+               multicast=None,
+               plan_mode=PLAN_STRICT,
+               image_index=None,
+               efi_index=None,
+               prefetch=True,
+               native=False):
     #
     # FIXME: Well, not having restore type is probably a show stopper.
     #
@@ -69,8 +81,45 @@ class RestoreDiskRunner(PartitionDiskRunner):
     self.newhostname = newhostname
     self.efi_source = efisrc # EFI partition is pretty small
     self.wce_share_url = wce_share_url
+    self.network_speed = network_speed
+    self.multicast = multicast
+    self.plan_mode = plan_mode
+    # lib/image_index of the images
+    self.image_index = image_index
+    self.efi_index = efi_index
+    # Full wipe zeroes only what the restore does not write. Legacy plan wipes the whole disk first.
+    self.restore_aware_wipe = (wipe == 2 and plan_mode != PLAN_LEGACY)
+    # The image is fetched while the disk is prepared. (lib/image_prefetch)
+    self.prefetch = prefetch
+    self.prefetcher = None
+    self.mirrors = None
+    # The image is decoded in process, with partclone as the fallback. (bin/restore_partclone)
+    self.native = native
     pass
 
+  def prepare_wipe(self):
+    if not self.restore_aware_wipe:
+      super().prepare_wipe()
+      return
+    regions = pplan_outside_regions(self.pplan, self.partition_id, self.disk.get_byte_size())
+    self.tasks.append(op_task_wipe_disk("Wipe disk outside of partition %s" % self.partition_id, disk=self.disk, regions=regions))
+    pass
+
+  def optimize(self):
+    optimizer = PlanOptimizer(self.pplan, mode=self.plan_mode)
+    self.tasks = optimizer.optimize(self.tasks)
+    if optimizer.removed:
+      self.ui.log(self.runner_id, optimizer.report())
+      pass
+    pass
+
+  def _get_partition_size(self):
+    for part in self.pplan:
+      if part.name == self.partition_id or str(part.no) == str(self.partition_id):
+        return part.size * 2**20
+      pass
+    return 0
+
   def prepare(self):
     # partition runner adds a few tasks to create new partition map.
     super().prepare()
@@ -88,9 +137,11 @@ class RestoreDiskRunner(PartitionDiskRunner):
     self.tasks.append(task_refresh_partitions("Refresh partition information", disk))
 
     # load efi
-    # hack - source size is hardcoded to 4MB...
+    # Without the index, source size is hardcoded to 4MB...
     if self.efi_source:
-      self.tasks.append(task_restore_disk_image("Load EFI System partition", disk=disk, partition_id=EFI_NAME, source=self.efi_source, source_size=2**22))
+      efi_size = self.efi_index["imageSize"] if self.efi_index else 2**22
+      efi_used_size = self.efi_index["usedSize"] if self.efi_index else None
+      self.tasks.append(task_restore_disk_image("Load EFI System partition", disk=disk, partition_id=EFI_NAME, source=self.efi_source, source_size=efi_size, used_size=efi_used_size))
       # Loading EFI parition changes the partition ID to the previous volume id. I want to have unique ID so
       # set the ID I have to the EFI partition.
       self.tasks.append(task_set_fat_volume_id("Set EFI partition UUID", disk=disk, partition_id=EFI_NAME))
@@ -99,11 +150,22 @@ class RestoreDiskRunner(PartitionDiskRunner):
       pass
 
     # load disk image
-    self.tasks.append(task_restore_disk_image("Load disk image", disk=disk, partition_id=partition_id, source=self.source, source_size=self.source_size))
+    # Mirrors of the image on the other servers per the disk image type
+    self.mirrors = get_mirror_urls(self.source, self.restore_type.get("mirrors"))
+    self.tasks.append(task_restore_disk_image("Load disk image", disk=disk, partition_id=partition_id, source=self.source, source_size=self.source_size,
+                                              network_speed=self.network_speed, multicast=self.multicast, mirrors=self.mirrors,
+                                              used_size=self.image_index["usedSize"] if self.image_index else None,
+                                              use_prefetch=True, native=self.native))
 
     # Make sure it went right. If this is a bad disk, this should catch it.
     self.tasks.append(task_fsck("fsck partition", disk=disk, partition_id=partition_id, payload_size=self.source_size/4))
 
+    # The file system is consistent and unmounted. Wipe the blocks the image did not write.
+    if self.restore_aware_wipe:
+      wipe_size = self._get_partition_size() - (self.image_index["usedSize"] if self.image_index else self.source_size)
+      self.tasks.append(op_task_wipe_disk("Wipe free space of partition %s" % partition_id, disk=disk, partition_id=partition_id, wipe_size=max(0, wipe_size)))
+      pass
+
     # Loading disk image changes file system's UUID. 
     if self.restore_type["id"] != const.clone:
       # set the fs's uuid to it
@@ -151,6 +213,28 @@ class RestoreDiskRunner(PartitionDiskRunner):
       pass
     pass
 
+  def _can_prefetch(self):
+    # Multicast and mirrors fetch the image their own way.
+    return (self.prefetch and not self.multicast and not self.mirrors
+            and get_transport_scheme(self.source) in ["http", "https"] and can_stream(self.source))
+
+  def run(self):
+    if self._can_prefetch():
+      # No point holding more than the image.
+      limit = self.source_size if self.source_size else None
+      self.prefetcher = ImagePrefetcher(self.source, budget=get_prefetch_budget(limit=limit))
+      self.prefetcher.start()
+      pass
+    try:
+      super().run()
+    finally:
+      if self.prefetcher:
+        self.prefetcher.cancel()
+        self.ui.log(self.runner_id, "Prefetch: " + json.dumps(self.prefetcher.stats()))
+        pass
+      pass
+    pass
+
   pass
 
 
@@ -162,7 +246,7 @@ def get_source_size(src):
 #
 # Running restore - loading disk image to a disk
 #
-def run_load_image(ui, devname, imagefile, imagefile_size, efisrc, newhostname, restore_type, wipe, do_it=True):
+def run_load_image(ui, devname, imagefile, imagefile_size, efisrc, newhostname, restore_type, wipe, do_it=True, network_speed=None, multicast=None, plan_mode=PLAN_STRICT, prefetch=True, native=False):
   '''Loading image to desk.
      :ui: User interface - instance of ops_ui
      :devname: Restroing device name
@@ -171,6 +255,11 @@ def run_load_image(ui, devname, imagefile, imagefile_size, efisrc, newhostname,
      :newhostname: New host name assigned to the restored disk. ORIGINAL and RANDOM are special host name.
      :restore_type: dictionary describing the restore parameter. should come from .disk_image_type.json in the image file directory.
      :wipe: 0: no wipe, 1: quick wipe, 2: full wipe
+     :network_speed: measured download speed (bytes/sec) for estimating the network bound load.
+     :multicast: GROUP:PORT of multicast session to receive the disk image from.
+     :plan_mode: "strict" removes redundant tasks from the plan. "legacy" runs all of them.
+     :prefetch: fetches the image while the disk is prepared.
+     :native: decodes the image in process instead of partclone.
   '''
   # Should the restore type be json or the file?
   
@@ -249,6 +338,17 @@ def run_load_image(ui, devname, imagefile, imagefile_size, efisrc, newhostname,
       pass
     raise Exception("Partion ID is not known for resotring disk.")
   
+  # Image captured without shrinking has the file system as big as the original
+  # partition. Make room for it. The expand after the restore takes care of the rest.
+  image_metadata = read_image_metadata(imagefile)
+  image_index = read_image_index(imagefile, image_size=imagefile_size)
+  if image_metadata and image_metadata.get("fsSize"):
+    fit_partition_plan(pplan, partition_id, math.ceil(image_metadata["fsSize"] / (1024*1024)))
+  elif image_index:
+    fit_partition_plan(pplan, partition_id, math.ceil(image_index["minPartitionSize"] / (1024*1024)))
+    pass
+  efi_index = read_image_index(efisrc) if efisrc else None
+
   # If new host name is not given, and if restore type asks for new host name,
   # let's do it.
   if newhostname is None:
@@ -269,7 +369,9 @@ def run_load_image(ui, devname, imagefile, imagefile_size, efisrc, newhostname,
   runner = RestoreDiskRunner(ui, disk.device_name, disk, imagefile, imagefile_size, efisrc,
                              partition_id=partition_id, pplan=pplan, partition_map=partition_map,
                              newhostname=newhostname, restore_type=restore_type, wipe=wipe,
-                             media=media, wce_share_url=wce_share_url)
+                             media=media, wce_share_url=wce_share_url, network_speed=network_speed,
+                             multicast=multicast, plan_mode=plan_mode, image_index=image_index, efi_index=efi_index,
+                             prefetch=prefetch, native=native)
   runner.prepare()
   runner.preflight()
   runner.explain()
@@ -292,10 +394,19 @@ if __name__ == "__main__":
   parser.add_argument("-m", "--hostname", help="new hostname. two keyword can be used for hostname. RANDOM and ORIGINAL")
   parser.add_argument("-p", "--preflight", action="store_true", help="Does preflight only.")
   parser.add_argument("-c", "--cli", action="store_true", help="Creates console UI instead of JSON UI for testing.")
-  parser.add_argument("-w", "--fullwipe", action="store_true", help="wipes full disk before partitioning")
+  parser.add_argument("-w", "--fullwipe", action="store_true", help="wipes full disk. The blocks the disk image writes are not wiped unless the plan is legacy.")
   parser.add_argument("--quickwipe", action="store_true", help="wipes first 1MB before partitioning, thus clearning the partition map.")
+  parser.add_argument("--network-speed", type=int, dest="network_speed", default=None, help="Measured download speed from the image server in bytes/sec.")
+  parser.add_argument("--multicast", default=None, metavar="GROUP:PORT", help="Receives the disk image from multicast session.")
+  parser.add_argument("--plan", dest="plan_mode", choices=PLAN_MODES, default=PLAN_STRICT, help="strict removes redundant tasks such as mkfs that the image overwrites. legacy runs all of tasks.")
+
+  parser.add_argument("--no-prefetch", dest="prefetch", action="store_false", help="Does not fetch the image while the disk is prepared.")
+  parser.add_argument("--native", action="store_true", help="Decodes the image in process. partclone is the fallback.")
 
   args = parser.parse_args()
+
+  # The web server stops the load with SIGTERM. Exit so that the prefetched image is removed.
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
   
   if args.cli:
     ui = console_ui()
@@ -380,7 +491,12 @@ if __name__ == "__main__":
                    args.hostname,
                    restore_param,
                    wipe,
-                   do_it=not args.preflight)
+                   do_it=not args.preflight,
+                   network_speed=args.network_speed,
+                   multicast=args.multicast,
+                   plan_mode=args.plan_mode,
+                   prefetch=args.prefetch,
+                   native=args.native)
     sys.exit(0)
     # NOTREACHED
   except Exception as exc:
@@ -50,6 +50,12 @@ class Runner:
     pass
 
 
+  def optimize(self):
+    '''optimize is between prepare and preflight. runner can remove the tasks
+       that are redundant in the plan. See plan_optimizer.'''
+    pass
+
+
   def preflight(self):
     '''preflight is for tasks's preparation, not for runner. during prepare,
        tasks should initalize all the necessary actions.
@@ -59,6 +65,7 @@ class Runner:
     if self.state != RunState.Prepare:
       raise Exception("Run state is not Prepare")
 
+    self.optimize()
     self.state = RunState.Preflight
     self.current_time = datetime.datetime.now()
 
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+#
+# Surface scan runner
+#
+# Read test of disks before loading an image. Each disk gets a scan task.
+# bin/surface_scan can scan disks concurrently by itself, and the http server
+# uses it directly. This is for the command line and json_ui.
+#
+import sys
+from argparse import ArgumentParser
+
+from .tasks import op_task_surface_scan
+from .runner import Runner
+from .json_ui import json_ui
+from .ops_ui import console_ui
+from ..components.disk import Disk
+from ..lib.util import get_triage_logger, init_triage_logger
+
+tlog = get_triage_logger()
+
+
+class SurfaceScanRunner(Runner):
+  def __init__(self, ui, runner_id, disks, sample=None):
+    super().__init__(ui, runner_id)
+    self.disks = disks
+    self.sample = sample
+    pass
+
+  def prepare(self):
+    super().prepare()
+
+    for disk in self.disks:
+      if self.sample:
+        desc = "Sampled surface scan of %s" % disk.device_name
+      else:
+        desc = "Surface scan of %s" % disk.device_name
+        pass
+      self.tasks.append(op_task_surface_scan(desc, disk=disk, sample=self.sample))
+      pass
+    pass
+  pass
+
+
+if __name__ == "__main__":
+  tlog = init_triage_logger()
+  parser = ArgumentParser(description="Read test of disks.")
+  parser.add_argument("devices", nargs="+", help="Device files such as /dev/sdb")
+  parser.add_argument("-s", "--sample", type=int, default=None, help="Reads only this many blocks spread over the disk.")
+  parser.add_argument("--json", action="store_true", help="Progress in json.")
+  args = parser.parse_args()
+
+  disks = [ Disk(device_name=device) for device in args.devices ]
+  ui = json_ui(wock_event="surfacescan") if args.json else console_ui()
+  runner = SurfaceScanRunner(ui, ",".join(args.devices), disks, sample=args.sample)
+  runner.prepare()
+  runner.preflight()
+  runner.explain()
+  runner.run()
+  sys.exit(0)
+  pass
@@ -3,7 +3,7 @@
 # Create disk image
 #
 
-import sys, logging, traceback
+import sys, logging, traceback, datetime
 
 from .ops_ui import console_ui
 from .runner import Runner
@@ -12,6 +12,8 @@ from .json_ui import json_ui
 from .sync_image_tasks import task_image_sync_delete, task_image_sync_metadata, task_image_sync_copy
 from .tasks import task_fetch_partitions, task_refresh_partitions, task_mount, task_unmount
 from ..lib.util import is_block_device, init_triage_logger
+from ..lib.timeutil import in_seconds
+from .run_state import RunState
 from ..components.disk import create_storage_instance
 
 
@@ -23,13 +25,23 @@ my_messages = { "Waiting":   "Syncing disk image is waiting.",
                 "Success":   "Syncing disk image completed successfully.",
                 "Failed":    "Syncing disk image failed." }
 
+# Copies running at the same time, writing to a disk and reading from a source device.
+MAX_COPIES_PER_DESTINATION = 2
+MAX_COPIES_PER_SOURCE = 3
+
+# Poll timeout of a copy task while copies run concurrently
+POOL_POLL_TIMEOUT = 0.1
+
 #
 class SyncImageRunner(Runner):
-  '''Runner for creating disk image. does fsck, shrink partition, create disk 
-image and resize the file system back to the max.
-For now, this is only dealing with the EXT4 linux partition.
+  '''Runner for syncing disk images to disks.
+
+The copy tasks are run concurrently as a pool. A copy starts when its source
+device and all of its destination disks have room, and the largest image goes
+first so that the small ones fill in at the end.
 '''
-  def __init__(self, ui, runner_id, sources, disks, testflight=False):
+  def __init__(self, ui, runner_id, sources, disks, testflight=False, delta=False,
+               max_per_destination=MAX_COPIES_PER_DESTINATION, max_per_source=MAX_COPIES_PER_SOURCE):
     super().__init__(ui, runner_id)
     self.sources = sources # This is a list of dict from get_disk_images()
     self.time_estimate = 600
@@ -37,6 +49,10 @@ For now, this is only dealing with the EXT4 linux partition.
     self.partition_id = 'Linux'
     self.sync_tasks = []
     self.testflight = testflight
+    self.delta = delta
+    self.max_per_destination = max_per_destination
+    self.max_per_source = max_per_source
+    self.copy_tasks = []
     self.scoreboard = {}
     pass
 
@@ -44,7 +60,7 @@ For now, this is only dealing with the EXT4 linux partition.
     super().prepare()
     
     for disk in self.disks:
-      self.scoreboard[disk.device_name] = {"total_size": 0, "completed_size": 0, "inflight_size" : 0, "completed_seconds": 0, "inflight_seconds": 0, "bps": 0}
+      self.scoreboard[disk.device_name] = {"total_size": 0, "completed_size": 0, "inflight_size" : 0, "inflight": {}, "completed_seconds": 0, "start_time": None, "bps": 0}
       pass
 
     for disk in self.disks:
@@ -63,16 +79,12 @@ For now, this is only dealing with the EXT4 linux partition.
       self.sync_tasks.append(sync_meta_task)
       pass
 
-    total_size = 0
+    # total_size of scoreboard is added up by the copy tasks for the disks lacking the image.
     for source in self.sources:
-      sync_task = task_image_sync_copy("Copy %s" % source['name'], source=source, testflight=self.testflight, scoreboard=self.scoreboard)
+      sync_task = task_image_sync_copy("Copy %s" % source['name'], source=source, testflight=self.testflight, scoreboard=self.scoreboard, delta=self.delta)
       self.tasks.append(sync_task)
       self.sync_tasks.append(sync_task)
-      total_size += source["size"]
-      pass
-
-    for disk in self.disks:
-      self.scoreboard[disk.device_name]["total_size"] = total_size
+      self.copy_tasks.append(sync_task)
       pass
 
     for disk in self.disks:
@@ -89,11 +101,45 @@ For now, this is only dealing with the EXT4 linux partition.
     pass
 
 
+  def _update_run_estimate(self):
+    '''Copies run concurrently. The copy part is the busiest disk's share, not the sum.'''
+    self.run_estimate = 0
+    for task in self.tasks:
+      if task not in self.copy_tasks:
+        self.run_estimate += task.estimate_time()
+        pass
+      pass
+
+    if not self.copy_tasks:
+      return
+    if [ task for task in self.copy_tasks if task.destinations is None ]:
+      # Not planned yet
+      self.run_estimate += sum([ task.estimate_time() for task in self.copy_tasks ])
+      return
+
+    per_disk = {}
+    for task in self.copy_tasks:
+      for disk, dest_path in task.destinations:
+        per_disk[disk.device_name] = per_disk.get(disk.device_name, 0) + task.estimate_time()
+        pass
+      pass
+    busiest = max(per_disk.values()) / self.max_per_destination if per_disk else 0
+    self.run_estimate += max([busiest] + [ task.estimate_time() for task in self.copy_tasks ])
+    pass
+
+  def _disk_run_estimate(self, disk):
+    '''Run estimate of disk from its own copy rate and remaining bytes.'''
+    scoreboard = self.scoreboard[disk.device_name]
+    if scoreboard["start_time"] is None or scoreboard["bps"] <= 0:
+      return self.run_estimate
+    remaining = max(0, scoreboard["total_size"] - scoreboard["completed_size"] - scoreboard["inflight_size"])
+    return in_seconds(self.run_time) + remaining / scoreboard["bps"]
+
   def report_run_state(self):
     sb_fd = open("/tmp/scoreboard", "w")
 
     for disk in self.disks:
-      self.ui.report_run_progress(disk.device_name, self.current_time, self.state, self.run_estimate, self.run_time, self.task_step, self.tasks)
+      self.ui.report_run_progress(disk.device_name, self.current_time, self.state, self._disk_run_estimate(disk), self.run_time, self.task_step, self.tasks)
 
       print("%s:" % disk.device_name, file=sb_fd)
       print(self.scoreboard[disk.device_name], file=sb_fd)
@@ -113,7 +159,93 @@ For now, this is only dealing with the EXT4 linux partition.
 
   def report_task_progress(self, run_time, task):
     for disk in self.disks:
-      ui.report_task_progress(disk.device_name, self.current_time, self.run_estimate, run_time, task, self.tasks)
+      self.ui.report_task_progress(disk.device_name, self.current_time, self.run_estimate, run_time, task, self.tasks)
+      pass
+    pass
+
+  def _run_task(self, task, ui):
+    if task not in self.copy_tasks:
+      super()._run_task(task, ui)
+    elif not task.is_started:
+      # First copy task runs all of them.
+      self._run_copy_pool(ui)
+      pass
+    pass
+
+  def _copy_slots(self, task):
+    return [("source", task.get_source_device())] + [ ("destination", disk.device_name) for disk, dest_path in task.destinations ]
+
+  def _can_start_copy(self, task, in_use):
+    for slot in self._copy_slots(task):
+      limit = self.max_per_source if slot[0] == "source" else self.max_per_destination
+      if in_use.get(slot, 0) >= limit:
+        return False
+      pass
+    return True
+
+  def _run_copy_pool(self, ui):
+    '''Runs the copy tasks concurrently within the per source/destination limits.'''
+    for task in self.copy_tasks:
+      task.plan_copy()
+      pass
+    # Largest first
+    pending = sorted(self.copy_tasks, key=lambda task: task.source["size"], reverse=True)
+    running = []
+    in_use = {}
+    last_report_time = None
+
+    while pending or running:
+      if self.state == RunState.Running:
+        for task in pending[:]:
+          if not self._can_start_copy(task, in_use):
+            continue
+          pending.remove(task)
+          for slot in self._copy_slots(task):
+            in_use[slot] = in_use.get(slot, 0) + 1
+            pass
+          task.select_timeout = POOL_POLL_TIMEOUT
+          task.pre_setup()
+          task.setup()
+          running.append(task)
+          pass
+        pass
+      elif not running:
+        # Failed. Copies not started yet are given up.
+        break
+
+      for task in running[:]:
+        task.poll()
+        self.current_time = datetime.datetime.now()
+        task.current_time = self.current_time
+        if task.progress < 100:
+          continue
+
+        run_time = self.current_time - self.start_time
+        task.teardown()
+        running.remove(task)
+        for slot in self._copy_slots(task):
+          in_use[slot] -= 1
+          pass
+        if task.progress > 100:
+          self.state = RunState.Failed
+          ui.report_task_failure(self.runner_id, self.current_time, run_time, task)
+          if task.verdict:
+            self.ui.log(self.runner_id, "%s failed.\n%s" % (task.description, "\n".join(task.verdict)))
+            pass
+          pass
+        else:
+          ui.report_task_success(self.runner_id, self.current_time, run_time, task)
+          pass
+        pass
+
+      self.current_time = datetime.datetime.now()
+      if last_report_time is None or in_seconds(self.current_time - last_report_time) >= 1:
+        last_report_time = self.current_time
+        self.report_run_state()
+        for task in running:
+          self.report_task_progress(self.current_time - self.start_time, task)
+          pass
+        pass
       pass
     pass
 
@@ -124,7 +256,7 @@ if __name__ == "__main__":
   tlog = init_triage_logger(log_level=logging.DEBUG)
 
   if len(sys.argv) == 1:
-    print( 'SYNC: devicenames [opt] image...')
+    print( 'SYNC: devicenames [delta] [opt] image...')
     sys.exit(0)
     # NOTREACHED
     pass 
@@ -141,6 +273,13 @@ if __name__ == "__main__":
     disks.append(create_storage_instance(device_name = devname))
     pass
 
+  # delta copies only the chunks not in the older images on the disks.
+  delta = False
+  if len(sources) > 0 and sources[0] == "delta":
+    delta = True
+    sources = sources[1:]
+    pass
+
   # Preflight is for me to see the tasks. http server runs this with json_ui.
   if len(sources) > 0:
     opt = sources[0]
@@ -197,7 +336,7 @@ if __name__ == "__main__":
       raise Exception("no sources?")
     pass
 
-  runner = SyncImageRunner(ui, runner_id, syncing, disks, testflight=testflight)
+  runner = SyncImageRunner(ui, runner_id, syncing, disks, testflight=testflight, delta=delta)
   try:
     runner.prepare()
     runner.preflight()
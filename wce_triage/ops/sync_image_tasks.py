@@ -7,15 +7,38 @@
 # exec runs through the tasks.
 #
 
-import os, json, traceback
+import os, json, time, shutil, traceback
 from ..lib.util import get_triage_logger
 from .run_state import RUN_STATE, RunState
-from ..lib.disk_images import list_image_files
+from ..lib.disk_images import list_image_files, get_image_metadata_path
+from ..lib.image_index import get_image_index_path
+from ..lib.chunker import manifest_path
 from .tasks import op_task_process_simple
 
 tlog = get_triage_logger()
 
 
+def get_image_sidecar_paths(image_path):
+  """Files that go with the image. Delete or copy them together."""
+  return [manifest_path(image_path), get_image_metadata_path(image_path), get_image_index_path(image_path)]
+
+
+def copy_image_sidecars(source_path, dest_path):
+  """Copies the sidecars of the source image next to the copied image.
+The manifest and the index are valid for the image of same size and mtime, so
+the copy gets the mtime of source first."""
+  filestat = os.stat(source_path)
+  os.utime(dest_path, ns=(filestat.st_atime_ns, filestat.st_mtime_ns))
+  for source_sidecar, dest_sidecar in zip(get_image_sidecar_paths(source_path), get_image_sidecar_paths(dest_path)):
+    if not os.path.exists(source_sidecar):
+      continue
+    tmp_path = dest_sidecar + ".tmp"
+    shutil.copyfile(source_sidecar, tmp_path)
+    os.rename(tmp_path, dest_sidecar)
+    pass
+  pass
+
+
 class task_image_sync:
   """image sync task
 """
@@ -90,6 +113,11 @@ class task_image_sync_delete( op_task_process_simple, task_image_sync ):
         if os.path.exists(fullpath):
           tlog.debug("'%s' exists. adding to the argv" % fullpath)
           self.argv.append(fullpath)
+          for sidecar in get_image_sidecar_paths(fullpath):
+            if os.path.exists(sidecar):
+              self.argv.append(sidecar)
+              pass
+            pass
           do_rm = True
           pass
         else:
@@ -110,9 +138,15 @@ class task_image_sync_delete( op_task_process_simple, task_image_sync ):
 
 class task_image_sync_copy(op_task_process_simple, task_image_sync):
   """copy disk image files
+
+With delta, the chunks the older images on the destination have are copied
+from them, and only the rest is read from the source. (bin/delta_copy)
+
+SyncImageRunner runs these concurrently, so the scoreboard keeps the in-flight
+bytes per task, and the rate is against the wall clock of each disk.
 """
 
-  def __init__(self, description, source={}, scoreboard={}, testflight=False, **kwargs):
+  def __init__(self, description, source={}, scoreboard={}, testflight=False, delta=False, **kwargs):
     self.source = source
     self.scoreboard = scoreboard
     self.testflight = testflight
@@ -123,22 +157,39 @@ class task_image_sync_copy(op_task_process_simple, task_image_sync):
       pass
 
     source_filename = self.source["name"]
-    argv = bin + ['-m', 'wce_triage.bin.fanout_copy', self.source["fullpath"]]
+    copier = 'wce_triage.bin.delta_copy' if delta else 'wce_triage.bin.fanout_copy'
+    argv = bin + ['-m', copier, self.source["fullpath"]]
     super().__init__(description,
                      argv=argv,
                      progress_finished="Image file %s copied" % source_filename,
                      time_estimate=100,
                      **kwargs)
     task_image_sync.__init__(self, description)
+    # (disk, destination path) of the disks not having the image. Set by plan_copy()
+    self.destinations = None
+    # device name: (bytes, seconds) copied by this task
+    self.copied = {}
+    self.failed_destinations = []
     pass
 
   def preflight(self, tasks):
     super().preflight(tasks)
     pass
 
-  def setup(self):
-    # First, need the list of files
-    #
+  def get_source_device(self):
+    """Device number of the source file. Copies from the same device compete for reads."""
+    try:
+      return os.stat(self.source["fullpath"]).st_dev
+    except OSError:
+      return None
+    pass
+
+  def plan_copy(self):
+    """Finds the disks that do not have the image yet. Needs the disks mounted."""
+    if self.destinations is not None:
+      return self.destinations
+
+    self.destinations = []
     src_fname = self.source["name"]
     for disk, part in self.partitions:
       do_copy = True
@@ -151,16 +202,36 @@ class task_image_sync_copy(op_task_process_simple, task_image_sync):
           break
         pass
       if do_copy:
-        self.argv.append("%s:%s" % (disk.device_name, os.path.join(dir, self.source["restoreType"], src_fname)))
+        self.destinations.append((disk, os.path.join(dir, self.source["restoreType"], src_fname)))
         self.scoreboard[disk.device_name]["total_size"] += self.source["size"]
         pass
       pass
+    return self.destinations
+
+  def setup(self):
+    # First, need the list of files
+    #
+    for disk, dest_path in self.plan_copy():
+      self.argv.append("%s:%s" % (disk.device_name, dest_path))
+      pass
+    if not self.destinations:
+      self.argv = ["true"]
+      self.kwargs['progress_finished'] = "Image file %s is on the disks already" % self.source["name"]
+      pass
     super().setup()
     pass
 
   def poll(self):
     self._poll_process()
     self.parse_fanout_copy_progess()
+    # Reports of each destination come separately. Done when all of them are in.
+    if self.process.returncode is not None and not self.read_set:
+      if self.failed_destinations:
+        self.set_progress(999, "Copying to %s failed" % ", ".join(self.failed_destinations))
+      else:
+        self._update_progress()
+        pass
+      pass
     pass
 
   def parse_fanout_copy_progess(self):
@@ -182,29 +253,40 @@ class task_image_sync_copy(op_task_process_simple, task_image_sync):
       try:
         report = json.loads(line)
         device_name = report['key']
-        self.scoreboard[device_name]["report"] = report
+        scoreboard = self.scoreboard[device_name]
+        scoreboard["report"] = report
         last_report = report
 
         if "verdict" in report:
           self.verdict.append("%s: %s" % (device_name, report["verdict"]))
           pass
 
-        scoreboard = self.scoreboard[device_name]
+        if scoreboard.get("start_time") is None:
+          scoreboard["start_time"] = time.monotonic()
+          pass
+
+        inflight = scoreboard.setdefault("inflight", {})
         if report["runStatus"] == RUN_STATE[RunState.Running.value]:
-          scoreboard["inflight_size"] = report["totalBytes"]
-          scoreboard["inflight_seconds"] = report["runTime"]
+          inflight[self.task_number] = report["totalBytes"]
         elif report["runStatus"] == RUN_STATE[RunState.Success.value]:
-          scoreboard["inflight_size"] = 0
-          scoreboard["inflight_seconds"] = 0
-
-          scoreboard["completed_size"] += report["totalBytes"]
-          scoreboard["completed_seconds"] += report["runTime"]
+          inflight.pop(self.task_number, None)
+          # fanout_copy may report the success more than once
+          if device_name not in self.copied:
+            scoreboard["completed_size"] += report["totalBytes"]
+            scoreboard["completed_seconds"] += report["runTime"]
+            pass
+          self.copied[device_name] = (report["totalBytes"], report["runTime"])
         elif report["runStatus"] == RUN_STATE[RunState.Failed.value]:
-          scoreboard["inflight_size"] = 0
-          scoreboard["inflight_seconds"] = report["runTime"]
+          inflight.pop(self.task_number, None)
+          self.copied[device_name] = (report["totalBytes"], report["runTime"])
+          if device_name not in self.failed_destinations:
+            self.failed_destinations.append(device_name)
+            pass
           pass
 
-        scoreboard["bps"] = (scoreboard["completed_size"] + scoreboard["inflight_size"]) / (scoreboard["completed_seconds"] + scoreboard["inflight_seconds"])
+        scoreboard["inflight_size"] = sum(inflight.values())
+        elapsed = time.monotonic() - scoreboard["start_time"]
+        scoreboard["bps"] = (scoreboard["completed_size"] + scoreboard["inflight_size"]) / max(1, elapsed)
         pass
       except Exception as exc:
         msg = "Output line: '" + line + "'\n" + traceback.format_exc()
@@ -215,7 +297,7 @@ class task_image_sync_copy(op_task_process_simple, task_image_sync):
 
     if last_report:
       report = last_report
-      self.set_progress(report['progress'], report['runMessage'])
+      self.set_progress(min(99, report['progress']), report['runMessage'])
       self.set_time_estimate(report['runEstimate'])
       pass
     pass
@@ -223,9 +305,26 @@ class task_image_sync_copy(op_task_process_simple, task_image_sync):
 
   def teardown(self):
     super().teardown()
-    for disk, part in self.partitions:
-      scoreboard = self.scoreboard[disk.device_name]
-      self.verdict.append("%s: Copied %d bytes in %d seconds. Byte/sec = %d" % (disk.device_name, scoreboard["completed_size"], scoreboard["completed_seconds"], scoreboard["bps"]))
+    for device_name, (n_bytes, seconds) in self.copied.items():
+      self.verdict.append("%s: Copied %d bytes in %d seconds. Byte/sec = %d" % (device_name, n_bytes, seconds, n_bytes / max(1, seconds)))
+      pass
+    if not self.testflight:
+      self.copy_sidecars()
+      pass
+    pass
+
+  def copy_sidecars(self):
+    """The metadata rsync skips the files in the image directories, so the
+sidecars of image go with the image."""
+    for disk, dest_path in self.destinations or []:
+      if disk.device_name not in self.copied or disk.device_name in self.failed_destinations:
+        continue
+      try:
+        copy_image_sidecars(self.source["fullpath"], dest_path)
+      except Exception as exc:
+        tlog.info("Copying sidecars of %s failed: %s" % (dest_path, str(exc)))
+        self.verdict.append("%s: Copying sidecars failed: %s" % (disk.device_name, str(exc)))
+        pass
       pass
     pass
 
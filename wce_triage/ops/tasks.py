@@ -15,7 +15,9 @@ from ..components.disk import Partition, PartitionLister, canonicalize_file_syst
 from ..components.network import detect_net_devices, get_router_ip_address
 from ..lib.util import get_triage_logger, safe_string, get_filename_stem
 from ..lib.timeutil import in_seconds
-from ..lib.grub import grub_config
+from ..lib.region_wipe import format_regions, total_region_size
+from ..lib.worker_pool import popen
+from ..lib.grub import grub_config, make_grub_template, write_grub_template, read_grub_template, is_grub_template_stale, render_grub_template, read_grub_cmdline
 from .pplan import EFI_NAME
 from ..version import TRIAGE_VERSION, TRIAGE_TIMESTAMP
 from ..const import const
@@ -259,7 +261,7 @@ class op_task_process(op_task):
   def setup(self):
     tlog.debug( "op_task_process Poepn: " + repr(self.argv))
     self.verdict.append("Process: " + repr(self.argv))
-    self.process = subprocess.Popen(self.argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL)
+    self.process = popen(self.argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL)
     self.stdout = self.process.stdout
     self.stderr = self.process.stderr
     self.read_set = [self.stdout, self.stderr]
@@ -841,6 +843,39 @@ class task_remove_logs(task_remove_files):
   pass
 
 
+# Record the grub.cfg template in the disk so that restoring the image
+# does not need grub-mkconfig.
+class task_save_grub_template(op_task_python_simple):
+  def __init__(self, description, disk=None, partition_id='Linux', **kwargs):
+    super().__init__(description, time_estimate=1, **kwargs)
+    self.disk = disk
+    self.partition_id = partition_id
+    pass
+
+  def run_python(self):
+    part = self.disk.find_partition(self.partition_id)
+    if part is None:
+      self.set_progress(999, 'Partition does not exist.')
+      return
+
+    rootpath = part.get_mount_point()
+    template = make_grub_template(rootpath)
+    if template is None:
+      # Not fatal. Restoring it runs grub-mkconfig.
+      msg = "No kernel in %s/boot. grub.cfg template is not recorded." % rootpath
+      tlog.info(msg)
+      self.verdict.append(msg)
+      self.set_progress(100, msg)
+      return
+
+    write_grub_template(rootpath, template)
+    kernels = ", ".join([ kernel["version"] for kernel in template["kernels"] ])
+    self.verdict.append("grub.cfg template for %s is recorded." % kernels)
+    self.set_progress(100, "grub.cfg template recorded")
+    pass
+  pass
+
+
 # Installing MBR on disk
 class task_install_mbr(op_task_process_simple):
   def __init__(self, description, disk=None, **kwargs):
@@ -983,9 +1018,11 @@ class task_refresh_partitions(op_task_command):
 #
 #
 class task_set_ext_partition_uuid(op_task_process_simple):
-  def __init__(self, description, disk=None, partition_id=None, time_estimate=6, **kwargs):
+  def __init__(self, description, disk=None, partition_id=None, time_estimate=6, fs_uuid=None, **kwargs):
     self.disk = disk
     self.partition_id = partition_id
+    # The UUID to set. When None, the one the runner knows.
+    self.fs_uuid = fs_uuid
     # argv is a placeholder
     super().__init__(description, encoding='iso-8859-1', time_estimate=3, argv=["tune2fs", "-f", "-U", disk.device_name, partition_id], **kwargs)
     pass
@@ -996,6 +1033,13 @@ class task_set_ext_partition_uuid(op_task_process_simple):
     if part1 is None:
       self.set_progress(999, "Partition %s does not exist on %s" % (self.partition_id, self.disk.device_name))
       return
+    if self.fs_uuid is not None:
+      # The mkfs before the restore is removed (see plan_optimizer), and this
+      # is the UUID it would have made. Remember it for fstab and grub.
+      part1.fs_uuid = self.fs_uuid
+    elif part1.fs_uuid is None:
+      part1.fs_uuid = str(uuid.uuid4())
+      pass
     self.argv = ["tune2fs", "-f", "-U", part1.fs_uuid, part1.device_name]
     super().setup()
     return
@@ -1186,9 +1230,13 @@ class task_install_grub(op_task_process):
       self.script.append("apt-get -q -y --force-yes purge `dpkg --get-selections | cut -f 1 | grep -v xorg | grep nvidia-`")
       pass
 
-    self.script.append('# Set up the grub.cfg')
-    self.script.append('chmod +rw /boot/grub/grub.cfg')
-    self.script.append('grub-mkconfig -o /boot/grub/grub.cfg')
+    # With the template recorded at capture, grub.cfg is written here and
+    # grub-install only sets up the boot sectors.
+    if not self._write_grub_cfg_from_template():
+      self.script.append('# Set up the grub.cfg')
+      self.script.append('chmod +rw /boot/grub/grub.cfg')
+      self.script.append('grub-mkconfig -o /boot/grub/grub.cfg')
+      pass
 
     self.script.append('# clean up')
     self.script.append('umount /proc || umount -lf /proc')
@@ -1216,6 +1264,34 @@ class task_install_grub(op_task_process):
     super().setup()
     pass
 
+  def _write_grub_cfg_from_template(self):
+    """Writes grub.cfg from the template. False when the template is missing or stale."""
+    template = read_grub_template(self.mount_dir)
+    if template is None:
+      self.verdict.append("No grub.cfg template. Running grub-mkconfig.")
+      return False
+    if is_grub_template_stale(template, self.mount_dir):
+      self.verdict.append("grub.cfg template does not match with the kernels. Running grub-mkconfig.")
+      return False
+    if not self.linuxpart.fs_uuid:
+      self.verdict.append("File system UUID is unknown. Running grub-mkconfig.")
+      return False
+
+    grub_default = os.path.join(self.mount_dir, "etc", "default", "grub")
+    cmdline = read_grub_cmdline(grub_default) if os.path.exists(grub_default) else None
+    grub_cfg_path = os.path.join(self.mount_dir, "boot", "grub", "grub.cfg")
+    try:
+      with open(grub_cfg_path + ".tmp", "w") as grub_cfg:
+        grub_cfg.write(render_grub_template(template, self.linuxpart.fs_uuid, cmdline))
+        pass
+      os.rename(grub_cfg_path + ".tmp", grub_cfg_path)
+    except Exception as exc:
+      self.verdict.append("Failed to write grub.cfg from the template. Running grub-mkconfig.")
+      self.verdict.append(str(exc))
+      return False
+    self.verdict.append("grub.cfg is written from the template with UUID %s" % self.linuxpart.fs_uuid)
+    return True
+
   # grub-install may take long time. time out only when
   # it takes 2x of time estmate.
   def _estimate_progress(self, total_seconds):
@@ -1628,13 +1704,23 @@ class task_uninstall_bcmwl(task_uninstall_package):
 #
 class op_task_wipe_disk(op_task_process):
   #
-  def __init__(self, description, disk=None, short=False, **kwargs):
+  # regions: wipes only the regions (byte offset, byte length) of disk
+  # partition_id: wipes only the free blocks of ext file system on the partition.
+  #   wipe_size is the guess of free bytes for time estimate.
+  def __init__(self, description, disk=None, short=False, regions=None, partition_id=None, wipe_size=None, **kwargs):
     self.disk = disk
-    argv = ["python3", "-m", "wce_triage.bin.zerowipe"]
+    self.partition_id = partition_id
+    argv = ["python3", "-m", "wce_triage.bin.multiwipe"]
 
     estimate = 2
     if short:
       argv.append("-s")
+    elif regions is not None:
+      argv = argv + ["-r", format_regions(regions)]
+      estimate += total_region_size(regions)/40000000
+    elif partition_id is not None:
+      argv.append("-e")
+      estimate += (wipe_size if wipe_size else 0)/40000000
     else:
       estimate += self.disk.get_byte_size()/40000000
       pass
@@ -1642,6 +1728,17 @@ class op_task_wipe_disk(op_task_process):
     super().__init__(description, argv=argv, time_estimate=estimate, **kwargs)
     pass
 
+  def setup(self):
+    if self.partition_id is not None:
+      part = self.disk.find_partition(self.partition_id)
+      if part is None:
+        self._setup_failed("No partition found. Parition id is %s" % str(self.partition_id))
+        return
+      self.argv[-1] = part.device_name
+      pass
+    super().setup()
+    pass
+
   def poll(self):
     super().poll()
 
@@ -1681,7 +1778,62 @@ class op_task_wipe_disk(op_task_process):
         break
       line = self.out[:newline]
       self.out = self.out[newline+1:]
-      self.verdict(line)
+      self.verdict.append(line)
+      pass
+    pass
+  pass
+
+
+#
+# Surface scan - read test of disk
+#
+class op_task_surface_scan(op_task_process):
+  #
+  def __init__(self, description, disk=None, sample=None, **kwargs):
+    self.disk = disk
+    argv = ["python3", "-m", "wce_triage.bin.surface_scan"]
+
+    estimate = 2
+    if sample:
+      argv = argv + ["--sample", str(sample)]
+      estimate += sample / 20
+    else:
+      estimate += self.disk.get_byte_size()/80000000
+      pass
+    argv.append(disk.device_name)
+    super().__init__(description, argv=argv, time_estimate=estimate, **kwargs)
+    pass
+
+  def poll(self):
+    super().poll()
+
+    while True:
+      newline = self.err.find('\n')
+      if newline < 0:
+        break
+      line = self.err[:newline]
+      self.err = self.err[newline+1:]
+
+      try:
+        report = json.loads(line).get("message")
+        self.set_progress(report.get('progress', 50), report.get('runMessage', 'Surface scan is running.'))
+        self.time_estimate = report.get("runEstimate")
+        # Final report has the ranges
+        if "badRanges" in report:
+          self.disk.surface_scan = report
+          for lba, count in report["badRanges"]:
+            self.verdict.append("Unreadable LBA %d - %d" % (lba, lba + count - 1))
+            pass
+          for lba, count, latency in report["slowRanges"]:
+            self.verdict.append("Slow LBA %d - %d (%d ms)" % (lba, lba + count - 1, latency))
+            pass
+          pass
+        pass
+      except Exception as exc:
+        msg = "bad surface scan ouptut? " + traceback.format_exc() + "\n" + line
+        self.verdict.append(msg)
+        tlog.info(msg)
+        pass
       pass
     pass
   pass